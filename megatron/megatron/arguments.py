@@ -105,6 +105,66 @@ def parse_args(extra_args_provider=None, defaults={},
             'global batch size is not divisible by pipeline parallel size when '\
             'using interleaved schedule'
 
+    if args.use_contiguous_buffers:
+        assert args.DDP_impl == 'local', \
+            '--use-contiguous-buffers requires the local DDP implementation'
+        assert args.fp16, '--use-contiguous-buffers requires --fp16'
+        assert not args.use_distributed_optimizer, \
+            '--use-contiguous-buffers is not supported with ' \
+            '--use-distributed-optimizer'
+        assert not args.offload_optimizer_state, \
+            '--use-contiguous-buffers is not supported with ' \
+            '--offload-optimizer-state'
+    if args.overlap_grad_reduce:
+        assert args.DDP_impl == 'local', \
+            '--overlap-grad-reduce requires the local DDP implementation'
+        assert not args.use_distributed_optimizer, \
+            '--overlap-grad-reduce is not supported with ' \
+            '--use-distributed-optimizer'
+    if args.hierarchical_allreduce:
+        assert args.DDP_impl == 'local', \
+            '--hierarchical-allreduce requires the local DDP implementation'
+        assert not args.use_distributed_optimizer, \
+            '--hierarchical-allreduce is not supported with ' \
+            '--use-distributed-optimizer'
+    if args.grad_compression != 'none':
+        assert args.DDP_impl == 'local', \
+            '--grad-compression requires the local DDP implementation'
+        assert not args.use_distributed_optimizer, \
+            '--grad-compression is not supported with ' \
+            '--use-distributed-optimizer'
+        assert not args.hierarchical_allreduce, \
+            '--grad-compression is not supported with ' \
+            '--hierarchical-allreduce'
+    if args.fused_grad_copy:
+        assert args.fp16 and args.use_contiguous_buffers, \
+            '--fused-grad-copy requires --fp16 and --use-contiguous-buffers'
+    if args.use_distributed_optimizer:
+        assert args.DDP_impl == 'local', \
+            '--use-distributed-optimizer requires the local DDP implementation'
+    if args.offload_optimizer_state:
+        assert not args.use_distributed_optimizer, \
+            '--offload-optimizer-state is not supported with ' \
+            '--use-distributed-optimizer'
+        assert not args.clip_grad_on_device, \
+            '--offload-optimizer-state clips the grads on the CPU, not ' \
+            'with --clip-grad-on-device'
+        assert args.optimizer == 'adam', \
+            '--offload-optimizer-state steps the params with a CPU Adam'
+
+    if args.pipeline_stash_limit is not None:
+        assert args.pipeline_no_flushes, \
+            '--pipeline-stash-limit requires --pipeline-no-flushes'
+        assert args.virtual_pipeline_model_parallel_size is None, \
+            '--pipeline-stash-limit is not supported with interleaving'
+        assert args.pipeline_stash_limit >= 1
+    if args.pipeline_weight_versions is not None:
+        assert args.pipeline_no_flushes, \
+            '--pipeline-weight-versions requires --pipeline-no-flushes'
+        assert args.virtual_pipeline_model_parallel_size is None, \
+            '--pipeline-weight-versions is not supported with interleaving'
+        assert args.pipeline_weight_versions >= 1
+
     # Parameters dtype.
     args.params_dtype = torch.float
     if args.fp16:
@@ -199,6 +259,10 @@ def parse_args(extra_args_provider=None, defaults={},
     if args.fp32_residual_connection:
         fused_kernels.load_fused_mix_prec_layer_norm_kernel()
 
+    # Load the fused copy, unscaling and norm of the grads.
+    if args.fused_grad_copy:
+        fused_kernels.load_fused_grad_copy_kernel()
+
     _print_args(args)
     return args
 
@@ -264,6 +328,11 @@ def _add_regularization_args(parser):
                        help='Weight decay coefficient for L2 regularization.')
     group.add_argument('--clip-grad', type=float, default=1.0,
                        help='Gradient clipping based on global L2 norm.')
+    group.add_argument('--clip-grad-on-device', action='store_true',
+                       help='Compute the clipping coefficient '
+                       'min(1, clip-grad / norm) on the GPU and always '
+                       'scale the grads by it, so that the norm is only '
+                       'read on the host when it is logged.')
     group.add_argument('--adam-beta1', type=float, default=0.9,
                        help='First coefficient for computing running averages of'
                        'gradient and its square')
@@ -273,6 +342,21 @@ def _add_regularization_args(parser):
     group.add_argument('--adam-eps', type=float, default=1e-08,
                        help='Term added to the denominator to improve'
                        'numerical stability')
+    group.add_argument('--optimizer', type=str, default='adam',
+                       help='Base optimizer, registered in megatron.optimizer: '
+                       'adam (apex FusedAdam, or torch_adam without apex), '
+                       'torch_adam (PyTorch Adam), adafactor (factored '
+                       'second moment) or quantized_adam (Adam with 8-bit '
+                       'block-quantized state).')
+    group.add_argument('--adafactor-beta1', type=float, default=None,
+                       help='First-moment coefficient of Adafactor; no first '
+                       'moment is kept if not given.')
+    group.add_argument('--adafactor-decay-rate', type=float, default=-0.8,
+                       help='Adafactor decays its second moment by '
+                       '1 - step ** decay rate.')
+    group.add_argument('--quantized-adam-block-size', type=int, default=2048,
+                       help='Elements of the state of quantized_adam sharing '
+                       'one scale.')
 
     return parser
 
@@ -325,6 +409,14 @@ def _add_training_args(parser):
                        'train-samples should be provided.')
     group.add_argument('--log-interval', type=int, default=100,
                        help='Report loss and timing interval.')
+    group.add_argument('--timing-sync-level', type=int, default=0,
+                       choices=[-1, 0, 1, 2],
+                       help='Timers of verbosity level at most this wait for '
+                       'the GPU when they start and stop. The others, such '
+                       'as those started per microbatch (level 2), record '
+                       'CUDA events that are only read when the timers are '
+                       'logged, and so time the current stream alone. -1 '
+                       'makes every timer asynchronous.')
     group.add_argument('--exit-interval', type=int, default=None,
                        help='Exit the program after the iteration is divisible '
                        'by this value.')
@@ -332,6 +424,11 @@ def _add_training_args(parser):
                        help='Exit the program after this many minutes.')
     group.add_argument('--tensorboard-dir', type=str, default=None,
                        help='Write TensorBoard logs to this directory.')
+    group.add_argument('--pipeline-trace-dir', type=str, default=None,
+                       help='Write a Chrome trace of the pipeline '
+                       'instructions run by every rank to this directory, '
+                       'at every log interval. Merge the traces of all '
+                       'ranks with tools/merge_pipeline_traces.py.')
     group.add_argument('--scaled-upper-triang-masked-softmax-fusion',
                        action='store_true',
                        help='Enable fusion of query_key_value_scaling '
@@ -478,6 +575,26 @@ def _add_distributed_args(parser):
                        '--tensor-model-parallel-size instead.')
     group.add_argument('--pipeline-no-flushes', action='store_true',
                        help='Pipeline without flushes.')
+    group.add_argument('--pipeline-stash-limit', type=int, default=None,
+                       help='Largest number of microbatches whose '
+                       'activations a stage keeps for their backward pass '
+                       'with --pipeline-no-flushes; forward passes are '
+                       'throttled when it is reached.')
+    group.add_argument('--pipeline-weight-versions', type=int, default=None,
+                       help='With --pipeline-no-flushes, use PipeDream '
+                       'weight stashing with at most this many weight '
+                       'versions per stage instead of the two versions of '
+                       'PipeDream-2BW: warmup is not bounded by the number '
+                       'of microbatches and backward passes use the weights '
+                       'of their forward pass.')
+    group.add_argument('--offload-stashed-activations', action='store_true',
+                       help='Keep the inputs received by a stage in pinned '
+                       'CPU memory between their forward and backward '
+                       'passes.')
+    group.add_argument('--log-pipeline-stash', action='store_true',
+                       help='Report the peak number of stashed microbatches '
+                       'and their bytes on every pipeline stage at every '
+                       'log interval.')
     group.add_argument('--virtual-pipeline-model-parallel-size', type=int, default=None,
                        help='Number of virtual pipeline stages in physical stage.')
     group.add_argument('--gpipe', action='store_true',
@@ -489,8 +606,92 @@ def _add_distributed_args(parser):
                        choices=['local', 'torch'],
                        help='which DistributedDataParallel implementation '
                        'to use.')
+    group.add_argument('--use-contiguous-buffers', action='store_true',
+                       help='With --fp16, lay out the model params, main '
+                       'params, stashed weight versions and their grads in '
+                       'one flat buffer each, so that the optimizer and the '
+                       'local DDP process them with single operations.')
+    group.add_argument('--overlap-grad-reduce', action='store_true',
+                       help='With the local DDP, all-reduce the grads in '
+                       'buckets, in reverse order of the params, each as '
+                       'soon as the last backward pass of the iteration has '
+                       'produced it, overlapping the pipeline cooldown.')
+    group.add_argument('--ddp-bucket-size', type=int, default=2 ** 24,
+                       help='Largest number of elements of a bucket of '
+                       'grads with --overlap-grad-reduce.')
+    group.add_argument('--hierarchical-allreduce', action='store_true',
+                       help='With the local DDP, reduce-scatter the grads '
+                       'within the node, all-reduce the shards across '
+                       'nodes and all-gather them within the node.')
+    group.add_argument('--ranks-per-node', type=int, default=None,
+                       help='Number of consecutive ranks on a node for '
+                       '--hierarchical-allreduce (defaults to the number of '
+                       'GPUs of the node).')
+    group.add_argument('--grad-compression', default='none',
+                       choices=['none', 'fp16', 'bf16', 'powersgd', 'topk'],
+                       help='With the local DDP, compress the data-parallel '
+                       'grad all-reduce: all-reduce fp32 grads in fp16 or '
+                       'bf16, or send a low-rank approximation (powersgd) '
+                       'or the largest grads (topk), with error feedback.')
+    group.add_argument('--powersgd-rank', type=int, default=4,
+                       help='Rank of the approximation of every bucket of '
+                       'grads with --grad-compression powersgd.')
+    group.add_argument('--grad-topk-ratio', type=float, default=0.01,
+                       help='Fraction of the grads of every bucket sent with '
+                       '--grad-compression topk.')
+    group.add_argument('--fused-grad-copy', action='store_true',
+                       help='With --use-contiguous-buffers, copy the grads '
+                       'to the main grads, unscale them, check them for '
+                       'inf/nan and compute their norm in one fused kernel, '
+                       'and all-reduce the inf/nan flag and the norm '
+                       'together.')
+    group.add_argument('--use-distributed-optimizer', action='store_true',
+                       help='Shard the main params, optimizer state and '
+                       'stashed weight versions across data-parallel ranks; '
+                       'grads are reduce-scattered and the updated params '
+                       'all-gathered by the optimizer.')
+    group.add_argument('--offload-optimizer-state', action='store_true',
+                       help='Keep the main params and Adam state in CPU '
+                       'memory and step them with a CPU Adam; grads and '
+                       'updated params are copied asynchronously.')
+    group.add_argument('--offload-chunk-size', type=int, default=2 ** 22,
+                       help='Number of params stepped on the CPU before they '
+                       'are copied back to the GPU, with '
+                       '--offload-optimizer-state.')
     group.add_argument('--scatter-gather-tensors-in-pipeline', action='store_true',
                        help='Use scatter/gather to optimize communication of tensors in pipeline')
+    group.add_argument('--async-pipeline-communication', action='store_true',
+                       help='Use non-blocking sends and receives between '
+                       'pipeline stages, so that communication overlaps with '
+                       'the forward and backward passes.')
+    group.add_argument('--reuse-pipeline-receive-buffers', action='store_true',
+                       help='Receive tensors from other pipeline stages into '
+                       'buffers that are recycled once the backward pass of '
+                       'their microbatch is done, instead of allocating new '
+                       'ones. Stages must not return views of their input.')
+    group.add_argument('--variable-seq-lengths', action='store_true',
+                       help='Exchange the shapes of the activations sent '
+                       'between pipeline stages before sending them, so that '
+                       'microbatches can have different sequence lengths. '
+                       'The exchange blocks, so receives are not posted '
+                       'ahead of time with --async-pipeline-communication.')
+    group.add_argument('--pipeline-activation-codec', default='none',
+                       choices=['none', 'bf16', 'fp8', 'int8'],
+                       help='Compression of the activations sent between '
+                       'pipeline stages: bf16 or fp8 (e4m3) truncation, or '
+                       'int8 quantization of blocks of '
+                       '--pipeline-codec-block-size elements.')
+    group.add_argument('--pipeline-gradient-codec', default='none',
+                       choices=['none', 'bf16', 'fp8', 'int8', 'topk'],
+                       help='Compression of the gradients sent between '
+                       'pipeline stages: as --pipeline-activation-codec, or '
+                       'the largest --pipeline-topk-ratio of the elements '
+                       'with error feedback.')
+    group.add_argument('--pipeline-codec-block-size', type=int, default=64,
+                       help='Block size of the int8 pipeline codec.')
+    group.add_argument('--pipeline-topk-ratio', type=float, default=0.1,
+                       help='Fraction of the gradient elements sent by the '
+                       'topk pipeline codec.')
     group.add_argument('--local_rank', type=int, default=None,
                        help='local rank passed from distributed launcher.')
     group.add_argument('--lazy-mpu-init', type=bool, required=False,
@@ -97,6 +97,22 @@ def get_checkpoint_name(checkpoints_path, iteration,
                         'model_optim_rng.pt')
 
 
+def get_distributed_optimizer_checkpoint_name(checkpoint_name):
+    """File of the optimizer shard of this data-parallel rank, next to the
+    model checkpoint, with --use-distributed-optimizer."""
+    return os.path.join(os.path.dirname(checkpoint_name),
+                        'distrib_optim_dp_rank_{:03d}.pt'.format(
+                            mpu.get_data_parallel_rank()))
+
+
+def get_grad_compressor_checkpoint_name(checkpoint_name):
+    """File of the grad compressor state of this data-parallel rank, next
+    to the model checkpoint, with --grad-compression."""
+    return os.path.join(os.path.dirname(checkpoint_name),
+                        'grad_compressor_dp_rank_{:03d}.pt'.format(
+                            mpu.get_data_parallel_rank()))
+
+
 def get_checkpoint_tracker_filename(checkpoints_path):
     """Tracker file rescords the latest chckpoint during
     training to restart from."""
@@ -135,7 +151,7 @@ def save_checkpoint(iteration, model, optimizer, lr_scheduler):
 
         # Optimizer stuff.
         if not args.no_save_optim:
-            if optimizer is not None:
+            if optimizer is not None and not args.use_distributed_optimizer:
                 state_dict['optimizer'] = optimizer.state_dict()
             if lr_scheduler is not None:
                 state_dict['lr_scheduler'] = lr_scheduler.state_dict()
@@ -154,6 +170,22 @@ def save_checkpoint(iteration, model, optimizer, lr_scheduler):
         ensure_directory_exists(checkpoint_name)
         torch.save(state_dict, checkpoint_name)
 
+    # Every data-parallel rank saves its shard of the distributed optimizer.
+    if args.use_distributed_optimizer and not args.no_save_optim and \
+            optimizer is not None:
+        optimizer_name = get_distributed_optimizer_checkpoint_name(
+            get_checkpoint_name(args.save, iteration))
+        os.makedirs(os.path.dirname(optimizer_name), exist_ok=True)
+        torch.save(optimizer.state_dict(), optimizer_name)
+
+    # Every data-parallel rank saves the state of its grad compressors.
+    if args.grad_compression != 'none':
+        compressor_name = get_grad_compressor_checkpoint_name(
+            get_checkpoint_name(args.save, iteration))
+        os.makedirs(os.path.dirname(compressor_name), exist_ok=True)
+        torch.save([model_module.grad_compressor.state_dict()
+                    for model_module in model], compressor_name)
+
     # Wait so everyone is done (necessary)
     torch.distributed.barrier()
     if torch.distributed.get_rank() == 0:
@@ -276,17 +308,34 @@ def load_checkpoint(model, optimizer, lr_scheduler, load_arg='load'):
     # Optimizer.
     if not release and not args.finetune and not args.no_load_optim:
         try:
-            if optimizer is not None:
+            if optimizer is not None and args.use_distributed_optimizer:
+                optimizer.load_state_dict(torch.load(
+                    get_distributed_optimizer_checkpoint_name(checkpoint_name),
+                    map_location='cpu'))
+            elif optimizer is not None:
                 optimizer.load_state_dict(state_dict['optimizer'])
             if lr_scheduler is not None:
                 lr_scheduler.load_state_dict(state_dict['lr_scheduler'])
-        except KeyError:
+        except (KeyError, FileNotFoundError):
             print_rank_0('Unable to load optimizer from checkpoint {}. '
                          'Specify --no-load-optim or --finetune to prevent '
                          'attempting to load the optimizer state, '
                          'exiting ...'.format(checkpoint_name))
             sys.exit()
 
+    # Grad compressors, which start afresh if the checkpoint has none.
+    if not release and not args.finetune and args.grad_compression != 'none':
+        try:
+            states = torch.load(
+                get_grad_compressor_checkpoint_name(checkpoint_name),
+                map_location='cpu')
+            for model_module, state in zip(model, states):
+                model_module.grad_compressor.load_state_dict(state)
+        except FileNotFoundError:
+            print_rank_0('could not find the grad compressor state in the '
+                         'checkpoint {}, starting without it'.format(
+                             checkpoint_name))
+
     # rng states.
     if not release and not args.finetune and not args.no_load_rng:
         try:
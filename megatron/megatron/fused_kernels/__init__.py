@@ -124,3 +124,29 @@ def load_fused_mix_prec_layer_norm_kernel():
                            '-gencode', 'arch=compute_70,code=sm_70',
                            '-maxrregcount=50',
                            '--use_fast_math'] + cc_flag)
+
+
+def load_fused_grad_copy_kernel():
+
+    # Check, if CUDA11 is installed for compute capability 8.0
+    cc_flag = []
+    _, bare_metal_major, _ = get_cuda_bare_metal_version(cpp_extension.CUDA_HOME)
+    if int(bare_metal_major) >= 11:
+        cc_flag.append('-gencode')
+        cc_flag.append('arch=compute_80,code=sm_80')
+
+    srcpath = pathlib.Path(__file__).parent.absolute()
+    buildpath = srcpath / 'build'
+
+    create_build_dir(buildpath)
+
+    fused_grad_copy_cuda = cpp_extension.load(
+        name='fused_grad_copy_cuda',
+        sources=[srcpath / 'fused_grad_copy.cpp',
+                 srcpath / 'fused_grad_copy_cuda.cu'],
+        build_directory=buildpath,
+        extra_cflags=['-O3',],
+        extra_cuda_cflags=['-O3',
+                           '-gencode', 'arch=compute_70,code=sm_70',
+                           '-U__CUDA_NO_HALF_OPERATORS__',
+                           '-U__CUDA_NO_HALF_CONVERSIONS__'] + cc_flag)
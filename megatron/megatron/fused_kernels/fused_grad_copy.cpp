@@ -0,0 +1,61 @@
+/* coding=utf-8
+ * Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include <torch/extension.h>
+
+namespace fused_grad_copy {
+
+void copy_unscale_norm_cuda(
+    torch::Tensor const& model_grads,
+    torch::Tensor const& main_grads,
+    torch::Tensor const& inv_scale,
+    torch::Tensor const& tiles,
+    torch::Tensor const& stats);
+
+void copy_unscale_norm(
+    torch::Tensor const& model_grads,
+    torch::Tensor const& main_grads,
+    torch::Tensor const& inv_scale,
+    torch::Tensor const& tiles,
+    torch::Tensor const& stats) {
+  AT_ASSERTM(model_grads.is_contiguous() && main_grads.is_contiguous(),
+      "expected contiguous grads");
+  AT_ASSERTM(model_grads.numel() == main_grads.numel(),
+      "expected as many model grads as main grads");
+  AT_ASSERTM(model_grads.scalar_type() == at::ScalarType::Half ||
+      model_grads.scalar_type() == at::ScalarType::Float,
+      "Only HALF and FLOAT model grads are supported");
+  AT_ASSERTM(main_grads.scalar_type() == at::ScalarType::Float,
+      "Only FLOAT main grads are supported");
+  AT_ASSERTM(inv_scale.scalar_type() == at::ScalarType::Float &&
+      inv_scale.numel() == 1, "expected a FLOAT inverse scale");
+  AT_ASSERTM(tiles.scalar_type() == at::ScalarType::Long &&
+      tiles.dim() == 2 && tiles.size(1) == 3,
+      "expected a LONG table of (start, end, counted) tiles");
+  AT_ASSERTM(stats.scalar_type() == at::ScalarType::Float &&
+      stats.numel() == 2, "expected FLOAT (found_inf, sum of squares) stats");
+
+  copy_unscale_norm_cuda(model_grads, main_grads, inv_scale, tiles, stats);
+}
+
+} // end namespace fused_grad_copy
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+  m.def("copy_unscale_norm",
+        &fused_grad_copy::copy_unscale_norm,
+	"Copy and unscale the model grads into the main grads, flag inf/nan "
+	"and accumulate the sum of squares of the counted tiles.");
+}
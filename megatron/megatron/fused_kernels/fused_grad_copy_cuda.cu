@@ -0,0 +1,110 @@
+/* coding=utf-8
+ * Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include <ATen/ATen.h>
+#include <ATen/cuda/CUDAContext.h>
+#include <cuda_fp16.h>
+#include <torch/extension.h>
+#include "type_shim.h"
+
+namespace fused_grad_copy {
+
+namespace {
+
+constexpr int kThreadsPerBlock = 512;
+
+// One block per tile of the flat grads: main_grads = model_grads * inv_scale,
+// stats[0] set to 1 if any result is inf or nan, and the sum of the squares
+// of the results of counted tiles added to stats[1]. model_grads may alias
+// main_grads, as every element is read before it is written by the same
+// thread.
+template <typename scalar_t>
+__global__ void copy_unscale_norm_kernel(
+    const scalar_t* model_grads,
+    float* main_grads,
+    const float* __restrict__ inv_scale,
+    const int64_t* __restrict__ tiles,
+    float* __restrict__ stats)
+{
+  __shared__ float partial_sums[kThreadsPerBlock / 32];
+
+  const int64_t start = tiles[3 * blockIdx.x];
+  const int64_t end = tiles[3 * blockIdx.x + 1];
+  const bool counted = tiles[3 * blockIdx.x + 2] != 0;
+  const float scale = *inv_scale;
+
+  float sum = 0.0f;
+  bool finite = true;
+  for (int64_t i = start + threadIdx.x; i < end; i += blockDim.x) {
+    const float value = static_cast<float>(model_grads[i]) * scale;
+    finite = finite && isfinite(value);
+    main_grads[i] = value;
+    sum += value * value;
+  }
+  if (!finite) {
+    stats[0] = 1.0f;
+  }
+  // counted is the same for the whole block.
+  if (!counted) {
+    return;
+  }
+
+  for (int offset = 16; offset > 0; offset /= 2) {
+    sum += __shfl_down_sync(0xffffffff, sum, offset);
+  }
+  if (threadIdx.x % 32 == 0) {
+    partial_sums[threadIdx.x / 32] = sum;
+  }
+  __syncthreads();
+  if (threadIdx.x < 32) {
+    sum = threadIdx.x < blockDim.x / 32 ? partial_sums[threadIdx.x] : 0.0f;
+    for (int offset = 16; offset > 0; offset /= 2) {
+      sum += __shfl_down_sync(0xffffffff, sum, offset);
+    }
+    if (threadIdx.x == 0) {
+      atomicAdd(stats + 1, sum);
+    }
+  }
+}
+
+} // end anonymous namespace
+
+void copy_unscale_norm_cuda(
+    torch::Tensor const& model_grads,
+    torch::Tensor const& main_grads,
+    torch::Tensor const& inv_scale,
+    torch::Tensor const& tiles,
+    torch::Tensor const& stats)
+{
+  const int64_t num_tiles = tiles.size(0);
+  if (num_tiles == 0) {
+    return;
+  }
+  const dim3 blocks(num_tiles);
+  const dim3 threads(kThreadsPerBlock);
+  cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+
+  DISPATCH_FLOAT_AND_HALF(
+      model_grads.scalar_type(), 0, "copy_unscale_norm",
+      copy_unscale_norm_kernel<scalar_t_0><<<blocks, threads, 0, stream>>>(
+          model_grads.data_ptr<scalar_t_0>(),
+          main_grads.data_ptr<float>(),
+          inv_scale.data_ptr<float>(),
+          tiles.data_ptr<int64_t>(),
+          stats.data_ptr<float>()));
+}
+
+} // end namespace fused_grad_copy
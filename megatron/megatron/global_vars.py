@@ -32,6 +32,10 @@ _GLOBAL_TENSORBOARD_WRITER = None
 _GLOBAL_ADLR_AUTORESUME = None
 _GLOBAL_TIMERS = None
 
+# Event pairs that an asynchronous timer keeps before adding the completed
+# ones to its elapsed time.
+_MAX_PENDING_EVENTS = 64
+
 
 def get_args():
     """Return arguments."""
@@ -86,7 +90,7 @@ def set_global_variables(extra_args_provider=None, args_defaults={},
     _ = _build_tokenizer(args)
     _set_tensorboard_writer(args)
     _set_adlr_autoresume(args)
-    _set_timers()
+    _set_timers(args)
 
 
 def _parse_args(extra_args_provider=None, defaults={},
@@ -161,11 +165,11 @@ def _set_adlr_autoresume(args):
         _GLOBAL_ADLR_AUTORESUME = AutoResume
 
 
-def _set_timers():
+def _set_timers(args):
     """Initialize timers."""
     global _GLOBAL_TIMERS
     _ensure_var_is_not_initialized(_GLOBAL_TIMERS, 'timers')
-    _GLOBAL_TIMERS = Timers()
+    _GLOBAL_TIMERS = Timers(args.timing_sync_level)
 
 
 def _ensure_var_is_initialized(var, name):
@@ -179,32 +183,70 @@ def _ensure_var_is_not_initialized(var, name):
 
 
 class _Timer:
-    """Timer."""
+    """Timer. A synchronizing timer waits for the device when it starts and
+    stops, so it times all the work queued before it. The others record CUDA
+    events on the current stream instead, whose times are only read by
+    elapsed(), or use the host clock without a GPU."""
 
-    def __init__(self, name):
+    def __init__(self, name, synchronize=True):
         self.name_ = name
         self.elapsed_ = 0.0
         self.started_ = False
-        self.start_time = time.time()
+        self.start_time = time.perf_counter()
+        self.synchronize = synchronize
+        self.use_events = not synchronize and torch.cuda.is_available()
+        self.start_event = None
+        # (start, stop) events not yet added to the elapsed time.
+        self.pending_events = []
 
     def start(self):
         """Start the timer."""
         assert not self.started_, 'timer has already been started'
-        torch.cuda.synchronize()
-        self.start_time = time.time()
+        if self.use_events:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record()
+        else:
+            if self.synchronize and torch.cuda.is_available():
+                torch.cuda.synchronize()
+            self.start_time = time.perf_counter()
         self.started_ = True
 
     def stop(self):
         """Stop the timer."""
         assert self.started_, 'timer is not started'
-        torch.cuda.synchronize()
-        self.elapsed_ += (time.time() - self.start_time)
+        if self.use_events:
+            stop_event = torch.cuda.Event(enable_timing=True)
+            stop_event.record()
+            self.pending_events.append((self.start_event, stop_event))
+            self.start_event = None
+            if len(self.pending_events) >= _MAX_PENDING_EVENTS:
+                self._resolve_events(blocking=False)
+        else:
+            if self.synchronize and torch.cuda.is_available():
+                torch.cuda.synchronize()
+            self.elapsed_ += (time.perf_counter() - self.start_time)
         self.started_ = False
 
+    def _resolve_events(self, blocking=True):
+        """Add the times of the pending events to the elapsed time, waiting
+        for them if blocking and taking only those that completed
+        otherwise."""
+        resolved = 0
+        for start_event, stop_event in self.pending_events:
+            if blocking:
+                stop_event.synchronize()
+            elif not stop_event.query():
+                break
+            self.elapsed_ += start_event.elapsed_time(stop_event) / 1000.0
+            resolved += 1
+        del self.pending_events[:resolved]
+
     def reset(self):
         """Reset timer."""
         self.elapsed_ = 0.0
         self.started_ = False
+        self.start_event = None
+        self.pending_events = []
 
     def elapsed(self, reset=True):
         """Calculate the elapsed time."""
@@ -212,6 +254,7 @@ class _Timer:
         # If the timing in progress, end it first.
         if self.started_:
             self.stop()
+        self._resolve_events()
         # Get the elapsed time.
         elapsed_ = self.elapsed_
         # Reset the elapsed time
@@ -224,16 +267,46 @@ class _Timer:
 
 
 class Timers:
-    """Group of timers."""
+    """Group of timers, and of counters logged with them.
+
+    Every timer has a verbosity level, set when it is first used: 0 for
+    those timing whole iterations or their main phases, 1 for finer phases
+    and 2 for those started per microbatch or per communication. Timers of
+    level at most `sync_level` synchronize the device; the others do not
+    (see _Timer)."""
 
-    def __init__(self):
+    def __init__(self, sync_level=0):
+        self.sync_level = sync_level
         self.timers = {}
+        self.log_levels = {}
+        self.counters = {}
 
-    def __call__(self, name):
+    def __call__(self, name, log_level=None):
+        """Timer `name`, of level `log_level` (0 for a new timer if None).
+        A timer keeps its level: later calls may omit it but not change
+        it."""
         if name not in self.timers:
-            self.timers[name] = _Timer(name)
+            if log_level is None:
+                log_level = 0
+            self.timers[name] = _Timer(
+                name, synchronize=log_level <= self.sync_level)
+            self.log_levels[name] = log_level
+        else:
+            assert log_level is None or log_level == self.log_levels[name], \
+                'timer {} has level {}, not {}'.format(
+                    name, self.log_levels[name], log_level)
         return self.timers[name]
 
+    def increment(self, name, value=1):
+        """Increment counter `name`."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def _count(self, name, reset):
+        count = self.counters[name]
+        if reset:
+            self.counters[name] = 0
+        return count
+
     def write(self, names, writer, iteration, normalizer=1.0, reset=False):
         """Write timers to a tensorboard writer"""
         # currently when using add_scalars,
@@ -241,6 +314,10 @@ class Timers:
         # polutes the runs list, so we just add each as a scalar
         assert normalizer > 0.0
         for name in names:
+            if name in self.counters:
+                value = self._count(name, reset) / normalizer
+                writer.add_scalar(name, value, iteration)
+                continue
             value = self.timers[name].elapsed(reset=reset) / normalizer
             writer.add_scalar(name + '-time', value, iteration)
 
@@ -248,10 +325,17 @@ class Timers:
         """Log a group of timers."""
         assert normalizer > 0.0
         string = 'time (ms)'
+        counts = ''
         for name in names:
+            if name in self.counters:
+                counts += ' | {}: {:.1f}'.format(
+                    name, self._count(name, reset) / normalizer)
+                continue
             elapsed_time = self.timers[name].elapsed(
                 reset=reset) * 1000.0 / normalizer
             string += ' | {}: {:.2f}'.format(name, elapsed_time)
+        if counts:
+            string += ' | counts' + counts
         if torch.distributed.is_initialized():
             if torch.distributed.get_rank() == (
                     torch.distributed.get_world_size() - 1):
@@ -0,0 +1,237 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compressors of the data-parallel grad all-reduce of the local DDP
+(--grad-compression).
+
+A compressor sums a flat grad bucket over the data-parallel group in place,
+sending less than the bucket. Buckets are identified by a key, under which
+compressors with error feedback keep the part of the grads that they did
+not send, to add it to the next grads of the bucket. That state is saved
+with the checkpoint of every data-parallel rank.
+"""
+
+import math
+
+import torch
+
+
+class GradCompressor:
+    """All-reduces grads uncompressed."""
+
+    def __init__(self):
+        # Bytes of the messages of this rank since the last reset.
+        self.bytes_sent = 0
+
+    def all_reduce(self, key, tensor, group, shapes=None):
+        """Sum the flat `tensor` of bucket `key` over `group`, in place.
+        `shapes` are those of the grads that it concatenates."""
+        torch.distributed.all_reduce(tensor, group=group)
+        self.bytes_sent += tensor.numel() * tensor.element_size()
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
+
+class LowPrecisionCompressor(GradCompressor):
+    """All-reduces grads in fp16 or bf16."""
+
+    def __init__(self, dtype):
+        super(LowPrecisionCompressor, self).__init__()
+        self.dtype = dtype
+
+    def all_reduce(self, key, tensor, group, shapes=None):
+        if tensor.dtype == self.dtype:
+            return super(LowPrecisionCompressor, self).all_reduce(
+                key, tensor, group)
+        compressed = tensor.to(self.dtype)
+        torch.distributed.all_reduce(compressed, group=group)
+        tensor.copy_(compressed)
+        self.bytes_sent += compressed.numel() * compressed.element_size()
+
+
+class TopKCompressor(GradCompressor):
+    """Sends the `ratio` fraction of the grads with the largest magnitudes
+    and their indices, all-gathered from every rank and summed. The grads
+    that are not sent are added to the next grads of the bucket (error
+    feedback)."""
+
+    def __init__(self, ratio):
+        super(TopKCompressor, self).__init__()
+        assert 0.0 < ratio <= 1.0
+        self.ratio = ratio
+        self.residuals = {}
+
+    def all_reduce(self, key, tensor, group, shapes=None):
+        flat = tensor.float()
+        residual = self.residuals.get(key)
+        if residual is not None and residual.shape == flat.shape:
+            flat = flat + residual.to(flat.device)
+        k = max(1, int(flat.numel() * self.ratio))
+        indices = torch.topk(flat.abs(), k, sorted=False)[1]
+        values = flat[indices]
+        residual = flat.clone()
+        residual[indices] = 0.0
+        self.residuals[key] = residual
+
+        world_size = torch.distributed.get_world_size(group=group)
+        all_values = [torch.empty_like(values) for _ in range(world_size)]
+        all_indices = [torch.empty_like(indices) for _ in range(world_size)]
+        torch.distributed.all_gather(all_values, values, group=group)
+        torch.distributed.all_gather(all_indices, indices, group=group)
+        summed = torch.zeros_like(flat)
+        for rank_values, rank_indices in zip(all_values, all_indices):
+            summed.index_add_(0, rank_indices, rank_values)
+        tensor.copy_(summed)
+        self.bytes_sent += k * (values.element_size() +
+                                indices.element_size())
+
+    def state_dict(self):
+        return {'residuals': self.residuals}
+
+    def load_state_dict(self, state_dict):
+        self.residuals = dict(state_dict['residuals'])
+
+
+class PowerSGDCompressor(GradCompressor):
+    """Rank-`rank` PowerSGD (Vogels et al., 2019): every grad of the bucket
+    with at least two dimensions is viewed as an n x m matrix M, and
+    P = M Q and Q = M^T orth(P) are all-reduced instead of M, which is
+    replaced by orth(P) Q^T. Q is reused across steps (warm start) and
+    M - orth(P) Q^T is added to the next grads of the bucket (error
+    feedback). The other grads, and matrices too small to gain, are
+    all-reduced as is."""
+
+    def __init__(self, rank):
+        super(PowerSGDCompressor, self).__init__()
+        assert rank >= 1
+        self.rank = rank
+        self.residuals = {}
+        self.qs = {}
+
+    def all_reduce(self, key, tensor, group, shapes=None):
+        if shapes is None:
+            shapes = [tensor.shape]
+        flat = tensor.view(-1).float()
+        residual = self.residuals.get(key)
+        if residual is not None and residual.shape == flat.shape:
+            flat = flat + residual.to(flat.device)
+        else:
+            flat = flat.clone()
+
+        matrices, uncompressed = [], []
+        offset = 0
+        for shape in shapes:
+            numel = int(math.prod(shape))
+            segment = flat[offset:offset + numel]
+            offset += numel
+            if len(shape) >= 2:
+                n, m = shape[0], numel // shape[0]
+                rank = min(self.rank, n, m)
+                if (n + m) * rank < numel:
+                    matrices.append((segment.view(n, m), rank))
+                    continue
+            uncompressed.append(segment)
+        assert offset == flat.numel()
+        residual = flat.clone()
+        world_size = torch.distributed.get_world_size(group=group)
+
+        if uncompressed:
+            sent = torch.cat(uncompressed)
+            torch.distributed.all_reduce(sent, group=group)
+            self.bytes_sent += sent.numel() * sent.element_size()
+            for segment, reduced in zip(uncompressed, sent.split(
+                    [segment.numel() for segment in uncompressed])):
+                # Sent exactly, so nothing is left for the next step.
+                start = _offset(segment, flat)
+                residual[start:start + segment.numel()] = 0.0
+                segment.copy_(reduced)
+
+        if matrices:
+            qs = self.qs.get(key)
+            if qs is None or [q.shape for q in qs] != \
+                    [(matrix.size(1), rank) for matrix, rank in matrices]:
+                # The same on every rank.
+                generator = torch.Generator().manual_seed(key)
+                qs = [torch.randn(matrix.size(1), rank, generator=generator)
+                      for matrix, rank in matrices]
+            qs = [q.to(flat.device) for q in qs]
+            ps = _all_reduce_matrices(
+                [torch.matmul(matrix, q)
+                 for (matrix, _), q in zip(matrices, qs)], group)
+            ps = [_orthogonalize(p) for p in ps]
+            qs = _all_reduce_matrices(
+                [torch.matmul(matrix.t(), p)
+                 for (matrix, _), p in zip(matrices, ps)], group)
+            self.qs[key] = qs
+            self.bytes_sent += sum((p.numel() + q.numel()) * p.element_size()
+                                   for p, q in zip(ps, qs))
+            for (matrix, _), p, q in zip(matrices, ps, qs):
+                approximation = torch.matmul(p, q.t())
+                # The approximation is of the sum of the grads, and the
+                # residual of the grads of this rank.
+                start = _offset(matrix, flat)
+                residual[start:start + matrix.numel()] -= \
+                    approximation.view(-1) / world_size
+                matrix.copy_(approximation)
+
+        self.residuals[key] = residual
+        tensor.view(-1).copy_(flat)
+
+    def state_dict(self):
+        return {'residuals': self.residuals, 'qs': self.qs}
+
+    def load_state_dict(self, state_dict):
+        self.residuals = dict(state_dict['residuals'])
+        self.qs = dict(state_dict['qs'])
+
+
+def _offset(segment, flat):
+    """Offset of the view `segment` in `flat`."""
+    return segment.storage_offset() - flat.storage_offset()
+
+
+def _all_reduce_matrices(matrices, group):
+    """Sum `matrices` over `group` with one all-reduce."""
+    flat = torch.cat([matrix.view(-1) for matrix in matrices])
+    torch.distributed.all_reduce(flat, group=group)
+    return [chunk.view_as(matrix) for chunk, matrix in zip(
+        flat.split([matrix.numel() for matrix in matrices]), matrices)]
+
+
+def _orthogonalize(matrix):
+    """Orthonormal columns spanning those of `matrix`."""
+    return torch.linalg.qr(matrix)[0]
+
+
+GRAD_COMPRESSORS = ('none', 'fp16', 'bf16', 'powersgd', 'topk')
+
+
+def build_grad_compressor(name, powersgd_rank=4, topk_ratio=0.01):
+    """Compressor called `name`, one of GRAD_COMPRESSORS."""
+    if name == 'none':
+        return GradCompressor()
+    if name == 'fp16':
+        return LowPrecisionCompressor(torch.half)
+    if name == 'bf16':
+        return LowPrecisionCompressor(torch.bfloat16)
+    if name == 'powersgd':
+        return PowerSGDCompressor(powersgd_rank)
+    if name == 'topk':
+        return TopKCompressor(topk_ratio)
+    raise Exception('unknown grad compressor {}'.format(name))
@@ -135,9 +135,13 @@ def _initialize_distributed():
         if mpu.model_parallel_is_initialized():
             print('model parallel is already initialized')
         else:
+            ranks_per_node = None
+            if args.hierarchical_allreduce:
+                ranks_per_node = args.ranks_per_node or device_count
             mpu.initialize_model_parallel(args.tensor_model_parallel_size,
                                           args.pipeline_model_parallel_size,
-                                          args.virtual_pipeline_model_parallel_size)
+                                          args.virtual_pipeline_model_parallel_size,
+                                          ranks_per_node=ranks_per_node)
 
 
 def _init_autoresume():
@@ -17,59 +17,214 @@ import torch
 from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 import torch.distributed as dist
 from torch.nn.modules import Module
-from torch.autograd import Variable
 
 from megatron import mpu
 from .module import MegatronModule
 
 
+def _contiguous_view(tensors):
+    """View of the flat buffer that `tensors` tile (e.g. grads laid out by
+    --use-contiguous-buffers), or None if they are not adjacent views of
+    one buffer."""
+    base = tensors[0]._base
+    if base is None or not base.is_contiguous():
+        return None
+    tensors = sorted(tensors, key=lambda tensor: tensor.storage_offset())
+    offset = tensors[0].storage_offset()
+    for tensor in tensors:
+        if tensor._base is not base or not tensor.is_contiguous() or \
+                tensor.storage_offset() != offset:
+            return None
+        offset += tensor.numel()
+    start = tensors[0].storage_offset() - base.storage_offset()
+    return base.view(-1)[start:start + offset - tensors[0].storage_offset()]
+
+
+class _GradBucket:
+    """Params of one type whose grads are all-reduced together, and the
+    all-reduce in flight for them."""
+
+    def __init__(self, params, key):
+        self.params = params
+        self.key = key
+        self.ready = set()
+        self.pending = None
+        # Left to allreduce_params() rather than started by the backward
+        # pass.
+        self.deferred = False
+
+
+def _build_buckets(params, bucket_size):
+    """Group `params` by type, in order, into buckets of at most
+    `bucket_size` elements (one bucket per type if it is None); a param
+    larger than `bucket_size` gets a bucket of its own."""
+    buckets = {}
+    for param in params:
+        tp = param.data.type()
+        if tp not in buckets:
+            buckets[tp] = [[]]
+        bucket = buckets[tp][-1]
+        if bucket and bucket_size is not None and \
+                sum(p.numel() for p in bucket) + param.numel() > bucket_size:
+            bucket = []
+            buckets[tp].append(bucket)
+        bucket.append(param)
+    return [_GradBucket(bucket, key) for key, bucket in
+            enumerate(bucket for tp in buckets for bucket in buckets[tp])]
+
+
 class DistributedDataParallel(MegatronModule):
+    """Data-parallel module whose grads allreduce_params() all-reduces.
+
+    With overlap_grad_reduce, the grads are all-reduced in buckets of at
+    most bucket_size elements, in reverse order of the params: once
+    enable_grad_sync() has been called before the last backward pass of the
+    iteration, the all-reduce of a bucket starts as soon as that backward
+    pass has produced all its grads, and allreduce_params() only waits for
+    them. The grads are divided by the world size before the all-reduce, as
+    with reduce_after=False.
+
+    With hierarchical_allreduce, buckets are reduced within the node, across
+    nodes and gathered within the node (see mpu.hierarchical_all_reduce).
+    With a grad_compressor (see megatron/grad_compression.py), buckets are
+    summed by it, synchronously.
+    """
 
-    def __init__(self, module):
+    def __init__(self, module, overlap_grad_reduce=False, bucket_size=None,
+                 fp32_allreduce=False, hierarchical_allreduce=False,
+                 grad_compressor=None):
         super(DistributedDataParallel, self).__init__()
-        self.warn_on_half = True if dist._backend == dist.dist_backend.GLOO else False
 
         self.module = module
         self.data_parallel_group = mpu.get_data_parallel_group()
+        self.warn_on_half = \
+            dist.get_backend(self.data_parallel_group) == dist.Backend.GLOO
+        self.overlap_grad_reduce = overlap_grad_reduce
+        self.fp32_allreduce = fp32_allreduce
+        self.hierarchical_allreduce = hierarchical_allreduce
+        self.grad_compressor = grad_compressor
+        self.needs_reduction = False
+        self._grad_sync_enabled = False
+
+        self._buckets = []
+        self._grad_accs = []
+        if overlap_grad_reduce:
+            # Reverse order of the params, in which the backward pass
+            # roughly produces their grads.
+            params = [param for param in self.module.parameters()
+                      if param.requires_grad]
+            self._buckets = _build_buckets(params[::-1], bucket_size)
+            for bucket in self._buckets:
+                for param in bucket.params:
+                    # The grad accumulator runs once the backward pass has
+                    # produced the whole grad of the param.
+                    param_tmp = param.expand_as(param)
+                    grad_acc = param_tmp.grad_fn.next_functions[0][0]
+                    grad_acc.register_hook(self._make_hook(param, bucket))
+                    self._grad_accs.append(grad_acc)
+
+    def _make_hook(self, param, bucket):
+        def allreduce_hook(*unused):
+            if self._grad_sync_enabled:
+                bucket.ready.add(param)
+                if len(bucket.ready) == len(bucket.params) and \
+                        not bucket.deferred:
+                    self._start_allreduce(bucket, reduce_after=False,
+                                          no_scale=False,
+                                          fp32_allreduce=self.fp32_allreduce)
+        return allreduce_hook
+
+    def enable_grad_sync(self):
+        """Start the all-reduce of the grads produced by the next backward
+        pass, the last one of the iteration (with overlap_grad_reduce)."""
+        self._grad_sync_enabled = self.overlap_grad_reduce
+
+    def defer_grad_sync(self, param):
+        """Leave the all-reduce of the bucket of `param` to the next
+        allreduce_params() (with overlap_grad_reduce), e.g. for a grad that
+        is all-reduced in another group first."""
+        for bucket in self._buckets:
+            if any(p is param for p in bucket.params):
+                bucket.deferred = True
+
+    def _start_allreduce(self, bucket, reduce_after, no_scale,
+                         fp32_allreduce):
+        params = [param for param in bucket.params if param.grad is not None]
+        if not params:
+            return
+        grads = [param.grad.data for param in params]
+        # Grads in a flat buffer are reduced in place.
+        coalesced = None
+        if not fp32_allreduce:
+            coalesced = _contiguous_view([param.grad for param in params])
+        in_place = coalesced is not None
+        if not in_place:
+            coalesced = _flatten_dense_tensors(grads)
+        if fp32_allreduce:
+            coalesced = coalesced.float()
+        if not no_scale and not reduce_after:
+            coalesced /= dist.get_world_size(group=self.data_parallel_group)
+        if self.grad_compressor is not None:
+            self.grad_compressor.all_reduce(
+                bucket.key, coalesced, self.data_parallel_group,
+                shapes=[param.shape for param in params])
+            handle = None
+        elif self.hierarchical_allreduce:
+            handle = mpu.hierarchical_all_reduce(coalesced, async_op=True)
+        else:
+            handle = dist.all_reduce(coalesced,
+                                     group=self.data_parallel_group,
+                                     async_op=True)
+        bucket.pending = (handle, coalesced, grads, in_place)
+
+    def _finish_allreduce(self, bucket, reduce_after, no_scale):
+        if bucket.pending is None:
+            return
+        handle, coalesced, grads, in_place = bucket.pending
+        bucket.pending = None
+        if handle is not None:
+            handle.wait()
+        if not no_scale and reduce_after:
+            coalesced /= dist.get_world_size(group=self.data_parallel_group)
+        if not in_place:
+            for buf, synced in zip(grads, _unflatten_dense_tensors(coalesced, grads)):
+                buf.copy_(synced)
+
+    def allreduce_params(self, reduce_after=True, no_scale=False,
+                         fp32_allreduce=False):
+        if not self.needs_reduction:
+            return
+        self.needs_reduction = False
+        if self.overlap_grad_reduce:
+            assert not reduce_after and not no_scale and \
+                fp32_allreduce == self.fp32_allreduce, \
+                'overlapped grad all-reduce options do not match'
+            # Buckets that the last backward pass did not complete, e.g.
+            # with params it does not use, are all-reduced now.
+            for bucket in self._buckets:
+                if bucket.pending is None:
+                    self._start_allreduce(bucket, reduce_after, no_scale,
+                                          fp32_allreduce)
+            for bucket in self._buckets:
+                self._finish_allreduce(bucket, reduce_after, no_scale)
+                bucket.ready.clear()
+                bucket.deferred = False
+            self._grad_sync_enabled = False
+            return
 
-        def allreduce_params(reduce_after=True, no_scale=False, fp32_allreduce=False):
-            if(self.needs_reduction):
-                self.needs_reduction = False
-                buckets = {}
-                for name, param in self.module.named_parameters():
-                    if param.requires_grad and param.grad is not None:
-                        tp = (param.data.type())
-                        if tp not in buckets:
-                            buckets[tp] = []
-                        buckets[tp].append(param)
-                if self.warn_on_half:
-                    if torch.cuda.HalfTensor in buckets:
-                        print("WARNING: gloo dist backend for half parameters may be extremely slow." +
-                              " It is recommended to use the NCCL backend in this case.")
-                        self.warn_on_half = False
-                for tp in buckets:
-                    bucket = buckets[tp]
-                    grads = [param.grad.data for param in bucket]
-                    coalesced = _flatten_dense_tensors(grads)
-                    if fp32_allreduce:
-                        coalesced = coalesced.float()
-                    if not no_scale and not reduce_after:
-                        coalesced /= dist.get_world_size(group=self.data_parallel_group)
-                    dist.all_reduce(coalesced, group=self.data_parallel_group)
-                    torch.cuda.synchronize()
-                    if not no_scale and reduce_after:
-                        coalesced /= dist.get_world_size(group=self.data_parallel_group)
-                    for buf, synced in zip(grads, _unflatten_dense_tensors(coalesced, grads)):
-                        buf.copy_(synced)
-        self.hook_handles = []
-        self.hooks = []
-        for param in list(self.module.parameters()):
-            def allreduce_hook(*unused):
-                Variable._execution_engine.queue_callback(allreduce_params)
-        #    handle = param.register_hook(allreduce_hook)
-            # self.hooks.append(allreduce_hook)
-            # self.hook_handles.append(handle)
-        self.allreduce_params = allreduce_params
+        params = [param for param in self.module.parameters()
+                  if param.requires_grad and param.grad is not None]
+        buckets = _build_buckets(params, None)
+        if self.warn_on_half:
+            if any(bucket.params[0].data.type() == 'torch.cuda.HalfTensor'
+                   for bucket in buckets):
+                print("WARNING: gloo dist backend for half parameters may be extremely slow." +
+                      " It is recommended to use the NCCL backend in this case.")
+                self.warn_on_half = False
+        for bucket in buckets:
+            self._start_allreduce(bucket, reduce_after, no_scale,
+                                  fp32_allreduce)
+            self._finish_allreduce(bucket, reduce_after, no_scale)
 
     def forward(self, *inputs, **kwargs):
         self.needs_reduction = True
@@ -0,0 +1,81 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Two-level data-parallel all-reduce: reduce-scatter within the node,
+all-reduce of 1 / local_size of the data across nodes, then all-gather
+within the node."""
+
+import math
+
+import torch
+
+from .initialize import get_data_parallel_group
+from .initialize import get_data_parallel_inter_node_group
+from .initialize import get_data_parallel_intra_node_group
+
+
+class _HierarchicalAllReduce:
+    """Hierarchical all-reduce of a flat tensor, whose intra-node
+    reduce-scatter is started on construction; wait() runs the rest."""
+
+    def __init__(self, tensor, intra_node_group, inter_node_group):
+        self.tensor = tensor
+        self.intra_node_group = intra_node_group
+        self.inter_node_group = inter_node_group
+        local_size = torch.distributed.get_world_size(group=intra_node_group)
+        self.local_rank = torch.distributed.get_rank(group=intra_node_group)
+        shard_size = math.ceil(tensor.numel() / local_size)
+        # Pad the tensor so that every rank of the node gets one shard.
+        self.buffer = tensor
+        if shard_size * local_size != tensor.numel():
+            self.buffer = torch.zeros(shard_size * local_size,
+                                      dtype=tensor.dtype,
+                                      device=tensor.device)
+            self.buffer[:tensor.numel()].copy_(tensor)
+        self.shards = list(self.buffer.split(shard_size))
+        # Gloo has no reduce-scatter, so the whole buffer is all-reduced
+        # there.
+        if torch.distributed.get_backend(intra_node_group) == 'nccl':
+            self.handle = torch.distributed.reduce_scatter(
+                self.shards[self.local_rank], self.shards,
+                group=intra_node_group, async_op=True)
+        else:
+            self.handle = torch.distributed.all_reduce(
+                self.buffer, group=intra_node_group, async_op=True)
+
+    def wait(self):
+        self.handle.wait()
+        shard = self.shards[self.local_rank]
+        torch.distributed.all_reduce(shard, group=self.inter_node_group)
+        torch.distributed.all_gather(self.shards, shard.clone(),
+                                     group=self.intra_node_group)
+        if self.buffer is not self.tensor:
+            self.tensor.copy_(self.buffer[:self.tensor.numel()])
+
+
+def hierarchical_all_reduce(tensor, async_op=False):
+    """Sum the flat `tensor` over the data-parallel group, in two levels if
+    the intra-node and inter-node groups exist (see
+    `initialize_model_parallel`) and with one all-reduce otherwise. With
+    async_op, returns a handle whose wait() completes the all-reduce."""
+    intra_node_group = get_data_parallel_intra_node_group()
+    if intra_node_group is None:
+        return torch.distributed.all_reduce(
+            tensor, group=get_data_parallel_group(), async_op=async_op)
+    work = _HierarchicalAllReduce(tensor, intra_node_group,
+                                  get_data_parallel_inter_node_group())
+    if async_op:
+        return work
+    work.wait()
@@ -31,6 +31,10 @@ _MODEL_PARALLEL_GROUP = None
 _EMBEDDING_GROUP = None
 # Data parallel group that the current rank belongs to.
 _DATA_PARALLEL_GROUP = None
+# Data parallel ranks on the node of the current rank, and ranks with the same
+# position on the other nodes, for the hierarchical all-reduce.
+_DATA_PARALLEL_INTRA_NODE_GROUP = None
+_DATA_PARALLEL_INTER_NODE_GROUP = None
 
 _VIRTUAL_PIPELINE_MODEL_PARALLEL_RANK = None
 _VIRTUAL_PIPELINE_MODEL_PARALLEL_WORLD_SIZE = None
@@ -52,13 +56,17 @@ def is_unitialized():
 
 def initialize_model_parallel(tensor_model_parallel_size_=1,
                               pipeline_model_parallel_size_=1,
-                              virtual_pipeline_model_parallel_size_=None):
+                              virtual_pipeline_model_parallel_size_=None,
+                              ranks_per_node=None):
     """
     Initialize model data parallel groups.
 
     Arguments:
         tensor_model_parallel_size: number of GPUs used to parallelize model tensor.
         pipeline_model_parallel_size: number of GPUs used to parallelize model pipeline.
+        ranks_per_node: if set, ranks r with the same r // ranks_per_node
+            are taken to share a node, and the groups of the hierarchical
+            data-parallel all-reduce are built.
 
     Let's say we have a total of 16 GPUs denoted by g0 ... g15 and we
     use 2 GPUs to parallelize the model tensor, and 4 GPUs to parallelize
@@ -119,6 +127,32 @@ def initialize_model_parallel(tensor_model_parallel_size_=1,
             if rank in ranks:
                 _DATA_PARALLEL_GROUP = group
 
+    # Build the intra-node and inter-node data-parallel groups. They are only
+    # built for data-parallel groups that span several nodes, with the same
+    # number of ranks on each.
+    global _DATA_PARALLEL_INTRA_NODE_GROUP
+    global _DATA_PARALLEL_INTER_NODE_GROUP
+    assert _DATA_PARALLEL_INTRA_NODE_GROUP is None, \
+        'intra-node data parallel group is already initialized'
+    if ranks_per_node is not None:
+        for ranks in all_data_parallel_group_ranks:
+            nodes = {}
+            for r in ranks:
+                nodes.setdefault(r // ranks_per_node, []).append(r)
+            nodes = list(nodes.values())
+            if len(nodes) == 1 or len(nodes) == len(ranks) or \
+                    any(len(node) != len(nodes[0]) for node in nodes):
+                continue
+            for node in nodes:
+                group = torch.distributed.new_group(node)
+                if rank in node:
+                    _DATA_PARALLEL_INTRA_NODE_GROUP = group
+            for i in range(len(nodes[0])):
+                inter_node_ranks = [node[i] for node in nodes]
+                group = torch.distributed.new_group(inter_node_ranks)
+                if rank in inter_node_ranks:
+                    _DATA_PARALLEL_INTER_NODE_GROUP = group
+
     # Build the model-parallel groups.
     global _MODEL_PARALLEL_GROUP
     assert _MODEL_PARALLEL_GROUP is None, \
@@ -205,6 +239,19 @@ def get_data_parallel_group():
     return _DATA_PARALLEL_GROUP
 
 
+def get_data_parallel_intra_node_group():
+    """Get the data parallel ranks on the node of the caller rank, or None
+    without hierarchical data-parallel groups."""
+    return _DATA_PARALLEL_INTRA_NODE_GROUP
+
+
+def get_data_parallel_inter_node_group():
+    """Get the data parallel ranks with the same position as the caller
+    rank on the other nodes, or None without hierarchical data-parallel
+    groups."""
+    return _DATA_PARALLEL_INTER_NODE_GROUP
+
+
 def get_embedding_group():
     """Get the embedding group the caller rank belongs to."""
     assert _EMBEDDING_GROUP is not None, \
@@ -358,3 +405,15 @@ def destroy_model_parallel():
     _PIPELINE_MODEL_PARALLEL_GROUP = None
     global _DATA_PARALLEL_GROUP
     _DATA_PARALLEL_GROUP = None
+    global _DATA_PARALLEL_INTRA_NODE_GROUP
+    _DATA_PARALLEL_INTRA_NODE_GROUP = None
+    global _DATA_PARALLEL_INTER_NODE_GROUP
+    _DATA_PARALLEL_INTER_NODE_GROUP = None
+    global _MODEL_PARALLEL_GROUP
+    _MODEL_PARALLEL_GROUP = None
+    global _EMBEDDING_GROUP
+    _EMBEDDING_GROUP = None
+    global _VIRTUAL_PIPELINE_MODEL_PARALLEL_RANK
+    _VIRTUAL_PIPELINE_MODEL_PARALLEL_RANK = None
+    global _VIRTUAL_PIPELINE_MODEL_PARALLEL_WORLD_SIZE
+    _VIRTUAL_PIPELINE_MODEL_PARALLEL_WORLD_SIZE = None
@@ -110,17 +110,25 @@ def split_tensor_into_1d_equal_chunks(tensor):
     return data[start_index:end_index]
 
 
-def gather_split_1d_tensor(tensor):
-    """Opposite of above function, gather values from model parallel ranks."""
+def gather_split_1d_tensor(tensor, gathered=None, async_op=False):
+    """Opposite of above function, gather values from model parallel ranks.
+    The values are gathered into the 1D tensor `gathered` if given. With
+    async_op, return (gathered, work) where work must be waited on before
+    gathered is used."""
     world_size = get_tensor_model_parallel_world_size()
     numel = torch.numel(tensor)
     numel_gathered = world_size * numel
-    gathered = torch.empty(numel_gathered, dtype=tensor.dtype,
-                           device=torch.cuda.current_device(),
-                           requires_grad=False)
+    if gathered is None:
+        gathered = torch.empty(numel_gathered, dtype=tensor.dtype,
+                               device=torch.cuda.current_device(),
+                               requires_grad=False)
+    assert torch.numel(gathered) == numel_gathered
     chunks = [gathered[i*numel:(i+1)*numel] for i in range(world_size)]
-    torch.distributed.all_gather(chunks, tensor,
-                                 group=get_tensor_model_parallel_group())
+    work = torch.distributed.all_gather(
+        chunks, tensor, group=get_tensor_model_parallel_group(),
+        async_op=async_op)
+    if async_op:
+        return gathered, work
     return gathered
 
 
@@ -13,13 +13,77 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from apex.optimizers import FusedAdam as Adam
+try:
+    from apex.optimizers import FusedAdam
+except ImportError:
+    FusedAdam = None
 
 from megatron import get_args
+from megatron import mpu
 from megatron.model import import_layernorm
 
+from .adafactor import Adafactor
+from .adam import Adam
+from .cpu_adam import CPUAdam
+from .distrib_optimizer import DistributedOptimizer
 from .grad_scaler import ConstantGradScaler, DynamicGradScaler
+from .offload_optimizer import CPUOffloadOptimizer
 from .optimizer import FP16OptimizerWithFP16Params, FP32Optimizer
+from .quantized_adam import QuantizedAdam
+
+
+# Builders of the base optimizers, from the param groups and the arguments,
+# by their --optimizer name.
+_OPTIMIZER_BUILDERS = {}
+
+
+def register_optimizer(name):
+    """Decorator registering a builder of base optimizers as `name`."""
+    def register(builder):
+        assert name not in _OPTIMIZER_BUILDERS, \
+            'optimizer {} is already registered'.format(name)
+        _OPTIMIZER_BUILDERS[name] = builder
+        return builder
+    return register
+
+
+@register_optimizer('adam')
+def _build_adam(param_groups, args):
+    """apex's FusedAdam, or its PyTorch implementation without apex."""
+    optimizer_class = Adam if FusedAdam is None else FusedAdam
+    return optimizer_class(param_groups,
+                           lr=args.lr,
+                           weight_decay=args.weight_decay,
+                           betas=(args.adam_beta1, args.adam_beta2),
+                           eps=args.adam_eps)
+
+
+@register_optimizer('torch_adam')
+def _build_torch_adam(param_groups, args):
+    return Adam(param_groups,
+                lr=args.lr,
+                weight_decay=args.weight_decay,
+                betas=(args.adam_beta1, args.adam_beta2),
+                eps=args.adam_eps)
+
+
+@register_optimizer('adafactor')
+def _build_adafactor(param_groups, args):
+    return Adafactor(param_groups,
+                     lr=args.lr,
+                     weight_decay=args.weight_decay,
+                     beta1=args.adafactor_beta1,
+                     decay_rate=args.adafactor_decay_rate)
+
+
+@register_optimizer('quantized_adam')
+def _build_quantized_adam(param_groups, args):
+    return QuantizedAdam(param_groups,
+                         lr=args.lr,
+                         weight_decay=args.weight_decay,
+                         betas=(args.adam_beta1, args.adam_beta2),
+                         eps=args.adam_eps,
+                         block_size=args.quantized_adam_block_size)
 
 
 def _get_params_for_weight_decay_optimization(modules):
@@ -48,17 +112,49 @@ def _get_params_for_weight_decay_optimization(modules):
     return weight_decay_params, no_weight_decay_params
 
 
+def _get_params_reduced_after_backward(modules):
+    """Params whose grads are all-reduced after the backward pass, besides
+    the data-parallel all-reduce: the word embeddings shared by the first
+    and last pipeline stages."""
+    if mpu.get_pipeline_model_parallel_world_size() == 1:
+        return []
+    stage_modules = []
+    if mpu.is_pipeline_first_stage(ignore_virtual=True):
+        stage_modules.append(modules[0])
+    if mpu.is_pipeline_last_stage(ignore_virtual=True):
+        stage_modules.append(modules[-1])
+    params = []
+    for module in stage_modules:
+        while hasattr(module, 'module'):
+            module = module.module
+        if getattr(module, 'share_word_embeddings', False):
+            params.append(module.word_embeddings_weight())
+    return params
+
+
 def get_megatron_optimizer(model):
     args = get_args()
 
-    # Base optimizer.
+    # Base optimizer, on the CPU with --offload-optimizer-state.
     param_groups = _get_params_for_weight_decay_optimization(model)
-    optimizer = Adam(param_groups,
-                     lr=args.lr,
-                     weight_decay=args.weight_decay,
-                     betas=(args.adam_beta1, args.adam_beta2),
-                     eps=args.adam_eps)
+    if args.offload_optimizer_state:
+        optimizer = CPUAdam(param_groups,
+                            lr=args.lr,
+                            weight_decay=args.weight_decay,
+                            betas=(args.adam_beta1, args.adam_beta2),
+                            eps=args.adam_eps)
+    else:
+        assert args.optimizer in _OPTIMIZER_BUILDERS, \
+            'unknown optimizer {}, expected one of {}'.format(
+                args.optimizer, ', '.join(sorted(_OPTIMIZER_BUILDERS)))
+        optimizer = _OPTIMIZER_BUILDERS[args.optimizer](param_groups, args)
 
+    # PipeDream-2BW keeps two weight versions in the optimizer; PipeDream
+    # weight stashing keeps them in the pipeline schedule.
+    weight_stashing = args.pipeline_no_flushes and \
+        args.pipeline_weight_versions is None
+
+    grad_scaler = None
     if args.fp16:
         # Constant loss scale.
         if args.loss_scale:
@@ -72,10 +168,31 @@ def get_megatron_optimizer(model):
                 backoff_factor=0.5,
                 growth_interval=args.loss_scale_window,
                 hysteresis=args.hysteresis)
+
+    # Optimizer state sharded across data-parallel ranks.
+    if args.use_distributed_optimizer:
+        return DistributedOptimizer(optimizer, grad_scaler, args.clip_grad,
+                                    weight_stashing=weight_stashing,
+                                    clip_grad_on_device=args.clip_grad_on_device)
+
+    # Main params and optimizer state in CPU memory.
+    if args.offload_optimizer_state:
+        return CPUOffloadOptimizer(
+            optimizer, grad_scaler, args.clip_grad,
+            weight_stashing=weight_stashing,
+            chunk_size=args.offload_chunk_size,
+            late_params=_get_params_reduced_after_backward(model))
+
+    if args.fp16:
         # Megatron optimizer.
         return FP16OptimizerWithFP16Params(optimizer, grad_scaler,
                                            args.clip_grad,
-                                           weight_stashing=args.pipeline_no_flushes)
+                                           weight_stashing=weight_stashing,
+                                           contiguous_buffers=args.use_contiguous_buffers,
+                                           fused_grad_copy=args.fused_grad_copy,
+                                           clip_grad_on_device=args.clip_grad_on_device)
 
     # FP32.
-    return FP32Optimizer(optimizer, args.clip_grad)
+    return FP32Optimizer(optimizer, args.clip_grad,
+                         weight_stashing=weight_stashing,
+                         clip_grad_on_device=args.clip_grad_on_device)
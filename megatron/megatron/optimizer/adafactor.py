@@ -0,0 +1,118 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adafactor (Shazeer and Stern, 2018), with the learning rate of the
+learning-rate scheduler.
+
+The second moment of params of two or more dimensions is factored into
+running averages over their rows and over their columns, so that its
+memory is that of a row plus a column instead of that of the param, and
+there is no first moment unless beta1 is given. Params that are flat (as
+the shards of the distributed optimizer) keep a full second moment.
+"""
+
+import torch
+
+
+def _rms(tensor):
+    return tensor.norm(2) / (tensor.numel() ** 0.5)
+
+
+class Adafactor(torch.optim.Optimizer):
+    """Adafactor with an external learning rate: the update of a param is
+    lr times its grad normalized by the factored second moment, clipped to
+    an RMS of at most clip_threshold, and also times the RMS of the param
+    with scale_parameter. The second moment decays by
+    1 - step ** decay_rate. Weight decay is decoupled, as in AdamW."""
+
+    def __init__(self, params, lr=1e-3, eps=(1e-30, 1e-3),
+                 clip_threshold=1.0, decay_rate=-0.8, beta1=None,
+                 weight_decay=0.0, scale_parameter=False):
+        defaults = dict(lr=lr, eps=eps, clip_threshold=clip_threshold,
+                        decay_rate=decay_rate, beta1=beta1,
+                        weight_decay=weight_decay,
+                        scale_parameter=scale_parameter)
+        super(Adafactor, self).__init__(params, defaults)
+
+    @staticmethod
+    def _approx_sq_grad(exp_avg_sq_row, exp_avg_sq_col):
+        """Inverse square root of the second moment from its factors."""
+        row_factor = (exp_avg_sq_row / exp_avg_sq_row.mean(
+            dim=-1, keepdim=True)).rsqrt_().unsqueeze(-1)
+        col_factor = exp_avg_sq_col.unsqueeze(-2).rsqrt()
+        return row_factor * col_factor
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            eps1, eps2 = group['eps']
+            for param in group['params']:
+                if param.grad is None:
+                    continue
+                grad = param.grad.float()
+                factored = grad.dim() >= 2
+                state = self.state[param]
+                if not state:
+                    state['step'] = 0
+                    if group['beta1'] is not None:
+                        state['exp_avg'] = torch.zeros_like(grad)
+                    if factored:
+                        state['exp_avg_sq_row'] = grad.new_zeros(
+                            grad.shape[:-1])
+                        state['exp_avg_sq_col'] = grad.new_zeros(
+                            grad.shape[:-2] + grad.shape[-1:])
+                    else:
+                        state['exp_avg_sq'] = torch.zeros_like(grad)
+                state['step'] += 1
+
+                beta2t = 1.0 - state['step'] ** group['decay_rate']
+                update = grad * grad + eps1
+                if factored:
+                    exp_avg_sq_row = state['exp_avg_sq_row']
+                    exp_avg_sq_col = state['exp_avg_sq_col']
+                    exp_avg_sq_row.mul_(beta2t).add_(
+                        update.mean(dim=-1), alpha=1.0 - beta2t)
+                    exp_avg_sq_col.mul_(beta2t).add_(
+                        update.mean(dim=-2), alpha=1.0 - beta2t)
+                    update = self._approx_sq_grad(exp_avg_sq_row,
+                                                  exp_avg_sq_col)
+                    update.mul_(grad)
+                else:
+                    exp_avg_sq = state['exp_avg_sq']
+                    exp_avg_sq.mul_(beta2t).add_(update, alpha=1.0 - beta2t)
+                    update = exp_avg_sq.rsqrt().mul_(grad)
+
+                # Clipped on the device, without reading the RMS.
+                update.div_((_rms(update) / group['clip_threshold']).clamp_(
+                    min=1.0))
+                lr = group['lr']
+                if group['scale_parameter']:
+                    lr = _rms(param.float()).clamp_(min=eps2) * lr
+                update.mul_(lr)
+
+                if group['beta1'] is not None:
+                    exp_avg = state['exp_avg']
+                    exp_avg.mul_(group['beta1']).add_(
+                        update, alpha=1.0 - group['beta1'])
+                    update = exp_avg
+
+                if group['weight_decay'] != 0.0:
+                    param.mul_(1.0 - group['lr'] * group['weight_decay'])
+                param.sub_(update.to(param.dtype))
+        return loss
@@ -0,0 +1,75 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""PyTorch implementation of apex's FusedAdam, used when apex is not
+installed."""
+
+import math
+
+import torch
+
+
+class Adam(torch.optim.Optimizer):
+    """Adam, or AdamW with adam_w_mode (the default), as apex's FusedAdam,
+    with one set of PyTorch operations per param."""
+
+    def __init__(self, params, lr=1e-3, bias_correction=True,
+                 betas=(0.9, 0.999), eps=1e-8, adam_w_mode=True,
+                 weight_decay=0.):
+        defaults = dict(lr=lr, bias_correction=bias_correction,
+                        betas=betas, eps=eps, weight_decay=weight_decay)
+        super(Adam, self).__init__(params, defaults)
+        self.adam_w_mode = adam_w_mode
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            lr = group['lr']
+            weight_decay = group['weight_decay']
+            for param in group['params']:
+                if param.grad is None:
+                    continue
+                grad = param.grad
+                state = self.state[param]
+                if not state:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(param)
+                    state['exp_avg_sq'] = torch.zeros_like(param)
+                state['step'] += 1
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+
+                if group['bias_correction']:
+                    step_size = lr / (1.0 - beta1 ** state['step'])
+                    bias_correction2_sqrt = math.sqrt(
+                        1.0 - beta2 ** state['step'])
+                else:
+                    step_size = lr
+                    bias_correction2_sqrt = 1.0
+
+                if weight_decay != 0.0 and not self.adam_w_mode:
+                    grad = grad.add(param, alpha=weight_decay)
+                exp_avg.mul_(beta1).add_(grad, alpha=1.0 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1.0 - beta2)
+                denom = exp_avg_sq.sqrt().div_(bias_correction2_sqrt).add_(
+                    group['eps'])
+                if weight_decay != 0.0 and self.adam_w_mode:
+                    param.mul_(1.0 - lr * weight_decay)
+                param.addcdiv_(exp_avg, denom, value=-step_size)
+        return loss
@@ -15,16 +15,17 @@
 
 """Gradient clipping."""
 
-import torch
-from torch._six import inf
+from math import inf
 
-from apex.multi_tensor_apply import multi_tensor_applier
-import amp_C
+import torch
 
 from megatron import mpu
 
+from .multi_tensor import current_device
+from .multi_tensor import multi_tensor_l2norm, multi_tensor_scale
 
-def clip_grad_norm_fp32(parameters, max_norm, norm_type=2):
+
+def clip_grad_norm_fp32(parameters, max_norm, norm_type=2, on_device=False):
     """Clips gradient norm of an iterable of parameters whose gradients
        are in fp32.
 
@@ -38,9 +39,12 @@ def clip_grad_norm_fp32(parameters, max_norm, norm_type=2):
         max_norm (float or int): max norm of the gradients
         norm_type (float or int): type of the used p-norm. Can be ``'inf'`` for
             infinity norm.
+        on_device (bool): compute the norm and the clipping coefficient on
+            the GPU, without reading them on the host.
 
     Returns:
-        Total norm of the parameters (viewed as a single vector).
+        Total norm of the parameters (viewed as a single vector), as a
+        one-element tensor with on_device.
     """
 
     if isinstance(parameters, torch.Tensor):
@@ -57,46 +61,65 @@ def clip_grad_norm_fp32(parameters, max_norm, norm_type=2):
         is_not_shared = not hasattr(param, 'shared') or not param.shared
         is_not_tp_duplicate = param.tensor_model_parallel or \
                               (mpu.get_tensor_model_parallel_rank() == 0)
-        grad = param.grad.detach()
         if grad_not_none:
+            grad = param.grad.detach()
             # Make sure the grads are in fp32
-            assert param.grad.type() == 'torch.cuda.FloatTensor'
+            assert grad.dtype == torch.float
             grads.append(grad)
         if grad_not_none and is_not_shared and is_not_tp_duplicate:
             grads_for_norm.append(grad)
 
+    return clip_grads_fp32(grads, grads_for_norm, max_norm, norm_type,
+                           on_device=on_device)
+
+
+def clip_grads_fp32(grads, grads_for_norm, max_norm, norm_type=2,
+                    on_device=False):
+    """Clips the fp32 tensors `grads` so that the norm of `grads_for_norm`,
+    summed across model-parallel GPUs, is at most max_norm, and returns
+    this norm. The tensors can be flat buffers of several gradients. With
+    on_device, the norm stays a device tensor and the grads are scaled
+    without a host synchronization."""
+
     # Norm parameters.
     max_norm = float(max_norm)
     norm_type = float(norm_type)
-    total_norm = 0.0
+    device = grads_for_norm[0].device if grads_for_norm else current_device()
 
     # Calculate norm.
     if norm_type == inf:
-        total_norm = max(grad.abs().max() for grad in grads_for_norm)
-        total_norm_cuda = torch.cuda.FloatTensor([float(total_norm)])
+        if on_device:
+            total_norm_cuda = torch.zeros(1, device=device)
+            for grad in grads_for_norm:
+                torch.max(total_norm_cuda, grad.abs().max(),
+                          out=total_norm_cuda)
+        else:
+            total_norm = max((grad.abs().max() for grad in grads_for_norm),
+                             default=0.0)
+            total_norm_cuda = torch.tensor([float(total_norm)],
+                                           device=device)
         # Take max across all model-parallel GPUs.
         torch.distributed.all_reduce(total_norm_cuda,
                                      op=torch.distributed.ReduceOp.MAX,
                                      group=mpu.get_model_parallel_group())
-        total_norm = total_norm_cuda[0].item()
+        if on_device:
+            total_norm = total_norm_cuda
+        else:
+            total_norm = total_norm_cuda[0].item()
 
     else:
         if norm_type == 2.0:
-            dummy_overflow_buf = torch.cuda.IntTensor([0])
-            # Use apex's multi-tensor applier for efficiency reasons.
+            # Use apex's multi-tensor applier, if installed, for
+            # efficiency reasons.
             # Multi-tensor applier takes a function and a list of list
             # and performs the operation on that list all in one kernel.
-            grad_norm, _ = multi_tensor_applier(
-                amp_C.multi_tensor_l2norm,
-                dummy_overflow_buf,
-                [grads_for_norm],
-                False # no per-parameter norm
-            )
+            grad_norm = multi_tensor_l2norm(grads_for_norm)
             # Since we will be summing across data parallel groups,
             # we need the pow(norm-type).
             total_norm = grad_norm ** norm_type
 
         else:
+            total_norm = torch.zeros(1, device=device)
             for grad in grads_for_norm:
                 grad_norm = torch.norm(grad, norm_type)
                 total_norm += grad_norm ** norm_type
@@ -105,15 +128,28 @@ def clip_grad_norm_fp32(parameters, max_norm, norm_type=2):
         torch.distributed.all_reduce(total_norm,
                                      op=torch.distributed.ReduceOp.SUM,
                                      group=mpu.get_model_parallel_group())
-        total_norm = total_norm.item() ** (1.0 / norm_type)
+        if on_device:
+            total_norm = total_norm ** (1.0 / norm_type)
+        else:
+            total_norm = total_norm.item() ** (1.0 / norm_type)
 
     # Scale.
-    clip_coeff = max_norm / (total_norm + 1.0e-6)
-    if clip_coeff < 1.0:
-        dummy_overflow_buf = torch.cuda.IntTensor([0])
-        multi_tensor_applier(amp_C.multi_tensor_scale,
-                             dummy_overflow_buf,
-                             [grads, grads],
-                             clip_coeff)
+    clip_grads_to_norm(grads, total_norm, max_norm)
 
     return total_norm
+
+
+def clip_grads_to_norm(grads, total_norm, max_norm):
+    """Scales the fp32 tensors `grads`, whose norm is `total_norm`, so
+    that it is at most max_norm. If `total_norm` is a tensor, the
+    coefficient min(1, max_norm / total_norm) is computed and applied on
+    its device, even when it is 1, so that it is never read on the host."""
+    if torch.is_tensor(total_norm):
+        clip_coeff = torch.clamp(float(max_norm) / (total_norm + 1.0e-6),
+                                 max=1.0)
+        for grad in grads:
+            grad.mul_(clip_coeff)
+        return
+    clip_coeff = float(max_norm) / (total_norm + 1.0e-6)
+    if clip_coeff < 1.0:
+        multi_tensor_scale(grads, grads, clip_coeff)
@@ -0,0 +1,120 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adam for params in CPU memory.
+
+cpu_adam_() updates flat fp32 tensors one block at a time, small enough to
+stay in the CPU caches, with torch's vectorized and multi-threaded in-place
+operations. It can fold an unscaling and clipping factor into the grads,
+which may be fp16, and write the updated params, cast, into another tensor
+(e.g. the pinned buffer they are copied to the GPU from). This module only
+depends on torch, so it can be used and benchmarked on a machine without
+GPUs (tools/benchmark_cpu_adam.py).
+"""
+
+import math
+
+import torch
+
+
+def cpu_adam_(param, grad, exp_avg, exp_avg_sq, step, lr, beta1, beta2, eps,
+              weight_decay, adam_w_mode=True, bias_correction=True,
+              grad_scale=1.0, out=None, workspace=None):
+    """Update the flat fp32 `param`, `exp_avg` and `exp_avg_sq` in place
+    with the flat `grad` times `grad_scale`, for the `step`-th time (from
+    1). The updated param is also copied into `out` if given, which may
+    alias `grad`. `workspace` is an fp32 tensor of shape (2, block size)."""
+    if workspace is None:
+        workspace = torch.empty(2, max(1, min(param.numel(), 2 ** 20)))
+    block_size = workspace.size(1)
+    if bias_correction:
+        step_size = lr / (1.0 - beta1 ** step)
+        bias_correction2_sqrt = math.sqrt(1.0 - beta2 ** step)
+    else:
+        step_size = lr
+        bias_correction2_sqrt = 1.0
+
+    for start in range(0, param.numel(), block_size):
+        end = min(start + block_size, param.numel())
+        p = param[start:end]
+        m = exp_avg[start:end]
+        v = exp_avg_sq[start:end]
+        g = workspace[0, :end - start]
+        denom = workspace[1, :end - start]
+
+        g.copy_(grad[start:end])
+        if grad_scale != 1.0:
+            g.mul_(grad_scale)
+        if weight_decay != 0.0 and not adam_w_mode:
+            g.add_(p, alpha=weight_decay)
+        m.mul_(beta1).add_(g, alpha=1.0 - beta1)
+        v.mul_(beta2).addcmul_(g, g, value=1.0 - beta2)
+        torch.sqrt(v, out=denom)
+        denom.div_(bias_correction2_sqrt).add_(eps)
+        if weight_decay != 0.0 and adam_w_mode:
+            p.mul_(1.0 - lr * weight_decay)
+        p.addcdiv_(m, denom, value=-step_size)
+        if out is not None:
+            out[start:end].copy_(p)
+
+
+class CPUAdam(torch.optim.Optimizer):
+    """Adam, or AdamW with adam_w_mode (the default, as apex's FusedAdam),
+    for contiguous fp32 params in CPU memory."""
+
+    def __init__(self, params, lr=1e-3, bias_correction=True,
+                 betas=(0.9, 0.999), eps=1e-8, adam_w_mode=True,
+                 weight_decay=0., block_size=2 ** 20):
+        defaults = dict(lr=lr, bias_correction=bias_correction,
+                        betas=betas, eps=eps, weight_decay=weight_decay)
+        super(CPUAdam, self).__init__(params, defaults)
+        self.adam_w_mode = adam_w_mode
+        self.block_size = block_size
+        self._workspace = None
+
+    @torch.no_grad()
+    def update(self, param, grad, group, grad_scale=1.0, out=None):
+        """Update `param` of `group` with `grad` times `grad_scale`, and copy
+        it into `out` if given."""
+        assert param.is_contiguous() and grad.is_contiguous()
+        state = self.state[param]
+        if not state:
+            state['step'] = 0
+            state['exp_avg'] = torch.zeros_like(param)
+            state['exp_avg_sq'] = torch.zeros_like(param)
+        state['step'] += 1
+        if self._workspace is None:
+            self._workspace = torch.empty(2, self.block_size)
+        beta1, beta2 = group['betas']
+        cpu_adam_(param.view(-1), grad.view(-1), state['exp_avg'].view(-1),
+                  state['exp_avg_sq'].view(-1), state['step'], group['lr'],
+                  beta1, beta2, group['eps'], group['weight_decay'],
+                  adam_w_mode=self.adam_w_mode,
+                  bias_correction=group['bias_correction'],
+                  grad_scale=grad_scale,
+                  out=None if out is None else out.view(-1),
+                  workspace=self._workspace)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            for param in group['params']:
+                if param.grad is not None:
+                    self.update(param, param.grad, group)
+        return loss
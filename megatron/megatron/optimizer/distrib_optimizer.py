@@ -0,0 +1,385 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Megatron optimizer with its state sharded across data-parallel ranks.
+
+With --use-distributed-optimizer, the params of every param group and dtype
+are laid out in a flat buffer, padded to a multiple of the data-parallel
+size, and every data-parallel rank owns one shard of it: the fp32 main
+params, their grads and the base optimizer state (ZeRO stage 1). A step
+reduce-scatters the model grads into the shards, unscales and clips them,
+steps the shards and all-gathers the updated model params.
+
+With weight stashing (--pipeline-no-flushes), the model params of both
+weight versions are kept in two flat buffers, and the params are switched
+between them by reference. The fp32 main params only hold the newer
+version, which the optimizer steps, so no fp32 copy of the older version
+is needed.
+"""
+
+import math
+
+import torch
+
+from megatron import get_timers
+from megatron import mpu
+
+from .optimizer import MegatronOptimizer
+
+
+def _reduce_scatter(buffer, shards, group):
+    """Sum `buffer` across `group` into the shard of this rank, one of the
+    `shards` that tile it. Gloo has no reduce-scatter, so the whole buffer
+    is all-reduced there."""
+    if torch.distributed.get_backend(group) == 'nccl':
+        rank = torch.distributed.get_rank(group=group)
+        torch.distributed.reduce_scatter(shards[rank], shards, group=group)
+    else:
+        torch.distributed.all_reduce(buffer, group=group)
+
+
+class _Bucket:
+    """The params of one param group and dtype, laid out in flat buffers
+    (one per weight version) of which this rank owns one shard, with the
+    fp32 main param of this shard."""
+
+    def __init__(self, params, num_versions, group):
+        self.params = params
+        self.group = group
+        self.rank = torch.distributed.get_rank(group=group)
+        world_size = torch.distributed.get_world_size(group=group)
+        numel = sum(param.numel() for param in params)
+        self.shard_size = int(math.ceil(numel / world_size))
+        self.start = self.rank * self.shard_size
+
+        def flat_buffer():
+            return torch.zeros(self.shard_size * world_size,
+                               dtype=params[0].dtype,
+                               device=params[0].device)
+
+        # Model params of every version and their grads. The params view
+        # the buffer of `version`.
+        self.buffers = [flat_buffer() for _ in range(num_versions)]
+        self.grad_buffer = flat_buffer()
+        self.views = [[] for _ in self.buffers]
+        offset = 0
+        for param in params:
+            end = offset + param.numel()
+            for buffer, views in zip(self.buffers, self.views):
+                buffer[offset:end].copy_(param.data.view(-1))
+                views.append(buffer[offset:end].view_as(param))
+            param.data = self.views[0][-1]
+            param.grad = self.grad_buffer[offset:end].view_as(param)
+            offset = end
+        self.version = 0
+        self.shards = [list(buffer.split(self.shard_size))
+                       for buffer in self.buffers]
+        self.grad_shards = list(self.grad_buffer.split(self.shard_size))
+
+        # Main param of the shard. fp32 grads are stepped in place in the
+        # grad buffer.
+        self.main_param = self.shards[0][self.rank].detach().clone().float()
+        self.main_param.requires_grad = True
+        if params[0].dtype == torch.float:
+            self.main_param.grad = self.grad_shards[self.rank]
+        else:
+            self.main_param.grad = torch.zeros_like(self.main_param)
+
+        # Slices of the main grad counted in the grad norm: params that are
+        # not shared and not duplicated by tensor model parallelism, with
+        # consecutive ones merged.
+        self.grads_for_norm = []
+        begin, offset = None, 0
+        for param in params:
+            start = max(offset, self.start) - self.start
+            end = min(offset + param.numel(),
+                      self.start + self.shard_size) - self.start
+            offset += param.numel()
+            is_not_shared = not getattr(param, 'shared', False)
+            is_not_tp_duplicate = param.tensor_model_parallel or \
+                (mpu.get_tensor_model_parallel_rank() == 0)
+            if start >= end:
+                continue
+            if is_not_shared and is_not_tp_duplicate:
+                if begin is None:
+                    begin = start
+                last = end
+            elif begin is not None:
+                self.grads_for_norm.append(self.main_param.grad[begin:last])
+                begin = None
+        if begin is not None:
+            self.grads_for_norm.append(self.main_param.grad[begin:last])
+
+    def use(self, version):
+        """Make the params view the buffer of `version`."""
+        if version == self.version:
+            return
+        for param, view in zip(self.params, self.views[version]):
+            param.data = view
+        self.version = version
+
+    def reduce_scatter_grads(self):
+        """Average the grads across the data-parallel group into the main
+        grad of this shard."""
+        self.grad_buffer.div_(
+            torch.distributed.get_world_size(group=self.group))
+        _reduce_scatter(self.grad_buffer, self.grad_shards, self.group)
+        if self.main_param.grad is not self.grad_shards[self.rank]:
+            self.main_param.grad.copy_(self.grad_shards[self.rank])
+
+    def all_gather(self, version):
+        """Gather the shards of `version` from all ranks, this rank's one
+        being its current shard of it."""
+        shards = self.shards[version]
+        torch.distributed.all_gather(shards, shards[self.rank],
+                                     group=self.group)
+
+
+class DistributedOptimizer(MegatronOptimizer):
+    """Steps the shard of the params owned by this data-parallel rank with
+    the base `optimizer`, whose param groups are replaced with the main
+    params of the shards. The grads must not be all-reduced by the DDP
+    wrapper, since step() reduce-scatters them. `grad_scaler` is None for
+    fp32 params."""
+
+    def __init__(self, optimizer, grad_scaler, clip_grad,
+                 weight_stashing=False, clip_grad_on_device=False):
+        super(DistributedOptimizer, self).__init__(optimizer)
+        assert not self.optimizer.state, \
+            'the base optimizer must not have any state yet'
+
+        self.grad_scaler = grad_scaler
+        self.clip_grad = clip_grad
+        self.clip_grad_on_device = clip_grad_on_device
+        self.weight_stashing = weight_stashing
+        self.data_parallel_group = mpu.get_data_parallel_group()
+        self.data_parallel_world_size = torch.distributed.get_world_size(
+            group=self.data_parallel_group)
+
+        # One bucket per param group and dtype, each stepped as a param
+        # group of its own with the options of the original one.
+        num_versions = 2 if self.weight_stashing else 1
+        self.buckets = []
+        param_groups = []
+        for param_group in self.optimizer.param_groups:
+            params_by_dtype = {}
+            for param in param_group['params']:
+                if param.requires_grad:
+                    params_by_dtype.setdefault(param.dtype, []).append(param)
+            for params in params_by_dtype.values():
+                bucket = _Bucket(params, num_versions,
+                                 self.data_parallel_group)
+                self.buckets.append(bucket)
+                param_group = dict(param_group)
+                param_group['params'] = [bucket.main_param]
+                param_groups.append(param_group)
+        self.optimizer.param_groups = param_groups
+
+        device = self.buckets[0].main_param.device
+        self.found_inf = torch.zeros(1, device=device)
+        self._scale = torch.ones(1, device=device)
+
+        # Versions held by the buffers, as indices into bucket.buffers.
+        self.newer = 0
+
+
+    def clip_grad_norm(self, clip_grad):
+        """Clip the main grads of all shards by their global 2-norm."""
+        total_norm = torch.zeros(1, device=self.found_inf.device)
+        for bucket in self.buckets:
+            for grad in bucket.grads_for_norm:
+                total_norm += torch.norm(grad) ** 2
+        torch.distributed.all_reduce(total_norm,
+                                     group=self.data_parallel_group)
+        torch.distributed.all_reduce(total_norm,
+                                     group=mpu.get_model_parallel_group())
+        if self.clip_grad_on_device:
+            total_norm = total_norm.sqrt()
+            clip_coeff = torch.clamp(clip_grad / (total_norm + 1.0e-6),
+                                     max=1.0)
+            for bucket in self.buckets:
+                bucket.main_param.grad.mul_(clip_coeff)
+            return total_norm
+        total_norm = total_norm.item() ** 0.5
+
+        clip_coeff = clip_grad / (total_norm + 1.0e-6)
+        if clip_coeff < 1.0:
+            for bucket in self.buckets:
+                bucket.main_param.grad.mul_(clip_coeff)
+        return total_norm
+
+
+    def zero_grad(self, set_to_none=True):
+        """The grad buffers are zeroed, whatever set_to_none."""
+        for bucket in self.buckets:
+            bucket.grad_buffer.zero_()
+
+
+    def get_loss_scale(self):
+        if self.grad_scaler is None:
+            return self._scale
+        return self.grad_scaler.scale
+
+
+    def _unscale_main_grads_and_check_for_nan(self):
+        self.found_inf.fill_(0.0)
+        inv_scale = self.grad_scaler.inv_scale
+        for bucket in self.buckets:
+            grad = bucket.main_param.grad
+            self.found_inf.copy_(torch.max(
+                self.found_inf, (~torch.isfinite(grad)).any().float()))
+            grad.mul_(inv_scale)
+        # The shards of all data-parallel and model-parallel ranks.
+        torch.distributed.all_reduce(self.found_inf,
+                                     op=torch.distributed.ReduceOp.MAX,
+                                     group=self.data_parallel_group)
+        torch.distributed.all_reduce(self.found_inf,
+                                     op=torch.distributed.ReduceOp.MAX,
+                                     group=mpu.get_model_parallel_group())
+        return self.found_inf.item() > 0
+
+
+    def _use(self, version):
+        for bucket in self.buckets:
+            bucket.use(version)
+
+
+    def _skip_version(self):
+        """Without an update, the microbatches run forward on the newer
+        version in this iteration are run backward on the older one in the
+        next: make both versions the newer one."""
+        for bucket in self.buckets:
+            bucket.buffers[1 - self.newer].copy_(bucket.buffers[self.newer])
+        self.swap_to_older_version()
+
+
+    def swap_to_older_version(self):
+        self._use(1 - self.newer)
+
+
+    def swap_to_newer_version(self):
+        self._use(self.newer)
+
+
+    @torch.no_grad()
+    def step(self):
+
+        timers = get_timers()
+        self.wait_for_grad_syncs()
+
+        # Average the grads across data-parallel ranks into the shards.
+        timers('optimizer-reduce-scatter-grads', log_level=1).start()
+        for bucket in self.buckets:
+            bucket.reduce_scatter_grads()
+        timers('optimizer-reduce-scatter-grads').stop()
+
+        if self.grad_scaler is not None:
+            # Unscale and check for inf/nan.
+            timers('optimizer-unscale-and-check-inf', log_level=1).start()
+            found_inf_flag = self._unscale_main_grads_and_check_for_nan()
+            timers('optimizer-unscale-and-check-inf').stop()
+
+            # We are done with scaling gradients
+            # so we can update the loss scale.
+            self.grad_scaler.update(found_inf_flag)
+
+            # If we found inf/nan, skip the update.
+            if found_inf_flag:
+                if self.weight_stashing:
+                    self._skip_version()
+                return False
+
+        # Clip the main gradients.
+        if self.clip_grad > 0.0:
+            timers('optimizer-clip-main-grad', log_level=1).start()
+            self.grad_norm = self.clip_grad_norm(self.clip_grad)
+            timers('optimizer-clip-main-grad').stop()
+
+        # Step the shards.
+        self.optimizer.step()
+
+        # Gather the updated params. With weight stashing, they overwrite
+        # the older version, which is no longer needed, and the newer
+        # version becomes the older one, which the params hold.
+        timers('optimizer-all-gather-params', log_level=1).start()
+        if self.weight_stashing:
+            self.newer = 1 - self.newer
+        for bucket in self.buckets:
+            bucket.shards[self.newer][bucket.rank].copy_(bucket.main_param)
+            bucket.all_gather(self.newer)
+        if self.weight_stashing:
+            self.swap_to_older_version()
+        timers('optimizer-all-gather-params').stop()
+
+        # Successful update.
+        return True
+
+
+    def reload_model_params(self):
+        for bucket in self.buckets:
+            current = bucket.buffers[bucket.version]
+            bucket.main_param.data.copy_(
+                bucket.shards[bucket.version][bucket.rank])
+            for buffer in bucket.buffers:
+                if buffer is not current:
+                    buffer.copy_(current)
+
+
+    def state_dict(self):
+        """The state of the shards of this rank. With weight stashing, also
+        this rank's shard of the version the params do not hold, since the
+        model checkpoint only has the other one."""
+        state_dict = {}
+        state_dict['optimizer'] = self.optimizer.state_dict()
+        if self.grad_scaler is not None:
+            state_dict['grad_scaler'] = self.grad_scaler.state_dict()
+        state_dict['data_parallel_size'] = self.data_parallel_world_size
+        state_dict['main_params'] = [bucket.main_param
+                                     for bucket in self.buckets]
+        if self.weight_stashing:
+            state_dict['params_version'] = \
+                'newer' if self.buckets[0].version == self.newer else 'older'
+            state_dict['stashed_params'] = [
+                bucket.shards[1 - bucket.version][bucket.rank].clone()
+                for bucket in self.buckets]
+        return state_dict
+
+
+    def load_state_dict(self, state_dict):
+        """Must be called after the model params are loaded."""
+        assert state_dict['data_parallel_size'] == \
+            self.data_parallel_world_size, \
+            'the distributed optimizer must be loaded with the ' \
+            'data-parallel size it was saved with'
+        self.optimizer.load_state_dict(state_dict['optimizer'])
+        if self.grad_scaler is not None:
+            self.grad_scaler.load_state_dict(state_dict['grad_scaler'])
+        for bucket, main_param in zip(self.buckets,
+                                      state_dict['main_params']):
+            bucket.main_param.data.copy_(main_param)
+
+        if self.weight_stashing:
+            # The params were loaded with the version they held when
+            # saved; gather the other one from the stashed shards.
+            for bucket, stashed in zip(self.buckets,
+                                       state_dict['stashed_params']):
+                other = 1 - bucket.version
+                bucket.shards[other][bucket.rank].copy_(stashed)
+                bucket.all_gather(other)
+            version = self.buckets[0].version
+            if state_dict['params_version'] == 'newer':
+                self.newer = version
+            else:
+                self.newer = 1 - version
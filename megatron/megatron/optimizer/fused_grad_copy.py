@@ -0,0 +1,76 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Copy of the model grads to the main grads fused with their unscaling,
+inf/nan check and squared norm (--fused-grad-copy).
+
+The flat grads are split into tiles, each marked as counted in the norm or
+not, so that one kernel (fused_kernels/fused_grad_copy_cuda.cu) reads every
+grad once. It accumulates into an fp32 `stats` tensor of two elements, the
+inf/nan flag and the sum of squares, which the optimizer all-reduces once
+over the model-parallel group. copy_unscale_and_norm_reference() computes
+the same with torch operations, on any device.
+"""
+
+import torch
+
+
+# Elements of a tile, processed by one block of the kernel.
+TILE_SIZE = 2 ** 14
+
+
+def build_tiles(counted_ranges, numel, device, tile_size=TILE_SIZE):
+    """Table of (start, end, counted) of the tiles, of at most `tile_size`
+    elements, covering [0, numel); a tile is counted if it lies in one of
+    the sorted and disjoint [start, end) `counted_ranges`."""
+    boundaries = [(0, False)]
+    for start, end in counted_ranges:
+        boundaries.append((start, True))
+        boundaries.append((end, False))
+    boundaries.append((numel, False))
+    tiles = []
+    for (start, counted), (end, _) in zip(boundaries[:-1], boundaries[1:]):
+        for tile_start in range(start, end, tile_size):
+            tiles.append((tile_start, min(tile_start + tile_size, end),
+                          int(counted)))
+    return torch.tensor(tiles, dtype=torch.long,
+                        device=device).view(-1, 3)
+
+
+def copy_unscale_and_norm(model_grads, main_grads, inv_scale, tiles, stats):
+    """main_grads = model_grads * inv_scale for flat grads (model_grads may
+    be main_grads), setting stats[0] to 1 if any is inf or nan and adding
+    the sum of squares of the counted tiles to stats[1]. `inv_scale` is a
+    one-element fp32 tensor, so that the loss scale is not read on the
+    host."""
+    if model_grads.is_cuda:
+        import fused_grad_copy_cuda
+        fused_grad_copy_cuda.copy_unscale_norm(model_grads, main_grads,
+                                               inv_scale, tiles, stats)
+    else:
+        copy_unscale_and_norm_reference(model_grads, main_grads, inv_scale,
+                                        tiles, stats)
+
+
+def copy_unscale_and_norm_reference(model_grads, main_grads, inv_scale,
+                                    tiles, stats):
+    """Reference implementation of copy_unscale_and_norm()."""
+    for start, end, counted in tiles.tolist():
+        grads = model_grads[start:end].float() * inv_scale
+        if not torch.isfinite(grads).all():
+            stats[0] = 1.0
+        main_grads[start:end].copy_(grads)
+        if counted:
+            stats[1] += grads.dot(grads)
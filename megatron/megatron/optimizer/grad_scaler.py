@@ -27,6 +27,9 @@ class MegatronGradScaler(ABC):
         """Initialize scale value with the input initial scale."""
         assert initial_scale > 0.0
         self._scale = torch.cuda.FloatTensor([initial_scale])
+        # Copy of the scale on the host, updated with the same fp32 ops,
+        # for kernels that take the inverse scale as an argument.
+        self._host_scale = torch.FloatTensor([initial_scale])
 
     @property
     def scale(self):
@@ -36,6 +39,11 @@ class MegatronGradScaler(ABC):
     def inv_scale(self):
         return self._scale.double().reciprocal().float()
 
+    @property
+    def inv_scale_value(self):
+        """The inverse scale as a Python float, without a device sync."""
+        return self._host_scale.double().reciprocal().float().item()
+
     @abstractmethod
     def update(self, found_inf):
         pass
@@ -76,12 +84,15 @@ class DynamicGradScaler(MegatronGradScaler):
         assert min_scale > 0.0
         assert min_scale <= initial_scale
         self.min_scale = torch.cuda.FloatTensor([min_scale])
+        self._host_min_scale = torch.FloatTensor([min_scale])
         # Growth and backoff factors for the scale.
         assert growth_factor > 1.0
         self.growth_factor = torch.cuda.FloatTensor([growth_factor])
+        self._host_growth_factor = torch.FloatTensor([growth_factor])
         assert backoff_factor < 1.0
         assert backoff_factor > 0.0
         self.backoff_factor = torch.cuda.FloatTensor([backoff_factor])
+        self._host_backoff_factor = torch.FloatTensor([backoff_factor])
         # Interval over which if we don't see any inf/nan,
         # we will scale the grad scale by the growth factor.
         assert growth_interval > 0
@@ -107,6 +118,9 @@ class DynamicGradScaler(MegatronGradScaler):
             if self._hysteresis_tracker <= 0:
                 self._scale = torch.max(self._scale * self.backoff_factor,
                                         self.min_scale)
+                self._host_scale = torch.max(
+                    self._host_scale * self._host_backoff_factor,
+                    self._host_min_scale)
         else:
             # If there is no nan/inf, increment the growth tracker.
             self._growth_tracker += 1
@@ -117,6 +131,7 @@ class DynamicGradScaler(MegatronGradScaler):
                 self._hysteresis_tracker = self.hysteresis
                 # and scale up the loss scale.
                 self._scale = self._scale * self.growth_factor
+                self._host_scale = self._host_scale * self._host_growth_factor
 
 
     def state_dict(self):
@@ -129,5 +144,6 @@ class DynamicGradScaler(MegatronGradScaler):
 
     def load_state_dict(self, state_dict):
         self._scale = state_dict['scale'].cuda(torch.cuda.current_device())
+        self._host_scale = state_dict['scale'].cpu()
         self._growth_tracker = state_dict['growth_tracker']
         self._hysteresis_tracker = state_dict['hysteresis_tracker']
@@ -0,0 +1,68 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Multi-tensor operations, with apex's fused kernels if apex is installed
+and with PyTorch operations otherwise (e.g. on a CPU-only machine)."""
+
+import torch
+
+try:
+    from apex.multi_tensor_apply import multi_tensor_applier
+    import amp_C
+except ImportError:
+    multi_tensor_applier = None
+
+
+def _use_apex(tensors):
+    return multi_tensor_applier is not None and tensors[0].is_cuda
+
+
+def multi_tensor_scale(this, that, scale, overflow_buf=None):
+    """that = this * scale for lists of tensors, setting overflow_buf to a
+    non-zero value if any result is inf or nan."""
+    if not this:
+        return
+    if _use_apex(this):
+        if overflow_buf is None:
+            overflow_buf = torch.cuda.IntTensor([0])
+        multi_tensor_applier(amp_C.multi_tensor_scale, overflow_buf,
+                             [this, that], scale)
+        return
+    for this_, that_ in zip(this, that):
+        torch.mul(this_, scale, out=that_)
+        if overflow_buf is not None:
+            overflow_buf.masked_fill_(~torch.isfinite(that_).all(), 1)
+
+
+def current_device():
+    """The current GPU, or the CPU without one."""
+    if torch.cuda.is_available():
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def multi_tensor_l2norm(tensors):
+    """2-norm of all `tensors`, as a one-element fp32 tensor on their
+    device (the current one if there are none)."""
+    if not tensors:
+        return torch.zeros(1, device=current_device())
+    if _use_apex(tensors):
+        norm, _ = multi_tensor_applier(amp_C.multi_tensor_l2norm,
+                                       torch.cuda.IntTensor([0]),
+                                       [tensors],
+                                       False) # no per-parameter norm
+        return norm
+    return torch.norm(torch.stack([torch.norm(tensor.float())
+                                   for tensor in tensors])).view(1)
@@ -0,0 +1,390 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Megatron optimizer with the main params and optimizer state in CPU memory.
+
+With --offload-optimizer-state, the model params and grads of every param
+group and dtype stay on the GPU in flat buffers, while the fp32 main params
+and the Adam state live in CPU memory and are stepped by CPUAdam, one chunk
+at a time. The grads are copied into a pinned buffer on a side stream as
+soon as the last microbatch has accumulated them, overlapping with the rest
+of the backward pass, and every updated chunk of params is copied back
+while the CPU steps the next one.
+
+With weight stashing (--pipeline-no-flushes), the model params of both
+weight versions are kept in two flat buffers on the GPU and switched by
+reference, so no fp32 copy of the older version is needed.
+
+Without a GPU (e.g. in tests), the "device" buffers are in CPU memory too
+and the copies are synchronous.
+"""
+
+import contextlib
+import math
+
+import torch
+
+from megatron import get_num_microbatches
+from megatron import get_timers
+from megatron import mpu
+
+from .multi_tensor import current_device
+from .optimizer import MegatronOptimizer
+
+
+def _on_stream(stream):
+    """Context running on the CUDA `stream`, or on the current one if it is
+    None (without a GPU)."""
+    if stream is None:
+        return contextlib.nullcontext()
+    return torch.cuda.stream(stream)
+
+
+def _sum_of_squares(tensor, workspace):
+    """Sum of the squares of the flat `tensor`, in fp32 blocks of the size
+    of the flat `workspace`."""
+    total = 0.0
+    for start in range(0, tensor.numel(), workspace.numel()):
+        block = tensor[start:start + workspace.numel()]
+        scratch = workspace[:block.numel()]
+        scratch.copy_(block)
+        total += torch.dot(scratch, scratch).item()
+    return total
+
+
+class _OffloadBucket:
+    """The params of one param group and dtype in flat GPU buffers (one per
+    weight version), their fp32 main param in CPU memory and the pinned
+    buffer the grads and updated params are transferred through, all split
+    into chunks of `chunk_size` elements."""
+
+    def __init__(self, params, num_versions, chunk_size):
+        self.params = params
+        numel = sum(param.numel() for param in params)
+
+        def flat_buffer():
+            return torch.zeros(numel, dtype=params[0].dtype,
+                               device=current_device())
+
+        # Model params of every version and their grads. The params view
+        # the buffer of `version`.
+        self.buffers = [flat_buffer() for _ in range(num_versions)]
+        self.grad_buffer = flat_buffer()
+        self.views = [[] for _ in self.buffers]
+        self.ranges = []
+        offset = 0
+        for param in params:
+            end = offset + param.numel()
+            for buffer, views in zip(self.buffers, self.views):
+                buffer[offset:end].copy_(param.data.view(-1))
+                views.append(buffer[offset:end].view_as(param))
+            param.data = self.views[0][-1]
+            param.grad = self.grad_buffer[offset:end].view_as(param)
+            self.ranges.append((offset, end))
+            offset = end
+        self.version = 0
+
+        self.transfer_buffer = torch.empty(
+            numel, dtype=params[0].dtype,
+            pin_memory=torch.cuda.is_available())
+        self.main_param = self.buffers[0].to('cpu', torch.float, copy=True)
+        self.main_chunks = list(self.main_param.split(chunk_size))
+        self.transfer_chunks = list(self.transfer_buffer.split(chunk_size))
+        self.buffer_chunks = [list(buffer.split(chunk_size))
+                              for buffer in self.buffers]
+
+        # Slices of the transferred grads counted in the grad norm: params
+        # that are not shared and not duplicated by tensor model
+        # parallelism, with consecutive ones merged.
+        self.grads_for_norm = []
+        start = None
+        for param, (begin, end) in zip(params, self.ranges):
+            is_not_shared = not getattr(param, 'shared', False)
+            is_not_tp_duplicate = param.tensor_model_parallel or \
+                (mpu.get_tensor_model_parallel_rank() == 0)
+            if is_not_shared and is_not_tp_duplicate:
+                if start is None:
+                    start = begin
+                last = end
+            elif start is not None:
+                self.grads_for_norm.append(self.transfer_buffer[start:last])
+                start = None
+        if start is not None:
+            self.grads_for_norm.append(self.transfer_buffer[start:last])
+
+        # Number of backward passes that accumulated into every grad, and
+        # whether it was copied to the transfer buffer.
+        self.backward_counts = [0] * len(params)
+        self.offloaded = [False] * len(params)
+
+    def use(self, version):
+        """Make the params view the buffer of `version`."""
+        if version == self.version:
+            return
+        for param, view in zip(self.params, self.views[version]):
+            param.data = view
+        self.version = version
+
+    def offload_grad(self, index, stream):
+        """Copy the grad of the index-th param to the transfer buffer on
+        `stream`, once the work queued so far on the current stream is
+        done."""
+        start, end = self.ranges[index]
+        if stream is not None:
+            stream.wait_stream(torch.cuda.current_stream())
+        with _on_stream(stream):
+            self.transfer_buffer[start:end].copy_(
+                self.grad_buffer[start:end], non_blocking=True)
+        self.offloaded[index] = True
+
+    def offload_remaining_grads(self, stream):
+        if not any(self.offloaded):
+            if stream is not None:
+                stream.wait_stream(torch.cuda.current_stream())
+            with _on_stream(stream):
+                self.transfer_buffer.copy_(self.grad_buffer,
+                                           non_blocking=True)
+            return
+        for index, offloaded in enumerate(self.offloaded):
+            if not offloaded:
+                self.offload_grad(index, stream)
+
+
+class CPUOffloadOptimizer(MegatronOptimizer):
+    """Steps the main params, in CPU memory, with the base `optimizer`, a
+    CPUAdam whose param groups are replaced with the chunks of the main
+    params. The grads of `late_params` are only copied to the CPU in
+    step(), since they are all-reduced after the backward pass (e.g. the
+    word embeddings shared by the first and last pipeline stages), as are
+    all grads with data parallelism. `grad_scaler` is None for fp32
+    params."""
+
+    def __init__(self, optimizer, grad_scaler, clip_grad,
+                 weight_stashing=False, chunk_size=2 ** 22, late_params=()):
+        super(CPUOffloadOptimizer, self).__init__(optimizer)
+        assert not self.optimizer.state, \
+            'the base optimizer must not have any state yet'
+
+        self.grad_scaler = grad_scaler
+        self.clip_grad = clip_grad
+        self.weight_stashing = weight_stashing
+        self.copy_stream = torch.cuda.Stream() \
+            if torch.cuda.is_available() else None
+        self._scale = torch.ones(1, device=current_device())
+        self._norm_workspace = torch.empty(2 ** 20)
+
+        # One bucket per param group and dtype, each stepped as a param
+        # group of its own with the options of the original one.
+        num_versions = 2 if self.weight_stashing else 1
+        self.buckets = []
+        param_groups = []
+        for param_group in self.optimizer.param_groups:
+            params_by_dtype = {}
+            for param in param_group['params']:
+                if param.requires_grad:
+                    params_by_dtype.setdefault(param.dtype, []).append(param)
+            for params in params_by_dtype.values():
+                bucket = _OffloadBucket(params, num_versions, chunk_size)
+                self.buckets.append(bucket)
+                param_group = dict(param_group)
+                param_group['params'] = bucket.main_chunks
+                param_groups.append(param_group)
+        self.optimizer.param_groups = param_groups
+
+        # Versions held by the buffers, as indices into bucket.buffers.
+        self.newer = 0
+
+        # Copy grads as soon as they are final, unless they are all-reduced
+        # after the backward pass.
+        self._grad_accumulators = []
+        if mpu.get_data_parallel_world_size() == 1:
+            late_params = set(late_params)
+            for bucket in self.buckets:
+                for index, param in enumerate(bucket.params):
+                    if param not in late_params:
+                        self._register_grad_hook(bucket, index)
+
+
+    def _register_grad_hook(self, bucket, index):
+        param = bucket.params[index]
+        grad_accumulator = param.expand_as(param).grad_fn.next_functions[0][0]
+
+        def hook(*unused):
+            bucket.backward_counts[index] += 1
+            if bucket.backward_counts[index] == get_num_microbatches():
+                bucket.offload_grad(index, self.copy_stream)
+
+        grad_accumulator.register_hook(hook)
+        # The accumulator must outlive this function for the hook to run.
+        self._grad_accumulators.append(grad_accumulator)
+
+
+    def zero_grad(self, set_to_none=True):
+        """The grad buffers are zeroed, whatever set_to_none."""
+        for bucket in self.buckets:
+            bucket.grad_buffer.zero_()
+            bucket.backward_counts = [0] * len(bucket.params)
+            bucket.offloaded = [False] * len(bucket.params)
+
+
+    def get_loss_scale(self):
+        if self.grad_scaler is None:
+            return self._scale
+        return self.grad_scaler.scale
+
+
+    def _use(self, version):
+        for bucket in self.buckets:
+            bucket.use(version)
+
+
+    def _skip_version(self):
+        """Without an update, the microbatches run forward on the newer
+        version in this iteration are run backward on the older one in the
+        next: make both versions the newer one."""
+        for bucket in self.buckets:
+            bucket.buffers[1 - self.newer].copy_(bucket.buffers[self.newer])
+        self.swap_to_older_version()
+
+
+    def swap_to_older_version(self):
+        self._use(1 - self.newer)
+
+
+    def swap_to_newer_version(self):
+        self._use(self.newer)
+
+
+    def _grad_norm(self):
+        """Norm of the transferred grads, still scaled, across
+        model-parallel ranks; inf or nan if any of them is."""
+        total_norm = 0.0
+        for bucket in self.buckets:
+            for grad in bucket.grads_for_norm:
+                total_norm += _sum_of_squares(grad, self._norm_workspace)
+        total_norm = torch.tensor([total_norm], device=current_device())
+        torch.distributed.all_reduce(total_norm,
+                                     group=mpu.get_model_parallel_group())
+        return total_norm.item() ** 0.5
+
+
+    @torch.no_grad()
+    def step(self):
+
+        timers = get_timers()
+        self.wait_for_grad_syncs()
+
+        # Wait for the grads, and for the backward pass to be done with
+        # the params overwritten below.
+        timers('optimizer-offload-grads', log_level=1).start()
+        for bucket in self.buckets:
+            bucket.offload_remaining_grads(self.copy_stream)
+        if self.copy_stream is not None:
+            self.copy_stream.wait_stream(torch.cuda.current_stream())
+            self.copy_stream.synchronize()
+        timers('optimizer-offload-grads').stop()
+
+        # Unscaling and clipping are folded into the step of the grads.
+        grad_scale = 1.0
+        if self.grad_scaler is not None or self.clip_grad > 0.0:
+            timers('optimizer-clip-main-grad', log_level=1).start()
+            grad_norm = self._grad_norm()
+            timers('optimizer-clip-main-grad').stop()
+            if self.grad_scaler is not None:
+                found_inf_flag = not math.isfinite(grad_norm)
+                self.grad_scaler.update(found_inf_flag)
+                if found_inf_flag:
+                    if self.weight_stashing:
+                        self._skip_version()
+                    return False
+                grad_scale = self.grad_scaler.inv_scale_value
+            if self.clip_grad > 0.0:
+                self.grad_norm = grad_norm * grad_scale
+                clip_coeff = self.clip_grad / (grad_norm * grad_scale + 1.0e-6)
+                if clip_coeff < 1.0:
+                    grad_scale *= clip_coeff
+
+        # Step every chunk on the CPU and copy it back while the next one
+        # is stepped. With weight stashing, the updated params overwrite
+        # the older version, which is no longer needed, and the newer
+        # version becomes the older one, which the params hold.
+        timers('optimizer-cpu-step', log_level=1).start()
+        if self.weight_stashing:
+            self.newer = 1 - self.newer
+        for bucket, group in zip(self.buckets, self.optimizer.param_groups):
+            for main, transfer, chunk in zip(
+                    bucket.main_chunks, bucket.transfer_chunks,
+                    bucket.buffer_chunks[self.newer]):
+                self.optimizer.update(main, transfer, group,
+                                      grad_scale=grad_scale, out=transfer)
+                with _on_stream(self.copy_stream):
+                    chunk.copy_(transfer, non_blocking=True)
+        if self.copy_stream is not None:
+            torch.cuda.current_stream().wait_stream(self.copy_stream)
+        if self.weight_stashing:
+            self.swap_to_older_version()
+        timers('optimizer-cpu-step').stop()
+
+        # Successful update.
+        return True
+
+
+    def reload_model_params(self):
+        for bucket in self.buckets:
+            current = bucket.buffers[bucket.version]
+            bucket.main_param.copy_(current)
+            for buffer in bucket.buffers:
+                if buffer is not current:
+                    buffer.copy_(current)
+
+
+    def state_dict(self):
+        """With weight stashing, also the version the params do not hold,
+        since the model checkpoint only has the other one."""
+        state_dict = {}
+        state_dict['optimizer'] = self.optimizer.state_dict()
+        if self.grad_scaler is not None:
+            state_dict['grad_scaler'] = self.grad_scaler.state_dict()
+        state_dict['main_params'] = [bucket.main_param
+                                     for bucket in self.buckets]
+        if self.weight_stashing:
+            state_dict['params_version'] = \
+                'newer' if self.buckets[0].version == self.newer else 'older'
+            state_dict['stashed_params'] = [
+                bucket.buffers[1 - bucket.version].cpu()
+                for bucket in self.buckets]
+        return state_dict
+
+
+    def load_state_dict(self, state_dict):
+        """Must be called after the model params are loaded."""
+        self.optimizer.load_state_dict(state_dict['optimizer'])
+        if self.grad_scaler is not None:
+            self.grad_scaler.load_state_dict(state_dict['grad_scaler'])
+        for bucket, main_param in zip(self.buckets,
+                                      state_dict['main_params']):
+            bucket.main_param.copy_(main_param)
+
+        if self.weight_stashing:
+            # The params were loaded with the version they held when
+            # saved; the other one is in the checkpoint.
+            for bucket, stashed in zip(self.buckets,
+                                       state_dict['stashed_params']):
+                bucket.buffers[1 - bucket.version].copy_(stashed)
+            version = self.buckets[0].version
+            if state_dict['params_version'] == 'newer':
+                self.newer = version
+            else:
+                self.newer = 1 - version
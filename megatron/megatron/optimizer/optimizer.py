@@ -20,14 +20,14 @@ from abc import abstractmethod
 
 import torch
 
-from apex.multi_tensor_apply import multi_tensor_applier
-import amp_C
-
 from megatron import get_timers
 from megatron import mpu
 from megatron import print_rank_0
 
-from .clip_grads import clip_grad_norm_fp32
+from .clip_grads import clip_grad_norm_fp32, clip_grads_fp32
+from .clip_grads import clip_grads_to_norm
+from .fused_grad_copy import build_tiles, copy_unscale_and_norm
+from .multi_tensor import current_device, multi_tensor_scale
 
 
 def _zero_grad_group_helper(group, set_to_none):
@@ -49,13 +49,74 @@ def _multi_tensor_copy_this_to_that(this, that, overflow_buf=None):
     """Use multi-tensor-applier to copy values from one list to another."""
     if overflow_buf:
         overflow_buf.fill_(0)
-    else:
-        overflow_buf = torch.cuda.IntTensor([0])
     # Scaling with factor `1.0` is equivalent to copy.
-    multi_tensor_applier(amp_C.multi_tensor_scale,
-                         overflow_buf,
-                         [this, that],
-                         1.0)
+    multi_tensor_scale(this, that, 1.0, overflow_buf=overflow_buf)
+
+
+def _flatten_into_buffer(tensors, copy=True):
+    """Allocate one flat buffer for `tensors`, which share a dtype, and make
+    each of them a view of it, in order. Their values are kept if `copy`."""
+    numel = sum(tensor.numel() for tensor in tensors)
+    buffer = torch.zeros(numel, dtype=tensors[0].dtype,
+                         device=torch.cuda.current_device())
+    offset = 0
+    for tensor in tensors:
+        view = buffer[offset:offset + tensor.numel()].view_as(tensor)
+        if copy:
+            view.copy_(tensor.data)
+        tensor.data = view
+        offset += tensor.numel()
+    return buffer
+
+
+def _grad_buffer(params):
+    """Allocate one flat buffer for the gradients of `params` and make their
+    .grad views of it, in order."""
+    buffer = torch.zeros(sum(param.numel() for param in params),
+                         dtype=params[0].dtype,
+                         device=torch.cuda.current_device())
+    offset = 0
+    for param in params:
+        param.grad = buffer[offset:offset + param.numel()].view_as(param)
+        offset += param.numel()
+    return buffer
+
+
+class _TwoVersionParams:
+    """Two weight versions of params that the optimizer steps directly.
+    The params hold the version named by `version` ('older' or 'newer') and
+    the stashed tensors the other one; switching versions exchanges
+    references, without copies. With `buffers`, the params and the stashed
+    tensors are views of these two flat buffers."""
+
+    def __init__(self, params, stashed, overflow_buf, buffers=None):
+        self.params = params
+        self.stashed = stashed
+        self.overflow_buf = overflow_buf
+        self.buffers = buffers
+        self.version = 'older'
+
+    def use(self, version):
+        """Make the params hold `version`."""
+        if version == self.version:
+            return
+        for param, stashed in zip(self.params, self.stashed):
+            param.data, stashed.data = stashed.data, param.data
+        if self.buffers is not None:
+            self.buffers = self.buffers[::-1]
+        self.version = version
+
+    def stash(self):
+        """Before the optimizer step, overwrite the older version, which is
+        no longer needed, with the newer one, which the step then updates
+        in the params."""
+        self.use('newer')
+        if self.buffers is not None:
+            self.buffers[1].copy_(self.buffers[0])
+        elif self.params:
+            _multi_tensor_copy_this_to_that(this=self.params,
+                                            that=self.stashed,
+                                            overflow_buf=self.overflow_buf)
 
 
 class MegatronOptimizer(ABC):
@@ -64,13 +125,45 @@ class MegatronOptimizer(ABC):
         """Input optimizer is the base optimizer for example Adam."""
         self.optimizer = optimizer
         assert self.optimizer, 'no optimizer is provided.'
+        # Clip the grads without reading their norm on the host.
+        self.clip_grad_on_device = False
+        # Norm of the grads at the last clipping.
+        self.grad_norm = None
+        # Handles of the asynchronous grad all-reduces that step() waits
+        # for.
+        self._grad_syncs = []
 
     def clip_grad_norm(self, clip_grad):
         params = []
         for param_group in self.optimizer.param_groups:
             for param in param_group['params']:
                 params.append(param)
-        clip_grad_norm_fp32(params, clip_grad)
+        return clip_grad_norm_fp32(params, clip_grad,
+                                   on_device=self.clip_grad_on_device)
+
+    def add_grad_sync(self, handle):
+        """Make the next wait_for_grad_syncs() or step() wait for `handle`,
+        of an asynchronous all-reduce of grads started after the backward
+        passes (e.g. of the word embeddings shared by the first and last
+        pipeline stages)."""
+        self._grad_syncs.append(handle)
+
+    def wait_for_grad_syncs(self):
+        """Wait for the grad all-reduces added by add_grad_sync(), before
+        the grads are all-reduced across data-parallel ranks or used."""
+        if not self._grad_syncs:
+            return
+        timers = get_timers()
+        timers('backward-embedding-all-reduce', log_level=1).start()
+        for handle in self._grad_syncs:
+            handle.wait()
+        self._grad_syncs = []
+        timers('backward-embedding-all-reduce').stop()
+
+    def get_grad_norm(self):
+        """Norm of the grads at the last clipping, or None. A device tensor
+        with clip_grad_on_device, only to be read on logging iterations."""
+        return self.grad_norm
 
     @abstractmethod
     def zero_grad(self, set_to_none=True):
@@ -131,12 +224,21 @@ class MegatronOptimizer(ABC):
 
 class FP16OptimizerWithFP16Params(MegatronOptimizer):
 
-    def __init__(self, optimizer, grad_scaler, clip_grad, weight_stashing=False):
+    def __init__(self, optimizer, grad_scaler, clip_grad, weight_stashing=False,
+                 contiguous_buffers=False, fused_grad_copy=False,
+                 clip_grad_on_device=False):
         super(FP16OptimizerWithFP16Params, self).__init__(optimizer)
 
         self.grad_scaler = grad_scaler
         self.clip_grad = clip_grad
+        self.clip_grad_on_device = clip_grad_on_device
         self.weight_stashing = weight_stashing
+        self.contiguous_buffers = contiguous_buffers
+        # Copy, unscale, check and compute the norm of the grads in one
+        # pass over the contiguous buffers.
+        self.fused_grad_copy = fused_grad_copy
+        assert contiguous_buffers or not fused_grad_copy, \
+            'the fused grad copy requires contiguous buffers'
 
         # Tensor used to determine if a nan/if has happend.
         # Any non-zero value indicates inf/nan.
@@ -145,6 +247,14 @@ class FP16OptimizerWithFP16Params(MegatronOptimizer):
         # Dummy tensor needed for apex multi-apply tensor.
         self._dummy_overflow_buf = torch.cuda.IntTensor([0])
 
+        # Set by the copy of the grads if any is inf or nan.
+        self._overflow_buf = torch.cuda.IntTensor([0])
+
+        # Inf/nan flag and sum of squares of the grads, accumulated by the
+        # fused grad copy and all-reduced together.
+        self._grad_stats = torch.cuda.FloatTensor([0.0, 0.0])
+        self._grad_norm = None
+
         # ======================
         # main parameter stuff
         # ======================
@@ -153,6 +263,11 @@ class FP16OptimizerWithFP16Params(MegatronOptimizer):
         #   fp16_groups: original fp16 parameters
         #   fp32_from_fp16_groups: fp32 copy of fp16 parameters
         #   fp32_from_fp32_groups: original fp32 parameters
+        # With weight stashing, two versions of the weights are kept: the
+        # newer one in fp32_from_fp16_groups (stepped by the optimizer) and
+        # the older one in fp32_from_fp16_groups_copy. The fp32 parameters
+        # and fp32_from_fp32_groups_copy hold one version each, exchanged
+        # by reference when the model switches versions.
         self.fp16_groups = []
         self.fp32_from_fp16_groups = []
         self.fp32_from_fp32_groups = []
@@ -221,10 +336,118 @@ class FP16OptimizerWithFP16Params(MegatronOptimizer):
         # recast preexisting per-param state tensors
         self.optimizer.load_state_dict(self.optimizer.state_dict())
 
+        if self.weight_stashing:
+            # Flat lists of the main params and of the tensors holding their
+            # other version, built once for the multi-tensor copies of step().
+            self._main_params = [param for group in self.fp32_from_fp16_groups
+                                 for param in group]
+            self._stashed_params = [
+                param for group in self.fp32_from_fp16_groups_copy
+                for param in group]
+
+        fp32_buffers = None
+        if self.contiguous_buffers:
+            fp32_buffers = self._build_contiguous_buffers()
+        if self.weight_stashing:
+            self.fp32_versions = _TwoVersionParams(
+                [param for group in self.fp32_from_fp32_groups
+                 for param in group],
+                [param for group in self.fp32_from_fp32_groups_copy
+                 for param in group],
+                self._dummy_overflow_buf, fp32_buffers)
+
+
+    def _build_contiguous_buffers(self):
+        """Make the fp16 params, fp32 params, main params, stashed versions
+        and their grads views of one flat buffer per kind, so that copying,
+        unscaling, clipping and all-reducing them are single operations.
+        Returns the buffers of the fp32 params and their stashed version
+        with weight stashing."""
+        fp16_params = [param for group in self.fp16_groups
+                       for param in group]
+        main_params = [param for group in self.fp32_from_fp16_groups
+                       for param in group]
+        fp32_params = [param for group in self.fp32_from_fp32_groups
+                       for param in group]
+        self._fp16_buffer = None
+        self._main_buffer = None
+        self._has_fp32_params = bool(fp32_params)
+        self._main_grad_buffers = []
+        fp32_buffers = None
+        if fp16_params:
+            self._fp16_buffer = _flatten_into_buffer(fp16_params)
+            self._fp16_grad_buffer = _grad_buffer(fp16_params)
+            self._main_buffer = _flatten_into_buffer(main_params)
+            self._main_grad_buffers.append(_grad_buffer(main_params))
+        if fp32_params:
+            fp32_buffer = _flatten_into_buffer(fp32_params)
+            self._main_grad_buffers.append(_grad_buffer(fp32_params))
+        if self.weight_stashing:
+            if fp16_params:
+                self._main_copy_buffer = _flatten_into_buffer(
+                    [param for group in self.fp32_from_fp16_groups_copy
+                     for param in group])
+            if fp32_params:
+                fp32_buffers = (fp32_buffer, _flatten_into_buffer(
+                    [param for group in self.fp32_from_fp32_groups_copy
+                     for param in group]))
+
+        # Slices of the grad buffers counted in the grad norm: params that
+        # are not shared and not duplicated by tensor model parallelism,
+        # with consecutive ones merged. The fused grad copy gets them as
+        # the counted tiles of each buffer.
+        self._grads_for_norm = []
+        self._grad_tiles = []
+        for params, grad_buffer in zip(
+                [params for params in (main_params, fp32_params) if params],
+                self._main_grad_buffers):
+            ranges = []
+            start, offset = None, 0
+            for param in params:
+                is_not_shared = not getattr(param, 'shared', False)
+                is_not_tp_duplicate = param.tensor_model_parallel or \
+                    (mpu.get_tensor_model_parallel_rank() == 0)
+                if is_not_shared and is_not_tp_duplicate:
+                    if start is None:
+                        start = offset
+                elif start is not None:
+                    ranges.append((start, offset))
+                    start = None
+                offset += param.numel()
+            if start is not None:
+                ranges.append((start, offset))
+            self._grads_for_norm.extend(grad_buffer[start:end]
+                                        for start, end in ranges)
+            if self.fused_grad_copy:
+                self._grad_tiles.append(build_tiles(
+                    ranges, grad_buffer.numel(), grad_buffer.device))
+        return fp32_buffers
+
+
+    def clip_grad_norm(self, clip_grad):
+        if not self.contiguous_buffers:
+            return super(FP16OptimizerWithFP16Params, self).clip_grad_norm(
+                clip_grad)
+        if self.fused_grad_copy:
+            # The norm was computed, and read on the host with the inf/nan
+            # flag, by the copy of the grads.
+            clip_grads_to_norm(self._main_grad_buffers, self._grad_norm,
+                               clip_grad)
+            return self._grad_norm
+        return clip_grads_fp32(self._main_grad_buffers, self._grads_for_norm,
+                               clip_grad, on_device=self.clip_grad_on_device)
+
 
     def zero_grad(self, set_to_none=True):
         """We only need to zero the model related parameters, i.e.,
-                fp16_groups & fp32_from_fp32_groups."""
+                fp16_groups & fp32_from_fp32_groups. Contiguous grad buffers
+                are zeroed instead, whatever set_to_none."""
+        if self.contiguous_buffers:
+            if self._fp16_buffer is not None:
+                self._fp16_grad_buffer.zero_()
+            if self._has_fp32_params:
+                self._main_grad_buffers[-1].zero_()
+            return
         for group in self.fp16_groups:
             _zero_grad_group_helper(group, set_to_none)
         for group in self.fp32_from_fp32_groups:
@@ -236,46 +459,75 @@ class FP16OptimizerWithFP16Params(MegatronOptimizer):
 
 
     def _copy_model_grads_to_main_grads(self):
-        # This only needs to be done for the fp16 group.
-        model_grads = []
-        main_grads = []
-        for model_group, main_group in zip(self.fp16_groups,
-                                           self.fp32_from_fp16_groups):
-            for model_param, main_param in zip(model_group, main_group):
-                if model_param.grad is not None:
-                    if main_param.grad is None:
-                        main_param.grad = torch.empty_like(main_param)
-                    model_grads.append(model_param.grad.data)
-                    main_grads.append(main_param.grad.data)
-        _multi_tensor_copy_this_to_that(this=model_grads, that=main_grads,
-                                        overflow_buf=self._dummy_overflow_buf)
-
-
-    def _unscale_main_grads_and_check_for_nan(self):
-        main_grads = []
-        # fp32 params fromm fp16 ones.
-        for main_group in self.fp32_from_fp16_groups:
-            for main_param in main_group:
-                if main_param.grad is not None:
-                    main_grads.append(main_param.grad.data)
-        # Append fp32 parameters.
-        for main_group in self.fp32_from_fp32_groups:
-            for main_param in main_group:
-                if main_param.grad is not None:
-                    main_grads.append(main_param.grad.data)
-        # Reset found inf.
-        self.found_inf.fill_(0.0)
-        # Unscale and set found inf/nan
-        torch._amp_foreach_non_finite_check_and_unscale_(
-            main_grads, self.found_inf, self.grad_scaler.inv_scale)
+        """Copy the model grads to the main grads and unscale them, and
+        unscale the grads of fp32 params in place, in one multi-tensor
+        pass that also sets self._overflow_buf if any of them is inf or
+        nan. The inverse loss scale is the grad scaler's host copy, so
+        reading it does not wait for the device. With the fused grad copy,
+        the squared norm of the grads is computed in the same pass, into
+        self._grad_stats."""
+        if self.fused_grad_copy:
+            self._fused_copy_model_grads_to_main_grads()
+            return
+        inv_scale = self.grad_scaler.inv_scale_value
+        self._overflow_buf.fill_(0)
+        if self.contiguous_buffers:
+            model_grads, main_grads, fp32_grads = [], [], []
+            if self._fp16_buffer is not None:
+                model_grads.append(self._fp16_grad_buffer)
+                main_grads.append(self._main_grad_buffers[0])
+            if self._has_fp32_params:
+                fp32_grads.append(self._main_grad_buffers[-1])
+        else:
+            model_grads = []
+            main_grads = []
+            for model_group, main_group in zip(self.fp16_groups,
+                                               self.fp32_from_fp16_groups):
+                for model_param, main_param in zip(model_group, main_group):
+                    if model_param.grad is not None:
+                        if main_param.grad is None:
+                            main_param.grad = torch.empty_like(main_param)
+                        model_grads.append(model_param.grad.data)
+                        main_grads.append(main_param.grad.data)
+            fp32_grads = [param.grad.data
+                          for group in self.fp32_from_fp32_groups
+                          for param in group if param.grad is not None]
+        for this, that in ((model_grads, main_grads),
+                           (fp32_grads, fp32_grads)):
+            multi_tensor_scale(this, that, inv_scale,
+                               overflow_buf=self._overflow_buf)
+
+
+    def _fused_copy_model_grads_to_main_grads(self):
+        inv_scale = self.grad_scaler.inv_scale
+        self._grad_stats.zero_()
+        pairs = []
+        if self._fp16_buffer is not None:
+            pairs.append((self._fp16_grad_buffer, self._main_grad_buffers[0]))
+        if self._has_fp32_params:
+            pairs.append((self._main_grad_buffers[-1],
+                          self._main_grad_buffers[-1]))
+        for (model_grads, main_grads), tiles in zip(pairs, self._grad_tiles):
+            copy_unscale_and_norm(model_grads, main_grads, inv_scale, tiles,
+                                  self._grad_stats)
+
+
+    def _check_for_nan(self):
+        """Whether any grad of any model-parallel rank was inf or nan.
+        With the fused grad copy, the flag and the squared norm are
+        all-reduced together, and the norm kept for clip_grad_norm()."""
+        if self.fused_grad_copy:
+            torch.distributed.all_reduce(self._grad_stats,
+                                         group=mpu.get_model_parallel_group())
+            found_inf, sum_of_squares = self._grad_stats.tolist()
+            self._grad_norm = sum_of_squares ** 0.5
+            return found_inf > 0
+        self.found_inf.copy_(self._overflow_buf)
         # Update across all model parallel instances.
         torch.distributed.all_reduce(self.found_inf,
                                      op=torch.distributed.ReduceOp.MAX,
                                      group=mpu.get_model_parallel_group())
-
-        # Check for nan.
-        found_inf_flag = (self.found_inf.item() > 0)
-        return found_inf_flag
+        return self.found_inf.item() > 0
 
 
     def _get_model_and_main_params_data_fp16(self, from_copy=False):
@@ -295,6 +547,11 @@ class FP16OptimizerWithFP16Params(MegatronOptimizer):
 
     def _copy_main_params_to_model_params(self, from_copy=False):
         # Only needed for the fp16 params.
+        if self.contiguous_buffers:
+            if self._fp16_buffer is not None:
+                self._fp16_buffer.copy_(self._main_copy_buffer if from_copy
+                                        else self._main_buffer)
+            return
         model_data, main_data = self._get_model_and_main_params_data_fp16(
             from_copy=from_copy)
         _multi_tensor_copy_this_to_that(this=main_data, that=model_data,
@@ -303,6 +560,10 @@ class FP16OptimizerWithFP16Params(MegatronOptimizer):
 
     def _copy_model_params_to_main_params(self):
         # Only needed for the fp16 params.
+        if self.contiguous_buffers:
+            if self._fp16_buffer is not None:
+                self._main_buffer.copy_(self._fp16_buffer)
+            return
         model_data, main_data = self._get_model_and_main_params_data_fp16()
         _multi_tensor_copy_this_to_that(this=model_data, that=main_data,
                                         overflow_buf=self._dummy_overflow_buf)
@@ -312,86 +573,88 @@ class FP16OptimizerWithFP16Params(MegatronOptimizer):
         self._copy_model_params_to_main_params()
 
 
-    def _copy(self):
-        for param_groups, param_groups_copy in [
-                [self.fp32_from_fp16_groups, self.fp32_from_fp16_groups_copy],
-                [self.fp32_from_fp32_groups, self.fp32_from_fp32_groups_copy]]:
-            for i, param_group in enumerate(param_groups):
-                for j, param in enumerate(param_group):
-                    param.data.copy_(param_groups_copy[i][j].data)
-        self.main_version = self.copy_version
-
-
-    def _swap(self):
-        for param_groups, param_groups_copy in [
-                [self.fp32_from_fp16_groups, self.fp32_from_fp16_groups_copy],
-                [self.fp32_from_fp32_groups, self.fp32_from_fp32_groups_copy]]:
-            for i, param_group in enumerate(param_groups):
-                for j, param in enumerate(param_group):
-                    param_copy = param.detach().clone()
-                    param.data.copy_(param_groups_copy[i][j].data)
-                    param_groups_copy[i][j].data.copy_(param_copy.data)
-        new_main_version = self.copy_version
+    def _stash_main_params(self):
+        """Before the optimizer step, overwrite the older version, which is
+        no longer needed, with the newer one, which becomes the older one."""
+        if self.contiguous_buffers:
+            if self._main_buffer is not None:
+                self._main_copy_buffer.copy_(self._main_buffer)
+        elif self._main_params:
+            _multi_tensor_copy_this_to_that(
+                this=self._main_params, that=self._stashed_params,
+                overflow_buf=self._dummy_overflow_buf)
+        self.fp32_versions.stash()
         self.copy_version = self.main_version
-        self.main_version = new_main_version
 
 
-    def swap_to_older_version(self):
-        if self.main_version != self.current_model_fp16_version:
-            self._copy_main_params_to_model_params(from_copy=False)
-            self.current_model_fp16_version = self.main_version
-        # TODO: Do something with fp32 params.
+    def _skip_version(self):
+        """Without an update, the microbatches run forward on the newer
+        version in this iteration are run backward on the older one in the
+        next: make both versions the newer one."""
+        self._stash_main_params()
+        self.swap_to_older_version()
 
-    def swap_to_newer_version(self):
+
+    def swap_to_older_version(self):
         if self.copy_version != self.current_model_fp16_version:
             self._copy_main_params_to_model_params(from_copy=True)
             self.current_model_fp16_version = self.copy_version
-        # TODO: Do something with fp32 params.
+        self.fp32_versions.use('older')
+
+    def swap_to_newer_version(self):
+        if self.main_version != self.current_model_fp16_version:
+            self._copy_main_params_to_model_params(from_copy=False)
+            self.current_model_fp16_version = self.main_version
+        self.fp32_versions.use('newer')
 
     @torch.no_grad()
     def step(self):
 
         timers = get_timers()
+        self.wait_for_grad_syncs()
 
-        # Copy gradients from model params to main params.
-        timers('optimizer-copy-to-main-grad').start()
+        # Copy gradients from model params to main params, unscaling them
+        # and checking for inf/nan.
+        timers('optimizer-copy-to-main-grad', log_level=1).start()
         self._copy_model_grads_to_main_grads()
         timers('optimizer-copy-to-main-grad').stop()
 
-        if not self.weight_stashing:
-            # Unscale and check for inf/nan.
-            timers('optimizer-unscale-and-check-inf').start()
-            found_inf_flag = self._unscale_main_grads_and_check_for_nan()
-            timers('optimizer-unscale-and-check-inf').stop()
-
-            # We are done with scaling gradients
-            # so we can update the loss scale.
-            self.grad_scaler.update(found_inf_flag)
-
-            # If we found inf/nan, skip the update.
-            if found_inf_flag:
-                return False
-
-            # Clip the main gradients.
-            timers('optimizer-clip-main-grad').start()
-            self.clip_grad_norm(self.clip_grad)
+        timers('optimizer-unscale-and-check-inf', log_level=1).start()
+        found_inf_flag = self._check_for_nan()
+        timers('optimizer-unscale-and-check-inf').stop()
+
+        # We are done with scaling gradients
+        # so we can update the loss scale.
+        self.grad_scaler.update(found_inf_flag)
+
+        # If we found inf/nan, skip the update.
+        if found_inf_flag:
+            if self.weight_stashing:
+                self._skip_version()
+            return False
+
+        # Clip the main gradients.
+        if self.clip_grad > 0.0:
+            timers('optimizer-clip-main-grad', log_level=1).start()
+            self.grad_norm = self.clip_grad_norm(self.clip_grad)
             timers('optimizer-clip-main-grad').stop()
 
         if self.weight_stashing:
-            self._copy()
+            self._stash_main_params()
 
         # Step the optimizer.
         self.optimizer.step()
 
         if self.weight_stashing:
             self.main_version += 1
-            self._swap()
 
-        # Update params from main params.
-        timers('optimizer-copy-main-to-model-params').start()
-        self._copy_main_params_to_model_params()
+        # Update params from main params, to the older version with weight
+        # stashing.
+        timers('optimizer-copy-main-to-model-params', log_level=1).start()
+        self._copy_main_params_to_model_params(
+            from_copy=self.weight_stashing)
         if self.weight_stashing:
-            self.current_model_fp16_version = self.main_version
+            self.current_model_fp16_version = self.copy_version
         timers('optimizer-copy-main-to-model-params').stop()
 
         # Successful update.
@@ -408,6 +671,7 @@ class FP16OptimizerWithFP16Params(MegatronOptimizer):
             state_dict['copy_version'] = self.copy_version
             state_dict['fp32_from_fp16_params_copy'] = self.fp32_from_fp16_groups_copy
             state_dict['fp32_from_fp32_params_copy'] = self.fp32_from_fp32_groups_copy
+            state_dict['fp32_params_version'] = self.fp32_versions.version
         return state_dict
 
 
@@ -448,6 +712,25 @@ class FP16OptimizerWithFP16Params(MegatronOptimizer):
                     for current_group, saved_group in zip(current_groups, saved_groups):
                         for current, saved in zip(current_group, saved_group):
                             current.data.copy_(saved.data)
+                # Older checkpoints keep the older version in the fp32
+                # params.
+                self.fp32_versions.version = state_dict.get(
+                    'fp32_params_version', 'older')
+                if self.main_version < self.copy_version:
+                    # Older checkpoints keep the older version in the main
+                    # params of fp16 params.
+                    for group, group_copy in zip(
+                            self.fp32_from_fp16_groups,
+                            self.fp32_from_fp16_groups_copy):
+                        for param, param_copy in zip(group, group_copy):
+                            param.data, param_copy.data = \
+                                param_copy.data, param.data
+                    if self.contiguous_buffers and \
+                            self._main_buffer is not None:
+                        self._main_buffer, self._main_copy_buffer = \
+                            self._main_copy_buffer, self._main_buffer
+                    self.main_version, self.copy_version = \
+                        self.copy_version, self.main_version
             else:
                 # Copy loaded parameters into copy if not available in checkpoint.
                 for param_groups, param_groups_copy in [
@@ -461,11 +744,23 @@ class FP16OptimizerWithFP16Params(MegatronOptimizer):
 
 class FP32Optimizer(MegatronOptimizer):
 
-    def __init__(self, optimizer, clip_grad):
+    def __init__(self, optimizer, clip_grad, weight_stashing=False,
+                 clip_grad_on_device=False):
 
         super(FP32Optimizer, self).__init__(optimizer)
         self.clip_grad = clip_grad
-        self._scale = torch.cuda.FloatTensor([1.0])
+        self.clip_grad_on_device = clip_grad_on_device
+        self.weight_stashing = weight_stashing
+        self._scale = torch.ones(1, device=current_device())
+
+        # With weight stashing, the params and a stashed copy hold one
+        # weight version each, exchanged by reference.
+        if self.weight_stashing:
+            params = [param for group in self.optimizer.param_groups
+                      for param in group['params']]
+            self.versions = _TwoVersionParams(
+                params, [param.detach().clone() for param in params],
+                torch.zeros(1, dtype=torch.int, device=self._scale.device))
 
 
     def zero_grad(self, set_to_none=True):
@@ -484,9 +779,14 @@ class FP32Optimizer(MegatronOptimizer):
         """Clip gradients (if needed) and step the base optimizer.
         Always return successful since there is no overflow."""
 
+        self.wait_for_grad_syncs()
+
         # Clip gradients.
         if self.clip_grad > 0.0:
-            self.clip_grad_norm(self.clip_grad)
+            self.grad_norm = self.clip_grad_norm(self.clip_grad)
+
+        if self.weight_stashing:
+            self.versions.stash()
 
         # Update parameters.
         self.optimizer.step()
@@ -495,13 +795,38 @@ class FP32Optimizer(MegatronOptimizer):
         return True
 
 
+    def swap_to_older_version(self):
+        self.versions.use('older')
+
+
+    def swap_to_newer_version(self):
+        self.versions.use('newer')
+
+
     def reload_model_params(self):
-        pass
+        if self.weight_stashing:
+            for param, stashed in zip(self.versions.params,
+                                      self.versions.stashed):
+                stashed.data.copy_(param.data)
 
 
     def state_dict(self):
-        return self.optimizer.state_dict()
+        if not self.weight_stashing:
+            return self.optimizer.state_dict()
+        return {'optimizer': self.optimizer.state_dict(),
+                'stashed_params': self.versions.stashed,
+                'params_version': self.versions.version}
 
 
     def load_state_dict(self, state_dict):
-        self.optimizer.load_state_dict(state_dict)
+        if 'stashed_params' not in state_dict:
+            self.optimizer.load_state_dict(state_dict.get('optimizer',
+                                                          state_dict))
+            self.reload_model_params()
+            return
+        self.optimizer.load_state_dict(state_dict['optimizer'])
+        if self.weight_stashing:
+            for current, saved in zip(self.versions.stashed,
+                                      state_dict['stashed_params']):
+                current.data.copy_(saved.data)
+            self.versions.version = state_dict['params_version']
@@ -0,0 +1,150 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adam with its state quantized to 8 bits per element.
+
+The first moment, and the square root of the second moment, are stored as
+8-bit codes in blocks of `block_size` elements, each with the fp32 absolute
+maximum of its block. Codes map to values by a power law rather than
+linearly, as a logarithmic code would, so that the small entries of a block
+are not rounded to zero next to its largest one. The state takes 2 bytes
+and 2 / block_size fp32 per param instead of 8 bytes. Each step dequantizes
+the state of `chunk_size` elements at a time into fp32, updates it with
+cpu_adam_() and quantizes it again.
+"""
+
+import torch
+
+from .cpu_adam import cpu_adam_
+
+
+# Codes of the first moment are signed, of the second moment unsigned, and
+# value / absmax = (code / levels) ** power.
+_EXP_AVG_LEVELS, _EXP_AVG_POWER = 127, 2.0
+_EXP_AVG_SQ_LEVELS, _EXP_AVG_SQ_POWER = 255, 4.0
+
+
+def _dequantize(codes, absmax, levels, power, out):
+    """Write the values of the flat `codes` into the flat fp32 `out`."""
+    values = out.view(absmax.numel(), -1)
+    values.copy_(codes.view_as(values))
+    values.div_(levels)
+    sign = values.sign()
+    values.abs_().pow_(power).mul_(sign).mul_(absmax.unsqueeze(1))
+
+
+def _quantize(values, codes, absmax, levels, power):
+    """Write the codes of the flat fp32 `values` into `codes` and `absmax`;
+    `values` is overwritten."""
+    values = values.view(absmax.numel(), -1)
+    torch.amax(values.abs(), dim=1, out=absmax)
+    values.div_(absmax.clamp(min=torch.finfo(torch.float).tiny).unsqueeze(1))
+    sign = values.sign()
+    values.abs_().pow_(1.0 / power).mul_(sign).mul_(levels).round_()
+    codes.view_as(values).copy_(values)
+
+
+class QuantizedAdam(torch.optim.Optimizer):
+    """Adam, or AdamW with adam_w_mode (the default, as apex's FusedAdam),
+    with block-quantized 8-bit state."""
+
+    def __init__(self, params, lr=1e-3, bias_correction=True,
+                 betas=(0.9, 0.999), eps=1e-8, adam_w_mode=True,
+                 weight_decay=0., block_size=2048, chunk_size=2 ** 20):
+        assert chunk_size % block_size == 0, \
+            'the chunk size must be a multiple of the block size'
+        defaults = dict(lr=lr, bias_correction=bias_correction,
+                        betas=betas, eps=eps, weight_decay=weight_decay)
+        super(QuantizedAdam, self).__init__(params, defaults)
+        self.adam_w_mode = adam_w_mode
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+        self._workspaces = {}
+
+    def _workspace(self, device):
+        """fp32 tensor of shape (4, chunk size) on `device`: the first and
+        second moments of a chunk and the workspace of cpu_adam_()."""
+        if device not in self._workspaces:
+            self._workspaces[device] = torch.empty(4, self.chunk_size,
+                                                   device=device)
+        return self._workspaces[device]
+
+    def _init_state(self, param, state):
+        num_blocks = -(-param.numel() // self.block_size)
+        numel = num_blocks * self.block_size
+        state['step'] = 0
+        state['exp_avg'] = torch.zeros(numel, dtype=torch.int8,
+                                       device=param.device)
+        state['exp_avg_absmax'] = torch.zeros(num_blocks,
+                                              device=param.device)
+        state['exp_avg_sq'] = torch.zeros(numel, dtype=torch.uint8,
+                                          device=param.device)
+        state['exp_avg_sq_absmax'] = torch.zeros(num_blocks,
+                                                 device=param.device)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for param in group['params']:
+                if param.grad is None:
+                    continue
+                assert param.is_contiguous() and param.grad.is_contiguous()
+                state = self.state[param]
+                if not state:
+                    self._init_state(param, state)
+                state['step'] += 1
+                workspace = self._workspace(param.device)
+                flat_param = param.view(-1)
+                flat_grad = param.grad.view(-1)
+                numel = state['exp_avg'].numel()
+                for start in range(0, numel, self.chunk_size):
+                    end = min(start + self.chunk_size, numel)
+                    blocks = slice(start // self.block_size,
+                                   end // self.block_size)
+                    param_end = min(end, flat_param.numel())
+                    exp_avg = workspace[0, :end - start]
+                    exp_avg_sq = workspace[1, :end - start]
+                    _dequantize(state['exp_avg'][start:end],
+                                state['exp_avg_absmax'][blocks],
+                                _EXP_AVG_LEVELS, _EXP_AVG_POWER, exp_avg)
+                    _dequantize(state['exp_avg_sq'][start:end],
+                                state['exp_avg_sq_absmax'][blocks],
+                                _EXP_AVG_SQ_LEVELS, _EXP_AVG_SQ_POWER,
+                                exp_avg_sq)
+                    exp_avg_sq.mul_(exp_avg_sq)
+
+                    # The padding of the last block stays zero.
+                    cpu_adam_(flat_param[start:param_end],
+                              flat_grad[start:param_end],
+                              exp_avg[:param_end - start],
+                              exp_avg_sq[:param_end - start],
+                              state['step'], group['lr'], beta1, beta2,
+                              group['eps'], group['weight_decay'],
+                              adam_w_mode=self.adam_w_mode,
+                              bias_correction=group['bias_correction'],
+                              workspace=workspace[2:])
+
+                    _quantize(exp_avg, state['exp_avg'][start:end],
+                              state['exp_avg_absmax'][blocks],
+                              _EXP_AVG_LEVELS, _EXP_AVG_POWER)
+                    _quantize(exp_avg_sq.sqrt_(), state['exp_avg_sq'][start:end],
+                              state['exp_avg_sq_absmax'][blocks],
+                              _EXP_AVG_SQ_LEVELS, _EXP_AVG_SQ_POWER)
+        return loss
@@ -13,42 +13,386 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import deque
 from functools import reduce
 import operator
 import torch
 
 from megatron import get_args
+from megatron import get_timers
 from megatron import mpu
+from megatron.p2p_compression import build_codec
+
+
+def _get_device():
+    """Device of the tensors exchanged between stages: the current GPU, or
+    the CPU if the pipeline group uses the gloo backend."""
+    group = mpu.get_pipeline_model_parallel_group()
+    if torch.distributed.get_backend(group) == 'gloo':
+        return torch.device('cpu')
+    return torch.device('cuda', torch.cuda.current_device())
+
+
+class ReceiveBufferPool:
+    """Free lists of receive buffers, per direction ('forward' for the
+    activations received from the previous stage, 'backward' for the
+    gradients received from the next one) and per shape, dtype and device.
+    Hits and misses are counted by the timers as
+    'pipeline-recv-buffer-hits' and 'pipeline-recv-buffer-misses'."""
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, direction, shape, dtype, device):
+        """Return a free buffer, or a new one if there is none."""
+        free = self.buffers.get((direction, tuple(shape), dtype, device))
+        if free:
+            get_timers().increment('pipeline-recv-buffer-hits')
+            return free.popleft()
+        get_timers().increment('pipeline-recv-buffer-misses')
+        return torch.empty(shape, dtype=dtype, device=device)
+
+    def put(self, direction, tensor):
+        """Return a buffer to the pool; its contents are overwritten by a
+        later receive."""
+        tensor.grad = None
+        tensor.requires_grad_(False)
+        key = (direction, tuple(tensor.shape), tensor.dtype, tensor.device)
+        self.buffers.setdefault(key, deque()).append(tensor)
+
+    def clear(self):
+        """Drop every buffer."""
+        self.buffers = {}
+
+
+_RECEIVE_BUFFER_POOL = ReceiveBufferPool()
+
+
+def _receive_buffer(direction, shape, dtype, device, requires_grad):
+    if get_args().reuse_pipeline_receive_buffers:
+        buffer = _RECEIVE_BUFFER_POOL.get(direction, shape, dtype, device)
+        return buffer.requires_grad_(requires_grad)
+    return torch.empty(shape, requires_grad=requires_grad, device=device,
+                       dtype=dtype)
+
+
+def release_received_tensor(direction, tensor):
+    """Recycle a tensor received from the previous stage (`direction`
+    'forward') or the next one ('backward') once the schedule is done with
+    it. Does nothing without --reuse-pipeline-receive-buffers."""
+    if tensor is not None and get_args().reuse_pipeline_receive_buffers:
+        _RECEIVE_BUFFER_POOL.put(direction, tensor)
+
+
+class CommunicationHandle:
+    """Batched point-to-point communication in flight, returned by the
+    non-blocking calls. Keeps the sent tensors alive until wait() or
+    wait_for_sends() is called; wait() returns (tensor_recv_prev,
+    tensor_recv_next).
+
+    With --scatter-gather-tensors-in-pipeline, the all-gathers of the
+    received chunks are issued asynchronously as soon as the point-to-point
+    communication has completed, and only wait() waits for them."""
+
+    def __init__(self, reqs, send_reqs, wire_sent, wire_recv_prev,
+                 wire_recv_next, recv_prev_shape, recv_next_shape, dtype):
+        self._reqs = reqs
+        self._send_reqs = send_reqs
+        self._wire_sent = wire_sent
+        self._wire_recv_prev = wire_recv_prev
+        self._wire_recv_next = wire_recv_next
+        self._recv_prev_shape = recv_prev_shape
+        self._recv_next_shape = recv_next_shape
+        self._dtype = dtype
+        self._tensor_recv_prev = None
+        self._tensor_recv_next = None
+        # (direction, work, received chunk) of the all-gathers in flight.
+        self._gathers = []
+        self._gather_stream = None
+
+    def wait_for_sends(self):
+        """Wait for the sends of the communication, but not for its
+        receives, and release the sent tensors. On GPUs, the caching
+        allocator does not reuse them before the communication stream is
+        done with them, so there is nothing to wait for."""
+        for req in self._send_reqs:
+            req.wait()
+        if self._reqs is not None:
+            # A request must not be waited for twice (gloo).
+            self._reqs = [req for req in self._reqs
+                          if all(req is not sent for sent in self._send_reqs)]
+        self._send_reqs = []
+        self._wire_sent = None
+
+    def wait_for_transfer(self):
+        """Wait for the point-to-point communication and issue the
+        all-gathers, without waiting for them."""
+        if self._reqs is None:
+            return
+        for req in self._reqs:
+            req.wait()
+        self._reqs = None
+        self._send_reqs = []
+        self._wire_sent = None
+        self._tensor_recv_prev = self._decode(
+            'forward', self._wire_recv_prev, self._recv_prev_shape)
+        self._tensor_recv_next = self._decode(
+            'backward', self._wire_recv_next, self._recv_next_shape)
+        self._wire_recv_prev = None
+        self._wire_recv_next = None
+
+    def _decode(self, direction, wire, tensor_shape):
+        tensor = _decode_received_tensor(direction, wire, tensor_shape,
+                                         self._dtype)
+        if tensor is None or \
+                not get_args().scatter_gather_tensors_in_pipeline:
+            return tensor
+        gathered = _receive_buffer(direction, tensor_shape, tensor.dtype,
+                                   tensor.device, requires_grad=False)
+        _, work = mpu.gather_split_1d_tensor(tensor, gathered.view(-1),
+                                             async_op=True)
+        self._gathers.append((direction, work, tensor))
+        return gathered
+
+    def start_gathers(self):
+        """Issue the all-gathers without blocking the host: on GPUs, they
+        are chained to the point-to-point communication on a side stream;
+        otherwise they are issued by wait_for_transfer() or wait()."""
+        if self._reqs is None or \
+                not get_args().scatter_gather_tensors_in_pipeline:
+            return
+        wire = (self._wire_recv_prev or []) + (self._wire_recv_next or [])
+        if not wire or wire[0].device.type != 'cuda':
+            return
+        # Tensors used on the side stream must not be reused by the caching
+        # allocator before the side stream is done with them.
+        self._gather_stream = _get_gather_stream()
+        for wire_tensor in wire:
+            wire_tensor.record_stream(self._gather_stream)
+        with torch.cuda.stream(self._gather_stream):
+            self.wait_for_transfer()
+
+    def wait(self):
+        self.wait_for_transfer()
+        for direction, work, tensor_chunk in self._gathers:
+            work.wait()
+            release_received_tensor(direction, tensor_chunk)
+        if self._gathers:
+            self._gathers = []
+            for tensor in (self._tensor_recv_prev, self._tensor_recv_next):
+                if tensor is None:
+                    continue
+                if self._gather_stream is not None:
+                    tensor.record_stream(torch.cuda.current_stream())
+                tensor.requires_grad_()
+        return self._tensor_recv_prev, self._tensor_recv_next
+
+
+# Side stream on which the all-gathers of received chunks wait for the
+# point-to-point communication, so that the compute stream does not.
+_GATHER_STREAM = None
+
+
+def _get_gather_stream():
+    global _GATHER_STREAM
+    if _GATHER_STREAM is None:
+        _GATHER_STREAM = torch.cuda.Stream()
+    return _GATHER_STREAM
+
+
+# Codecs of the tensors sent between stages, per direction and settings.
+_CODECS = {}
+
+
+def _get_codec(direction):
+    """Codec of the activations ('forward') or of the gradients
+    ('backward') sent between stages."""
+    args = get_args()
+    if direction == 'forward':
+        name = args.pipeline_activation_codec
+    else:
+        name = args.pipeline_gradient_codec
+    key = (direction, name, args.pipeline_codec_block_size,
+           args.pipeline_topk_ratio)
+    if key not in _CODECS:
+        _CODECS[key] = build_codec(name, args.pipeline_codec_block_size,
+                                   args.pipeline_topk_ratio)
+    return _CODECS[key]
+
+
+def _chunk_shape(tensor_shape):
+    """Shape of the part of a tensor sent by each tensor-model-parallel
+    rank."""
+    if get_args().scatter_gather_tensors_in_pipeline:
+        return (reduce(operator.mul, tensor_shape, 1) //
+                mpu.get_tensor_model_parallel_world_size(),)
+    return tuple(tensor_shape)
+
+
+def _decode_received_tensor(direction, wire, tensor_shape, dtype):
+    """Rebuild a received tensor (or, with
+    --scatter-gather-tensors-in-pipeline, the received chunk of it) from
+    its wire tensors."""
+    if wire is None:
+        return None
+    codec = _get_codec(direction)
+    out = None
+    if codec.copies:
+        out = _receive_buffer(direction, _chunk_shape(tensor_shape), dtype,
+                              wire[0].device, requires_grad=False)
+    tensor = codec.decode(wire, out)
+    for wire_tensor in wire:
+        if wire_tensor is not tensor:
+            release_received_tensor(direction, wire_tensor)
+    if get_args().scatter_gather_tensors_in_pipeline:
+        return tensor
+    return tensor.requires_grad_()
+
+
+def _batch_isend_irecv(send_next, recv_prev, send_prev, recv_next):
+    """Post the sends and receives of the given lists of tensors (or None)
+    in one batch and return the requests."""
+    # Activations are posted before gradients on both the sending and the
+    # receiving side: with two stages, the previous and next ranks are the
+    # same and messages between them are matched in order.
+    next_rank = mpu.get_pipeline_model_parallel_next_rank()
+    prev_rank = mpu.get_pipeline_model_parallel_prev_rank()
+    ops = []
+    for tensor in send_next or []:
+        ops.append(torch.distributed.P2POp(torch.distributed.isend, tensor,
+                                           next_rank))
+    for tensor in recv_prev or []:
+        ops.append(torch.distributed.P2POp(torch.distributed.irecv, tensor,
+                                           prev_rank))
+    for tensor in send_prev or []:
+        ops.append(torch.distributed.P2POp(torch.distributed.isend, tensor,
+                                           prev_rank))
+    for tensor in recv_next or []:
+        ops.append(torch.distributed.P2POp(torch.distributed.irecv, tensor,
+                                           next_rank))
+    if not ops:
+        return []
+    return torch.distributed.batch_isend_irecv(ops)
+
+
+# Shape handshake messages: the shapes sent, cached per shape since they
+# are never modified, and the buffers receiving shapes, per direction.
+_SHAPE_TENSORS = {}
+_SHAPE_BUFFERS = {}
+
+
+def _shape_tensor(shape, device):
+    key = (tuple(shape), device)
+    if key not in _SHAPE_TENSORS:
+        _SHAPE_TENSORS[key] = torch.tensor(shape, dtype=torch.long,
+                                           device=device)
+    return _SHAPE_TENSORS[key]
+
+
+def _shape_buffer(direction, device):
+    key = (direction, device)
+    if key not in _SHAPE_BUFFERS:
+        _SHAPE_BUFFERS[key] = torch.empty(3, dtype=torch.long, device=device)
+    return _SHAPE_BUFFERS[key]
+
+
+def _communicate_shapes(tensor_send_next, recv_prev, device):
+    """Exchange the (seq_length, micro_batch_size, hidden_size) shapes of
+    the activations about to be communicated, for --variable-seq-lengths,
+    and return the shape of the received one. The shapes of grads are not
+    exchanged: a grad has the shape of the activation sent for the same
+    microbatch."""
+    shape_send_next = None
+    shape_recv_prev = None
+    if tensor_send_next is not None:
+        assert tensor_send_next.dim() == 3
+        shape_send_next = [_shape_tensor(tensor_send_next.shape, device)]
+    if recv_prev:
+        shape_recv_prev = [_shape_buffer('forward', device)]
+    for req in _batch_isend_irecv(shape_send_next, shape_recv_prev,
+                                  None, None):
+        req.wait()
+
+    if recv_prev:
+        return tuple(shape_recv_prev[0].tolist())
+    return None
+
+
+# Pipeline group for which the receive buffers, codecs and shape buffers
+# above were created.
+_PIPELINE_GROUP = None
+
+
+def _reset_for_pipeline_group():
+    """Drop the receive buffers, codecs (with their error feedback) and
+    shape buffers of the previous pipeline group once the model-parallel
+    groups have been re-initialized."""
+    global _PIPELINE_GROUP
+    group = mpu.get_pipeline_model_parallel_group()
+    if group is _PIPELINE_GROUP:
+        return
+    _PIPELINE_GROUP = group
+    _RECEIVE_BUFFER_POOL.clear()
+    _CODECS.clear()
+    _SHAPE_BUFFERS.clear()
 
 
 def _communicate(tensor_send_next, tensor_send_prev, recv_prev, recv_next,
-                 use_ring_exchange=False):
-    """Communicate tensors between stages."""
+                 use_ring_exchange=False, async_op=False, tensor_shape=None,
+                 grad_model_chunk=0, grad_shape=None):
+    """Communicate tensors between stages. With async_op, return a
+    CommunicationHandle instead of waiting for the communication.
+
+    Received tensors have shape `tensor_shape` if given, which the peer
+    stages must also pass. Otherwise, with --variable-seq-lengths, the
+    shapes of activations are first exchanged with the peer stages, and a
+    received grad has shape `grad_shape`, that of the activation sent for
+    its microbatch; without it they are (seq_length, micro_batch_size,
+    hidden_size).
+
+    Tensors are sent through the codecs selected by
+    --pipeline-activation-codec and --pipeline-gradient-codec; the error
+    feedback of the gradient codec is kept per `grad_model_chunk`, the
+    model chunk of tensor_send_prev.
+    """
     args = get_args()
+    device = _get_device()
+    _reset_for_pipeline_group()
+
+    if tensor_shape is not None:
+        recv_prev_shape = recv_next_shape = tuple(tensor_shape)
+    elif args.variable_seq_lengths:
+        assert not recv_next or grad_shape is not None, \
+            'the shape of received grads must be given with ' \
+            '--variable-seq-lengths'
+        recv_prev_shape = _communicate_shapes(tensor_send_next, recv_prev,
+                                              device)
+        recv_next_shape = None if grad_shape is None else tuple(grad_shape)
+    else:
+        recv_prev_shape = recv_next_shape = \
+            (args.seq_length, args.micro_batch_size, args.hidden_size)
 
     # Create placeholder tensors for receive in forward and backward directions
     # if needed.
-    tensor_recv_prev = None
-    tensor_recv_next = None
-    tensor_shape = (args.seq_length, args.micro_batch_size, args.hidden_size)
-    if args.scatter_gather_tensors_in_pipeline:
-        tensor_chunk_shape = reduce(operator.mul, tensor_shape, 1) // \
-            mpu.get_tensor_model_parallel_world_size()
-    else:
-        tensor_chunk_shape = tensor_shape
     dtype = args.params_dtype
     if args.fp32_residual_connection:
         dtype = torch.float
+    activation_codec = _get_codec('forward')
+    gradient_codec = _get_codec('backward')
+    wire_recv_prev = None
+    wire_recv_next = None
     if recv_prev:
-        tensor_recv_prev = torch.empty(tensor_chunk_shape,
-                                       requires_grad=True,
-                                       device=torch.cuda.current_device(),
-                                       dtype=dtype)
+        wire_recv_prev = [
+            _receive_buffer('forward', shape, wire_dtype, device,
+                            requires_grad=False)
+            for shape, wire_dtype in activation_codec.wire_specs(
+                _chunk_shape(recv_prev_shape), dtype)]
     if recv_next:
-        tensor_recv_next = torch.empty(tensor_chunk_shape,
-                                       requires_grad=True,
-                                       device=torch.cuda.current_device(),
-                                       dtype=dtype)
+        wire_recv_next = [
+            _receive_buffer('backward', shape, wire_dtype, device,
+                            requires_grad=False)
+            for shape, wire_dtype in gradient_codec.wire_specs(
+                _chunk_shape(recv_next_shape), dtype)]
 
     if args.scatter_gather_tensors_in_pipeline:
         if tensor_send_next is not None:
@@ -57,168 +401,216 @@ def _communicate(tensor_send_next, tensor_send_prev, recv_prev, recv_next,
         if tensor_send_prev is not None:
             tensor_send_prev = mpu.split_tensor_into_1d_equal_chunks(tensor_send_prev)
 
+    wire_send_next = None
+    wire_send_prev = None
+    if tensor_send_next is not None:
+        wire_send_next = activation_codec.encode(tensor_send_next)
+    if tensor_send_prev is not None:
+        wire_send_prev = gradient_codec.encode(tensor_send_prev,
+                                               key=grad_model_chunk)
+
     # Send tensors in both the forward and backward directions as appropriate.
     if use_ring_exchange:
-        torch.distributed.ring_exchange(tensor_send_prev=tensor_send_prev,
-                                        tensor_recv_prev=tensor_recv_prev,
-                                        tensor_send_next=tensor_send_next,
-                                        tensor_recv_next=tensor_recv_next,
+        assert not async_op, 'ring exchange is blocking'
+        assert not activation_codec.copies and not gradient_codec.copies, \
+            'ring exchange does not support pipeline codecs'
+        def single(wire):
+            return None if wire is None else wire[0]
+        torch.distributed.ring_exchange(tensor_send_prev=single(wire_send_prev),
+                                        tensor_recv_prev=single(wire_recv_prev),
+                                        tensor_send_next=single(wire_send_next),
+                                        tensor_recv_next=single(wire_recv_next),
                                         group=mpu.get_pipeline_model_parallel_group())
+        reqs = []
     else:
-        ops = []
-        if tensor_send_prev is not None:
-            send_prev_op = torch.distributed.P2POp(torch.distributed.isend, tensor_send_prev,
-                                                   mpu.get_pipeline_model_parallel_prev_rank())
-            ops.append(send_prev_op)
-        if tensor_recv_prev is not None:
-            recv_prev_op = torch.distributed.P2POp(torch.distributed.irecv, tensor_recv_prev,
-                                                   mpu.get_pipeline_model_parallel_prev_rank())
-            ops.append(recv_prev_op)
-        if tensor_send_next is not None:
-            send_next_op = torch.distributed.P2POp(torch.distributed.isend, tensor_send_next,
-                                                   mpu.get_pipeline_model_parallel_next_rank())
-            ops.append(send_next_op)
-        if tensor_recv_next is not None:
-            recv_next_op = torch.distributed.P2POp(torch.distributed.irecv, tensor_recv_next,
-                                                   mpu.get_pipeline_model_parallel_next_rank())
-            ops.append(recv_next_op)
-        reqs = torch.distributed.batch_isend_irecv(ops)
-        for req in reqs:
-            req.wait()
-    torch.cuda.synchronize()
+        reqs = _batch_isend_irecv(wire_send_next, wire_recv_prev,
+                                  wire_send_prev, wire_recv_next)
 
-    tensor_recv_prev_before = tensor_recv_prev
-    if args.scatter_gather_tensors_in_pipeline:
-        if recv_prev:
-            tensor_recv_prev = mpu.gather_split_1d_tensor(
-                tensor_recv_prev).view(tensor_shape).requires_grad_()
+    # Requests of the sends, in the order of _batch_isend_irecv, which
+    # returns one request per operation on the CPU.
+    send_reqs = []
+    if reqs and device.type != 'cuda':
+        num_send_next = len(wire_send_next or [])
+        num_recv_prev = len(wire_recv_prev or [])
+        num_send_prev = len(wire_send_prev or [])
+        send_reqs = reqs[:num_send_next] + \
+            reqs[num_send_next + num_recv_prev:
+                 num_send_next + num_recv_prev + num_send_prev]
+    handle = CommunicationHandle(reqs, send_reqs,
+                                 (wire_send_next, wire_send_prev),
+                                 wire_recv_prev, wire_recv_next,
+                                 recv_prev_shape, recv_next_shape, dtype)
+    if async_op:
+        return handle
+    tensor_recv_prev, tensor_recv_next = handle.wait()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return tensor_recv_prev, tensor_recv_next
 
-        if recv_next:
-            tensor_recv_next = mpu.gather_split_1d_tensor(
-                tensor_recv_next).view(tensor_shape).requires_grad_()
 
-    return tensor_recv_prev, tensor_recv_next
+def send_and_recv(tensor_send_next, tensor_send_prev, recv_prev, recv_next,
+                  async_op=False, tensor_shape=None, grad_model_chunk=0,
+                  grad_shape=None):
+    """Send and receive tensors in both directions in a single batched
+    communication. Returns (tensor_recv_prev, tensor_recv_next), or a
+    CommunicationHandle with async_op."""
+    return _communicate(tensor_send_next=tensor_send_next,
+                        tensor_send_prev=tensor_send_prev,
+                        recv_prev=recv_prev,
+                        recv_next=recv_next,
+                        async_op=async_op,
+                        tensor_shape=tensor_shape,
+                        grad_model_chunk=grad_model_chunk,
+                        grad_shape=grad_shape)
 
 
-def recv_forward(timers=None, use_ring_exchange=False):
+def recv_forward(timers=None, use_ring_exchange=False,
+                 tensor_shape=None):
     if mpu.is_pipeline_first_stage():
         input_tensor = None
     else:
         if timers is not None:
-            timers('forward-recv').start()
+            timers('forward-recv', log_level=2).start()
         input_tensor, _ = _communicate(
             tensor_send_next=None,
             tensor_send_prev=None,
             recv_prev=True,
             recv_next=False,
-            use_ring_exchange=use_ring_exchange)
+            use_ring_exchange=use_ring_exchange,
+            tensor_shape=tensor_shape)
         if timers is not None:
             timers('forward-recv').stop()
     return input_tensor
 
 
-def recv_backward(timers=None, use_ring_exchange=False):
+def recv_backward(timers=None, use_ring_exchange=False,
+                  tensor_shape=None):
     if mpu.is_pipeline_last_stage():
         output_tensor_grad = None
     else:
         if timers is not None:
-            timers('backward-recv').start()
+            timers('backward-recv', log_level=2).start()
         _, output_tensor_grad = _communicate(
             tensor_send_next=None,
             tensor_send_prev=None,
             recv_prev=False,
             recv_next=True,
-            use_ring_exchange=use_ring_exchange)
+            use_ring_exchange=use_ring_exchange,
+            tensor_shape=tensor_shape)
         if timers is not None:
             timers('backward-recv').stop()
     return output_tensor_grad
 
 
-def send_forward(output_tensor, timers=None, use_ring_exchange=False):
+def send_forward(output_tensor, timers=None, use_ring_exchange=False,
+                 async_op=False, tensor_shape=None):
+    """With async_op, return a CommunicationHandle (or None on the last
+    stage) to wait on before output_tensor is modified."""
+    handle = None
     if not mpu.is_pipeline_last_stage():
         if timers is not None:
-            timers('forward-send').start()
-        _communicate(
+            timers('forward-send', log_level=2).start()
+        handle = _communicate(
             tensor_send_next=output_tensor,
             tensor_send_prev=None,
             recv_prev=False,
             recv_next=False,
-            use_ring_exchange=use_ring_exchange)
+            use_ring_exchange=use_ring_exchange,
+            async_op=async_op,
+            tensor_shape=tensor_shape)
         if timers is not None:
             timers('forward-send').stop()
+    if async_op:
+        return handle
 
 
-def send_backward(input_tensor_grad, timers=None, use_ring_exchange=False):
+def send_backward(input_tensor_grad, timers=None, use_ring_exchange=False,
+                  async_op=False, tensor_shape=None):
+    """With async_op, return a CommunicationHandle (or None on the first
+    stage) to wait on before input_tensor_grad is modified."""
+    handle = None
     if not mpu.is_pipeline_first_stage():
         if timers is not None:
-            timers('backward-send').start()
-        _communicate(
+            timers('backward-send', log_level=2).start()
+        handle = _communicate(
             tensor_send_next=None,
             tensor_send_prev=input_tensor_grad,
             recv_prev=False,
             recv_next=False,
-            use_ring_exchange=use_ring_exchange)
+            use_ring_exchange=use_ring_exchange,
+            async_op=async_op,
+            tensor_shape=tensor_shape)
         if timers is not None:
             timers('backward-send').stop()
+    if async_op:
+        return handle
 
 
-def send_forward_recv_backward(output_tensor, timers=None, use_ring_exchange=False):
+def send_forward_recv_backward(output_tensor, timers=None, use_ring_exchange=False,
+                               tensor_shape=None):
     if mpu.is_pipeline_last_stage():
         output_tensor_grad = None
     else:
         if timers is not None:
-            timers('forward-send-backward-recv').start()
+            timers('forward-send-backward-recv', log_level=2).start()
         _, output_tensor_grad = _communicate(
             tensor_send_next=output_tensor,
             tensor_send_prev=None,
             recv_prev=False,
             recv_next=True,
-            use_ring_exchange=use_ring_exchange)
+            use_ring_exchange=use_ring_exchange,
+            tensor_shape=tensor_shape)
         if timers is not None:
             timers('forward-send-backward-recv').stop()
     return output_tensor_grad
 
 
-def send_backward_recv_forward(input_tensor_grad, timers=None, use_ring_exchange=False):
+def send_backward_recv_forward(input_tensor_grad, timers=None, use_ring_exchange=False,
+                               tensor_shape=None):
     if mpu.is_pipeline_first_stage():
         input_tensor = None
     else:
         if timers is not None:
-            timers('backward-send-forward-recv').start()
+            timers('backward-send-forward-recv', log_level=2).start()
         input_tensor, _ = _communicate(
             tensor_send_next=None,
             tensor_send_prev=input_tensor_grad,
             recv_prev=True,
             recv_next=False,
-            use_ring_exchange=use_ring_exchange)
+            use_ring_exchange=use_ring_exchange,
+            tensor_shape=tensor_shape)
         if timers is not None:
             timers('backward-send-forward-recv').stop()
     return input_tensor
 
 
-def send_forward_recv_forward(output_tensor, recv_prev, timers=None):
+def send_forward_recv_forward(output_tensor, recv_prev, timers=None,
+                              tensor_shape=None):
     if timers is not None:
-        timers('forward-send-forward-recv').start()
+        timers('forward-send-forward-recv', log_level=2).start()
     input_tensor, _ = _communicate(
         tensor_send_next=output_tensor,
         tensor_send_prev=None,
         recv_prev=recv_prev,
         recv_next=False,
-        use_ring_exchange=True)
+        use_ring_exchange=True,
+        tensor_shape=tensor_shape)
     if timers is not None:
         timers('forward-send-forward-recv').stop()
     return input_tensor
 
 
-def send_backward_recv_backward(input_tensor_grad, recv_next, timers=None):
+def send_backward_recv_backward(input_tensor_grad, recv_next, timers=None,
+                                tensor_shape=None):
     if timers is not None:
-        timers('backward-send-backward-recv').start()
+        timers('backward-send-backward-recv', log_level=2).start()
     _, output_tensor_grad = _communicate(
         tensor_send_next=None,
         tensor_send_prev=input_tensor_grad,
         recv_prev=False,
         recv_next=recv_next,
-        use_ring_exchange=True)
+        use_ring_exchange=True,
+        tensor_shape=tensor_shape)
     if timers is not None:
         timers('backward-send-backward-recv').stop()
     return output_tensor_grad
@@ -226,15 +618,17 @@ def send_backward_recv_backward(input_tensor_grad, recv_next, timers=None):
 
 def send_forward_backward_recv_forward_backward(
         output_tensor, input_tensor_grad, recv_prev,
-        recv_next, timers=None):
+        recv_next, timers=None, tensor_shape=None):
     if timers is not None:
-        timers('forward-backward-send-forward-backward-recv').start()
+        timers('forward-backward-send-forward-backward-recv',
+               log_level=2).start()
     input_tensor, output_tensor_grad = _communicate(
         tensor_send_next=output_tensor,
         tensor_send_prev=input_tensor_grad,
         recv_prev=recv_prev,
         recv_next=recv_next,
-        use_ring_exchange=True)
+        use_ring_exchange=True,
+        tensor_shape=tensor_shape)
     if timers is not None:
         timers('forward-backward-send-forward-backward-recv').stop()
     return input_tensor, output_tensor_grad
@@ -0,0 +1,227 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Codecs for the activations and gradients sent between pipeline stages.
+
+A codec encodes a tensor into the list of "wire" tensors that are sent
+instead of it. The receiving stage only knows the shape and dtype of the
+original tensor, from which wire_specs() gives the shapes and dtypes of the
+wire tensors to receive; decode() rebuilds the tensor from them.
+"""
+
+import math
+
+import torch
+
+
+class Codec:
+    """Sends tensors unchanged."""
+
+    # Whether decode() copies into a new tensor or returns a wire tensor.
+    copies = False
+
+    def wire_specs(self, shape, dtype):
+        """List of (shape, dtype) of the wire tensors of a tensor."""
+        return [(tuple(shape), dtype)]
+
+    def encode(self, tensor, key=None):
+        """List of wire tensors of `tensor`. `key` identifies the sender of
+        `tensor` for codecs with error feedback."""
+        return [tensor]
+
+    def decode(self, wire, out=None):
+        """Decode wire tensors into `out`, which has the shape and dtype of
+        the encoded tensor, and return it."""
+        return wire[0]
+
+
+class Bf16Codec(Codec):
+    """Truncates tensors to bfloat16."""
+
+    copies = True
+
+    def wire_specs(self, shape, dtype):
+        return [(tuple(shape), torch.bfloat16)]
+
+    def encode(self, tensor, key=None):
+        return [tensor.to(torch.bfloat16)]
+
+    def decode(self, wire, out=None):
+        return out.copy_(wire[0])
+
+
+def _e4m3_values():
+    """The 127 non-negative finite values of the fp8 e4m3 format, in the
+    order of their codes."""
+    values = []
+    for exponent in range(16):
+        for mantissa in range(8):
+            if exponent == 15 and mantissa == 7:
+                continue  # NaN
+            if exponent == 0:
+                values.append(mantissa / 8.0 * 2.0 ** -6)
+            else:
+                values.append((1.0 + mantissa / 8.0) * 2.0 ** (exponent - 7))
+    return values
+
+
+class Fp8Codec(Codec):
+    """Rounds tensors to fp8 (e4m3) values, after scaling them by a
+    per-tensor factor that maps their largest magnitude to the largest
+    e4m3 value. Sends one byte per element and the scale."""
+
+    copies = True
+
+    def __init__(self):
+        values = _e4m3_values()
+        self.max_value = values[-1]
+        self._values = torch.tensor(values, dtype=torch.float)
+        self._midpoints = (self._values[1:] + self._values[:-1]) / 2
+        self._tables = {}
+
+    def _table(self, device):
+        if device not in self._tables:
+            self._tables[device] = (self._values.to(device),
+                                    self._midpoints.to(device))
+        return self._tables[device]
+
+    def wire_specs(self, shape, dtype):
+        return [(tuple(shape), torch.uint8), ((1,), torch.float)]
+
+    def encode(self, tensor, key=None):
+        _, midpoints = self._table(tensor.device)
+        tensor = tensor.float()
+        scale = tensor.abs().max().clamp(min=1e-30).view(1) / self.max_value
+        # Round to the nearest e4m3 value; the sign is the top bit.
+        codes = torch.bucketize((tensor / scale).abs(), midpoints)
+        codes = codes + (tensor < 0).long() * 128
+        return [codes.to(torch.uint8), scale]
+
+    def decode(self, wire, out=None):
+        codes, scale = wire
+        values, _ = self._table(codes.device)
+        codes = codes.long()
+        decoded = values[codes & 127] * scale
+        decoded = torch.where(codes >= 128, -decoded, decoded)
+        return out.copy_(decoded)
+
+
+class BlockInt8Codec(Codec):
+    """Quantizes blocks of `block_size` consecutive elements to int8 with
+    one float scale per block."""
+
+    copies = True
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+
+    def _num_blocks(self, shape):
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        return int(math.ceil(numel / self.block_size))
+
+    def wire_specs(self, shape, dtype):
+        num_blocks = self._num_blocks(shape)
+        return [((num_blocks, self.block_size), torch.int8),
+                ((num_blocks, 1), torch.float)]
+
+    def encode(self, tensor, key=None):
+        num_blocks = self._num_blocks(tensor.shape)
+        blocks = torch.zeros(num_blocks * self.block_size, dtype=torch.float,
+                             device=tensor.device)
+        blocks[:tensor.numel()] = tensor.reshape(-1)
+        blocks = blocks.view(num_blocks, self.block_size)
+        scales = blocks.abs().max(dim=1, keepdim=True)[0].clamp(
+            min=1e-30) / 127.0
+        quantized = torch.round(blocks / scales).to(torch.int8)
+        return [quantized, scales]
+
+    def decode(self, wire, out=None):
+        quantized, scales = wire
+        decoded = (quantized.float() * scales).view(-1)[:out.numel()]
+        return out.copy_(decoded.view(out.shape))
+
+
+class TopKCodec(Codec):
+    """Sends the `ratio` fraction of elements with the largest magnitudes,
+    and their indices. The elements that are not sent are added to the
+    next tensor encoded with the same key (error feedback)."""
+
+    copies = True
+
+    def __init__(self, ratio):
+        assert 0.0 < ratio <= 1.0
+        self.ratio = ratio
+        self.residuals = {}
+
+    def _k(self, shape):
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        return max(1, int(numel * self.ratio))
+
+    def wire_specs(self, shape, dtype):
+        k = self._k(shape)
+        return [((k,), dtype), ((k,), torch.int32)]
+
+    def encode(self, tensor, key=None):
+        flat = tensor.reshape(-1).float()
+        residual = self.residuals.get(key)
+        if residual is not None and residual.shape == flat.shape:
+            flat = flat + residual
+        indices = torch.topk(flat.abs(), self._k(tensor.shape),
+                             sorted=False)[1]
+        values = flat[indices]
+        residual = flat.clone()
+        residual[indices] = 0.0
+        self.residuals[key] = residual
+        return [values.to(tensor.dtype), indices.to(torch.int32)]
+
+    def decode(self, wire, out=None):
+        values, indices = wire
+        out.zero_()
+        out.view(-1)[indices.long()] = values
+        return out
+
+
+ACTIVATION_CODECS = ('none', 'bf16', 'fp8', 'int8')
+GRADIENT_CODECS = ACTIVATION_CODECS + ('topk',)
+
+
+def build_codec(name, block_size=64, topk_ratio=0.1):
+    """Codec called `name`, one of GRADIENT_CODECS."""
+    if name == 'none':
+        return Codec()
+    if name == 'bf16':
+        return Bf16Codec()
+    if name == 'fp8':
+        return Fp8Codec()
+    if name == 'int8':
+        return BlockInt8Codec(block_size)
+    if name == 'topk':
+        return TopKCodec(topk_ratio)
+    raise Exception('unknown codec {}'.format(name))
+
+
+def wire_bytes(codec, shape, dtype):
+    """Number of bytes sent for a tensor of the given shape and dtype."""
+    num_bytes = 0
+    for wire_shape, wire_dtype in codec.wire_specs(shape, dtype):
+        numel = 1
+        for dim in wire_shape:
+            numel *= dim
+        num_bytes += numel * torch.empty((), dtype=wire_dtype).element_size()
+    return num_bytes
@@ -0,0 +1,909 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pipeline schedules as per-rank instruction lists.
+
+Every pipeline schedule is compiled into one list of instructions per
+pipeline rank. The same lists are run by the executor in
+megatron/schedules.py, replayed by megatron/schedule_simulator.py and
+checked by `verify_instructions`, which needs neither GPUs nor torch.
+
+Microbatch ids are global: in schedules without flushes they keep counting
+across iterations. Model chunk `c` on pipeline rank `s` is virtual stage
+`c * num_stages + s`.
+"""
+
+from collections import deque
+from collections import namedtuple
+
+
+class Forward(namedtuple('Forward', ['microbatch', 'model_chunk'])):
+    """Forward pass of a microbatch through a model chunk."""
+    __slots__ = ()
+
+
+class Backward(namedtuple('Backward', ['microbatch', 'model_chunk'])):
+    """Backward pass of a microbatch through a model chunk."""
+    __slots__ = ()
+
+
+class SendActivation(namedtuple('SendActivation',
+                                ['microbatch', 'model_chunk'])):
+    """Send the output of Forward(microbatch, model_chunk) to the next
+    virtual stage."""
+    __slots__ = ()
+
+
+class RecvActivation(namedtuple('RecvActivation',
+                                ['microbatch', 'model_chunk'])):
+    """Receive the input of Forward(microbatch, model_chunk) from the
+    previous virtual stage."""
+    __slots__ = ()
+
+
+class SendGrad(namedtuple('SendGrad', ['microbatch', 'model_chunk'])):
+    """Send the input gradient of Backward(microbatch, model_chunk) to the
+    previous virtual stage."""
+    __slots__ = ()
+
+
+class RecvGrad(namedtuple('RecvGrad', ['microbatch', 'model_chunk'])):
+    """Receive the output gradient of Backward(microbatch, model_chunk) from
+    the next virtual stage."""
+    __slots__ = ()
+
+
+class SwapVersion(namedtuple('SwapVersion', ['version'])):
+    """Switch the model to the 'older' or 'newer' weight version (2BW)."""
+    __slots__ = ()
+
+
+class Barrier(namedtuple('Barrier', [])):
+    """Barrier over the pipeline-model-parallel group."""
+    __slots__ = ()
+
+
+class AllReduceGrads(namedtuple('AllReduceGrads', [])):
+    """Data-parallel gradient all-reduce. Simulation only: used in the
+    multi-iteration programs of `build_training_instructions`, which
+    `verify_instructions`, `run_instructions` and the schedule simulator
+    replay. The executor runs one iteration at a time and rejects it;
+    `train_step` reduces the gradients when running the model."""
+    __slots__ = ()
+
+
+class OptimizerStep(namedtuple('OptimizerStep', [])):
+    """Optimizer step. Simulation only, like `AllReduceGrads`: the executor
+    rejects it, and `train_step` steps the optimizer when running the
+    model."""
+    __slots__ = ()
+
+
+COMPUTE_INSTRUCTIONS = (Forward, Backward)
+COMMUNICATION_INSTRUCTIONS = (SendActivation, RecvActivation,
+                              SendGrad, RecvGrad)
+
+
+def _is_first_virtual_stage(stage, model_chunk):
+    return stage == 0 and model_chunk == 0
+
+
+def _is_last_virtual_stage(num_stages, stage, num_model_chunks, model_chunk):
+    return stage == num_stages - 1 and model_chunk == num_model_chunks - 1
+
+
+def _needed_receives(op, num_stages, stage, num_model_chunks):
+    if isinstance(op, Forward):
+        if not _is_first_virtual_stage(stage, op.model_chunk):
+            return [RecvActivation(*op)]
+    elif not _is_last_virtual_stage(num_stages, stage, num_model_chunks,
+                                    op.model_chunk):
+        return [RecvGrad(*op)]
+    return []
+
+
+def _produced_sends(op, num_stages, stage, num_model_chunks):
+    if isinstance(op, Forward):
+        if not _is_last_virtual_stage(num_stages, stage, num_model_chunks,
+                                      op.model_chunk):
+            return [SendActivation(*op)]
+    elif not _is_first_virtual_stage(stage, op.model_chunk):
+        return [SendGrad(*op)]
+    return []
+
+
+def _add_communication(ops, num_stages, stage, num_model_chunks=1,
+                       barrier_after=None, versions=None):
+    """Turn an ordered list of Forward / Backward instructions into a
+    program. Tensors produced by an operation are sent together with the
+    receives needed by the next operation, so that consecutive sends and
+    receives are issued as a single batched communication.
+
+    barrier_after: index of the operation after which (before its sends) a
+        Barrier is inserted; -1 inserts it at the start of the program.
+    versions: weight version of every operation; a SwapVersion is inserted
+        whenever it changes.
+    """
+    program = []
+    if barrier_after == -1:
+        program.append(Barrier())
+    if ops:
+        program.extend(_needed_receives(ops[0], num_stages, stage,
+                                        num_model_chunks))
+    current_version = None
+    for i, op in enumerate(ops):
+        if versions is not None and versions[i] != current_version:
+            current_version = versions[i]
+            program.append(SwapVersion(current_version))
+        program.append(op)
+        if barrier_after == i:
+            program.append(Barrier())
+        program.extend(_produced_sends(op, num_stages, stage,
+                                       num_model_chunks))
+        if i + 1 < len(ops):
+            program.extend(_needed_receives(ops[i + 1], num_stages, stage,
+                                            num_model_chunks))
+    return program
+
+
+def _has_forward_stall_barrier(num_stages, num_microbatches):
+    """Whether the warmup phase ends with the 'forward-pipeline-stall'
+    barrier. With fewer than num_stages - 1 microbatches, warmup is cut
+    short and a rank would wait at the barrier for a tensor that its
+    predecessor only sends after the barrier."""
+    return num_microbatches > 1 and num_microbatches >= num_stages - 1
+
+
+def one_f_one_b_instructions(num_stages, stage, num_microbatches,
+                             forward_only=False, gpipe=False,
+                             microbatch_offset=0):
+    """Program of `forward_backward_pipelining` (PipeDream-Flush, or GPipe
+    if `gpipe` is set) for one pipeline rank and one iteration."""
+    num_warmup_microbatches = min(num_stages - stage - 1, num_microbatches)
+    if num_microbatches == 1:
+        num_warmup_microbatches = 1
+    if gpipe:
+        num_warmup_microbatches = num_microbatches
+    num_microbatches_remaining = num_microbatches - num_warmup_microbatches
+
+    ops = [Forward(microbatch_offset + i, 0)
+           for i in range(num_warmup_microbatches)]
+    for i in range(num_microbatches_remaining):
+        ops.append(Forward(microbatch_offset + num_warmup_microbatches + i, 0))
+        if not forward_only:
+            ops.append(Backward(microbatch_offset + i, 0))
+    if not forward_only:
+        for i in range(num_warmup_microbatches):
+            ops.append(Backward(
+                microbatch_offset + num_microbatches_remaining + i, 0))
+
+    # Barrier before the first receive to measure the forward stall.
+    barrier_after = None
+    if not gpipe and _has_forward_stall_barrier(num_stages, num_microbatches):
+        barrier_after = num_warmup_microbatches - 1
+    return _add_communication(ops, num_stages, stage,
+                              barrier_after=barrier_after)
+
+
+def no_flushes_instructions(num_stages, stage, num_microbatches, iteration,
+                            first_iteration=False, last_iteration=False,
+                            max_in_flight=None, pipedream=False,
+                            num_iterations=None):
+    """Program of `forward_backward_pipelining_no_flushes` (PipeDream-2BW)
+    for one pipeline rank and the `iteration`-th iteration since the start
+    of the run.
+
+    Warmup forward passes only happen in the first iteration and cooldown
+    backward passes only in the last one, so the forward passes of an
+    iteration run `num_warmup` microbatches ahead of its backward passes.
+    Microbatches of the i-th batch use weight version i - 1: forward passes
+    that already belong to the next batch use the 'newer' version, all
+    other passes use the 'older' one.
+
+    With `max_in_flight`, at most that many microbatches are stashed for
+    their backward pass at a time: warmup stops early and the forward passes
+    are throttled to one per backward pass.
+
+    With `pipedream` (PipeDream weight stashing), warmup is num_stages -
+    stage - 1 microbatches even if that spans several batches, forward
+    passes use the latest weights and backward passes the weights of their
+    forward pass, which megatron/weight_versions.py keeps; no SwapVersion is
+    emitted. No forward pass runs past the last microbatch of the
+    `num_iterations` iterations of the run.
+    """
+    num_warmup_microbatches = num_stages - stage - 1
+    if not pipedream:
+        num_warmup_microbatches = min(num_warmup_microbatches,
+                                      num_microbatches)
+    if max_in_flight is not None:
+        assert max_in_flight >= 1
+        num_warmup_microbatches = min(num_warmup_microbatches,
+                                      max_in_flight - 1)
+    first_microbatch = iteration * num_microbatches
+    end_microbatch = first_microbatch + num_microbatches
+    # Forward passes stop at the end of the run.
+    end_forward = None
+    if last_iteration:
+        end_forward = end_microbatch
+    elif pipedream and num_iterations is not None:
+        end_forward = num_iterations * num_microbatches
+    next_forward = first_microbatch
+    if not first_iteration:
+        next_forward += num_warmup_microbatches
+
+    ops = []
+    barrier_after = None
+    if first_iteration:
+        num_warmup = num_warmup_microbatches
+        if end_forward is not None:
+            num_warmup = min(num_warmup, end_forward - first_microbatch)
+        for _ in range(num_warmup):
+            ops.append(Forward(next_forward, 0))
+            next_forward += 1
+        # The barrier needs warmup to shrink by one microbatch per stage,
+        # which a limit below num_stages breaks.
+        if pipedream:
+            has_barrier = end_forward is None or \
+                end_forward - first_microbatch >= num_stages - 1
+        else:
+            has_barrier = _has_forward_stall_barrier(num_stages,
+                                                     num_microbatches)
+        if has_barrier and \
+                (max_in_flight is None or max_in_flight >= num_stages):
+            barrier_after = num_warmup - 1
+    for backward in range(first_microbatch, end_microbatch):
+        if end_forward is None or next_forward < end_forward:
+            ops.append(Forward(next_forward, 0))
+            next_forward += 1
+        ops.append(Backward(backward, 0))
+
+    versions = None
+    if not pipedream:
+        versions = []
+        for op in ops:
+            if isinstance(op, Forward) and \
+                    op.microbatch // num_microbatches > iteration:
+                versions.append('newer')
+            else:
+                versions.append('older')
+    return _add_communication(ops, num_stages, stage,
+                              barrier_after=barrier_after, versions=versions)
+
+
+def weight_version_statistics(program):
+    """Peak number of weight versions that a rank keeps and largest
+    staleness, in optimizer steps, of the weights used by its backward
+    passes, for a multi-iteration program of `build_training_instructions`.
+    Passes use the version of the last SwapVersion (2BW, which keeps two
+    versions) or, without any, forward passes use the latest version and
+    backward passes that of their forward pass (PipeDream)."""
+    num_steps = 0
+    weights = None
+    forward_weights = {}
+    peak_versions = 1
+    max_staleness = 0
+    for instruction in program:
+        if isinstance(instruction, OptimizerStep):
+            num_steps += 1
+        elif isinstance(instruction, SwapVersion):
+            weights = max(num_steps - 1, 0) \
+                if instruction.version == 'older' else num_steps
+        elif isinstance(instruction, Forward):
+            forward_weights[tuple(instruction)] = \
+                num_steps if weights is None else weights
+        elif isinstance(instruction, Backward):
+            version = forward_weights.pop(tuple(instruction))
+            max_staleness = max(max_staleness, num_steps - version)
+        else:
+            continue
+        versions = set(forward_weights.values())
+        versions.add(num_steps)
+        if weights is not None:
+            versions.add(max(num_steps - 1, 0))
+        peak_versions = max(peak_versions, len(versions))
+    return peak_versions, max_staleness
+
+
+def _interleaved_op(k, forward, num_stages, num_model_chunks,
+                    microbatch_offset):
+    """k-th forward (or backward) operation of the interleaved schedule."""
+    group_size = num_stages * num_model_chunks
+    model_chunk = (k % group_size) // num_stages
+    if not forward:
+        model_chunk = num_model_chunks - model_chunk - 1
+    microbatch = microbatch_offset + (k // group_size) * num_stages + \
+        k % num_stages
+    if forward:
+        return Forward(microbatch, model_chunk)
+    return Backward(microbatch, model_chunk)
+
+
+def _interleaved_num_warmup(num_stages, stage, num_microbatches,
+                            num_model_chunks):
+    num_warmup = (num_stages - stage - 1) * 2
+    num_warmup += (num_model_chunks - 1) * num_stages
+    return min(num_warmup, num_microbatches * num_model_chunks)
+
+
+def _interleaved_program(num_stages, stage, num_microbatches,
+                         num_model_chunks, num_warmup, received,
+                         iteration=0, first_iteration=True,
+                         last_iteration=True, microbatch_offset=0,
+                         all_warmup_microbatches=False, forward_only=False,
+                         weight_versions=False):
+    """Program of one iteration of an interleaved schedule.
+
+    Neighbouring ranks exchange tensors in lockstep: after every step, a rank
+    receives whatever its neighbours produced in the same step. Model chunks
+    process microbatches in order, so a received tensor belongs to the next
+    microbatch of the receiving chunk; `received` holds these next
+    microbatches (activations and gradients, one entry per model chunk) and
+    is updated in place.
+
+    Warmup forward passes only run in the first iteration and cooldown
+    backward passes only in the last one; in between, the steady state
+    continues where the previous iteration stopped (with
+    `weight_versions`, as in PipeDream-2BW).
+    """
+    total = num_microbatches * num_model_chunks
+    base = iteration * total
+    first_rank = stage == 0
+    last_rank = stage == num_stages - 1
+    next_activations, next_grads = received
+    program = []
+    current_version = [None]
+
+    def op(k, forward):
+        return _interleaved_op(k, forward, num_stages, num_model_chunks,
+                               microbatch_offset)
+
+    def chunk(k, forward):
+        return op(k, forward).model_chunk
+
+    def compute(o):
+        if weight_versions:
+            version = 'older'
+            if isinstance(o, Forward) and \
+                    o.microbatch // num_microbatches > iteration:
+                version = 'newer'
+            if version != current_version[0]:
+                current_version[0] = version
+                program.append(SwapVersion(version))
+        program.append(o)
+
+    def send(ops):
+        for o in ops:
+            program.extend(_produced_sends(o, num_stages, stage,
+                                           num_model_chunks))
+
+    def recv_activation(model_chunk):
+        program.append(RecvActivation(next_activations[model_chunk],
+                                      model_chunk))
+        next_activations[model_chunk] += 1
+
+    def recv_grad(model_chunk):
+        program.append(RecvGrad(next_grads[model_chunk], model_chunk))
+        next_grads[model_chunk] += 1
+
+    # Warmup forward passes.
+    if first_iteration:
+        if not first_rank:
+            recv_activation(0)
+        for k in range(num_warmup):
+            forward = op(k, True)
+            compute(forward)
+            send([forward])
+            next_chunk = chunk(k + 1, True)
+            if not (first_rank and next_chunk == 0) and k != total - 1:
+                recv_activation(next_chunk)
+            if k == num_warmup - 1 and not forward_only and \
+                    not all_warmup_microbatches and not last_rank:
+                recv_grad(num_model_chunks - 1)
+
+    # Steady state: one forward and one backward pass per step.
+    num_steady = total - num_warmup if last_iteration else total
+    for j in range(num_steady):
+        forward_k = base + num_warmup + j
+        backward_k = base + j
+        forward, backward = op(forward_k, True), op(backward_k, False)
+        compute(forward)
+        compute(backward)
+        send([forward, backward])
+
+        recv_prev = True
+        if first_rank:
+            # First stage is ahead of last stage by (num_stages - 1).
+            next_forward_chunk = chunk(forward_k - (num_stages - 1), True)
+            if next_forward_chunk == num_model_chunks - 1:
+                recv_prev = False
+            next_forward_chunk += 1
+        else:
+            next_forward_chunk = chunk(forward_k + 1, True)
+        recv_next = True
+        if last_rank:
+            # Last stage is ahead of first stage by (num_stages - 1).
+            next_backward_chunk = chunk(backward_k - (num_stages - 1), False)
+            if next_backward_chunk == 0:
+                recv_next = False
+            next_backward_chunk -= 1
+        else:
+            next_backward_chunk = chunk(backward_k + 1, False)
+        if last_iteration and j == num_steady - 1:
+            recv_prev = False
+        if recv_prev:
+            recv_activation(next_forward_chunk)
+        if recv_next:
+            recv_grad(next_backward_chunk)
+
+    # Cooldown backward passes.
+    if last_iteration and not forward_only:
+        if all_warmup_microbatches and not last_rank:
+            recv_grad(num_model_chunks - 1)
+        for k in range(base + total - num_warmup, base + total):
+            backward = op(k, False)
+            compute(backward)
+            send([backward])
+            next_chunk = chunk(k + 1, False)
+            if not (last_rank and next_chunk == num_model_chunks - 1) and \
+                    k != base + total - 1:
+                recv_grad(next_chunk)
+    return program
+
+
+def interleaved_instructions(num_stages, stage, num_microbatches,
+                             num_model_chunks, forward_only=False,
+                             microbatch_offset=0):
+    """Program of `forward_backward_pipelining_with_interleaving` for one
+    pipeline rank and one iteration."""
+    assert num_microbatches % num_stages == 0, \
+        'number of microbatches ({}) is not divisible by the number of ' \
+        'pipeline stages ({}) when using the interleaved schedule'.format(
+            num_microbatches, num_stages)
+    total = num_microbatches * num_model_chunks
+    all_warmup_microbatches = False
+    if forward_only:
+        num_warmup = total
+    elif num_microbatches == num_stages:
+        num_warmup = total
+        all_warmup_microbatches = True
+    else:
+        num_warmup = _interleaved_num_warmup(num_stages, stage,
+                                             num_microbatches,
+                                             num_model_chunks)
+    received = ([microbatch_offset] * num_model_chunks,
+                [microbatch_offset] * num_model_chunks)
+    return _interleaved_program(
+        num_stages, stage, num_microbatches, num_model_chunks, num_warmup,
+        received, microbatch_offset=microbatch_offset,
+        all_warmup_microbatches=all_warmup_microbatches,
+        forward_only=forward_only)
+
+
+def interleaved_no_flushes_instructions(num_stages, stage, num_microbatches,
+                                        num_model_chunks, iteration,
+                                        first_iteration=False,
+                                        last_iteration=False):
+    """Program of `forward_backward_pipelining_no_flushes` with interleaved
+    model chunks for one pipeline rank and the `iteration`-th iteration
+    since the start of the run.
+
+    Forward passes run the warmup microbatches ahead of the backward passes
+    across iteration boundaries, and, as without interleaving, forward
+    passes that already belong to the next batch use the 'newer' weight
+    version of every model chunk. Only two weight versions are kept, so the
+    warmup phase has to be shorter than one iteration.
+    """
+    assert num_microbatches % num_stages == 0, \
+        'number of microbatches ({}) is not divisible by the number of ' \
+        'pipeline stages ({}) when using the interleaved schedule'.format(
+            num_microbatches, num_stages)
+    total = num_microbatches * num_model_chunks
+    max_num_warmup = _interleaved_num_warmup(num_stages, 0,
+                                             num_microbatches,
+                                             num_model_chunks)
+    assert max_num_warmup < total, \
+        'interleaved schedule without flushes needs more than {} forward ' \
+        'passes per iteration, got {} microbatches x {} model chunks'.format(
+            max_num_warmup, num_microbatches, num_model_chunks)
+    num_warmup = _interleaved_num_warmup(num_stages, stage, num_microbatches,
+                                         num_model_chunks)
+
+    # Every iteration after the first receives one tensor per microbatch
+    # and model chunk, so the next microbatches to receive follow from the
+    # ones after the first iteration.
+    received = ([0] * num_model_chunks, [0] * num_model_chunks)
+    if not first_iteration:
+        _interleaved_program(num_stages, stage, num_microbatches,
+                             num_model_chunks, num_warmup, received,
+                             last_iteration=False)
+        for counts in received:
+            for model_chunk in range(num_model_chunks):
+                counts[model_chunk] += (iteration - 1) * num_microbatches
+    return _interleaved_program(
+        num_stages, stage, num_microbatches, num_model_chunks, num_warmup,
+        received, iteration=iteration, first_iteration=first_iteration,
+        last_iteration=last_iteration, weight_versions=True)
+
+
+def build_training_instructions(schedule, num_stages, num_microbatches,
+                                num_iterations=1, num_model_chunks=1,
+                                max_in_flight=None):
+    """Per-rank programs for `num_iterations` training iterations, each
+    followed by the gradient all-reduce, the pipeline flush Barrier (for the
+    schedules that flush) and the optimizer step, as in `train_step`.
+    `schedule` is one of '1f1b', 'gpipe', '2bw', 'pipedream', 'interleaved'
+    or 'interleaved-2bw'; `max_in_flight` limits the stash of '2bw' and
+    'pipedream'."""
+    programs = []
+    for stage in range(num_stages):
+        program = []
+        for iteration in range(num_iterations):
+            offset = iteration * num_microbatches
+            if schedule == 'interleaved-2bw':
+                program.extend(interleaved_no_flushes_instructions(
+                    num_stages, stage, num_microbatches, num_model_chunks,
+                    iteration, first_iteration=(iteration == 0),
+                    last_iteration=(iteration == num_iterations - 1)))
+            elif schedule in ('2bw', 'pipedream'):
+                program.extend(no_flushes_instructions(
+                    num_stages, stage, num_microbatches, iteration,
+                    first_iteration=(iteration == 0),
+                    last_iteration=(iteration == num_iterations - 1),
+                    max_in_flight=max_in_flight,
+                    pipedream=(schedule == 'pipedream'),
+                    num_iterations=num_iterations))
+            elif schedule == 'interleaved':
+                program.extend(interleaved_instructions(
+                    num_stages, stage, num_microbatches, num_model_chunks,
+                    microbatch_offset=offset))
+            elif schedule in ('1f1b', 'gpipe'):
+                program.extend(one_f_one_b_instructions(
+                    num_stages, stage, num_microbatches,
+                    gpipe=(schedule == 'gpipe'), microbatch_offset=offset))
+            else:
+                raise Exception('unknown schedule {}'.format(schedule))
+            program.append(AllReduceGrads())
+            if schedule not in ('2bw', 'pipedream', 'interleaved-2bw') and \
+                    num_stages > 1:
+                program.append(Barrier())
+            program.append(OptimizerStep())
+        programs.append(program)
+    return programs
+
+
+def _communication_slot(instruction):
+    """Tensor slot of `_communicate` used by a communication instruction."""
+    if isinstance(instruction, SendActivation):
+        return 'send_next'
+    if isinstance(instruction, RecvActivation):
+        return 'recv_prev'
+    if isinstance(instruction, SendGrad):
+        return 'send_prev'
+    return 'recv_next'
+
+
+def group_instructions(program):
+    """Split a program into items that are either a single non-communication
+    instruction or a list of consecutive communication instructions that
+    are issued together (at most one per send / receive direction)."""
+    items = []
+    group = None
+    for instruction in program:
+        if isinstance(instruction, COMMUNICATION_INSTRUCTIONS):
+            slot = _communication_slot(instruction)
+            if group is None or \
+                    any(_communication_slot(i) == slot for i in group):
+                group = []
+                items.append(group)
+            group.append(instruction)
+        else:
+            group = None
+            items.append(instruction)
+    return items
+
+
+def communication_name(group):
+    """Timer name of a communication group, for example
+    'forward-send-backward-recv'."""
+    def directions(activation, grad):
+        names = []
+        if any(isinstance(i, activation) for i in group):
+            names.append('forward')
+        if any(isinstance(i, grad) for i in group):
+            names.append('backward')
+        return '-'.join(names)
+    sends = directions(SendActivation, SendGrad)
+    recvs = directions(RecvActivation, RecvGrad)
+    name = []
+    if sends:
+        name.append(sends + '-send')
+    if recvs:
+        name.append(recvs + '-recv')
+    return '-'.join(name)
+
+
+def _issue_order(group):
+    """Order in which a group is posted: activations before gradients, so
+    that messages between the same pair of ranks (pipelines of two stages)
+    are matched in the same order on both sides."""
+    return sorted(group, key=lambda i: isinstance(i, (SendGrad, RecvGrad)))
+
+
+def hoist_receives(program):
+    """Move every receive in front of the compute instruction that precedes
+    it, so that with non-blocking communication the input of the next pass
+    is in flight while the current one runs. Receives are not moved across
+    barriers, and their order on each channel is unchanged."""
+    hoisted = []
+    compute_index = None
+    for instruction in program:
+        if isinstance(instruction, (RecvActivation, RecvGrad)) and \
+                compute_index is not None:
+            hoisted.insert(compute_index, instruction)
+            compute_index += 1
+            continue
+        if isinstance(instruction, COMPUTE_INSTRUCTIONS):
+            compute_index = len(hoisted)
+        elif not isinstance(instruction, COMMUNICATION_INSTRUCTIONS):
+            compute_index = None
+        hoisted.append(instruction)
+    return hoisted
+
+
+def run_instructions(programs, num_model_chunks=1, compute_cost=None,
+                     transfer_cost=None, blocking=True):
+    """Replay per-rank programs with the semantics of the executor.
+
+    Every operation in a communication group is posted at once, and a send
+    is matched with the corresponding receive on the peer rank (messages
+    between two ranks are matched in order). With `blocking`, a group
+    completes when all of its operations have been matched. Otherwise
+    posting a group does not block: a forward or backward pass waits for
+    the receive of its input, and sends are waited for before barriers,
+    gradient all-reduces and optimizer steps. Barriers complete when all
+    ranks reach them.
+
+    Arguments:
+        programs: one instruction list per pipeline rank.
+        compute_cost: function (rank, instruction) -> duration of a
+            non-communication instruction. Defaults to zero.
+        transfer_cost: function (rank, instruction) -> latency of a send
+            instruction issued by `rank`. Defaults to zero.
+
+    Returns a list of (rank, instruction or communication group, start, end)
+    tuples. Raises RuntimeError on mismatched messages or deadlocks.
+    """
+    num_stages = len(programs)
+    if compute_cost is None:
+        compute_cost = lambda rank, instruction: 0.0
+    if transfer_cost is None:
+        transfer_cost = lambda rank, instruction: 0.0
+
+    items = [group_instructions(program) for program in programs]
+    pointers = [0] * num_stages
+    clocks = [0.0] * num_stages
+    # Posted operations are [rank, instruction, post time, completion time]
+    # entries; the completion time is set when they are matched.
+    posted = [None] * num_stages
+    received = [{} for _ in range(num_stages)]
+    outstanding_sends = [[] for _ in range(num_stages)]
+    barrier_arrivals = [None] * num_stages
+    sends = {}
+    recvs = {}
+    timeline = []
+
+    def peer(rank, instruction):
+        if isinstance(instruction, (SendActivation, RecvGrad)):
+            return (rank + 1) % num_stages
+        return (rank - 1) % num_stages
+
+    def post(rank, group):
+        entries = []
+        for instruction in _issue_order(group):
+            entry = [rank, instruction, clocks[rank], None]
+            if isinstance(instruction, (SendActivation, SendGrad)):
+                key = (rank, peer(rank, instruction))
+                sends.setdefault(key, deque()).append(entry)
+            else:
+                key = (peer(rank, instruction), rank)
+                recvs.setdefault(key, deque()).append(entry)
+            entries.append(entry)
+        return entries
+
+    def completion(entries):
+        """Time at which all entries complete, or None if one is pending."""
+        if any(entry[3] is None for entry in entries):
+            return None
+        return max([entry[3] for entry in entries] + [0.0])
+
+    def check_match(sender, send, receiver, recv):
+        if isinstance(send, SendActivation):
+            expected_chunk = send.model_chunk + \
+                (1 if sender == num_stages - 1 else 0)
+            expected_type = RecvActivation
+        else:
+            expected_chunk = send.model_chunk - (1 if sender == 0 else 0)
+            expected_type = RecvGrad
+        if not isinstance(recv, expected_type) or \
+                recv.microbatch != send.microbatch or \
+                recv.model_chunk != expected_chunk:
+            raise RuntimeError(
+                'mismatched communication: rank {} {} is matched with '
+                'rank {} {}'.format(sender, send, receiver, recv))
+
+    while True:
+        progress = False
+        for rank in range(num_stages):
+            while pointers[rank] < len(items[rank]) and \
+                    barrier_arrivals[rank] is None:
+                item = items[rank][pointers[rank]]
+                start = clocks[rank]
+                if isinstance(item, list) and blocking:
+                    if posted[rank] is None:
+                        posted[rank] = post(rank, item)
+                        progress = True
+                    end = completion(posted[rank])
+                    if end is None:
+                        break
+                    clocks[rank] = max(start, end)
+                    posted[rank] = None
+                elif isinstance(item, list):
+                    for entry in post(rank, item):
+                        instruction = entry[1]
+                        if isinstance(instruction, (SendActivation, SendGrad)):
+                            outstanding_sends[rank].append(entry)
+                        else:
+                            received[rank][(type(instruction),
+                                            tuple(instruction))] = entry
+                else:
+                    if isinstance(item, COMPUTE_INSTRUCTIONS):
+                        recv_type = RecvActivation \
+                            if isinstance(item, Forward) else RecvGrad
+                        waiting = received[rank].get((recv_type, tuple(item)))
+                        waiting = [] if waiting is None else [waiting]
+                    else:
+                        waiting = outstanding_sends[rank]
+                    end = completion(waiting)
+                    if end is None:
+                        break
+                    start = max(start, end)
+                    if not isinstance(item, COMPUTE_INSTRUCTIONS):
+                        outstanding_sends[rank] = []
+                    if isinstance(item, Barrier):
+                        barrier_arrivals[rank] = start
+                        break
+                    clocks[rank] = start + compute_cost(rank, item)
+                timeline.append((rank, item, start, clocks[rank]))
+                pointers[rank] += 1
+                progress = True
+
+        # Match posted sends and receives, in order, on every channel.
+        for key in sends:
+            send_queue = sends[key]
+            recv_queue = recvs.get(key)
+            while send_queue and recv_queue:
+                send_entry = send_queue.popleft()
+                recv_entry = recv_queue.popleft()
+                check_match(send_entry[0], send_entry[1],
+                            recv_entry[0], recv_entry[1])
+                end = max(send_entry[2], recv_entry[2]) + \
+                    transfer_cost(send_entry[0], send_entry[1])
+                send_entry[3] = recv_entry[3] = end
+                progress = True
+
+        if all(arrival is not None for arrival in barrier_arrivals):
+            release = max(barrier_arrivals)
+            for rank in range(num_stages):
+                timeline.append((rank, Barrier(), barrier_arrivals[rank],
+                                 release))
+                clocks[rank] = release
+                pointers[rank] += 1
+                barrier_arrivals[rank] = None
+            progress = True
+
+        if not progress:
+            break
+
+    stuck = [rank for rank in range(num_stages)
+             if pointers[rank] < len(items[rank])]
+    if stuck:
+        raise RuntimeError('pipeline programs deadlock; ranks {} are blocked '
+                           'at {}'.format(stuck, [items[rank][pointers[rank]]
+                                                  for rank in stuck]))
+    unmatched = [entry[:2] for queue in list(sends.values()) +
+                 list(recvs.values()) for entry in queue]
+    if unmatched:
+        raise RuntimeError('unmatched communication: {}'.format(unmatched))
+    return timeline
+
+
+def _check_dependencies(program, num_stages, stage, num_model_chunks,
+                        forward_only):
+    received_activations = set()
+    received_grads = set()
+    forwarded = set()
+    backwarded = set()
+    # Weights used by every forward pass: the 'older' version is the one
+    # before the last optimizer step, the 'newer' one is the current one.
+    num_steps = 0
+    weights = None
+    forward_weights = {}
+    for instruction in program:
+        key = tuple(instruction)
+        if isinstance(instruction, OptimizerStep):
+            num_steps += 1
+        elif isinstance(instruction, SwapVersion):
+            weights = max(num_steps - 1, 0) \
+                if instruction.version == 'older' else num_steps
+        if isinstance(instruction, (Forward, Backward,
+                                    SendActivation, SendGrad,
+                                    RecvActivation, RecvGrad)):
+            microbatch, model_chunk = key
+            first = _is_first_virtual_stage(stage, model_chunk)
+            last = _is_last_virtual_stage(num_stages, stage,
+                                          num_model_chunks, model_chunk)
+            assert 0 <= model_chunk < num_model_chunks, \
+                'rank {}: invalid model chunk in {}'.format(stage, instruction)
+        if isinstance(instruction, Forward):
+            assert key not in forwarded, \
+                'rank {}: {} runs twice'.format(stage, instruction)
+            assert first or key in received_activations, \
+                'rank {}: {} runs before its input is received'.format(
+                    stage, instruction)
+            forwarded.add(key)
+            forward_weights[key] = weights
+        elif isinstance(instruction, Backward):
+            assert key in forwarded and key not in backwarded, \
+                'rank {}: {} does not follow its forward pass'.format(
+                    stage, instruction)
+            assert forward_weights[key] == weights, \
+                'rank {}: {} uses different weights than its forward ' \
+                'pass'.format(stage, instruction)
+            assert last or key in received_grads, \
+                'rank {}: {} runs before its output gradient is ' \
+                'received'.format(stage, instruction)
+            backwarded.add(key)
+        elif isinstance(instruction, SendActivation):
+            assert not last and key in forwarded, \
+                'rank {}: invalid {}'.format(stage, instruction)
+        elif isinstance(instruction, SendGrad):
+            assert not first and key in backwarded, \
+                'rank {}: invalid {}'.format(stage, instruction)
+        elif isinstance(instruction, RecvActivation):
+            assert not first and key not in received_activations, \
+                'rank {}: invalid {}'.format(stage, instruction)
+            received_activations.add(key)
+        elif isinstance(instruction, RecvGrad):
+            assert not last and key not in received_grads, \
+                'rank {}: invalid {}'.format(stage, instruction)
+            received_grads.add(key)
+    if not forward_only:
+        assert forwarded == backwarded, \
+            'rank {}: microbatches {} are never run backward'.format(
+                stage, sorted(forwarded - backwarded))
+
+
+def verify_instructions(programs, num_model_chunks=1, forward_only=False,
+                        blocking=True):
+    """Check per-rank programs on the CPU: every pass runs after its inputs
+    are available, every forward pass has a backward pass (unless
+    `forward_only`) that uses the same weight version, sends and receives
+    are matched pairwise and the programs do not deadlock with blocking or
+    non-blocking communication. Raises AssertionError or RuntimeError."""
+    num_stages = len(programs)
+    for stage, program in enumerate(programs):
+        _check_dependencies(program, num_stages, stage, num_model_chunks,
+                            forward_only)
+    run_instructions(programs, num_model_chunks, blocking=blocking)
@@ -0,0 +1,180 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Chrome-trace export of the instructions run by the pipeline executor.
+
+With --pipeline-trace-dir, every rank records a span for each forward and
+backward pass, communication, receive / send wait, barrier and weight
+version swap, and appends them to `pipeline_trace_rank<rank>.json` in that
+directory at every log interval. On the GPU, spans are timed with CUDA
+events, so recording them does not synchronize; the device is only
+synchronized once per flush. merge_traces() (or
+tools/merge_pipeline_traces.py) merges the files of all ranks into one trace
+for chrome://tracing or Perfetto.
+"""
+
+import json
+import os
+import time
+
+import torch
+
+from megatron import get_args
+from megatron import mpu
+
+
+# Thread of the spans of each category in the trace of a rank.
+_THREADS = {'compute': 0, 'communication': 1}
+
+_PIPELINE_TRACER = None
+
+
+class PipelineTracer:
+    """Records spans of the executor on one rank and appends them to `path`
+    in the Chrome trace JSON array format."""
+
+    def __init__(self, path, rank, stage, use_cuda_events):
+        self.path = path
+        self.rank = rank
+        self.stage = stage
+        self.use_cuda_events = use_cuda_events
+        self.iteration = None
+        self.spans = []
+        self._free_events = []
+        # Wall-clock time of the origin of the timestamps, so that the
+        # traces of different ranks line up.
+        if use_cuda_events:
+            torch.cuda.synchronize()
+            self._origin = self._event()
+        self._origin_time = time.time()
+        self._origin_counter = time.perf_counter()
+
+        with open(path, 'w') as f:
+            f.write('[\n')
+            self._write(f, [
+                {'name': 'process_name', 'ph': 'M', 'pid': rank,
+                 'args': {'name': 'stage {} (rank {})'.format(stage, rank)}},
+                {'name': 'process_sort_index', 'ph': 'M', 'pid': rank,
+                 'args': {'sort_index': stage}}] + [
+                {'name': 'thread_name', 'ph': 'M', 'pid': rank, 'tid': tid,
+                 'args': {'name': name}} for name, tid in _THREADS.items()])
+
+    def _event(self):
+        if self._free_events:
+            event = self._free_events.pop()
+        else:
+            event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def _now(self):
+        if self.use_cuda_events:
+            return self._event()
+        return time.perf_counter()
+
+    def begin(self, name, category, args=None):
+        """Start a span of `category` ('compute' or 'communication');
+        `args` (e.g. the microbatch and model chunk) are shown with it."""
+        span = [name, category, args, self.iteration, self._now(), None]
+        self.spans.append(span)
+        return span
+
+    def end(self, span):
+        span[5] = self._now()
+
+    def _microseconds(self, timestamp):
+        if self.use_cuda_events:
+            seconds = self._origin.elapsed_time(timestamp) / 1000.0
+        else:
+            seconds = timestamp - self._origin_counter
+        return (self._origin_time + seconds) * 1e6
+
+    def flush(self):
+        """Append the finished spans to the trace file."""
+        if not self.spans:
+            return
+        if self.use_cuda_events:
+            torch.cuda.synchronize()
+        events, unfinished = [], []
+        for span in self.spans:
+            name, category, args, iteration, start, end = span
+            if end is None:
+                unfinished.append(span)
+                continue
+            start_us = self._microseconds(start)
+            args = dict(args or {})
+            if iteration is not None:
+                args['iteration'] = iteration
+            events.append({
+                'name': name, 'cat': category, 'ph': 'X',
+                'pid': self.rank, 'tid': _THREADS[category],
+                'ts': start_us,
+                'dur': max(self._microseconds(end) - start_us, 0.0),
+                'args': args})
+            if self.use_cuda_events:
+                self._free_events.extend((start, end))
+        self.spans = unfinished
+        with open(self.path, 'a') as f:
+            self._write(f, events)
+
+    @staticmethod
+    def _write(f, events):
+        for event in events:
+            f.write(json.dumps(event))
+            f.write(',\n')
+
+
+def init_pipeline_tracer():
+    """Create the tracer of this rank if --pipeline-trace-dir is set. Must be
+    called by all ranks, after the model parallel groups are initialized."""
+    global _PIPELINE_TRACER
+    args = get_args()
+    if args.pipeline_trace_dir is None:
+        return
+    rank = torch.distributed.get_rank()
+    if rank == 0:
+        os.makedirs(args.pipeline_trace_dir, exist_ok=True)
+    torch.distributed.barrier()
+    _PIPELINE_TRACER = PipelineTracer(
+        os.path.join(args.pipeline_trace_dir,
+                     'pipeline_trace_rank{}.json'.format(rank)),
+        rank, mpu.get_pipeline_model_parallel_rank(),
+        use_cuda_events=torch.cuda.is_available())
+
+
+def get_pipeline_tracer():
+    """The tracer of this rank, or None if tracing is disabled."""
+    return _PIPELINE_TRACER
+
+
+def load_trace(path):
+    """Events of a trace file, which may lack its closing bracket."""
+    with open(path) as f:
+        text = f.read().strip()
+    if text.endswith(','):
+        text = text[:-1]
+    if not text.endswith(']'):
+        text += ']'
+    return json.loads(text)
+
+
+def merge_traces(paths, output_path):
+    """Merge the trace files of several ranks into one Chrome trace."""
+    events = []
+    for path in paths:
+        events.extend(load_trace(path))
+    with open(output_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return len(events)
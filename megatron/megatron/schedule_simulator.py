@@ -0,0 +1,249 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline simulator for the pipeline schedules in megatron/schedules.py.
+
+The simulator replays the per-rank instruction lists of
+megatron/pipeline_instructions.py, i.e. exactly the programs run by the
+executor, and computes start and end times from per-stage cost inputs. It
+does not need GPUs, torch.distributed or even torch, so it can be used to
+reject bad (pipeline, data-parallel, micro-batch) configurations before
+running them on a cluster.
+
+Communication is blocking as in the executor: a batched send / receive
+completes once every message in it has been matched by the peer rank, plus
+the point-to-point latency of the sending stage. With async_communication,
+it is non-blocking as with --async-pipeline-communication: receives are
+posted one pass early and only the pass consuming a tensor waits for it.
+"""
+
+from megatron.pipeline_instructions import Forward, Backward
+from megatron.pipeline_instructions import hoist_receives
+from megatron.pipeline_instructions import AllReduceGrads, OptimizerStep
+from megatron.pipeline_instructions import build_training_instructions
+from megatron.pipeline_instructions import run_instructions
+from megatron.pipeline_instructions import weight_version_statistics
+
+SCHEDULES = ('1f1b', 'gpipe', '2bw', 'pipedream', 'interleaved',
+             'interleaved-2bw')
+
+
+def _per_stage(value, num_stages, name):
+    """Broadcast a scalar cost to all stages."""
+    if isinstance(value, (int, float)):
+        return [float(value)] * num_stages
+    value = [float(v) for v in value]
+    assert len(value) == num_stages, \
+        '{} should have one entry per stage ({}), got {}'.format(
+            name, num_stages, len(value))
+    return value
+
+
+def ring_allreduce_time(data_parallel_size, grad_bytes, bandwidth):
+    """Time of a ring all-reduce of `grad_bytes` bytes over
+    `data_parallel_size` ranks with a bus bandwidth of `bandwidth` bytes per
+    unit of time: each rank sends and receives 2 (dp - 1) / dp of the
+    gradients."""
+    assert data_parallel_size >= 1
+    if data_parallel_size == 1:
+        return 0.0
+    assert bandwidth is not None and bandwidth > 0.0, \
+        'the all-reduce bandwidth should be positive'
+    return 2.0 * (data_parallel_size - 1) / data_parallel_size * \
+        grad_bytes / bandwidth
+
+
+class SimulationResult:
+    """Timings produced by `simulate_schedule`.
+
+    All times are in the units of the cost inputs (seconds by convention).
+        iteration_time: steady-state time of one training iteration
+            (time between the ends of the first and the last simulated
+            iteration divided by the number of iterations in between).
+        stage_busy_time: per-stage forward + backward compute time in one
+            iteration.
+        stage_idle_time: per-stage time in one iteration that is spent
+            neither on compute nor on the all-reduce / optimizer step.
+        bubble_fraction: idle time summed over stages divided by
+            (number of stages x iteration time).
+        peak_in_flight_activations: per-stage maximum number of
+            (microbatch, model chunk) pairs whose forward pass has run but
+            whose backward pass has not.
+        peak_weight_versions: per-stage maximum number of weight versions
+            kept at a time.
+        max_staleness: per-stage largest number of optimizer steps between
+            the weights used by a backward pass and the latest ones.
+        timeline: list of (stage, instruction, start, end), where the
+            instruction is a list for batched communication.
+    """
+
+    def __init__(self, schedule, num_stages, num_microbatches,
+                 num_model_chunks, iteration_time, stage_busy_time,
+                 stage_idle_time, peak_in_flight_activations,
+                 peak_weight_versions, max_staleness, timeline):
+        self.schedule = schedule
+        self.num_stages = num_stages
+        self.num_microbatches = num_microbatches
+        self.num_model_chunks = num_model_chunks
+        self.iteration_time = iteration_time
+        self.stage_busy_time = stage_busy_time
+        self.stage_idle_time = stage_idle_time
+        self.bubble_fraction = sum(stage_idle_time) / \
+            (num_stages * iteration_time) if iteration_time > 0.0 else 0.0
+        self.peak_in_flight_activations = peak_in_flight_activations
+        self.peak_weight_versions = peak_weight_versions
+        self.max_staleness = max_staleness
+        self.timeline = timeline
+
+    def summary(self):
+        string = 'schedule: {} | stages: {} | microbatches: {}'.format(
+            self.schedule, self.num_stages, self.num_microbatches)
+        if self.num_model_chunks > 1:
+            string += ' | model chunks: {}'.format(self.num_model_chunks)
+        string += ' | iteration time: {:.4f}'.format(self.iteration_time)
+        string += ' | bubble fraction: {:.3f}'.format(self.bubble_fraction)
+        string += ' | idle time per stage: [{}]'.format(
+            ', '.join('{:.4f}'.format(t) for t in self.stage_idle_time))
+        string += ' | peak in-flight activations per stage: {}'.format(
+            self.peak_in_flight_activations)
+        string += ' | peak weight versions per stage: {}'.format(
+            self.peak_weight_versions)
+        string += ' | max staleness per stage: {}'.format(self.max_staleness)
+        return string
+
+
+def simulate_schedule(schedule, num_stages, num_microbatches,
+                      forward_times, backward_times, p2p_times=0.0,
+                      allreduce_times=None, optimizer_times=0.0,
+                      num_model_chunks=1, num_iterations=3,
+                      async_communication=False, max_in_flight=None,
+                      data_parallel_size=1, grad_bytes=0.0,
+                      allreduce_bandwidth=None):
+    """Simulate `num_iterations` training iterations of a pipeline schedule.
+
+    Arguments:
+        schedule: one of '1f1b' (`forward_backward_pipelining`), 'gpipe'
+            (`forward_backward_pipelining` with --gpipe), '2bw'
+            (`forward_backward_pipelining_no_flushes`), 'pipedream'
+            (`forward_backward_pipelining_no_flushes` with
+            --pipeline-weight-versions), 'interleaved'
+            (`forward_backward_pipelining_with_interleaving`) or
+            'interleaved-2bw' (`forward_backward_pipelining_no_flushes` with
+            several model chunks).
+        num_stages: pipeline-model-parallel size.
+        num_microbatches: number of microbatches per iteration.
+        forward_times, backward_times: time of a forward / backward pass of
+            one microbatch through the whole stage (scalar or one value per
+            stage). With interleaving, each of the `num_model_chunks` chunks
+            of a stage takes 1 / num_model_chunks of this.
+        p2p_times: latency of sending an activation or gradient from a stage
+            to the next (or previous) one (scalar or one value per sending
+            stage).
+        allreduce_times: data-parallel gradient all-reduce time per stage,
+            paid once per iteration after the last backward pass. Derived
+            from `data_parallel_size`, `grad_bytes` and
+            `allreduce_bandwidth` with `ring_allreduce_time` when not given.
+        optimizer_times: optimizer step time per stage.
+        num_iterations: number of iterations to simulate; the steady-state
+            iteration time is measured between the first and last one.
+        async_communication: simulate --async-pipeline-communication.
+        max_in_flight: simulate --pipeline-stash-limit ('2bw' and
+            'pipedream' only).
+        data_parallel_size: number of data-parallel replicas of each stage.
+        grad_bytes: size in bytes of the gradients of a stage (scalar or one
+            value per stage).
+        allreduce_bandwidth: all-reduce bus bandwidth in bytes per unit of
+            time (only needed with a data-parallel size above 1).
+    """
+    assert num_stages >= 1 and num_microbatches >= 1 and num_iterations >= 1
+    assert schedule in SCHEDULES, 'unknown schedule {}'.format(schedule)
+    if not schedule.startswith('interleaved'):
+        assert num_model_chunks == 1, \
+            'only the interleaved schedules support multiple model chunks'
+    forward_times = _per_stage(forward_times, num_stages, 'forward_times')
+    backward_times = _per_stage(backward_times, num_stages, 'backward_times')
+    p2p_times = _per_stage(p2p_times, num_stages, 'p2p_times')
+    if allreduce_times is None:
+        grad_bytes = _per_stage(grad_bytes, num_stages, 'grad_bytes')
+        allreduce_times = [ring_allreduce_time(data_parallel_size, size,
+                                               allreduce_bandwidth)
+                           for size in grad_bytes]
+    allreduce_times = _per_stage(allreduce_times, num_stages,
+                                 'allreduce_times')
+    optimizer_times = _per_stage(optimizer_times, num_stages,
+                                 'optimizer_times')
+
+    programs = build_training_instructions(schedule, num_stages,
+                                           num_microbatches, num_iterations,
+                                           num_model_chunks, max_in_flight)
+    weight_versions = [weight_version_statistics(program)
+                       for program in programs]
+    if async_communication:
+        programs = [hoist_receives(program) for program in programs]
+
+    def compute_cost(stage, instruction):
+        if isinstance(instruction, Forward):
+            return forward_times[stage] / num_model_chunks
+        if isinstance(instruction, Backward):
+            return backward_times[stage] / num_model_chunks
+        if isinstance(instruction, AllReduceGrads):
+            return allreduce_times[stage]
+        if isinstance(instruction, OptimizerStep):
+            return optimizer_times[stage]
+        return 0.0
+
+    def transfer_cost(stage, instruction):
+        return p2p_times[stage]
+
+    try:
+        timeline = run_instructions(programs, num_model_chunks,
+                                    compute_cost, transfer_cost,
+                                    blocking=not async_communication)
+    except RuntimeError as e:
+        raise RuntimeError('simulation of schedule {} failed: {}'.format(
+            schedule, e))
+
+    in_flight = [0] * num_stages
+    peak_in_flight = [0] * num_stages
+    iteration_ends = [[] for _ in range(num_stages)]
+    for stage, instruction, start, end in timeline:
+        if isinstance(instruction, (Forward, Backward)):
+            in_flight[stage] += 1 if isinstance(instruction, Forward) else -1
+            peak_in_flight[stage] = max(peak_in_flight[stage],
+                                        in_flight[stage])
+        elif isinstance(instruction, OptimizerStep):
+            iteration_ends[stage].append(end)
+
+    ends = [max(iteration_ends[stage][i] for stage in range(num_stages))
+            for i in range(num_iterations)]
+    if num_iterations > 1:
+        iteration_time = (ends[-1] - ends[0]) / (num_iterations - 1)
+    else:
+        iteration_time = ends[0]
+
+    stage_busy_time = [num_microbatches * (forward_times[stage] +
+                                           backward_times[stage])
+                       for stage in range(num_stages)]
+    stage_idle_time = [max(0.0, iteration_time - stage_busy_time[stage] -
+                           allreduce_times[stage] - optimizer_times[stage])
+                       for stage in range(num_stages)]
+
+    return SimulationResult(schedule, num_stages, num_microbatches,
+                            num_model_chunks, iteration_time,
+                            stage_busy_time, stage_idle_time,
+                            peak_in_flight,
+                            [versions for versions, _ in weight_versions],
+                            [staleness for _, staleness in weight_versions],
+                            timeline)
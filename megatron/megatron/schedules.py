@@ -14,26 +14,74 @@
 # limitations under the License.
 
 import torch
+from torch.nn.parallel.distributed import DistributedDataParallel as torchDDP
 
 from megatron import get_args
 from megatron import get_timers
 from megatron import mpu
 from megatron import get_num_microbatches
-from megatron.p2p_communication import recv_forward, recv_backward
-from megatron.p2p_communication import send_forward, send_backward
-from megatron.p2p_communication import send_forward_recv_backward, send_backward_recv_forward
-from megatron.p2p_communication import send_forward_recv_forward, send_backward_recv_backward
-from megatron.p2p_communication import send_forward_backward_recv_forward_backward
-
-input_tensors = []
-output_tensors  = []
+from megatron.model.distributed import DistributedDataParallel as LocalDDP
+from megatron.model.module import FP16Module
+from megatron.p2p_communication import release_received_tensor
+from megatron.p2p_communication import send_and_recv
+from megatron.pipeline_trace import get_pipeline_tracer
+from megatron.pipeline_instructions import Forward, Backward
+from megatron.pipeline_instructions import SendActivation, SendGrad
+from megatron.pipeline_instructions import RecvActivation
+from megatron.pipeline_instructions import SwapVersion, Barrier
+from megatron.pipeline_instructions import AllReduceGrads, OptimizerStep
+from megatron.pipeline_instructions import group_instructions
+from megatron.pipeline_instructions import hoist_receives
+from megatron.pipeline_instructions import communication_name
+from megatron.pipeline_instructions import one_f_one_b_instructions
+from megatron.pipeline_instructions import no_flushes_instructions
+from megatron.pipeline_instructions import interleaved_instructions
+from megatron.pipeline_instructions import interleaved_no_flushes_instructions
+from megatron.weight_versions import WeightVersionStore
+
+
+class PipelineState:
+    """Tensors passed between the instructions of a pipeline program, keyed
+    by (microbatch, model_chunk)."""
+
+    def __init__(self):
+        self.input_tensors = {}
+        self.output_tensors = {}
+        self.input_tensor_grads = {}
+        self.output_tensor_grads = {}
+        # Non-blocking communication in flight: receives keyed like the
+        # tensors they produce, and the last send to the 'next' and 'prev'
+        # stages if it was not waited for yet.
+        self.input_tensor_handles = {}
+        self.output_tensor_grad_handles = {}
+        self.send_handles = {}
+        # Device of the received inputs offloaded to the CPU until their
+        # backward pass.
+        self.offloaded_devices = {}
+        self.iteration = 0
+        # Peak number of microbatches stashed for their backward pass, and
+        # bytes of their stashed tensors left on the device and offloaded,
+        # during the last program.
+        self.peak_stash_depth = 0
+        self.peak_stash_bytes = 0
+        self.peak_offloaded_bytes = 0
+        # WeightVersionStore of --pipeline-weight-versions.
+        self.weight_versions = None
+
+
+# State carried across iterations by the schedule without flushes.
+_NO_FLUSHES_STATE = None
+
+# Peak stash statistics of the programs run since the last call to
+# get_stash_statistics().
+_STASH_STATISTICS = [0, 0, 0]
 
 
 def forward_step(forward_step_func, data_iterator, model, input_tensor, losses_reduced):
     """Forward step."""
     timers = get_timers()
 
-    timers('forward-compute').start()
+    timers('forward-compute', log_level=2).start()
     output_tensor = forward_step_func(data_iterator, model, input_tensor)
     if mpu.is_pipeline_last_stage():
         loss, loss_reduced = output_tensor
@@ -49,7 +97,7 @@ def backward_step(optimizer, input_tensor, output_tensor, output_tensor_grad):
     args = get_args()
 
     timers = get_timers()
-    timers('backward-compute').start()
+    timers('backward-compute', log_level=2).start()
 
     # Retain the grad on the input_tensor.
     if input_tensor is not None:
@@ -82,404 +130,499 @@ def forward_backward_no_pipelining(forward_step_func, data_iterator, model,
         output_tensor = forward_step(forward_step_func, data_iterator, model,
                                      input_tensor, losses_reduced)
         if not forward_only:
+            if i == get_num_microbatches() - 1:
+                _enable_grad_sync(model)
             backward_step(optimizer, input_tensor, output_tensor,
                           output_tensor_grad)
 
     return losses_reduced
 
 
-def forward_backward_pipelining_with_interleaving(forward_step_func, data_iterator, model,
-                                                  optimizer, timers, forward_only):
-    """Run interleaved 1F1B schedule."""
-    input_tensors = [[] for _ in range(len(model))]
-    output_tensors = [[] for _ in range(len(model))]
-    losses_reduced = []
-    if not forward_only:
-        output_tensor_grads = [[] for _ in range(len(model))]
-
-    pipeline_parallel_size = mpu.get_pipeline_model_parallel_world_size()
-    pipeline_parallel_rank = mpu.get_pipeline_model_parallel_rank()
-
-    # Compute number of warmup and remaining microbatches.
-    num_model_chunks = len(model)
-    num_microbatches = get_num_microbatches() * num_model_chunks
-    all_warmup_microbatches = False
-    if forward_only:
-        num_warmup_microbatches = num_microbatches
-    else:
-        if get_num_microbatches() == pipeline_parallel_size:
-            num_warmup_microbatches = num_microbatches
-            all_warmup_microbatches = True
-        else:
-            num_warmup_microbatches = \
-                (pipeline_parallel_size - pipeline_parallel_rank - 1) * 2
-            num_warmup_microbatches += (num_model_chunks - 1) * pipeline_parallel_size
-            num_warmup_microbatches = min(num_warmup_microbatches, num_microbatches)
-    num_microbatches_remaining = \
-        num_microbatches - num_warmup_microbatches
-
-    def get_model_chunk_id(k, forward):
-        k_in_group = k % (pipeline_parallel_size * num_model_chunks)
-        i = k_in_group // pipeline_parallel_size
-        if not forward:
-            i = (num_model_chunks - i - 1)
-        return i
-
-    def forward_step_helper(k):
-        model_chunk_id = get_model_chunk_id(k, forward=True)
-        mpu.set_virtual_pipeline_model_parallel_rank(model_chunk_id)
-
-        if mpu.is_pipeline_first_stage():
-            if len(input_tensors[model_chunk_id]) == len(output_tensors[model_chunk_id]):
-                input_tensors[model_chunk_id].append(None)
-        input_tensor = input_tensors[model_chunk_id][-1]
-        output_tensor = forward_step(forward_step_func, data_iterator[model_chunk_id],
-                                     model[model_chunk_id],
-                                     input_tensor, losses_reduced)
-        output_tensors[model_chunk_id].append(output_tensor)
-
-        return output_tensor
-
-    def backward_step_helper(k):
-        model_chunk_id = get_model_chunk_id(k, forward=False)
-        mpu.set_virtual_pipeline_model_parallel_rank(model_chunk_id)
-
-        if mpu.is_pipeline_last_stage():
-            if len(output_tensor_grads[model_chunk_id]) == 0:
-                output_tensor_grads[model_chunk_id].append(None)
-        input_tensor = input_tensors[model_chunk_id].pop(0)
-        output_tensor = output_tensors[model_chunk_id].pop(0)
-        output_tensor_grad = output_tensor_grads[model_chunk_id].pop(0)
-        input_tensor_grad = \
-            backward_step(optimizer, input_tensor, output_tensor, output_tensor_grad)
-
-        return input_tensor_grad
-
-    # Run warmup forward passes.
-    mpu.set_virtual_pipeline_model_parallel_rank(0)
-    input_tensors[0].append(recv_forward(timers, use_ring_exchange=True))
-    for k in range(num_warmup_microbatches):
-        output_tensor = forward_step_helper(k)
-        next_forward_model_chunk_id = get_model_chunk_id(k+1, forward=True)
-        recv_prev = True
-        if mpu.is_pipeline_first_stage(ignore_virtual=True):
-            if next_forward_model_chunk_id == 0:
-                recv_prev = False
-        if k == (num_microbatches - 1):
-            recv_prev = False
-        if mpu.is_pipeline_last_stage():
-            output_tensor = None
-        if k == (num_warmup_microbatches - 1) and not forward_only and \
-                not all_warmup_microbatches:
-            input_tensor_grad = None
-            recv_next = True
-            if mpu.is_pipeline_last_stage(ignore_virtual=True):
-                recv_next = False
-            input_tensor, output_tensor_grad = \
-                send_forward_backward_recv_forward_backward(
-                        output_tensor, input_tensor_grad,
-                        recv_prev=recv_prev, recv_next=recv_next,
-                        timers=timers)
-            output_tensor_grads[num_model_chunks-1].append(output_tensor_grad)
-        else:
-            input_tensor = send_forward_recv_forward(output_tensor, recv_prev, timers)
-        input_tensors[next_forward_model_chunk_id].append(input_tensor)
-
-    # Run 1F1B in steady state.
-    for k in range(num_microbatches_remaining):
-        # Forward pass.
-        forward_k = k + num_warmup_microbatches
-        output_tensor = forward_step_helper(forward_k)
-
-        # Backward pass.
-        backward_k = k
-        input_tensor_grad = backward_step_helper(backward_k)
-
-        # Send output_tensor and input_tensor_grad, receive input_tensor
-        # and output_tensor_grad.
-
-        # Determine if current stage has anything to send in either direction,
-        # otherwise set tensor to None.
-        forward_model_chunk_id = get_model_chunk_id(forward_k, forward=True)
-        mpu.set_virtual_pipeline_model_parallel_rank(forward_model_chunk_id)
-        if mpu.is_pipeline_last_stage():
-            output_tensor = None
-
-        backward_model_chunk_id = get_model_chunk_id(backward_k, forward=False)
-        mpu.set_virtual_pipeline_model_parallel_rank(backward_model_chunk_id)
-        if mpu.is_pipeline_first_stage():
-            input_tensor_grad = None
-
-        # Determine if peers are sending, and where in data structure to put
-        # received tensors.
-        recv_prev = True
-        if mpu.is_pipeline_first_stage(ignore_virtual=True):
-            # First stage is ahead of last stage by (pipeline_parallel_size - 1).
-            next_forward_model_chunk_id = get_model_chunk_id(
-                forward_k - (pipeline_parallel_size - 1), forward=True)
-            if next_forward_model_chunk_id == (num_model_chunks - 1):
-                recv_prev = False
-            next_forward_model_chunk_id += 1
-        else:
-            next_forward_model_chunk_id = get_model_chunk_id(forward_k + 1, forward=True)
-
-        recv_next = True
-        if mpu.is_pipeline_last_stage(ignore_virtual=True):
-            # Last stage is ahead of first stage by (pipeline_parallel_size - 1).
-            next_backward_model_chunk_id = get_model_chunk_id(
-                backward_k - (pipeline_parallel_size - 1), forward=False)
-            if next_backward_model_chunk_id == 0:
-                recv_next = False
-            next_backward_model_chunk_id -= 1
+def _enable_grad_sync(model, embedding_chunk=False):
+    """Let the local DDP with --overlap-grad-reduce all-reduce the grads of
+    the next backward pass, the last one of the iteration for `model`. The
+    grad of word embeddings shared with the other end of the pipeline
+    (embedding_chunk) is left to allreduce_params(), which runs after their
+    embedding all-reduce."""
+    if isinstance(model, LocalDDP):
+        model.enable_grad_sync()
+        weight = _shared_word_embeddings_weight(model) \
+            if embedding_chunk else None
+        if weight is not None:
+            model.defer_grad_sync(weight)
+
+
+def _embedding_model_chunk(num_model_chunks):
+    """Index of the model chunk of this rank that may hold word embeddings
+    shared by the first and last pipeline stages, or None."""
+    if mpu.get_pipeline_model_parallel_world_size() == 1:
+        return None
+    if mpu.is_pipeline_first_stage(ignore_virtual=True):
+        return 0
+    if mpu.is_pipeline_last_stage(ignore_virtual=True):
+        return num_model_chunks - 1
+    return None
+
+
+def _shared_word_embeddings_weight(model):
+    """Weight of the word embeddings that `model` shares with the other end
+    of the pipeline, or None."""
+    while isinstance(model, (torchDDP, LocalDDP, FP16Module)):
+        model = model.module
+    if not getattr(model, 'share_word_embeddings', False):
+        return None
+    return model.word_embeddings_weight()
+
+
+def _start_embedding_grad_sync(model, optimizer):
+    """Start the all-reduce of the grad of the word embeddings of `model`
+    with the other stage that shares them. optimizer.wait_for_grad_syncs()
+    waits for it, before the data-parallel all-reduce of the grads."""
+    weight = _shared_word_embeddings_weight(model)
+    if weight is None:
+        return
+    optimizer.add_grad_sync(torch.distributed.all_reduce(
+        weight.grad, group=mpu.get_embedding_group(), async_op=True))
+
+
+def _set_model_chunk(model_chunk, num_model_chunks):
+    if num_model_chunks > 1:
+        mpu.set_virtual_pipeline_model_parallel_rank(model_chunk)
+
+
+def _execute_communication(group, state, timers, forward_only,
+                           async_communication):
+    """Issue a group of send / receive instructions as one batched
+    communication and store the received tensors, or the handle of the
+    communication if it is non-blocking. With scatter-gather, the passes
+    consuming the received tensors wait for their all-gathers."""
+    tensor_send_next = None
+    tensor_send_prev = None
+    recv_prev_key = None
+    recv_next_key = None
+    grad_model_chunk = 0
+    for instruction in group:
+        key = tuple(instruction)
+        if isinstance(instruction, SendActivation):
+            if forward_only:
+                tensor_send_next = state.output_tensors.pop(key)
+            else:
+                tensor_send_next = state.output_tensors[key]
+        elif isinstance(instruction, SendGrad):
+            tensor_send_prev = state.input_tensor_grads.pop(key)
+            grad_model_chunk = instruction.model_chunk
+        elif isinstance(instruction, RecvActivation):
+            recv_prev_key = key
         else:
-            next_backward_model_chunk_id = get_model_chunk_id(backward_k + 1, forward=False)
-
-        # If last iteration, don't receive; we already received one extra before the
-        # start of the for loop.
-        if k == (num_microbatches_remaining - 1):
-            recv_prev = False
-
-        # Communicate tensors.
-        input_tensor, output_tensor_grad = \
-            send_forward_backward_recv_forward_backward(
-                    output_tensor, input_tensor_grad,
-                    recv_prev=recv_prev, recv_next=recv_next,
-                    timers=timers)
-
-        # Put input_tensor and output_tensor_grad in data structures in the right location.
-        if recv_prev:
-            input_tensors[next_forward_model_chunk_id].append(input_tensor)
-        if recv_next:
-            output_tensor_grads[next_backward_model_chunk_id].append(output_tensor_grad)
-
-    # Run cooldown backward passes.
-    if not forward_only:
-        if all_warmup_microbatches:
-            output_tensor_grads[num_model_chunks-1].append(
-                recv_backward(timers, use_ring_exchange=True))
-        for k in range(num_microbatches_remaining, num_microbatches):
-            input_tensor_grad = backward_step_helper(k)
-            next_backward_model_chunk_id = get_model_chunk_id(k+1, forward=False)
-            recv_next = True
-            if mpu.is_pipeline_last_stage(ignore_virtual=True):
-                if next_backward_model_chunk_id == (num_model_chunks - 1):
-                    recv_next = False
-            if k == (num_microbatches - 1):
-                recv_next = False
-            output_tensor_grads[next_backward_model_chunk_id].append(
-                send_backward_recv_backward(input_tensor_grad, recv_next, timers))
-
-    return losses_reduced
-
-
-def forward_backward_pipelining(forward_step_func, data_iterator, model,
-                                optimizer, timers, forward_only):
-    """Run 1F1B schedule, with communication and warmup + cooldown microbatches as needed."""
-    timers = get_timers()
-    args = get_args()
-
-    assert len(model) == 1
-    model = model[0]
-
-    # Compute number of warmup microbatches.
-    num_microbatches = get_num_microbatches()
-    num_warmup_microbatches = \
-        (mpu.get_pipeline_model_parallel_world_size() -
-         mpu.get_pipeline_model_parallel_rank() - 1)
-    num_warmup_microbatches = min(
-        num_warmup_microbatches,
-        num_microbatches)
-    if num_microbatches == 1:
-        num_warmup_microbatches = 1
-    if args.gpipe:
-        num_warmup_microbatches = num_microbatches
-    num_microbatches_remaining = \
-        num_microbatches - num_warmup_microbatches
-
-    input_tensors = []
-    output_tensors = []
+            recv_next_key = key
+
+    defer_gathers = get_args().scatter_gather_tensors_in_pipeline and \
+        (recv_prev_key is not None or recv_next_key is not None)
+    directions = []
+    if tensor_send_next is not None:
+        directions.append('next')
+    if tensor_send_prev is not None:
+        directions.append('prev')
+    # At most one send per direction is in flight, so that the sent tensors
+    # are freed as in blocking mode.
+    _wait_for_sends(state, timers, directions)
+    name = communication_name(group)
+    tracer = get_pipeline_tracer()
+    if tracer is not None:
+        span = tracer.begin(name, 'communication',
+                            {'instructions': [repr(i) for i in group]})
+    if timers is not None:
+        timers(name, log_level=2).start()
+    result = send_and_recv(
+        tensor_send_next, tensor_send_prev,
+        recv_prev=recv_prev_key is not None,
+        recv_next=recv_next_key is not None,
+        async_op=async_communication or defer_gathers,
+        grad_model_chunk=grad_model_chunk,
+        grad_shape=None if recv_next_key is None else
+        state.output_tensors[recv_next_key].shape)
+    if async_communication:
+        result.start_gathers()
+    elif defer_gathers:
+        result.wait_for_transfer()
+    if timers is not None:
+        timers(name).stop()
+    if tracer is not None:
+        tracer.end(span)
+
+    if async_communication or defer_gathers:
+        if async_communication:
+            for direction in directions:
+                state.send_handles[direction] = result
+        if recv_prev_key is not None:
+            state.input_tensor_handles[recv_prev_key] = result
+        if recv_next_key is not None:
+            state.output_tensor_grad_handles[recv_next_key] = result
+        return
+
+    input_tensor, output_tensor_grad = result
+    if recv_prev_key is not None:
+        state.input_tensors[recv_prev_key] = input_tensor
+    if recv_next_key is not None:
+        state.output_tensor_grads[recv_next_key] = output_tensor_grad
+
+
+def _wait_for_receive(handles, tensors, key, index, timers, name):
+    """Wait for the non-blocking receive of tensors[key], if any."""
+    handle = handles.pop(key, None)
+    if handle is None:
+        return
+    tracer = get_pipeline_tracer()
+    if tracer is not None:
+        span = tracer.begin(name, 'communication', _trace_args(key))
+    if timers is not None:
+        timers(name, log_level=2).start()
+    tensors[key] = handle.wait()[index]
+    if timers is not None:
+        timers(name).stop()
+    if tracer is not None:
+        tracer.end(span)
+
+
+def _trace_args(key):
+    microbatch, model_chunk = key
+    return {'microbatch': microbatch, 'model_chunk': model_chunk}
+
+
+def _tensor_bytes(tensor):
+    if tensor is None:
+        return 0
+    return tensor.numel() * tensor.element_size()
+
+
+def _memory_span(tensor):
+    """[start, end) addresses of the memory that `tensor` may access."""
+    start = tensor.data_ptr()
+    if tensor.numel() == 0:
+        return start, start
+    extent = 1 + sum((size - 1) * stride
+                     for size, stride in zip(tensor.shape, tensor.stride()))
+    return start, start + extent * tensor.element_size()
+
+
+def _overlaps(tensor, other):
+    """Whether two tensors may share memory, e.g. an output that is a view
+    of the input of a forward pass."""
+    if not (torch.is_tensor(tensor) and torch.is_tensor(other)):
+        return False
+    start, end = _memory_span(tensor)
+    other_start, other_end = _memory_span(other)
+    return start < other_end and other_start < end
+
+
+def _record_stash(state):
+    """Update the peak stash statistics of `state`."""
+    num_bytes = 0
+    for tensors in (state.input_tensors, state.output_tensors):
+        for tensor in tensors.values():
+            num_bytes += _tensor_bytes(tensor)
+    offloaded_bytes = sum(_tensor_bytes(state.input_tensors[key])
+                          for key in state.offloaded_devices)
+    state.peak_stash_depth = max(state.peak_stash_depth,
+                                 len(state.output_tensors))
+    state.peak_stash_bytes = max(state.peak_stash_bytes,
+                                 num_bytes - offloaded_bytes)
+    state.peak_offloaded_bytes = max(state.peak_offloaded_bytes,
+                                     offloaded_bytes)
+
+
+def get_stash_statistics(reset=True):
+    """Peak number of microbatches stashed for their backward pass, and
+    bytes of their stashed inputs and outputs on the device and offloaded
+    to the CPU, over the programs run since the last reset."""
+    statistics = tuple(_STASH_STATISTICS)
+    if reset:
+        _STASH_STATISTICS[:] = [0, 0, 0]
+    return statistics
+
+
+def get_weight_version_statistics(reset=True):
+    """Peak number of weight versions kept, their bytes and the largest
+    staleness of the weights used by a backward pass since the last reset,
+    or None without --pipeline-weight-versions."""
+    if _NO_FLUSHES_STATE is None or _NO_FLUSHES_STATE.weight_versions is None:
+        return None
+    return _NO_FLUSHES_STATE.weight_versions.statistics(reset)
+
+
+def _offload(tensor):
+    """Copy of `tensor` in CPU memory, pinned if `tensor` is on the GPU."""
+    offloaded = torch.empty(tensor.shape, dtype=tensor.dtype,
+                            pin_memory=tensor.is_cuda)
+    offloaded.copy_(tensor, non_blocking=True)
+    return offloaded
+
+
+def _wait_for_sends(state, timers, directions=('next', 'prev')):
+    """Wait for the non-blocking sends of this rank in `directions`."""
+    handles = []
+    for direction in directions:
+        handle = state.send_handles.pop(direction, None)
+        if handle is not None and handle not in handles:
+            handles.append(handle)
+    if not handles:
+        return
+    tracer = get_pipeline_tracer()
+    if tracer is not None:
+        span = tracer.begin('send-wait', 'communication')
+    if timers is not None:
+        timers('send-wait', log_level=2).start()
+    for handle in handles:
+        handle.wait_for_sends()
+    if timers is not None:
+        timers('send-wait').stop()
+    if tracer is not None:
+        tracer.end(span)
+
+
+def execute_instructions(program, forward_step_func, data_iterator, model,
+                         optimizer, timers, forward_only, state=None,
+                         async_communication=False):
+    """Run the program of this pipeline rank (see
+    megatron/pipeline_instructions.py), the passes and communication of
+    one iteration: train_step() all-reduces the grads and steps the
+    optimizer, so AllReduceGrads and OptimizerStep are rejected.
+    data_iterator and model hold one entry per model chunk.
+
+    With async_communication, communication groups do not block: a pass
+    waits for the receive of its input when it runs, and a send is waited
+    for before the next send in its direction, before barriers and at the
+    end of the program.
+
+    With --offload-stashed-activations, the received input of a forward
+    pass is moved to the CPU until its backward pass.
+
+    With state.weight_versions, forward passes use the latest weights and
+    backward passes the weights of their forward pass.
+
+    On the first and last pipeline stages, the all-reduce of the grad of
+    the shared word embeddings starts after the last backward pass of their
+    model chunk, and optimizer.wait_for_grad_syncs() waits for it.
+
+    With --pipeline-trace-dir, every instruction is recorded by the pipeline
+    tracer (see megatron/pipeline_trace.py)."""
+    assert not any(isinstance(instruction, (AllReduceGrads, OptimizerStep))
+                   for instruction in program), \
+        'AllReduceGrads and OptimizerStep are only simulated; train_step() ' \
+        'all-reduces the grads and steps the optimizer'
+    if state is None:
+        state = PipelineState()
+    tracer = get_pipeline_tracer()
+    offload = get_args().offload_stashed_activations and not forward_only
+    num_model_chunks = len(model)
+    state.peak_stash_depth = 0
+    state.peak_stash_bytes = 0
+    state.peak_offloaded_bytes = 0
     losses_reduced = []
-
-    # Run warmup forward passes.
-    for i in range(num_warmup_microbatches):
-        input_tensor = recv_forward(timers)
-        output_tensor = forward_step(forward_step_func, data_iterator, model,
-                                     input_tensor, losses_reduced)
-        # Barrier before first receive to measure forward stall.
-        if i == (num_warmup_microbatches - 1) and not args.gpipe and num_microbatches > 1:
-            timers('forward-pipeline-stall').start()
-            torch.distributed.barrier(group=mpu.get_pipeline_model_parallel_group())
-            timers('forward-pipeline-stall').stop()
-        send_forward(output_tensor, timers)
-
-        input_tensors.append(input_tensor)
-        output_tensors.append(output_tensor)
-
-    # Barrier before first receive to measure forward stall.
-    if num_warmup_microbatches == 0 and not args.gpipe:
-        timers('forward-pipeline-stall').start()
-        torch.distributed.barrier(group=mpu.get_pipeline_model_parallel_group())
-        timers('forward-pipeline-stall').stop()
-
-    # Before running 1F1B, need to receive first forward tensor.
-    # If all microbatches are run in warmup / cooldown phase, then no need to
-    # receive this tensor here.
-    if num_microbatches_remaining > 0:
-        input_tensor = recv_forward(timers)
-
-    # Run 1F1B in steady state.
-    for i in range(num_microbatches_remaining):
-        last_iteration_in_for_loop = (i == (num_microbatches_remaining - 1))
-
-        output_tensor = forward_step(forward_step_func, data_iterator, model,
-                                     input_tensor, losses_reduced)
-        if forward_only:
-            send_forward(output_tensor, timers)
-        else:
-            output_tensor_grad = send_forward_recv_backward(output_tensor, timers)
-
-        # Add input_tensor and output_tensor to end of list, then pop from the
-        # start of the list for backward pass.
-        input_tensors.append(input_tensor)
-        output_tensors.append(output_tensor)
-
-        if forward_only:
-            if not last_iteration_in_for_loop:
-                input_tensor = recv_forward(timers)
-        else:
-            input_tensor, output_tensor = input_tensors.pop(0), output_tensors.pop(0)
-
+    # Last backward pass of every model chunk, after which its grads can be
+    # all-reduced.
+    last_backwards = {instruction.model_chunk: tuple(instruction)
+                      for instruction in program
+                      if isinstance(instruction, Backward)}
+    embedding_chunk = None if forward_only else \
+        _embedding_model_chunk(num_model_chunks)
+
+    for item in group_instructions(program):
+        if isinstance(item, list):
+            _execute_communication(item, state, timers, forward_only,
+                                   async_communication)
+
+        elif isinstance(item, Forward):
+            _set_model_chunk(item.model_chunk, num_model_chunks)
+            key = tuple(item)
+            _wait_for_receive(state.input_tensor_handles,
+                              state.input_tensors, key, 0, timers,
+                              'forward-recv-wait')
+            if forward_only:
+                input_tensor = state.input_tensors.pop(key, None)
+            else:
+                input_tensor = state.input_tensors.get(key)
+            if state.weight_versions is not None and not forward_only:
+                state.weight_versions.acquire(key)
+            if tracer is not None:
+                span = tracer.begin('forward', 'compute', _trace_args(key))
+            output_tensor = forward_step(
+                forward_step_func, data_iterator[item.model_chunk],
+                model[item.model_chunk], input_tensor, losses_reduced)
+            if tracer is not None:
+                tracer.end(span)
+            # Without a backward pass, the input can be recycled right away,
+            # unless the output that is sent on, maybe asynchronously, is
+            # (a view of) it.
+            if forward_only and not _overlaps(output_tensor, input_tensor):
+                release_received_tensor('forward', input_tensor)
+            if not (forward_only and mpu.is_pipeline_last_stage()):
+                state.output_tensors[key] = output_tensor
+            if offload and input_tensor is not None:
+                state.offloaded_devices[key] = input_tensor.device
+                input_tensor.data = _offload(input_tensor.data)
+            if not forward_only:
+                _record_stash(state)
+
+        elif isinstance(item, Backward):
+            _set_model_chunk(item.model_chunk, num_model_chunks)
+            key = tuple(item)
+            _wait_for_receive(state.output_tensor_grad_handles,
+                              state.output_tensor_grads, key, 1, timers,
+                              'backward-recv-wait')
+            input_tensor = state.input_tensors.pop(key, None)
+            device = state.offloaded_devices.pop(key, None)
+            if device is not None:
+                input_tensor.data = input_tensor.data.to(device,
+                                                         non_blocking=True)
+            output_tensor = state.output_tensors.pop(key)
+            output_tensor_grad = state.output_tensor_grads.pop(key, None)
+            if state.weight_versions is not None:
+                state.weight_versions.use(key)
+            if last_backwards[item.model_chunk] == key:
+                _enable_grad_sync(model[item.model_chunk],
+                                  item.model_chunk == embedding_chunk)
+            if tracer is not None:
+                span = tracer.begin('backward', 'compute', _trace_args(key))
             input_tensor_grad = \
                 backward_step(optimizer, input_tensor, output_tensor,
                               output_tensor_grad)
-
-            if last_iteration_in_for_loop:
-                input_tensor = None
-                send_backward(input_tensor_grad, timers)
+            if tracer is not None:
+                tracer.end(span)
+            if state.weight_versions is not None:
+                state.weight_versions.release(key)
+            if item.model_chunk == embedding_chunk and \
+                    last_backwards[item.model_chunk] == key:
+                _start_embedding_grad_sync(model[item.model_chunk],
+                                           optimizer)
+            if not mpu.is_pipeline_first_stage():
+                state.input_tensor_grads[key] = input_tensor_grad
+            release_received_tensor('forward', input_tensor)
+            release_received_tensor('backward', output_tensor_grad)
+
+        elif isinstance(item, SwapVersion):
+            if tracer is not None:
+                span = tracer.begin('swap-to-' + item.version, 'compute')
+            if item.version == 'older':
+                optimizer.swap_to_older_version()
             else:
-                input_tensor = send_backward_recv_forward(input_tensor_grad, timers)
+                optimizer.swap_to_newer_version()
+            if tracer is not None:
+                tracer.end(span)
+
+        elif isinstance(item, Barrier):
+            # Barrier before first receive to measure forward stall.
+            _wait_for_sends(state, timers)
+            if tracer is not None:
+                span = tracer.begin('forward-pipeline-stall', 'communication')
+            timers('forward-pipeline-stall').start()
+            torch.distributed.barrier(
+                group=mpu.get_pipeline_model_parallel_group())
+            timers('forward-pipeline-stall').stop()
+            if tracer is not None:
+                tracer.end(span)
 
-    # Run cooldown backward passes.
-    if not forward_only:
-        for i in range(num_warmup_microbatches):
-            input_tensor = input_tensors.pop(0)
-            output_tensor = output_tensors.pop(0)
+        else:
+            raise Exception('{} cannot be executed by the pipeline '
+                            'executor'.format(item))
+
+    _wait_for_sends(state, timers)
+    _STASH_STATISTICS[0] = max(_STASH_STATISTICS[0], state.peak_stash_depth)
+    _STASH_STATISTICS[1] = max(_STASH_STATISTICS[1], state.peak_stash_bytes)
+    _STASH_STATISTICS[2] = max(_STASH_STATISTICS[2],
+                               state.peak_offloaded_bytes)
+    return losses_reduced
 
-            output_tensor_grad = recv_backward(timers)
 
-            input_tensor_grad = \
-                backward_step(optimizer, input_tensor, output_tensor,
-                              output_tensor_grad)
+def _execute_program(program, forward_step_func, data_iterator, model,
+                     optimizer, timers, forward_only, state=None):
+    """Run a program with the communication mode selected by
+    --async-pipeline-communication. Non-blocking receives are posted before
+    the pass that precedes their consumer, unless their shape has to be
+    received first (--variable-seq-lengths)."""
+    args = get_args()
+    if args.async_pipeline_communication and not args.variable_seq_lengths:
+        program = hoist_receives(program)
+    return execute_instructions(
+        program, forward_step_func, data_iterator, model, optimizer, timers,
+        forward_only, state=state,
+        async_communication=args.async_pipeline_communication)
 
-            send_backward(input_tensor_grad, timers)
 
-    return losses_reduced
+def forward_backward_pipelining_with_interleaving(forward_step_func, data_iterator, model,
+                                                  optimizer, timers, forward_only):
+    """Run interleaved 1F1B schedule."""
+    program = interleaved_instructions(
+        mpu.get_pipeline_model_parallel_world_size(),
+        mpu.get_pipeline_model_parallel_rank(),
+        get_num_microbatches(), len(model), forward_only=forward_only)
+    return _execute_program(program, forward_step_func, data_iterator,
+                            model, optimizer, timers, forward_only)
 
 
-def forward_backward_pipelining_no_flushes(forward_step_func, data_iterator, model,
-                                           optimizer, timers,
-                                           first_iteration=False, last_iteration=False):
+def forward_backward_pipelining(forward_step_func, data_iterator, model,
+                                optimizer, timers, forward_only):
     """Run 1F1B schedule, with communication and warmup + cooldown microbatches as needed."""
     timers = get_timers()
+    args = get_args()
 
     assert len(model) == 1
-    model = model[0]
-
-    # Compute number of warmup microbatches.
-    num_microbatches = get_num_microbatches()
-    num_warmup_microbatches = \
-        (mpu.get_pipeline_model_parallel_world_size() -
-         mpu.get_pipeline_model_parallel_rank() - 1)
-    num_warmup_microbatches = min(
-        num_warmup_microbatches,
-        num_microbatches)
-    num_cooldown_microbatches = num_warmup_microbatches
-    if last_iteration:
-        num_microbatches_remaining = \
-            num_microbatches - num_warmup_microbatches
-    else:
-        num_microbatches_remaining = num_microbatches
-    num_warmup_microbatches_in_first_iteration = num_warmup_microbatches
-    if not first_iteration:
-        num_warmup_microbatches = 0
-    if not last_iteration:
-        num_cooldown_microbatches = 0
-
-    global input_tensors, output_tensors
-    losses_reduced = []
-
-    # Run warmup forward passes.
-    for i in range(num_warmup_microbatches):
-        input_tensor = recv_forward(timers)
-        optimizer.swap_to_older_version()
-        output_tensor = forward_step(forward_step_func, data_iterator, model,
-                                     input_tensor, losses_reduced)
-        # Barrier before first receive to measure forward stall.
-        if i == (num_warmup_microbatches - 1):
-            timers('forward-pipeline-stall').start()
-            torch.distributed.barrier(group=mpu.get_pipeline_model_parallel_group())
-            timers('forward-pipeline-stall').stop()
-        send_forward(output_tensor, timers)
-
-        input_tensors.append(input_tensor)
-        output_tensors.append(output_tensor)
+    program = one_f_one_b_instructions(
+        mpu.get_pipeline_model_parallel_world_size(),
+        mpu.get_pipeline_model_parallel_rank(),
+        get_num_microbatches(), forward_only=forward_only, gpipe=args.gpipe)
+    return _execute_program(program, forward_step_func, [data_iterator],
+                            model, optimizer, timers, forward_only)
 
-    if first_iteration:
-        # Barrier before first receive to measure forward stall.
-        if num_warmup_microbatches == 0:
-            timers('forward-pipeline-stall').start()
-            torch.distributed.barrier(group=mpu.get_pipeline_model_parallel_group())
-            timers('forward-pipeline-stall').stop()
-
-        # Before running 1F1B, need to receive first forward tensor.
-        # If all microbatches are run in warmup / cooldown phase, then no need to
-        # receive this tensor here.
-        if num_microbatches_remaining > 0:
-            input_tensors.append(recv_forward(timers))
-
-    # Run 1F1B in steady state.
-    for i in range(num_microbatches_remaining):
-        last_iteration_in_for_loop = (i == (num_microbatches_remaining - 1))
-
-        input_tensor = input_tensors[-1]
-        if i < (num_microbatches - num_warmup_microbatches_in_first_iteration):
-            optimizer.swap_to_older_version()
-        else:
-            optimizer.swap_to_newer_version()
-        output_tensor = forward_step(forward_step_func, data_iterator, model,
-                                     input_tensor, losses_reduced)
-        output_tensor_grad = send_forward_recv_backward(output_tensor, timers)
-
-        # Add output_tensor to end of list, then pop from the
-        # start of the list for backward pass.
-        output_tensors.append(output_tensor)
-
-        input_tensor, output_tensor = input_tensors.pop(0), output_tensors.pop(0)
-
-        optimizer.swap_to_older_version()
-        input_tensor_grad = \
-            backward_step(optimizer, input_tensor, output_tensor,
-                          output_tensor_grad)
 
-        if last_iteration_in_for_loop and last_iteration:
-            input_tensor = None
-            send_backward(input_tensor_grad, timers)
-        else:
-            input_tensor = send_backward_recv_forward(input_tensor_grad, timers)
-            input_tensors.append(input_tensor)
-
-    # Run cooldown backward passes.
-    for i in range(num_cooldown_microbatches):
-        input_tensor = input_tensors.pop(0)
-        output_tensor = output_tensors.pop(0)
-
-        output_tensor_grad = recv_backward(timers)
+def forward_backward_pipelining_no_flushes(forward_step_func, data_iterator, model,
+                                           optimizer, timers,
+                                           first_iteration=False, last_iteration=False,
+                                           num_iterations=None):
+    """Run 1F1B schedule without pipeline flushes (PipeDream-2BW), with
+    interleaved model chunks if model holds more than one. Tensors of
+    microbatches still in flight are kept until the next call; there are at
+    most --pipeline-stash-limit of them per stage.
+
+    With --pipeline-weight-versions, forward passes run up to num_stages - 1
+    microbatches ahead, possibly into later batches, with PipeDream weight
+    stashing instead of the two versions of 2BW; `num_iterations` is then
+    the number of iterations of the run, if known, so that no forward pass
+    runs past its last batch."""
+    global _NO_FLUSHES_STATE
+    timers = get_timers()
+    args = get_args()
 
-        optimizer.swap_to_older_version()
-        input_tensor_grad = \
-            backward_step(optimizer, input_tensor, output_tensor,
-                          output_tensor_grad)
+    if first_iteration or _NO_FLUSHES_STATE is None:
+        _NO_FLUSHES_STATE = PipelineState()
+        if args.pipeline_weight_versions is not None:
+            _NO_FLUSHES_STATE.weight_versions = WeightVersionStore(
+                [param for module in model for param in module.parameters()],
+                args.pipeline_weight_versions)
+    state = _NO_FLUSHES_STATE
 
-        send_backward(input_tensor_grad, timers)
+    pipeline_parallel_size = mpu.get_pipeline_model_parallel_world_size()
+    pipeline_parallel_rank = mpu.get_pipeline_model_parallel_rank()
+    if len(model) > 1:
+        program = interleaved_no_flushes_instructions(
+            pipeline_parallel_size, pipeline_parallel_rank,
+            get_num_microbatches(), len(model), state.iteration,
+            first_iteration=first_iteration, last_iteration=last_iteration)
+    else:
+        program = no_flushes_instructions(
+            pipeline_parallel_size, pipeline_parallel_rank,
+            get_num_microbatches(), state.iteration,
+            first_iteration=first_iteration, last_iteration=last_iteration,
+            max_in_flight=args.pipeline_stash_limit,
+            pipedream=(state.weight_versions is not None),
+            num_iterations=num_iterations)
+        data_iterator = [data_iterator]
+    losses_reduced = _execute_program(
+        program, forward_step_func, data_iterator, model, optimizer,
+        timers, False, state=state)
+    state.iteration += 1
+    if state.weight_versions is not None:
+        # The optimizer step that follows updates the latest version.
+        state.weight_versions.advance()
 
     return losses_reduced
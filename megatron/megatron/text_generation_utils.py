@@ -26,7 +26,7 @@ import torch.nn.functional as F
 from megatron import get_args
 from megatron import get_tokenizer
 from megatron import mpu
-from megatron.training import communicate
+from megatron.p2p_communication import recv_forward, send_forward
 from megatron.utils import get_ltor_masks_and_position_ids
 
 
@@ -395,20 +395,12 @@ def forward_step(model, tokens, position_ids, attention_mask, tokentype_ids,
                  layer_past=None, get_key_value=None,
                  forward_method_parallel_output=None):
 
-    # Hidden size changes when not using recompute, need to tell communicate()
-    # the correct size
+    # The sequence length changes when not using recompute, tell the
+    # pipeline communication the shape of the hidden states.
     args = get_args()
-    orig_seq_length = args.seq_length
-    args.seq_length = tokens.shape[1]
-
-    if not mpu.is_pipeline_first_stage():
-        input_tensor, _ = communicate(
-            tensor_send_next=None,
-            tensor_send_prev=None,
-            recv_forward=True,
-            recv_backward=False)
-    else:
-        input_tensor = None
+    tensor_shape = (tokens.size(1), tokens.size(0), args.hidden_size)
+
+    input_tensor = recv_forward(tensor_shape=tensor_shape)
 
     # Forward pass through the model.
     if mpu.is_pipeline_first_stage():
@@ -439,13 +431,8 @@ def forward_step(model, tokens, position_ids, attention_mask, tokentype_ids,
     if get_key_value:
         output_tensor, layer_past = output_tensor
 
-    if not mpu.is_pipeline_last_stage():
-        communicate(tensor_send_next=output_tensor,
-                    tensor_send_prev=None,
-                    recv_forward=False,
-                    recv_backward=False)
+    send_forward(output_tensor, tensor_shape=tensor_shape)
 
-    args.seq_length = orig_seq_length
     if get_key_value:
         return output_tensor, layer_past
     return output_tensor
@@ -37,6 +37,7 @@ from megatron import print_rank_0
 from megatron import print_rank_last
 from megatron.checkpointing import load_checkpoint
 from megatron.checkpointing import save_checkpoint
+from megatron.grad_compression import build_grad_compressor
 from megatron.model import FP16Module
 from megatron.optimizer import get_megatron_optimizer
 
@@ -52,6 +53,9 @@ from megatron.schedules import forward_backward_pipelining
 from megatron.schedules import forward_backward_pipelining_with_interleaving
 from megatron.schedules import forward_backward_pipelining_no_flushes
 from megatron.utils import report_memory
+from megatron.utils import report_pipeline_stash
+from megatron.pipeline_trace import get_pipeline_tracer
+from megatron.pipeline_trace import init_pipeline_tracer
 
 
 def print_datetime(string):
@@ -112,6 +116,7 @@ def pretrain(train_valid_test_dataset_provider, model_provider,
     timers('model-and-optimizer-setup').stop()
     print_datetime('after model, optimizer, and learning rate '
                    'scheduler are built')
+    init_pipeline_tracer()
 
     # Data stuff.
     timers('train/valid/test-data-iterators-setup').start()
@@ -229,7 +234,18 @@ def get_model(model_provider_func):
                  for model_module in model]
         return model
     if args.DDP_impl == 'local':
-        model = [LocalDDP(model_module) for model_module in model]
+        # One compressor per model chunk, whose buckets have their own keys.
+        model = [LocalDDP(model_module,
+                          overlap_grad_reduce=args.overlap_grad_reduce,
+                          bucket_size=args.ddp_bucket_size,
+                          fp32_allreduce=args.fp32_allreduce,
+                          hierarchical_allreduce=args.hierarchical_allreduce,
+                          grad_compressor=None
+                          if args.grad_compression == 'none' else
+                          build_grad_compressor(args.grad_compression,
+                                                args.powersgd_rank,
+                                                args.grad_topk_ratio))
+                 for model_module in model]
         return model
 
     raise NotImplementedError('Unknown DDP implementation specified: {}. '
@@ -338,6 +354,7 @@ def train_step(forward_step_func, data_iterator,
             forward_backward_func = forward_backward_pipelining_no_flushes
             kwargs['first_iteration'] = (iteration == args.iteration)
             kwargs['last_iteration'] = ((iteration + 1) == args.train_iters)
+            kwargs['num_iterations'] = args.train_iters - args.iteration
             del kwargs['forward_only']
         elif args.virtual_pipeline_model_parallel_size is not None:
             forward_backward_func = forward_backward_pipelining_with_interleaving
@@ -349,8 +366,12 @@ def train_step(forward_step_func, data_iterator,
         forward_step_func, data_iterator, model,
         optimizer, timers, **kwargs)
 
-    # All-reduce if needed.
-    if args.DDP_impl == 'local':
+    # All-reduce if needed. The distributed optimizer reduce-scatters the
+    # grads itself. The word_embeddings' grad is all-reduced across the
+    # first and last stages, to keep their copies in sync, while the
+    # pipeline drains; that all-reduce is waited for first.
+    if args.DDP_impl == 'local' and not args.use_distributed_optimizer:
+        optimizer.wait_for_grad_syncs()
         timers('backward-params-all-reduce').start()
         for model_module in model:
             model_module.allreduce_params(reduce_after=False,
@@ -363,27 +384,8 @@ def train_step(forward_step_func, data_iterator,
         torch.distributed.barrier(group=mpu.get_pipeline_model_parallel_group())
         timers('backward-pipeline-stall').stop()
 
-        # All-reduce word_embeddings' grad across first and last stages to ensure
-        # that word_embeddings parameters stay in sync.
-        # This should only run for models that support pipelined model parallelism
-        # (BERT and GPT-2).
-        timers('backward-embedding-all-reduce').start()
-        if (mpu.is_pipeline_first_stage(ignore_virtual=True) or mpu.is_pipeline_last_stage(ignore_virtual=True)) and \
-                mpu.get_pipeline_model_parallel_world_size() > 1:
-            if mpu.is_pipeline_first_stage(ignore_virtual=True):
-                unwrapped_model = model[0]
-            elif mpu.is_pipeline_last_stage(ignore_virtual=True):
-                unwrapped_model = model[-1]
-            while isinstance(unwrapped_model, (torchDDP, LocalDDP, FP16Module)):
-                unwrapped_model = unwrapped_model.module
-
-            if unwrapped_model.share_word_embeddings:
-                word_embeddings_weight = unwrapped_model.word_embeddings_weight()
-                torch.distributed.all_reduce(word_embeddings_weight.grad,
-                                             group=mpu.get_embedding_group())
-        timers('backward-embedding-all-reduce').stop()
-
-    # Update parameters.
+    # Update parameters. Otherwise, the optimizer waits for the all-reduce of
+    # the word_embeddings' grad.
     timers('optimizer').start()
     update_successful = optimizer.step()
     timers('optimizer').stop()
@@ -409,8 +411,10 @@ def train_step(forward_step_func, data_iterator,
 
 
 def training_log(loss_dict, total_loss_dict, learning_rate, iteration,
-                 loss_scale, report_memory_flag, skipped_iter):
-    """Log training information such as losses, timing, ...."""
+                 loss_scale, report_memory_flag, skipped_iter, grad_norm=None):
+    """Log training information such as losses, timing, ....
+    The loss scale and grad norm may be device tensors, read on the host
+    only when they are logged."""
     args = get_args()
     timers = get_timers()
     writer = get_tensorboard_writer()
@@ -448,12 +452,15 @@ def training_log(loss_dict, total_loss_dict, learning_rate, iteration,
     timers_to_log = []
 
     def add_to_logging(name):
-        if name in timers.timers:
+        if name in timers.timers or name in timers.counters:
             timers_to_log.append(name)
     add_to_logging('forward-compute')
     add_to_logging('forward-pipeline-stall')
     add_to_logging('forward-recv')
     add_to_logging('forward-send')
+    add_to_logging('forward-send-forward-recv')
+    add_to_logging('forward-send-backward-recv')
+    add_to_logging('forward-recv-wait')
     add_to_logging('forward-backward-send-forward-backward-recv')
     add_to_logging('backward-compute')
     add_to_logging('backward-pipeline-stall')
@@ -461,12 +468,20 @@ def training_log(loss_dict, total_loss_dict, learning_rate, iteration,
     add_to_logging('backward-send')
     add_to_logging('backward-send-forward-recv')
     add_to_logging('backward-send-backward-recv')
+    add_to_logging('backward-recv-wait')
+    add_to_logging('send-wait')
+    add_to_logging('pipeline-recv-buffer-hits')
+    add_to_logging('pipeline-recv-buffer-misses')
     add_to_logging('backward-params-all-reduce')
     add_to_logging('backward-embedding-all-reduce')
+    add_to_logging('optimizer-reduce-scatter-grads')
+    add_to_logging('optimizer-offload-grads')
     add_to_logging('optimizer-copy-to-main-grad')
     add_to_logging('optimizer-unscale-and-check-inf')
     add_to_logging('optimizer-clip-main-grad')
     add_to_logging('optimizer-copy-main-to-model-params')
+    add_to_logging('optimizer-all-gather-params')
+    add_to_logging('optimizer-cpu-step')
     add_to_logging('optimizer')
     add_to_logging('batch-generator')
 
@@ -489,8 +504,8 @@ def training_log(loss_dict, total_loss_dict, learning_rate, iteration,
             writer.add_scalar(key , loss_dict[key], iteration)
             writer.add_scalar(key + ' vs samples', loss_dict[key],
                               args.consumed_train_samples)
-        writer.add_scalar('loss-scale', loss_scale, iteration)
-        writer.add_scalar('loss-scale vs samples', loss_scale,
+        writer.add_scalar('loss-scale', float(loss_scale), iteration)
+        writer.add_scalar('loss-scale vs samples', float(loss_scale),
                           args.consumed_train_samples)
         timers.write(timers_to_log, writer, iteration,
                      normalizer=total_iterations)
@@ -517,7 +532,12 @@ def training_log(loss_dict, total_loss_dict, learning_rate, iteration,
                 if avg > 0.0:
                     log_string += ' {}: {:.6E} |'.format(key, avg)
                 total_loss_dict[key] = torch.cuda.FloatTensor([0.0])
-        log_string += ' loss scale: {:.1f} |'.format(loss_scale)
+        log_string += ' loss scale: {:.1f} |'.format(float(loss_scale))
+        if grad_norm is not None:
+            grad_norm = float(grad_norm)
+            log_string += ' grad norm: {:.3f} |'.format(grad_norm)
+            if writer and is_last_rank():
+                writer.add_scalar('grad-norm', grad_norm, iteration)
         log_string += ' number of skipped iterations: {:3d} |'.format(
             total_loss_dict[skipped_iters_key])
         log_string += ' number of nan iterations: {:3d} |'.format(
@@ -530,6 +550,10 @@ def training_log(loss_dict, total_loss_dict, learning_rate, iteration,
             # Report memory after optimizer state has been initialized.
             report_memory('(after {} iterations)'.format(iteration))
             report_memory_flag = False
+        if args.log_pipeline_stash:
+            report_pipeline_stash('(after {} iterations)'.format(iteration))
+        if get_pipeline_tracer() is not None:
+            get_pipeline_tracer().flush()
         timers.log(timers_to_log, normalizer=args.log_interval)
 
     return report_memory_flag
@@ -569,8 +593,11 @@ def train(forward_step_func, model, optimizer, lr_scheduler,
     timers('interval-time').start()
     print_datetime('before the start of training step')
     report_memory_flag = True
+    tracer = get_pipeline_tracer()
     while iteration < args.train_iters:
         update_num_microbatches(args.consumed_train_samples)
+        if tracer is not None:
+            tracer.iteration = iteration
         loss_dict, skipped_iter = train_step(forward_step_func,
                                              train_data_iterator,
                                              model,
@@ -582,12 +609,15 @@ def train(forward_step_func, model, optimizer, lr_scheduler,
                                        args.micro_batch_size * \
                                        get_num_microbatches()
 
-        # Logging.
-        loss_scale = optimizer.get_loss_scale().item()
+        # Logging. The loss scale and grad norm are not read on the host
+        # here, to not synchronize with the GPU at every iteration.
+        loss_scale = optimizer.get_loss_scale()
+        grad_norm = None if skipped_iter else optimizer.get_grad_norm()
         report_memory_flag = training_log(loss_dict, total_loss_dict,
                                           optimizer.param_groups[0]['lr'],
                                           iteration, loss_scale,
-                                          report_memory_flag, skipped_iter)
+                                          report_memory_flag, skipped_iter,
+                                          grad_norm=grad_norm)
 
         # Autoresume
         if args.adlr_autoresume and \
@@ -635,6 +665,8 @@ def train(forward_step_func, model, optimizer, lr_scheduler,
             print_datetime('exiting program at iteration {}'.format(iteration))                
             sys.exit()
 
+    if tracer is not None:
+        tracer.flush()
 
     return iteration
 
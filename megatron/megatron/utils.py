@@ -24,6 +24,8 @@ from megatron import print_rank_0
 from megatron import get_adlr_autoresume
 from megatron import mpu
 from megatron.checkpointing import save_checkpoint
+from megatron.schedules import get_stash_statistics
+from megatron.schedules import get_weight_version_statistics
 
 
 def average_losses_across_data_parallel_group(losses):
@@ -55,6 +57,29 @@ def report_memory(name):
               flush=True)
 
 
+def report_pipeline_stash(name):
+    """Report the peak pipeline stash since the last report."""
+    depth, num_bytes, offloaded_bytes = get_stash_statistics()
+    mega_bytes = 1024.0 * 1024.0
+    string = name + ' pipeline stash'
+    string += ' | stage: {}'.format(mpu.get_pipeline_model_parallel_rank())
+    string += ' | peak microbatches: {}'.format(depth)
+    string += ' | peak stashed (MB): {:.1f}'.format(num_bytes / mega_bytes)
+    string += ' | peak offloaded (MB): {:.1f}'.format(
+        offloaded_bytes / mega_bytes)
+    weight_versions = get_weight_version_statistics()
+    if weight_versions is not None:
+        num_versions, version_bytes, staleness = weight_versions
+        string += ' | peak weight versions: {}'.format(num_versions)
+        string += ' | weight versions (MB): {:.1f}'.format(
+            version_bytes / mega_bytes)
+        string += ' | max staleness: {}'.format(staleness)
+    if mpu.get_data_parallel_rank() == 0 and \
+            mpu.get_tensor_model_parallel_rank() == 0:
+        print("[Rank {}] {}".format(torch.distributed.get_rank(), string),
+              flush=True)
+
+
 def print_params_min_max_norm(optimizer, iteration):
     """Print min, max, and norm of all parameters."""
     index = 0
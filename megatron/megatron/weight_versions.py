@@ -0,0 +1,120 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Weight versions of PipeDream weight stashing (--pipeline-weight-versions).
+
+Without pipeline flushes, the forward pass of a microbatch can run several
+optimizer steps before its backward pass. Forward passes use the latest
+weights, and the backward pass has to use the same weights as the forward
+pass. The latest version lives in the parameters' own storage, which the
+optimizer updates in place. A version is copied into one of the ring slots
+when an optimizer step would overwrite it while in-flight microbatches still
+need it, and the slot is freed once the last of them has run backward.
+"""
+
+
+class WeightVersionStore:
+    """Up to `num_versions` versions of `params`: the latest one and at most
+    num_versions - 1 stashed ones. Versions are counted in optimizer steps
+    and referenced by the microbatches (any hashable key) whose forward pass
+    used them."""
+
+    def __init__(self, params, num_versions):
+        assert num_versions >= 1
+        self.params = list(params)
+        self.num_versions = num_versions
+        self.latest = 0
+        self._latest_data = [param.data for param in self.params]
+        self._slots = [None] * (num_versions - 1)
+        self._next_slot = 0
+        self._slot_of_version = {}
+        self._version_of_microbatch = {}
+        self._refcounts = {}
+        self._current = 0
+        self.version_bytes = sum(param.numel() * param.element_size()
+                                 for param in self.params)
+        self.peak_versions = 1
+        self.max_staleness = 0
+
+    def _switch_to(self, version):
+        """Point the params to the storage of `version`."""
+        if version == self._current:
+            return
+        if version == self.latest:
+            data = self._latest_data
+        else:
+            data = self._slots[self._slot_of_version[version]]
+        for param, tensor in zip(self.params, data):
+            param.data = tensor
+        self._current = version
+
+    def acquire(self, key):
+        """Switch to the latest version for the forward pass of microbatch
+        `key`, and keep that version until `release(key)`."""
+        self._switch_to(self.latest)
+        self._version_of_microbatch[key] = self.latest
+        self._refcounts[self.latest] = self._refcounts.get(self.latest, 0) + 1
+
+    def use(self, key):
+        """Switch to the version used by the forward pass of `key`."""
+        version = self._version_of_microbatch[key]
+        self.max_staleness = max(self.max_staleness, self.latest - version)
+        self._switch_to(version)
+
+    def release(self, key):
+        """Drop the reference of `key`, after its backward pass; a stashed
+        version is freed once no microbatch needs it."""
+        version = self._version_of_microbatch.pop(key)
+        self._refcounts[version] -= 1
+        if self._refcounts[version] > 0:
+            return
+        del self._refcounts[version]
+        if version != self.latest:
+            self._switch_to(self.latest)
+            self._slots[self._slot_of_version.pop(version)] = None
+
+    def advance(self):
+        """Called before the optimizer step: stash the latest version if
+        in-flight microbatches need it, and switch to the storage that the
+        step updates, which holds the next version."""
+        self._switch_to(self.latest)
+        if self.latest in self._refcounts:
+            free_slots = [slot for slot in range(len(self._slots))
+                          if self._slots[(self._next_slot + slot) %
+                                         len(self._slots)] is None]
+            assert free_slots, \
+                'more than {} weight versions in flight, increase ' \
+                '--pipeline-weight-versions'.format(self.num_versions)
+            slot = (self._next_slot + free_slots[0]) % len(self._slots)
+            self._slots[slot] = [tensor.clone()
+                                 for tensor in self._latest_data]
+            self._slot_of_version[self.latest] = slot
+            self._next_slot = (slot + 1) % len(self._slots)
+        self.latest += 1
+        self._current = self.latest
+        self.peak_versions = max(self.peak_versions,
+                                 len(self._slot_of_version) + 1)
+
+    def statistics(self, reset=True):
+        """Peak number of versions kept, their bytes and the largest
+        staleness, in optimizer steps, of the weights used by a backward
+        pass, since the last reset."""
+        statistics = (self.peak_versions,
+                      self.peak_versions * self.version_bytes,
+                      self.max_staleness)
+        if reset:
+            self.peak_versions = len(self._slot_of_version) + 1
+            self.max_staleness = 0
+        return statistics
@@ -23,7 +23,7 @@ import torch
 from megatron import get_args
 from megatron import print_rank_last, is_last_rank
 from megatron import mpu
-from megatron.training import communicate
+from megatron.p2p_communication import recv_forward, send_forward
 from tasks.finetune_utils import build_data_loader
 from tasks.finetune_utils import process_batch
 
@@ -80,7 +80,6 @@ def calculate_correct_answers(name, model, dataloader,
     args = get_args()
     start_time = time.time()
     model.eval()
-    saved_batch_size = args.micro_batch_size
     with torch.no_grad():
         # For all the batches in the dataset.
         total = 0
@@ -97,22 +96,16 @@ def calculate_correct_answers(name, model, dataloader,
 
             # For evaluation only mode we use drop_last = False to get all the
             # samples, which means we might not have a full batch, so we
-            # adjust batch_size here to actual batch size of data
+            # communicate tensors of the actual batch size of data
             actual_batch_size = len(labels_)
             # ... applying sample_multiplier if necessary
             ds = dataloader.dataset
             if hasattr(ds, 'sample_multiplier'):
                 actual_batch_size *= ds.sample_multiplier
-            args.micro_batch_size = actual_batch_size
-
-            if not mpu.is_pipeline_first_stage():
-                input_tensor, _ = communicate(
-                    tensor_send_next=None,
-                    tensor_send_prev=None,
-                    recv_forward=True,
-                    recv_backward=False)
-            else:
-                input_tensor = None
+            tensor_shape = (args.seq_length, actual_batch_size,
+                            args.hidden_size)
+
+            input_tensor = recv_forward(tensor_shape=tensor_shape)
 
             # Forward model.
             if mpu.is_pipeline_first_stage():
@@ -138,14 +131,9 @@ def calculate_correct_answers(name, model, dataloader,
                 total += labels_.size(0)
                 correct += corrects.sum().item()
             else:
-                communicate(
-                    tensor_send_next=output_tensor,
-                    tensor_send_prev=None,
-                    recv_forward=False,
-                    recv_backward=False)
+                send_forward(output_tensor, tensor_shape=tensor_shape)
 
     model.train()
-    args.micro_batch_size = saved_batch_size
 
     # Reduce.
     if mpu.is_pipeline_last_stage():
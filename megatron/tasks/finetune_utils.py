@@ -50,7 +50,7 @@ def _cross_entropy_forward_step(batch, model, input_tensor):
     timers = get_timers()
 
     # Get the batch.
-    timers('batch-generator').start()
+    timers('batch-generator', log_level=2).start()
     try:
         batch_ = next(batch)
     except BaseException:
@@ -25,7 +25,8 @@ from megatron import get_tokenizer
 from megatron import mpu
 from megatron.checkpointing import load_checkpoint
 from megatron.model import GPT2Model, GPT2ModelFirstStage, GPT2ModelLastStage, GPT2ModelIntermediateStage
-from megatron.training import get_model, communicate
+from megatron.p2p_communication import recv_forward, send_forward
+from megatron.training import get_model
 from megatron.utils import get_ltor_masks_and_position_ids
 from tasks.finetune_utils import build_data_loader
 
@@ -93,19 +94,12 @@ def forward_step(batch, model, eval_metric):
     tokens, labels, attention_mask, position_ids, loss_mask = process_batch(
         batch)
 
-    # Tell the model what our actual batch size will be
+    # Communicate tensors of the actual batch size.
     args = get_args()
-    args.micro_batch_size = len(labels)
+    tensor_shape = (tokens.size(1), tokens.size(0), args.hidden_size)
 
     # Forward model.
-    if not mpu.is_pipeline_first_stage():
-        input_tensor, _ = communicate(
-            tensor_send_next=None,
-            tensor_send_prev=None,
-            recv_forward=True,
-            recv_backward=False)
-    else:
-        input_tensor = None
+    input_tensor = recv_forward(tensor_shape=tensor_shape)
 
     # Forward pass through the model.
     if mpu.is_pipeline_first_stage():
@@ -119,10 +113,7 @@ def forward_step(batch, model, eval_metric):
         output = model(input_tensor, attention_mask)
 
     if not mpu.is_pipeline_last_stage():
-        communicate(tensor_send_next=output,
-                    tensor_send_prev=None,
-                    recv_forward=False,
-                    recv_backward=False)
+        send_forward(output, tensor_shape=tensor_shape)
         return None
 
     if mpu.is_pipeline_last_stage():
@@ -0,0 +1,90 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for the multi-process tests that run on the CPU with gloo."""
+
+import argparse
+import os
+import socket
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+
+import torch
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def _worker(rank, world_size, port, func, args):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group(backend='gloo', rank=rank,
+                                         world_size=world_size)
+    try:
+        func(*args)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def spawn(func, world_size, *args):
+    """Run func(*args) in `world_size` processes that share a gloo process
+    group."""
+    torch.multiprocessing.spawn(_worker,
+                                args=(world_size, _free_port(), func, args),
+                                nprocs=world_size, join=True)
+
+
+def set_global_variables(**kwargs):
+    """Set the Megatron arguments, number of microbatches and timers read by
+    the schedules, without parsing the command line or building a
+    tokenizer. Arguments default to an fp32 model of hidden size 8."""
+    from megatron import global_vars
+    from megatron.microbatches import ConstantNumMicroBatches
+
+    args = argparse.Namespace(
+        rank=torch.distributed.get_rank(),
+        seq_length=4,
+        micro_batch_size=2,
+        hidden_size=8,
+        global_batch_size=8,
+        data_parallel_size=1,
+        params_dtype=torch.float,
+        fp32_residual_connection=False,
+        scatter_gather_tensors_in_pipeline=False,
+        async_pipeline_communication=False,
+        reuse_pipeline_receive_buffers=False,
+        variable_seq_lengths=False,
+        pipeline_activation_codec='none',
+        pipeline_gradient_codec='none',
+        pipeline_codec_block_size=64,
+        pipeline_topk_ratio=0.1,
+        pipeline_stash_limit=None,
+        pipeline_weight_versions=None,
+        offload_stashed_activations=False,
+        gpipe=False)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+
+    global_vars._GLOBAL_ARGS = args
+    global_vars._GLOBAL_NUM_MICROBATCHES_CALCULATOR = ConstantNumMicroBatches(
+        args.global_batch_size, args.micro_batch_size,
+        args.data_parallel_size)
+    global_vars._GLOBAL_TIMERS = global_vars.Timers()
+    return args
+
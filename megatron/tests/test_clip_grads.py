@@ -0,0 +1,109 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Compare the grad clipping of megatron.optimizer, on the host and on the
+device, over grads split across tensor-model-parallel ranks with
+torch.nn.utils.clip_grad_norm_ on all the grads, and check that params
+without grads are left out of the norm, on the CPU with gloo:
+
+    python tests/test_clip_grads.py
+"""
+
+from commons import spawn
+import torch
+
+from megatron import mpu
+from megatron.optimizer.clip_grads import clip_grad_norm_fp32
+from megatron.optimizer.clip_grads import clip_grads_fp32
+
+
+SHAPES = ((5, 3), (7,), (4, 4), (1,), (9, 2))
+
+
+def make_grads():
+    generator = torch.Generator().manual_seed(1234)
+    return [torch.randn(shape, generator=generator) for shape in SHAPES]
+
+
+def _test_clip_grads(max_norm, norm_type):
+    world_size = torch.distributed.get_world_size()
+    mpu.initialize_model_parallel(world_size, 1)
+    rank = mpu.get_tensor_model_parallel_rank()
+
+    for on_device in (False, True):
+        reference = [torch.nn.Parameter(torch.zeros(shape))
+                     for shape in SHAPES]
+        for param, grad in zip(reference, make_grads()):
+            param.grad = grad
+        expected_norm = torch.nn.utils.clip_grad_norm_(
+            reference, max_norm, norm_type).item()
+
+        # Each rank clips a flat buffer of its share of the grads.
+        own = make_grads()[rank::world_size]
+        buffer = torch.cat([grad.view(-1) for grad in own])
+        total_norm = clip_grads_fp32([buffer], [buffer], max_norm, norm_type,
+                                     on_device=on_device)
+        assert torch.is_tensor(total_norm) == on_device
+        assert abs(float(total_norm) - expected_norm) < 1e-5, \
+            (float(total_norm), expected_norm)
+        expected = torch.cat([param.grad.view(-1)
+                              for param in reference[rank::world_size]])
+        assert torch.allclose(buffer, expected, rtol=1e-5, atol=1e-6)
+
+    mpu.destroy_model_parallel()
+    if rank == 0:
+        print('>> clipping of grads with a {}-norm of {:.3f} to {} matches '
+              'clip_grad_norm_ on the host and on the device'.format(
+                  norm_type, expected_norm, max_norm), flush=True)
+
+
+def test_clip_grads(tensor_model_parallel_size=2, max_norm=1.0,
+                    norm_type=2.0):
+    spawn(_test_clip_grads, tensor_model_parallel_size, max_norm, norm_type)
+
+
+def _test_params_without_grads(norm_type):
+    mpu.initialize_model_parallel(1, 1)
+    params = [torch.nn.Parameter(torch.zeros(shape)) for shape in SHAPES]
+    for param in params:
+        mpu.set_defaults_if_not_set_tensor_model_parallel_attributes(param)
+    for on_device in (False, True):
+        assert float(clip_grad_norm_fp32(params, 1.0, norm_type,
+                                         on_device=on_device)) == 0.0
+        params[0].grad = torch.full(SHAPES[0], 2.0)
+        total_norm = clip_grad_norm_fp32(params, 1.0, norm_type,
+                                         on_device=on_device)
+        expected_norm = 2.0 * 15 ** (1.0 / norm_type)
+        assert abs(float(total_norm) - expected_norm) < 1e-5, \
+            (float(total_norm), expected_norm)
+        params[0].grad = None
+    mpu.destroy_model_parallel()
+    print('>> params without grads are left out of the {}-norm'.format(
+        norm_type), flush=True)
+
+
+def test_params_without_grads(norm_type=2.0):
+    spawn(_test_params_without_grads, 1, norm_type)
+
+
+if __name__ == '__main__':
+    test_clip_grads()
+    test_clip_grads(max_norm=100.0)
+    test_clip_grads(3, norm_type=3.0)
+    test_clip_grads(norm_type=float('inf'))
+    test_params_without_grads()
+    test_params_without_grads(norm_type=1.0)
+    test_params_without_grads(norm_type=float('inf'))
@@ -0,0 +1,277 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the overlapped, bucketed grad all-reduce of the local
+DistributedDataParallel with the all-reduce after the backward passes, and
+the hierarchical all-reduce over simulated nodes and the grad compressors
+with the flat one, on the CPU with gloo:
+
+    python tests/test_distributed.py
+"""
+
+from commons import set_global_variables
+from commons import spawn
+import torch
+
+from megatron import get_args
+from megatron import mpu
+from megatron.grad_compression import build_grad_compressor
+from megatron.model.distributed import DistributedDataParallel
+from megatron.schedules import forward_backward_no_pipelining
+
+
+class MLP(torch.nn.Module):
+    """Three layers of tanh(x W + b) and a param that gets no grad."""
+
+    def __init__(self, hidden_size):
+        super(MLP, self).__init__()
+        torch.manual_seed(1234)
+        self.unused = torch.nn.Parameter(torch.randn(hidden_size))
+        self.layers = torch.nn.ModuleList(
+            [torch.nn.Linear(hidden_size, hidden_size) for _ in range(3)])
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = torch.tanh(layer(x))
+        return x
+
+
+class UnscaledLoss:
+    def scale_loss(self, loss):
+        return loss
+
+
+def microbatches(rank):
+    args = get_args()
+    index = 0
+    while True:
+        generator = torch.Generator().manual_seed(1000 * rank + index)
+        shape = (args.micro_batch_size, args.hidden_size)
+        yield torch.randn(shape, generator=generator), \
+            torch.randn(shape, generator=generator)
+        index += 1
+
+
+def forward_step(data_iterator, model, input_tensor):
+    inputs, targets = next(data_iterator)
+    loss = ((model(inputs) - targets) ** 2).mean()
+    return loss, {'loss': loss.detach()}
+
+
+def train(overlap_grad_reduce, bucket_size, contiguous, fp32_allreduce,
+          num_iterations, hierarchical_allreduce=False, grad_compressor=None):
+    """Grads of every iteration after the all-reduce."""
+    args = get_args()
+    module = MLP(args.hidden_size)
+    params = list(module.parameters())
+    if contiguous:
+        # Grads laid out as by --use-contiguous-buffers.
+        buffer = torch.zeros(sum(param.numel() for param in params))
+        offset = 0
+        for param in params:
+            param.grad = buffer[offset:offset + param.numel()].view_as(param)
+            offset += param.numel()
+    model = DistributedDataParallel(
+        module, overlap_grad_reduce=overlap_grad_reduce,
+        bucket_size=bucket_size, fp32_allreduce=fp32_allreduce,
+        hierarchical_allreduce=hierarchical_allreduce,
+        grad_compressor=grad_compressor)
+    data_iterator = microbatches(mpu.get_data_parallel_rank())
+
+    grads = []
+    for _ in range(num_iterations):
+        for param in params:
+            if contiguous:
+                param.grad.zero_()
+            else:
+                param.grad = None
+        forward_backward_no_pipelining(forward_step, data_iterator, [model],
+                                       UnscaledLoss(), None,
+                                       forward_only=False)
+        if overlap_grad_reduce:
+            # Only the bucket of the unused param is left.
+            pending = [bucket.pending is not None
+                       for bucket in model._buckets]
+            assert sum(pending) == len(pending) - 1, pending
+        model.allreduce_params(reduce_after=False,
+                               fp32_allreduce=fp32_allreduce)
+        grads.append([None if param.grad is None else param.grad.clone()
+                      for param in params])
+    return grads
+
+
+def _test_overlapped_allreduce(num_microbatches, bucket_size, contiguous,
+                               fp32_allreduce, num_iterations):
+    world_size = torch.distributed.get_world_size()
+    set_global_variables(global_batch_size=num_microbatches * 2 * world_size,
+                         micro_batch_size=2, data_parallel_size=world_size)
+    mpu.initialize_model_parallel(1, 1)
+
+    expected = train(False, None, contiguous, fp32_allreduce,
+                     num_iterations)
+    grads = train(True, bucket_size, contiguous, fp32_allreduce,
+                  num_iterations)
+    mode = 'bucket size {}, contiguous {}, fp32 all-reduce {}'.format(
+        bucket_size, contiguous, fp32_allreduce)
+    for iteration_grads, iteration_expected in zip(grads, expected):
+        for grad, expected_grad in zip(iteration_grads, iteration_expected):
+            assert (grad is None and expected_grad is None) or \
+                torch.equal(grad, expected_grad), \
+                'gradients differ with {}'.format(mode)
+
+    mpu.destroy_model_parallel()
+    if torch.distributed.get_rank() == 0:
+        print('>> overlapped grad all-reduce matches the all-reduce after '
+              'the backward passes with {}'.format(mode), flush=True)
+
+
+def test_overlapped_allreduce(num_microbatches=4, bucket_size=None,
+                              contiguous=False, fp32_allreduce=False,
+                              num_iterations=2):
+    spawn(_test_overlapped_allreduce, 2, num_microbatches, bucket_size,
+          contiguous, fp32_allreduce, num_iterations)
+
+
+def _test_hierarchical_allreduce(ranks_per_node, numel):
+    world_size = torch.distributed.get_world_size()
+    rank = torch.distributed.get_rank()
+    set_global_variables(global_batch_size=4 * 2 * world_size,
+                         micro_batch_size=2, data_parallel_size=world_size)
+    mpu.initialize_model_parallel(1, 1, ranks_per_node=ranks_per_node)
+    assert torch.distributed.get_world_size(
+        group=mpu.get_data_parallel_intra_node_group()) == ranks_per_node
+
+    tensor = torch.randn(numel, generator=torch.Generator().manual_seed(rank))
+    expected = tensor.clone()
+    torch.distributed.all_reduce(expected)
+    mpu.hierarchical_all_reduce(tensor)
+    assert torch.allclose(tensor, expected, rtol=1e-5, atol=1e-6), \
+        'rank {}: hierarchical all-reduce differs'.format(rank)
+
+    # Same grads as the flat all-reduce, up to the order of the sums.
+    for overlap_grad_reduce in (False, True):
+        expected = train(overlap_grad_reduce, 20, False, False, 2)
+        grads = train(overlap_grad_reduce, 20, False, False, 2,
+                      hierarchical_allreduce=True)
+        for iteration_grads, iteration_expected in zip(grads, expected):
+            for grad, expected_grad in zip(iteration_grads,
+                                           iteration_expected):
+                assert (grad is None and expected_grad is None) or \
+                    torch.allclose(grad, expected_grad, rtol=1e-5,
+                                   atol=1e-6), \
+                    'rank {}: gradients differ'.format(rank)
+
+    mpu.destroy_model_parallel()
+    if rank == 0:
+        print('>> hierarchical all-reduce matches the flat one on {} '
+              'simulated nodes of {} ranks'.format(
+                  world_size // ranks_per_node, ranks_per_node), flush=True)
+
+
+def test_hierarchical_allreduce(world_size=4, ranks_per_node=2, numel=1001):
+    spawn(_test_hierarchical_allreduce, world_size, ranks_per_node, numel)
+
+
+def _test_grad_compression(size):
+    world_size = torch.distributed.get_world_size()
+    rank = torch.distributed.get_rank()
+    set_global_variables(global_batch_size=4 * 2 * world_size,
+                         micro_batch_size=2, data_parallel_size=world_size)
+    mpu.initialize_model_parallel(1, 1)
+    group = mpu.get_data_parallel_group()
+
+    generator = torch.Generator().manual_seed(rank)
+    numel, shapes = size * size, [(size, size)]
+    tensor = torch.randn(numel, generator=generator)
+    expected = tensor.clone()
+    torch.distributed.all_reduce(expected, group=group)
+    # Lossless settings, and the low precisions up to their rounding.
+    for name, kwargs, tolerance in (('none', {}, 0.0),
+                                    ('topk', {'topk_ratio': 1.0}, 1e-6),
+                                    ('fp16', {}, 1e-2),
+                                    ('bf16', {}, 1e-1)):
+        compressor = build_grad_compressor(name, **kwargs)
+        result = tensor.clone()
+        compressor.all_reduce(0, result, group, shapes)
+        assert torch.allclose(result, expected, rtol=tolerance,
+                              atol=tolerance), \
+            'rank {}: {} all-reduce differs'.format(rank, name)
+
+    # PowerSGD recovers sums of the rank it sends.
+    v = torch.randn(size, generator=torch.Generator().manual_seed(1234))
+    low_rank = torch.outer(torch.randn(size, generator=generator), v)
+    low_rank_expected = low_rank.clone()
+    torch.distributed.all_reduce(low_rank_expected, group=group)
+    compressor = build_grad_compressor('powersgd', powersgd_rank=1)
+    compressor.all_reduce(0, low_rank.view(-1), group, shapes)
+    assert torch.allclose(low_rank, low_rank_expected, rtol=1e-4,
+                          atol=1e-4), \
+        'rank {}: powersgd all-reduce differs'.format(rank)
+    assert compressor.bytes_sent == 2 * size * 4
+
+    # With error feedback, what is not sent is sent later: the sum of the
+    # all-reduces of tensor, then zeros, tends to the sum of the tensors.
+    for name, kwargs in (('topk', {'topk_ratio': 0.25}),
+                         ('powersgd', {'powersgd_rank': 1})):
+        compressor = build_grad_compressor(name, **kwargs)
+        total = torch.zeros(numel)
+        for step in range(200):
+            result = tensor.clone() if step == 0 else torch.zeros(numel)
+            compressor.all_reduce(0, result, group, shapes)
+            total += result
+        assert torch.allclose(total, expected, rtol=1e-3, atol=1e-3), \
+            'rank {}: {} error feedback loses grads'.format(rank, name)
+        assert compressor.bytes_sent < 200 * numel * 4
+
+        # The state restores the compressor.
+        restored = build_grad_compressor(name, **kwargs)
+        restored.load_state_dict(compressor.state_dict())
+        result, restored_result = tensor.clone(), tensor.clone()
+        compressor.all_reduce(0, result, group, shapes)
+        restored.all_reduce(0, restored_result, group, shapes)
+        assert torch.equal(result, restored_result)
+
+    # The DDP sums the grads with the compressor, overlapped or not.
+    for overlap_grad_reduce in (False, True):
+        expected = train(overlap_grad_reduce, 20, False, False, 2)
+        grads = train(overlap_grad_reduce, 20, False, False, 2,
+                      grad_compressor=build_grad_compressor(
+                          'topk', topk_ratio=1.0))
+        for iteration_grads, iteration_expected in zip(grads, expected):
+            for grad, expected_grad in zip(iteration_grads,
+                                           iteration_expected):
+                assert (grad is None and expected_grad is None) or \
+                    torch.allclose(grad, expected_grad, rtol=1e-5,
+                                   atol=1e-6), \
+                    'rank {}: gradients differ'.format(rank)
+
+    mpu.destroy_model_parallel()
+    if rank == 0:
+        print('>> grad compressors match the flat all-reduce', flush=True)
+
+
+def test_grad_compression(size=16):
+    spawn(_test_grad_compression, 2, size)
+
+
+if __name__ == '__main__':
+    test_overlapped_allreduce()
+    test_overlapped_allreduce(bucket_size=20)
+    test_overlapped_allreduce(1, bucket_size=20)
+    test_overlapped_allreduce(bucket_size=20, contiguous=True)
+    test_overlapped_allreduce(bucket_size=100, fp32_allreduce=True)
+    test_hierarchical_allreduce(4, 2)
+    test_hierarchical_allreduce(8, 4, numel=64)
+    test_grad_compression()
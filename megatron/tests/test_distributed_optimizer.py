@@ -0,0 +1,198 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the distributed optimizer, with and without PipeDream-2BW weight
+stashing, with a skipped step, with grad clipping on the host or on the
+device and after a checkpoint round trip, with an unsharded optimizer
+stepping the averaged grads of all data-parallel ranks, on the CPU with
+gloo:
+
+    python tests/test_distributed_optimizer.py
+"""
+
+from commons import set_global_variables
+from commons import spawn
+import torch
+
+from megatron import mpu
+from megatron.optimizer.distrib_optimizer import DistributedOptimizer
+from megatron.optimizer.grad_scaler import ConstantGradScaler
+
+
+# Shapes of the params; 39 elements, which are padded to shard them.
+SHAPES = ((5, 3), (7,), (4, 4), (1,))
+
+
+class CPUGradScaler(ConstantGradScaler):
+    """Constant loss scale kept on the CPU."""
+
+    def __init__(self, scale):
+        self._scale = torch.FloatTensor([scale])
+
+
+def make_param_groups():
+    generator = torch.Generator().manual_seed(1234)
+    params = [torch.nn.Parameter(torch.randn(shape, generator=generator))
+              for shape in SHAPES]
+    for param in params:
+        mpu.set_defaults_if_not_set_tensor_model_parallel_attributes(param)
+    return [{'params': params[:3]},
+            {'params': params[3:], 'weight_decay': 0.0}]
+
+
+def make_grads(iteration, rank):
+    generator = torch.Generator().manual_seed(1000 * iteration + rank)
+    return [torch.randn(shape, generator=generator) for shape in SHAPES]
+
+
+def make_base_optimizer(param_groups):
+    return torch.optim.Adam(param_groups, lr=0.01, weight_decay=0.01)
+
+
+def params_of(param_groups):
+    return [param for group in param_groups for param in group['params']]
+
+
+def assert_close(params, expected, message):
+    for param, expected_param in zip(params, expected):
+        assert torch.allclose(param, expected_param, rtol=1e-5, atol=1e-6), \
+            '{}: {} != {}'.format(message, param, expected_param)
+
+
+def _test_distributed_optimizer(num_iterations, loss_scale, clip_grad,
+                                weight_stashing, overflow_iteration,
+                                clip_grad_on_device):
+    set_global_variables()
+    mpu.initialize_model_parallel(1, 1)
+    rank = mpu.get_data_parallel_rank()
+    world_size = mpu.get_data_parallel_world_size()
+    mode = 'loss scale {}, clip {}{}, weight stashing {}, overflow at ' \
+        '{}'.format(loss_scale, clip_grad,
+                    ' on the device' if clip_grad_on_device else '',
+                    weight_stashing, overflow_iteration)
+
+    def make_optimizer():
+        param_groups = make_param_groups()
+        grad_scaler = None
+        if loss_scale is not None:
+            grad_scaler = CPUGradScaler(loss_scale)
+        optimizer = DistributedOptimizer(
+            make_base_optimizer(param_groups), grad_scaler, clip_grad,
+            weight_stashing=weight_stashing,
+            clip_grad_on_device=clip_grad_on_device)
+        return params_of(param_groups), optimizer
+
+    def step(params, optimizer, iteration):
+        optimizer.zero_grad()
+        for param, grad in zip(params, make_grads(iteration, rank)):
+            param.grad.add_(grad * (loss_scale or 1.0))
+        if iteration == overflow_iteration and rank == 0:
+            params[0].grad[0, 0] = float('inf')
+        assert optimizer.step() == (iteration != overflow_iteration)
+
+    # Unsharded reference.
+    reference_groups = make_param_groups()
+    reference_params = params_of(reference_groups)
+    reference_optimizer = make_base_optimizer(reference_groups)
+    reference_norms = {}
+
+    def reference_step(iteration):
+        older = [param.detach().clone() for param in reference_params]
+        if iteration == overflow_iteration:
+            # Both versions are the newer one after a skipped step.
+            return older
+        grads = [make_grads(iteration, r) for r in range(world_size)]
+        for i, param in enumerate(reference_params):
+            param.grad = sum(grad[i] / world_size for grad in grads)
+        if clip_grad > 0.0:
+            reference_norms[iteration] = torch.nn.utils.clip_grad_norm_(
+                reference_params, clip_grad).item()
+        reference_optimizer.step()
+        return older
+
+    def check_grad_norm(optimizer, iteration):
+        if clip_grad > 0.0 and iteration != overflow_iteration:
+            # A tensor, never read on the host, when clipping on the device.
+            assert torch.is_tensor(optimizer.grad_norm) == \
+                clip_grad_on_device, mode
+            assert abs(float(optimizer.grad_norm) -
+                       reference_norms[iteration]) < 1e-5, mode
+
+    params, optimizer = make_optimizer()
+    for iteration in range(num_iterations):
+        step(params, optimizer, iteration)
+        older = reference_step(iteration)
+        check_grad_norm(optimizer, iteration)
+        if weight_stashing:
+            # The params hold the older version after the step.
+            assert_close(params, older, mode)
+            optimizer.swap_to_newer_version()
+            assert_close(params, reference_params, mode)
+            optimizer.swap_to_older_version()
+            assert_close(params, older, mode)
+        else:
+            assert_close(params, reference_params, mode)
+
+    # Checkpoint round trip: the model params are loaded before the
+    # optimizer.
+    state_dict = optimizer.state_dict()
+    loaded_params, loaded_optimizer = make_optimizer()
+    for param, saved in zip(loaded_params, params):
+        param.data.copy_(saved.data)
+    loaded_optimizer.load_state_dict(state_dict)
+    for iteration in range(num_iterations, num_iterations + 2):
+        step(loaded_params, loaded_optimizer, iteration)
+        older = reference_step(iteration)
+        check_grad_norm(loaded_optimizer, iteration)
+        expected = older if weight_stashing else reference_params
+        assert_close(loaded_params, expected, mode + ' after loading')
+        if weight_stashing:
+            loaded_optimizer.swap_to_newer_version()
+            assert_close(loaded_params, reference_params,
+                         mode + ' after loading')
+            loaded_optimizer.swap_to_older_version()
+
+    mpu.destroy_model_parallel()
+    if rank == 0:
+        print('>> distributed optimizer matches the unsharded one with {} '
+              'data-parallel ranks and {}'.format(world_size, mode),
+              flush=True)
+
+
+def test_distributed_optimizer(data_parallel_size=2, num_iterations=4,
+                               loss_scale=None, clip_grad=0.0,
+                               weight_stashing=False, overflow_iteration=None,
+                               clip_grad_on_device=False):
+    spawn(_test_distributed_optimizer, data_parallel_size, num_iterations,
+          loss_scale, clip_grad, weight_stashing, overflow_iteration,
+          clip_grad_on_device)
+
+
+def test_clip_grad_on_device(data_parallel_size=2, num_iterations=4,
+                             loss_scale=1024.0, clip_grad=1.0):
+    test_distributed_optimizer(data_parallel_size, num_iterations,
+                               loss_scale, clip_grad, clip_grad_on_device=True)
+
+
+if __name__ == '__main__':
+    test_distributed_optimizer(2)
+    test_distributed_optimizer(2, clip_grad=1.0)
+    test_distributed_optimizer(4, loss_scale=1024.0, clip_grad=1.0)
+    test_clip_grad_on_device()
+    test_distributed_optimizer(2, weight_stashing=True)
+    test_distributed_optimizer(4, loss_scale=1024.0, clip_grad=1.0,
+                               weight_stashing=True)
+    test_distributed_optimizer(2, loss_scale=1024.0, weight_stashing=True,
+                               overflow_iteration=2)
@@ -0,0 +1,106 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Compare the reference implementation of the fused grad copy with the
+separate copy, unscaling, inf/nan check and norm it replaces, on the CPU,
+and the CUDA kernel with the reference implementation if a GPU is
+available:
+
+    python tests/test_fused_grad_copy.py
+"""
+
+import commons  # Puts megatron on the path.
+import torch
+
+from megatron.optimizer.fused_grad_copy import build_tiles
+from megatron.optimizer.fused_grad_copy import copy_unscale_and_norm
+from megatron.optimizer.fused_grad_copy import copy_unscale_and_norm_reference
+
+
+# Ranges of the flat grads counted in the norm, as the grads of params that
+# are not shared or duplicated by tensor model parallelism.
+NUMEL = 1000
+COUNTED_RANGES = ((0, 130), (200, 201), (517, 900))
+
+
+def make_grads(dtype, device, inf_index):
+    generator = torch.Generator().manual_seed(1234)
+    grads = torch.randn(NUMEL, generator=generator) * 1024.0
+    if inf_index is not None:
+        grads[inf_index] = float('inf')
+    return grads.to(dtype=dtype, device=device)
+
+
+def unfused(model_grads, inv_scale):
+    main_grads = model_grads.float() * inv_scale
+    found_inf = not torch.isfinite(main_grads).all().item()
+    sum_of_squares = sum(main_grads[start:end].double().pow(2).sum().item()
+                         for start, end in COUNTED_RANGES)
+    return main_grads, found_inf, sum_of_squares
+
+
+def run(function, model_grads, in_place, inv_scale, tiles):
+    main_grads = model_grads if in_place else \
+        torch.empty(NUMEL, device=model_grads.device)
+    stats = torch.zeros(2, device=model_grads.device)
+    function(model_grads, main_grads, inv_scale, tiles, stats)
+    found_inf, sum_of_squares = stats.tolist()
+    return main_grads, found_inf > 0, sum_of_squares
+
+
+def assert_matches(result, expected, message):
+    main_grads, found_inf, sum_of_squares = result
+    expected_grads, expected_found_inf, expected_sum = expected
+    assert found_inf == expected_found_inf, message
+    assert torch.equal(main_grads.cpu(), expected_grads.cpu()), message
+    if not expected_found_inf:
+        assert abs(sum_of_squares - expected_sum) <= 1e-5 * expected_sum, \
+            '{}: {} != {}'.format(message, sum_of_squares, expected_sum)
+
+
+def test_fused_grad_copy(dtype=torch.half, in_place=False, tile_size=64,
+                         inf_index=None):
+    mode = '{} grads{}, tiles of {}, inf at {}'.format(
+        dtype, ' unscaled in place' if in_place else '', tile_size,
+        inf_index)
+    inv_scale = torch.FloatTensor([1.0 / 1024.0])
+    tiles = build_tiles(COUNTED_RANGES, NUMEL, 'cpu', tile_size=tile_size)
+    assert tiles[:, 0].tolist() == sorted(tiles[:, 0].tolist())
+    assert (tiles[:, 1] - tiles[:, 0]).sum().item() == NUMEL
+    assert (tiles[:, 1] - tiles[:, 0]).max().item() <= tile_size
+
+    model_grads = make_grads(dtype, 'cpu', inf_index)
+    expected = unfused(model_grads, inv_scale)
+    assert_matches(run(copy_unscale_and_norm_reference, model_grads.clone(),
+                       in_place, inv_scale, tiles),
+                   expected, mode)
+    if torch.cuda.is_available():
+        from megatron import fused_kernels
+        fused_kernels.load_fused_grad_copy_kernel()
+        assert_matches(run(copy_unscale_and_norm, model_grads.cuda(),
+                           in_place, inv_scale.cuda(), tiles.cuda()),
+                       expected, mode + ' on the GPU')
+    print('>> fused grad copy matches the unfused one with {}'.format(mode),
+          flush=True)
+
+
+if __name__ == '__main__':
+    test_fused_grad_copy()
+    test_fused_grad_copy(tile_size=2 ** 14)
+    test_fused_grad_copy(inf_index=517)
+    test_fused_grad_copy(inf_index=150)
+    test_fused_grad_copy(torch.float, in_place=True)
+    test_fused_grad_copy(torch.float, in_place=True, inf_index=999)
@@ -0,0 +1,407 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Compare the PyTorch Adam, the CPU Adam and the block-quantized Adam of
+megatron.optimizer with torch.optim.AdamW, check that Adafactor factors
+its state and minimizes a least-squares loss, compare the optimizer with
+its state offloaded to the CPU with the fp32 optimizer, and check the two
+weight versions of the fp32 optimizer with weight stashing, on the CPU.
+With a GPU, also compare the offloading optimizer with the fp16 optimizer,
+check the two weight versions of the fp16 optimizer through an overflowed
+step, and the host copy of the loss scale:
+
+    python tests/test_optimizers.py
+"""
+
+import copy
+
+from commons import set_global_variables
+from commons import spawn
+import pytest
+import torch
+
+from megatron import mpu
+from megatron.optimizer.adafactor import Adafactor
+from megatron.optimizer.adam import Adam
+from megatron.optimizer.cpu_adam import CPUAdam, cpu_adam_
+from megatron.optimizer.grad_scaler import ConstantGradScaler
+from megatron.optimizer.grad_scaler import DynamicGradScaler
+from megatron.optimizer.offload_optimizer import CPUOffloadOptimizer
+from megatron.optimizer.optimizer import FP16OptimizerWithFP16Params
+from megatron.optimizer.optimizer import FP32Optimizer
+from megatron.optimizer.quantized_adam import QuantizedAdam
+
+
+SHAPES = ((64, 48), (300,), (1,))
+
+requires_gpu = pytest.mark.skipif(not torch.cuda.is_available(),
+                                  reason='requires a GPU')
+
+
+def make_params(seed=1234):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.nn.Parameter(torch.randn(shape, generator=generator))
+            for shape in SHAPES]
+
+
+def set_grads(params, iteration):
+    generator = torch.Generator().manual_seed(iteration)
+    for param in params:
+        param.grad = torch.randn(param.shape, generator=generator)
+
+
+def run(optimizer, params, iterations, first_iteration=0):
+    for iteration in range(first_iteration, first_iteration + iterations):
+        set_grads(params, iteration)
+        optimizer.step()
+
+
+def test_adam(adam_w_mode=True, num_iterations=10):
+    kwargs = dict(lr=1e-2, weight_decay=0.1)
+    params, reference = make_params(), make_params()
+    run(Adam(params, adam_w_mode=adam_w_mode, **kwargs), params,
+        num_iterations)
+    reference_class = torch.optim.AdamW if adam_w_mode else torch.optim.Adam
+    run(reference_class(reference, **kwargs), reference, num_iterations)
+    for param, expected in zip(params, reference):
+        assert torch.allclose(param, expected, rtol=1e-5, atol=1e-6)
+    print('>> adam matches {}'.format(reference_class.__name__), flush=True)
+
+
+def test_cpu_adam(adam_w_mode=True, block_size=37, num_iterations=10):
+    kwargs = dict(lr=1e-2, weight_decay=0.1)
+    params, reference = make_params(), make_params()
+    run(CPUAdam(params, adam_w_mode=adam_w_mode, block_size=block_size,
+                **kwargs), params, num_iterations)
+    reference_class = torch.optim.AdamW if adam_w_mode else torch.optim.Adam
+    run(reference_class(reference, **kwargs), reference, num_iterations)
+    for param, expected in zip(params, reference):
+        assert torch.allclose(param, expected, rtol=1e-5, atol=1e-6)
+
+    # Unscaling folded into the update of fp16 grads, and the updated param
+    # written into another tensor.
+    generator = torch.Generator().manual_seed(1234)
+    param = torch.randn(1000, generator=generator)
+    expected = param.clone()
+    grad = torch.randn(1000, generator=generator).half().float()
+    out = torch.empty(1000, dtype=torch.half)
+    states = [torch.zeros(1000) for _ in range(4)]
+    for step in (1, 2):
+        cpu_adam_(param, (1024.0 * grad).half(), states[0], states[1], step,
+                  beta1=0.9, beta2=0.999, eps=1e-8, adam_w_mode=adam_w_mode,
+                  grad_scale=1.0 / 1024.0, out=out,
+                  workspace=torch.empty(2, block_size), **kwargs)
+        cpu_adam_(expected, grad, states[2], states[3], step, beta1=0.9,
+                  beta2=0.999, eps=1e-8, adam_w_mode=adam_w_mode, **kwargs)
+    assert torch.allclose(param, expected, rtol=1e-5, atol=1e-6)
+    assert torch.equal(out, param.half())
+    print('>> cpu adam with blocks of {} matches {}'.format(
+        block_size, reference_class.__name__), flush=True)
+
+
+def test_quantized_adam(block_size=256, chunk_size=1024, num_iterations=10):
+    kwargs = dict(lr=1e-3, weight_decay=0.1)
+    params, reference = make_params(), make_params()
+    optimizer = QuantizedAdam(params, block_size=block_size,
+                              chunk_size=chunk_size, **kwargs)
+    run(optimizer, params, num_iterations)
+    run(torch.optim.AdamW(reference, **kwargs), reference, num_iterations)
+    for param, expected in zip(params, reference):
+        state = optimizer.state[param]
+        assert state['exp_avg'].dtype == torch.int8
+        assert state['exp_avg_sq'].dtype == torch.uint8
+        # Updates are at most lr per element; quantization changes them
+        # by a fraction of that.
+        error = (param - expected).abs().max().item()
+        assert error < 0.1 * kwargs['lr'] * num_iterations, error
+
+    # Checkpoint round trip.
+    loaded = make_params()
+    for param, saved in zip(loaded, params):
+        param.data.copy_(saved.data)
+    loaded_optimizer = QuantizedAdam(loaded, block_size=block_size,
+                                     chunk_size=chunk_size, **kwargs)
+    # Copied, as by torch.save and torch.load.
+    loaded_optimizer.load_state_dict(copy.deepcopy(optimizer.state_dict()))
+    run(optimizer, params, 2, first_iteration=num_iterations)
+    run(loaded_optimizer, loaded, 2, first_iteration=num_iterations)
+    for param, expected in zip(loaded, params):
+        assert torch.equal(param, expected)
+    print('>> quantized adam with blocks of {} is within quantization error '
+          'of AdamW'.format(block_size), flush=True)
+
+
+def test_adafactor(beta1=None, num_iterations=300):
+    generator = torch.Generator().manual_seed(1234)
+    inputs = torch.randn(256, 64, generator=generator)
+    targets = inputs @ torch.randn(64, 48, generator=generator)
+    weight = torch.nn.Parameter(torch.zeros(64, 48))
+    bias = torch.nn.Parameter(torch.zeros(48))
+    optimizer = Adafactor([weight, bias], lr=5e-2, beta1=beta1)
+
+    def loss():
+        return (inputs @ weight + bias - targets).pow(2).mean()
+
+    initial_loss = loss().item()
+    for _ in range(num_iterations):
+        optimizer.zero_grad()
+        loss().backward()
+        optimizer.step()
+    assert loss().item() < 0.1 * initial_loss, (initial_loss, loss().item())
+    assert optimizer.state[weight]['exp_avg_sq_row'].shape == (64,)
+    assert optimizer.state[weight]['exp_avg_sq_col'].shape == (48,)
+    assert optimizer.state[bias]['exp_avg_sq'].shape == (48,)
+    assert ('exp_avg' in optimizer.state[weight]) == (beta1 is not None)
+    print('>> adafactor with beta1 {} reduces the loss from {:.3f} to '
+          '{:.3f}'.format(beta1, initial_loss, loss().item()), flush=True)
+
+
+class MLP(torch.nn.Module):
+    """Two layers, in fp16 on the GPU or in fp32 on the CPU."""
+
+    def __init__(self, fp16):
+        super(MLP, self).__init__()
+        torch.manual_seed(1234)
+        self.first = torch.nn.Linear(16, 32)
+        self.second = torch.nn.Linear(32, 8)
+        if fp16:
+            self.cuda().half()
+        for param in self.parameters():
+            mpu.set_defaults_if_not_set_tensor_model_parallel_attributes(
+                param)
+
+    def forward(self, x):
+        return self.second(torch.tanh(self.first(x)))
+
+
+def train_mlp(model, optimizer, num_microbatches, iterations,
+              overflow_iteration, weight_stashing):
+    """Params after every step, of both versions with weight stashing."""
+    params = []
+    weight = model.first.weight
+    for iteration in iterations:
+        optimizer.zero_grad()
+        for microbatch in range(num_microbatches):
+            generator = torch.Generator().manual_seed(
+                1000 * iteration + microbatch)
+            inputs = torch.randn(2, 16, generator=generator).to(
+                weight.device, weight.dtype)
+            targets = torch.randn(2, 8, generator=generator).to(
+                weight.device)
+            loss = ((model(inputs).float() - targets) ** 2).mean()
+            if iteration == overflow_iteration:
+                loss = loss * float('inf')
+            optimizer.scale_loss(loss).backward()
+        optimizer.step()
+        versions = ('older', 'newer') if weight_stashing else ('older',)
+        for version in versions:
+            if weight_stashing:
+                getattr(optimizer, 'swap_to_{}_version'.format(version))()
+            params.append([param.detach().float().clone()
+                           for param in model.parameters()])
+        if weight_stashing:
+            optimizer.swap_to_older_version()
+    return params
+
+
+def build_optimizer(model, fp16, offload, weight_stashing, chunk_size):
+    """Adam for the fp16 or fp32 params of `model`, stepped on the CPU with
+    offload."""
+    decay = [param for name, param in model.named_parameters()
+             if name.endswith('weight')]
+    no_decay = [param for name, param in model.named_parameters()
+                if not name.endswith('weight')]
+    param_groups = [{'params': decay},
+                    {'params': no_decay, 'weight_decay': 0.0}]
+    grad_scaler = None
+    if fp16:
+        grad_scaler = DynamicGradScaler(
+            initial_scale=1024.0, min_scale=1.0, growth_factor=2.0,
+            backoff_factor=0.5, growth_interval=2, hysteresis=1)
+    if offload:
+        return CPUOffloadOptimizer(
+            CPUAdam(param_groups, lr=1e-2, weight_decay=0.1), grad_scaler,
+            1.0, weight_stashing=weight_stashing, chunk_size=chunk_size)
+    if not fp16:
+        return FP32Optimizer(Adam(param_groups, lr=1e-2, weight_decay=0.1),
+                             1.0, weight_stashing=weight_stashing)
+    return FP16OptimizerWithFP16Params(
+        Adam(param_groups, lr=1e-2, weight_decay=0.1), grad_scaler, 1.0,
+        weight_stashing=weight_stashing)
+
+
+def _test_offload_optimizer(fp16, weight_stashing, num_microbatches,
+                            num_iterations, overflow_iteration, chunk_size):
+    set_global_variables(global_batch_size=2 * num_microbatches,
+                         micro_batch_size=2)
+    mpu.initialize_model_parallel(1, 1)
+
+    results = []
+    for offload in (False, True):
+        model = MLP(fp16)
+        optimizer = build_optimizer(model, fp16, offload, weight_stashing,
+                                    chunk_size)
+        results.append(train_mlp(model, optimizer, num_microbatches,
+                                 range(num_iterations), overflow_iteration,
+                                 weight_stashing))
+    for step_params, expected_params in zip(*results):
+        for param, expected in zip(step_params, expected_params):
+            assert torch.allclose(param, expected, rtol=1e-3, atol=1e-3), \
+                (param - expected).abs().max().item()
+
+    # Checkpoint round trip.
+    loaded_model = MLP(fp16)
+    for param, saved in zip(loaded_model.parameters(), model.parameters()):
+        param.data.copy_(saved.data)
+    loaded_optimizer = build_optimizer(loaded_model, fp16, True,
+                                       weight_stashing, chunk_size)
+    loaded_optimizer.load_state_dict(copy.deepcopy(optimizer.state_dict()))
+    iterations = range(num_iterations, num_iterations + 2)
+    expected = train_mlp(model, optimizer, num_microbatches, iterations,
+                         None, weight_stashing)
+    loaded = train_mlp(loaded_model, loaded_optimizer, num_microbatches,
+                       iterations, None, weight_stashing)
+    for step_params, expected_params in zip(loaded, expected):
+        for param, expected_param in zip(step_params, expected_params):
+            assert torch.equal(param, expected_param)
+
+    mpu.destroy_model_parallel()
+    print('>> cpu offload optimizer matches the {} optimizer{}{}'.format(
+              'fp16' if fp16 else 'fp32',
+              ' with weight stashing' if weight_stashing else '',
+              ', with an overflow at iteration {}'.format(
+                  overflow_iteration) if fp16 else ''), flush=True)
+
+
+def test_offload_optimizer(weight_stashing=False, num_microbatches=3,
+                           num_iterations=6, chunk_size=100):
+    """fp32 params, without a GPU."""
+    spawn(_test_offload_optimizer, 1, False, weight_stashing,
+          num_microbatches, num_iterations, None, chunk_size)
+
+
+@requires_gpu
+def test_fp16_offload_optimizer(weight_stashing=False, num_microbatches=3,
+                                num_iterations=6, overflow_iteration=2,
+                                chunk_size=100):
+    spawn(_test_offload_optimizer, 1, True, weight_stashing,
+          num_microbatches, num_iterations, overflow_iteration, chunk_size)
+
+
+@requires_gpu
+def test_grad_scaler(num_updates=40):
+    """The host copy of the scale follows the scale on the device."""
+    grad_scaler = DynamicGradScaler(initial_scale=3.0 * 2 ** 16, min_scale=0.7,
+                                    growth_factor=1.9, backoff_factor=0.3,
+                                    growth_interval=2, hysteresis=2)
+    generator = torch.Generator().manual_seed(1234)
+    for _ in range(num_updates):
+        found_inf = torch.rand(1, generator=generator).item() < 0.4
+        grad_scaler.update(found_inf)
+        assert grad_scaler.inv_scale_value == grad_scaler.inv_scale.item()
+    reloaded = DynamicGradScaler(1.0, 1.0, 2.0, 0.5, 1, 1)
+    reloaded.load_state_dict(grad_scaler.state_dict())
+    assert reloaded.inv_scale_value == grad_scaler.inv_scale.item()
+    print('>> the host copy of the loss scale matches the device scale',
+          flush=True)
+
+
+def _test_weight_stashing(fp16, num_iterations, overflow_iteration):
+    set_global_variables()
+    mpu.initialize_model_parallel(1, 1)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    # The fp16 optimizer also gets an fp32 param.
+    reference = make_params()
+    params = [torch.nn.Parameter(param.detach().clone().to(device))
+              for param in reference]
+    if fp16:
+        for param in params[:-1]:
+            param.data = param.data.half()
+        for param in reference[:-1]:
+            param.data = param.data.half().float()
+    for param in params:
+        mpu.set_defaults_if_not_set_tensor_model_parallel_attributes(param)
+    if fp16:
+        optimizer = FP16OptimizerWithFP16Params(
+            torch.optim.SGD(params, lr=0.1), ConstantGradScaler(1.0),
+            0.0, weight_stashing=True)
+    else:
+        optimizer = FP32Optimizer(torch.optim.SGD(params, lr=0.1), 0.0,
+                                  weight_stashing=True)
+    reference_optimizer = torch.optim.SGD(reference, lr=0.1)
+
+    versions = [[param.detach().clone() for param in reference]]
+    for iteration in range(num_iterations):
+        # The step updates the newer version whichever the params hold.
+        if iteration % 2:
+            optimizer.swap_to_older_version()
+        set_grads(reference, iteration)
+        for param, expected in zip(params, reference):
+            expected.grad = expected.grad.to(param.dtype).float()
+            param.grad = expected.grad.to(param.dtype).to(device)
+        overflow = fp16 and iteration == overflow_iteration
+        if overflow:
+            params[0].grad[0, 0] = float('inf')
+        assert optimizer.step() != overflow
+        if not overflow:
+            reference_optimizer.step()
+        versions.append([param.detach().clone() for param in reference])
+
+        # Without an update, both versions are the newer one.
+        for version, expected_params in (('older', versions[-2]),
+                                         ('newer', versions[-1])):
+            getattr(optimizer, 'swap_to_{}_version'.format(version))()
+            for param, expected in zip(params, expected_params):
+                assert torch.allclose(param.float().cpu(), expected,
+                                      rtol=1e-3, atol=1e-3), \
+                    (iteration, version)
+
+    print('>> {} optimizer with weight stashing holds the older and newer '
+          'versions{}'.format(
+              'fp16' if fp16 else 'fp32',
+              ', with an overflow at iteration {}'.format(
+                  overflow_iteration) if fp16 else ''), flush=True)
+    mpu.destroy_model_parallel()
+
+
+def test_weight_stashing(num_iterations=5):
+    spawn(_test_weight_stashing, 1, False, num_iterations, None)
+
+
+@requires_gpu
+def test_fp16_weight_stashing(num_iterations=5, overflow_iteration=2):
+    spawn(_test_weight_stashing, 1, True, num_iterations,
+          overflow_iteration)
+
+
+if __name__ == '__main__':
+    test_adam()
+    test_adam(adam_w_mode=False)
+    test_cpu_adam()
+    test_cpu_adam(adam_w_mode=False, block_size=2 ** 20)
+    test_quantized_adam()
+    test_quantized_adam(block_size=64, chunk_size=64)
+    test_adafactor()
+    test_adafactor(beta1=0.9)
+    test_offload_optimizer()
+    test_offload_optimizer(weight_stashing=True)
+    test_weight_stashing()
+    if torch.cuda.is_available():
+        test_grad_scaler()
+        test_fp16_offload_optimizer()
+        test_fp16_offload_optimizer(weight_stashing=True)
+        test_fp16_weight_stashing()
@@ -0,0 +1,148 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Verify the per-rank programs of every pipeline schedule over a small grid
+of pipeline sizes, microbatches and model chunks, with blocking and
+non-blocking communication, and check that the verifier rejects broken
+programs, on the CPU:
+
+    python tests/test_pipeline_instructions.py
+"""
+
+import commons  # Puts megatron on the path.
+
+from megatron.pipeline_instructions import Backward
+from megatron.pipeline_instructions import Forward
+from megatron.pipeline_instructions import RecvActivation
+from megatron.pipeline_instructions import RecvGrad
+from megatron.pipeline_instructions import SendActivation
+from megatron.pipeline_instructions import SendGrad
+from megatron.pipeline_instructions import build_training_instructions
+from megatron.pipeline_instructions import hoist_receives
+from megatron.pipeline_instructions import interleaved_instructions
+from megatron.pipeline_instructions import one_f_one_b_instructions
+from megatron.pipeline_instructions import run_instructions
+from megatron.pipeline_instructions import verify_instructions
+
+
+def configurations(max_pipeline_size, max_microbatches, max_model_chunks,
+                   num_iterations):
+    """Yield (description, programs, num_model_chunks, forward_only)."""
+    for p in range(1, max_pipeline_size + 1):
+        for m in range(1, max_microbatches + 1):
+            for schedule in ('1f1b', 'gpipe', '2bw', 'pipedream'):
+                yield ('{} p={} m={}'.format(schedule, p, m),
+                       build_training_instructions(
+                           schedule, p, m, num_iterations), 1, False)
+            for limit in range(1, p):
+                for schedule in ('2bw', 'pipedream'):
+                    yield ('{} p={} m={} max-in-flight={}'.format(
+                               schedule, p, m, limit),
+                           build_training_instructions(
+                               schedule, p, m, num_iterations,
+                               max_in_flight=limit), 1, False)
+            yield ('1f1b forward-only p={} m={}'.format(p, m),
+                   [one_f_one_b_instructions(p, s, m, forward_only=True)
+                    for s in range(p)], 1, True)
+            if p == 1 or m % p != 0:
+                continue
+            for v in range(1, max_model_chunks + 1):
+                yield ('interleaved p={} m={} v={}'.format(p, m, v),
+                       build_training_instructions(
+                           'interleaved', p, m, num_iterations, v), v, False)
+                if 2 * (p - 1) + (v - 1) * p < m * v:
+                    yield ('interleaved-2bw p={} m={} v={}'.format(p, m, v),
+                           build_training_instructions(
+                               'interleaved-2bw', p, m, num_iterations, v),
+                           v, False)
+                yield ('interleaved forward-only p={} m={} v={}'.format(
+                           p, m, v),
+                       [interleaved_instructions(p, s, m, v,
+                                                 forward_only=True)
+                        for s in range(p)], v, True)
+
+
+def test_schedules(max_pipeline_size=4, max_microbatches=8,
+                   max_model_chunks=2, num_iterations=3):
+    num_checked = 0
+    for description, programs, num_model_chunks, forward_only in \
+            configurations(max_pipeline_size, max_microbatches,
+                           max_model_chunks, num_iterations):
+        for blocking in (True, False):
+            if not blocking:
+                programs = [hoist_receives(program) for program in programs]
+            try:
+                verify_instructions(programs, num_model_chunks,
+                                    forward_only, blocking=blocking)
+            except (AssertionError, RuntimeError) as e:
+                raise AssertionError('{} ({}): {}'.format(
+                    description, 'blocking' if blocking else 'async', e))
+            num_checked += 1
+    print('>> verified {} schedule configurations'.format(num_checked),
+          flush=True)
+
+
+def expect_failure(programs, exception_type, num_model_chunks=1,
+                   blocking=True):
+    try:
+        verify_instructions(programs, num_model_chunks, blocking=blocking)
+    except exception_type:
+        return
+    raise AssertionError('broken programs passed verification: {}'.format(
+        programs))
+
+
+def test_broken_programs():
+    # Both ranks wait for the other to send first.
+    expect_failure([[Forward(0, 0), RecvGrad(0, 0), Backward(0, 0),
+                     SendActivation(0, 0)],
+                    [RecvActivation(0, 0), Forward(0, 0), Backward(0, 0),
+                     SendGrad(0, 0)]], RuntimeError)
+    # The receiver expects another microbatch.
+    expect_failure([[Forward(0, 0), SendActivation(0, 0), RecvGrad(0, 0),
+                     Backward(0, 0)],
+                    [RecvActivation(1, 0), Forward(1, 0), Backward(1, 0),
+                     SendGrad(1, 0)]], (AssertionError, RuntimeError))
+    # A backward pass before its forward pass.
+    expect_failure([[Backward(0, 0), Forward(0, 0)]], AssertionError)
+    # A forward pass without its input.
+    expect_failure([[Forward(0, 0), SendActivation(0, 0), RecvGrad(0, 0),
+                     Backward(0, 0)],
+                    [Forward(0, 0), RecvActivation(0, 0), Backward(0, 0),
+                     SendGrad(0, 0)]], AssertionError)
+
+    # Timings of the same exchange in a working order.
+    timeline = run_instructions(
+        [[Forward(0, 0), SendActivation(0, 0), RecvGrad(0, 0),
+          Backward(0, 0)],
+         [RecvActivation(0, 0), Forward(0, 0), Backward(0, 0),
+          SendGrad(0, 0)]],
+        compute_cost=lambda rank, instruction: 1.0,
+        transfer_cost=lambda rank, instruction: 0.5)
+    ends = {(rank, type(instruction).__name__): end
+            for rank, instruction, start, end in timeline
+            if not isinstance(instruction, list)}
+    assert ends[(0, 'Forward')] == 1.0
+    assert ends[(1, 'Forward')] == 2.5
+    assert ends[(1, 'Backward')] == 3.5
+    assert ends[(0, 'Backward')] == 5.0, timeline
+    print('>> verification rejects deadlocks, mismatched messages and '
+          'passes without their inputs', flush=True)
+
+
+if __name__ == '__main__':
+    test_schedules()
+    test_broken_programs()
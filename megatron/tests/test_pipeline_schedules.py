@@ -0,0 +1,815 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the interleaved PipeDream-2BW schedule with the flush-based
+interleaved schedule, the pipeline communication options with blocking
+communication into new buffers, PipeDream-2BW with a bounded or offloaded
+stash with the unbounded one, PipeDream weight stashing with sequential
+training on stashed weights, and the asynchronous all-reduce of shared
+embeddings, also through the local DDP, with the blocking one, on a tiny
+model, on the CPU with gloo.
+Also checks that a non-blocking send is waited for before the next send in
+its direction, that forward-only passes do not recycle a receive buffer
+they send on, the merged traces of the pipeline tracer, and that the
+executor rejects the simulation-only instructions:
+
+    python tests/test_pipeline_schedules.py
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+from commons import set_global_variables
+from commons import spawn
+import torch
+
+from megatron import get_args
+from megatron import get_timers
+from megatron import mpu
+from megatron import p2p_communication
+from megatron import pipeline_trace
+from megatron import schedules
+from megatron.model.distributed import DistributedDataParallel
+from megatron.schedules import forward_backward_pipelining_no_flushes
+from megatron.schedules import forward_backward_pipelining_with_interleaving
+from megatron.pipeline_instructions import AllReduceGrads
+from megatron.pipeline_instructions import Forward, OptimizerStep
+from megatron.pipeline_instructions import build_training_instructions
+from megatron.schedules import get_stash_statistics
+from megatron.schedules import get_weight_version_statistics
+
+
+class Chunk(torch.nn.Module):
+    """Model chunk of virtual stage `virtual_stage`: tanh(x W + b)."""
+
+    def __init__(self, virtual_stage, hidden_size):
+        super(Chunk, self).__init__()
+        generator = torch.Generator().manual_seed(1234 + virtual_stage)
+        self.weight = torch.nn.Parameter(
+            torch.randn(hidden_size, hidden_size, generator=generator) /
+            hidden_size ** 0.5)
+        self.bias = torch.nn.Parameter(
+            0.1 * torch.randn(hidden_size, generator=generator))
+
+    def forward(self, x):
+        return torch.tanh(torch.matmul(x, self.weight) + self.bias)
+
+
+class TiedChunk(Chunk):
+    """Chunk whose weight, on the first and last pipeline stages, stands for
+    the word embeddings that they share."""
+
+    def __init__(self, virtual_stage, hidden_size, share_word_embeddings):
+        super(TiedChunk, self).__init__(virtual_stage, hidden_size)
+        self.share_word_embeddings = share_word_embeddings
+
+    def word_embeddings_weight(self):
+        return self.weight
+
+
+class TwoVersionSGD:
+    """Implements the optimizer interface used by the schedules with
+    PipeDream-2BW weight versions: during the k-th iteration the 'older'
+    version is W_{k-1} and the 'newer' one W_k, and step() computes
+    W_{k+1} = W_k - lr * grad."""
+
+    def __init__(self, params, lr):
+        self.params = params
+        self.lr = lr
+        self.older = [param.detach().clone() for param in params]
+        self.newer = [param.detach().clone() for param in params]
+        self.grad_syncs = []
+
+    def scale_loss(self, loss):
+        return loss
+
+    def swap_to_older_version(self):
+        for param, weights in zip(self.params, self.older):
+            param.data = weights
+
+    def swap_to_newer_version(self):
+        for param, weights in zip(self.params, self.newer):
+            param.data = weights
+
+    def add_grad_sync(self, handle):
+        self.grad_syncs.append(handle)
+
+    def wait_for_grad_syncs(self):
+        for handle in self.grad_syncs:
+            handle.wait()
+        self.grad_syncs = []
+
+    def step(self):
+        self.wait_for_grad_syncs()
+        grads = [param.grad.detach().clone() for param in self.params]
+        updated = [weights - self.lr * grad
+                   for weights, grad in zip(self.newer, grads)]
+        self.older, self.newer = self.newer, updated
+        for param in self.params:
+            param.grad = None
+        return grads
+
+
+class SGD:
+    """Implements the optimizer interface used by the schedules with one
+    weight version, updated in place: W_{k+1} = W_k - lr * grad."""
+
+    def __init__(self, params, lr):
+        self.params = params
+        self.lr = lr
+
+    def scale_loss(self, loss):
+        return loss
+
+    def step(self):
+        grads = [param.grad.detach().clone() for param in self.params]
+        for param, grad in zip(self.params, grads):
+            param.data.sub_(self.lr * grad)
+            param.grad = None
+        return grads
+
+
+def microbatches():
+    """Random (inputs, targets) pairs, with sequence lengths varying between
+    seq_length / 2 and seq_length with --variable-seq-lengths."""
+    args = get_args()
+    index = 0
+    while True:
+        seq_length = args.seq_length
+        if args.variable_seq_lengths:
+            seq_length -= index % (args.seq_length // 2 + 1)
+        shape = (seq_length, args.micro_batch_size, args.hidden_size)
+        generator = torch.Generator().manual_seed(index)
+        yield torch.randn(shape, generator=generator), \
+            torch.randn(shape, generator=generator)
+        index += 1
+
+
+def forward_step(data_iterator, model, input_tensor):
+    inputs, targets = next(data_iterator)
+    if mpu.is_pipeline_first_stage():
+        input_tensor = inputs
+    output_tensor = model(input_tensor)
+    if mpu.is_pipeline_last_stage():
+        loss = ((output_tensor - targets) ** 2).mean()
+        return loss, {'loss': loss.detach()}
+    return output_tensor
+
+
+def run_schedule(no_flushes, num_model_chunks, num_iterations,
+                 share_word_embeddings=None, overlap_grad_reduce=None):
+    """Train for `num_iterations` and return the gradients of every
+    iteration and the reduced losses. With share_word_embeddings, the
+    weights of the first and last model chunks are tied; if it is False,
+    their grads are all-reduced here, before the optimizer step. Unless
+    overlap_grad_reduce is None, the model chunks are wrapped in the local
+    DDP, with or without overlapped grad all-reduces; otherwise, the grads
+    are all-reduced across data-parallel ranks here."""
+    args = get_args()
+    pipeline_size = mpu.get_pipeline_model_parallel_world_size()
+    rank = mpu.get_pipeline_model_parallel_rank()
+    if share_word_embeddings is None:
+        model = [Chunk(chunk * pipeline_size + rank, args.hidden_size)
+                 for chunk in range(num_model_chunks)]
+    else:
+        model = [TiedChunk(chunk * pipeline_size + rank, args.hidden_size,
+                           share_word_embeddings)
+                 for chunk in range(num_model_chunks)]
+    if overlap_grad_reduce is not None:
+        model = [DistributedDataParallel(
+                     module, overlap_grad_reduce=overlap_grad_reduce)
+                 for module in model]
+    if mpu.is_pipeline_first_stage(ignore_virtual=True):
+        embedding_chunk = model[0]
+    elif mpu.is_pipeline_last_stage(ignore_virtual=True):
+        embedding_chunk = model[-1]
+    else:
+        embedding_chunk = None
+    params = [param for module in model for param in module.parameters()]
+    optimizer = TwoVersionSGD(params, lr=0.1)
+    iterators = [microbatches() for _ in model]
+
+    grads, losses = [], []
+    for iteration in range(num_iterations):
+        if no_flushes:
+            losses.extend(forward_backward_pipelining_no_flushes(
+                forward_step, iterators if num_model_chunks > 1 else
+                iterators[0], model, optimizer, None,
+                first_iteration=(iteration == 0),
+                last_iteration=(iteration == num_iterations - 1)))
+        else:
+            # The flush-based schedule computes the gradient of batch k
+            # with the weights that 2BW uses for it, W_{k-1}.
+            optimizer.swap_to_older_version()
+            losses.extend(forward_backward_pipelining_with_interleaving(
+                forward_step, iterators, model, optimizer, None,
+                forward_only=False))
+        if share_word_embeddings is False and embedding_chunk is not None:
+            torch.distributed.all_reduce(embedding_chunk.weight.grad,
+                                         group=mpu.get_embedding_group())
+        # As in train_step(), after the embedding grad all-reduce.
+        optimizer.wait_for_grad_syncs()
+        if overlap_grad_reduce is None:
+            for param in params:
+                param.grad /= mpu.get_data_parallel_world_size()
+                torch.distributed.all_reduce(
+                    param.grad, group=mpu.get_data_parallel_group())
+        else:
+            for module in model:
+                module.allreduce_params(reduce_after=False)
+        grads.append(optimizer.step())
+    return grads, [loss['loss'] for loss in losses]
+
+
+def _test_interleaved_no_flushes(pipeline_size, num_model_chunks,
+                                 num_microbatches, num_iterations,
+                                 variable_seq_lengths):
+    set_global_variables(global_batch_size=num_microbatches * 2,
+                         micro_batch_size=2,
+                         variable_seq_lengths=variable_seq_lengths)
+    mpu.initialize_model_parallel(1, pipeline_size, num_model_chunks)
+
+    grads_2bw, losses_2bw = run_schedule(True, num_model_chunks,
+                                         num_iterations)
+    grads_flush, losses_flush = run_schedule(False, num_model_chunks,
+                                             num_iterations)
+
+    rank = torch.distributed.get_rank()
+    for iteration in range(num_iterations):
+        for grad_2bw, grad_flush in zip(grads_2bw[iteration],
+                                        grads_flush[iteration]):
+            error = (grad_2bw - grad_flush).abs().max().item()
+            assert error < 1e-6, \
+                'rank {} iteration {}: max gradient error {}'.format(
+                    rank, iteration, error)
+    assert len(losses_2bw) == len(losses_flush)
+    for loss_2bw, loss_flush in zip(losses_2bw, losses_flush):
+        assert abs(loss_2bw.item() - loss_flush.item()) < 1e-6
+
+    mpu.destroy_model_parallel()
+    if rank == 0:
+        print('>> interleaved 2BW matches the flush-based schedule with {} '
+              'stages, {} model chunks and {} microbatches{}'.format(
+                  pipeline_size, num_model_chunks, num_microbatches,
+                  ' of variable lengths' if variable_seq_lengths else ''),
+              flush=True)
+
+
+def test_interleaved_no_flushes(pipeline_size=2, num_model_chunks=2,
+                                num_microbatches=4, num_iterations=3,
+                                variable_seq_lengths=False):
+    spawn(_test_interleaved_no_flushes, pipeline_size, pipeline_size,
+          num_model_chunks, num_microbatches, num_iterations,
+          variable_seq_lengths)
+
+
+def _test_embedding_grad_sync(pipeline_size, num_model_chunks,
+                              num_microbatches, num_iterations):
+    rank = torch.distributed.get_rank()
+    data_parallel_size = torch.distributed.get_world_size() // pipeline_size
+    # The blocking all-reduce after the program would deadlock 2BW, whose
+    # stages run programs of different iterations at the same time.
+    expected = None
+    for no_flushes, share_word_embeddings, overlap_grad_reduce in (
+            (False, False, None), (False, True, None), (True, True, None),
+            (False, True, False), (False, True, True), (True, True, True)):
+        set_global_variables(
+            global_batch_size=num_microbatches * 2 * data_parallel_size,
+            micro_batch_size=2)
+        mpu.initialize_model_parallel(1, pipeline_size, num_model_chunks)
+        grads = run_schedule(no_flushes, num_model_chunks, num_iterations,
+                             share_word_embeddings, overlap_grad_reduce)[0]
+        mpu.destroy_model_parallel()
+        if expected is None:
+            expected = grads
+            continue
+        for iteration_grads, iteration_expected in zip(grads, expected):
+            for grad, expected_grad in zip(iteration_grads,
+                                           iteration_expected):
+                error = (grad - expected_grad).abs().max().item()
+                assert error < 1e-6, \
+                    'rank {}: max gradient error {} with{} flushes{}'.format(
+                        rank, error, 'out' if no_flushes else '',
+                        '' if overlap_grad_reduce is None else
+                        ' and the local DDP, overlap_grad_reduce={}'.format(
+                            overlap_grad_reduce))
+
+    if rank == 0:
+        print('>> asynchronous embedding grad all-reduce matches the '
+              'blocking one with {} stages, {} model chunks, {} '
+              'microbatches and {} data-parallel ranks'.format(
+                  pipeline_size, num_model_chunks, num_microbatches,
+                  data_parallel_size), flush=True)
+
+
+def test_embedding_grad_sync(pipeline_size=4, num_model_chunks=2,
+                             num_microbatches=8, num_iterations=3,
+                             data_parallel_size=1):
+    spawn(_test_embedding_grad_sync, pipeline_size * data_parallel_size,
+          pipeline_size, num_model_chunks, num_microbatches, num_iterations)
+
+
+# Communication options compared with blocking communication into newly
+# allocated buffers.
+COMMUNICATION_MODES = (
+    {'async_pipeline_communication': True},
+    {'reuse_pipeline_receive_buffers': True},
+    {'async_pipeline_communication': True,
+     'reuse_pipeline_receive_buffers': True},
+    # Sending all the elements with the topk codec is lossless.
+    {'pipeline_gradient_codec': 'topk', 'pipeline_topk_ratio': 1.0,
+     'reuse_pipeline_receive_buffers': True},
+    {'scatter_gather_tensors_in_pipeline': True},
+    {'scatter_gather_tensors_in_pipeline': True,
+     'async_pipeline_communication': True,
+     'reuse_pipeline_receive_buffers': True},
+)
+
+# Lossy pipeline codecs and the largest relative error of the gradients
+# they cause.
+LOSSY_CODECS = (
+    ({'pipeline_activation_codec': 'int8', 'pipeline_gradient_codec': 'int8'},
+     0.05),
+    ({'pipeline_activation_codec': 'fp8', 'pipeline_gradient_codec': 'bf16'},
+     0.2),
+)
+
+
+def _test_communication_modes(pipeline_size, num_model_chunks,
+                              num_microbatches, num_iterations,
+                              tensor_model_parallel_size):
+    rank = torch.distributed.get_rank()
+    for no_flushes in (False, True):
+        results = []
+        for mode in ({},) + COMMUNICATION_MODES:
+            set_global_variables(global_batch_size=num_microbatches * 2,
+                                 micro_batch_size=2, **mode)
+            mpu.initialize_model_parallel(tensor_model_parallel_size,
+                                          pipeline_size, num_model_chunks)
+            results.append(run_schedule(no_flushes, num_model_chunks,
+                                        num_iterations))
+            mpu.destroy_model_parallel()
+            if mode.get('reuse_pipeline_receive_buffers'):
+                counters = get_timers().counters
+                assert counters['pipeline-recv-buffer-hits'] > \
+                    counters['pipeline-recv-buffer-misses'], counters
+
+        expected_grads, expected_losses = results[0]
+        for mode, (grads, losses) in zip(COMMUNICATION_MODES, results[1:]):
+            for iteration_grads, iteration_expected in zip(grads,
+                                                           expected_grads):
+                for grad, expected_grad in zip(iteration_grads,
+                                               iteration_expected):
+                    assert torch.equal(grad, expected_grad), \
+                        'rank {}: gradients differ with {}'.format(rank, mode)
+            assert [loss.item() for loss in losses] == \
+                [loss.item() for loss in expected_losses], \
+                'rank {}: losses differ with {}'.format(rank, mode)
+    if rank == 0:
+        print('>> pipeline communication options match blocking '
+              'communication with {} stages, {} model chunks, {} '
+              'microbatches and tensor-parallel size {}'.format(
+                  pipeline_size, num_model_chunks, num_microbatches,
+                  tensor_model_parallel_size),
+              flush=True)
+
+
+def test_communication_modes(pipeline_size=2, num_model_chunks=2,
+                             num_microbatches=4, num_iterations=3,
+                             tensor_model_parallel_size=1):
+    spawn(_test_communication_modes,
+          tensor_model_parallel_size * pipeline_size, pipeline_size,
+          num_model_chunks, num_microbatches, num_iterations,
+          tensor_model_parallel_size)
+
+
+def _test_send_handles(pipeline_size, num_model_chunks, num_microbatches,
+                       num_iterations):
+    rank = torch.distributed.get_rank()
+    send_and_recv = schedules.send_and_recv
+    # Handles of the non-blocking sends to the next and previous stages.
+    sends = {'next': [], 'prev': []}
+    peak = [0]
+
+    def recording_send_and_recv(tensor_send_next, tensor_send_prev, *args,
+                                **kwargs):
+        in_flight = {direction: [handle for handle in handles
+                                 if handle._wire_sent is not None]
+                     for direction, handles in sends.items()}
+        for direction, tensor in (('next', tensor_send_next),
+                                  ('prev', tensor_send_prev)):
+            # The previous send in the direction completed.
+            assert tensor is None or not in_flight[direction], \
+                'rank {}: {} sends to the {} stage in flight'.format(
+                    rank, len(in_flight[direction]), direction)
+        handle = send_and_recv(tensor_send_next, tensor_send_prev, *args,
+                               **kwargs)
+        for direction, tensor in (('next', tensor_send_next),
+                                  ('prev', tensor_send_prev)):
+            if tensor is not None:
+                in_flight[direction].append(handle)
+        sends.update(in_flight)
+        peak[0] = max(peak[0], len(set(in_flight['next'] +
+                                       in_flight['prev'])))
+        return handle
+
+    schedules.send_and_recv = recording_send_and_recv
+    for no_flushes in (False, True):
+        set_global_variables(global_batch_size=num_microbatches * 2,
+                             micro_batch_size=2,
+                             async_pipeline_communication=True)
+        mpu.initialize_model_parallel(1, pipeline_size, num_model_chunks)
+        run_schedule(no_flushes, num_model_chunks, num_iterations)
+        mpu.destroy_model_parallel()
+    schedules.send_and_recv = send_and_recv
+    assert 0 < peak[0] <= 2, peak[0]
+
+    if rank == 0:
+        print('>> at most one non-blocking send per direction is in flight '
+              'with {} stages, {} model chunks and {} microbatches'.format(
+                  pipeline_size, num_model_chunks, num_microbatches),
+              flush=True)
+
+
+def test_send_handles(pipeline_size=4, num_model_chunks=2,
+                      num_microbatches=8, num_iterations=3):
+    spawn(_test_send_handles, pipeline_size, pipeline_size, num_model_chunks,
+          num_microbatches, num_iterations)
+
+
+def _test_pipeline_trace(pipeline_size, num_model_chunks, num_microbatches,
+                         num_iterations, trace_dir):
+    rank = torch.distributed.get_rank()
+    for no_flushes in (False, True):
+        directory = os.path.join(trace_dir,
+                                 '2bw' if no_flushes else 'interleaved')
+        set_global_variables(global_batch_size=num_microbatches * 2,
+                             micro_batch_size=2,
+                             pipeline_trace_dir=directory)
+        mpu.initialize_model_parallel(1, pipeline_size, num_model_chunks)
+        pipeline_trace.init_pipeline_tracer()
+        tracer = pipeline_trace.get_pipeline_tracer()
+        for iteration in range(num_iterations):
+            tracer.iteration = iteration
+            run_schedule(no_flushes, num_model_chunks, 1)
+        tracer.flush()
+        pipeline_trace._PIPELINE_TRACER = None
+        mpu.destroy_model_parallel()
+        torch.distributed.barrier()
+        if rank != 0:
+            continue
+
+        merged_path = os.path.join(directory, 'pipeline_trace.json')
+        paths = [
+            os.path.join(directory, 'pipeline_trace_rank{}.json'.format(r))
+            for r in range(pipeline_size)]
+        pipeline_trace.merge_traces(paths, merged_path)
+        with open(merged_path) as f:
+            events = json.load(f)['traceEvents']
+
+        stages = {event['pid']: event['args']['sort_index']
+                  for event in events
+                  if event['name'] == 'process_sort_index'}
+        assert stages == {r: r for r in range(pipeline_size)}, stages
+        spans = {}
+        for event in events:
+            if event['ph'] != 'X' or \
+                    event['name'] not in ('forward', 'backward'):
+                continue
+            key = (event['name'], stages[event['pid']],
+                   event['args']['model_chunk'], event['args']['iteration'],
+                   event['args']['microbatch'])
+            assert key not in spans, 'two spans for {}'.format(key)
+            spans[key] = event
+        expected = set(
+            (name, stage, model_chunk, iteration, microbatch)
+            for name in ('forward', 'backward')
+            for stage in range(pipeline_size)
+            for model_chunk in range(num_model_chunks)
+            for iteration in range(num_iterations)
+            for microbatch in range(num_microbatches))
+        assert set(spans) == expected, set(spans) ^ expected
+
+        # The traces of the ranks are aligned: a forward pass starts after
+        # that of the previous virtual stage ended.
+        for name, stage, model_chunk, iteration, microbatch in expected:
+            if name != 'forward' or (stage == 0 and model_chunk == 0):
+                continue
+            previous = (stage - 1, model_chunk) if stage > 0 else \
+                (pipeline_size - 1, model_chunk - 1)
+            previous_span = spans[(name,) + previous +
+                                  (iteration, microbatch)]
+            span = spans[(name, stage, model_chunk, iteration, microbatch)]
+            assert span['ts'] >= previous_span['ts'] + previous_span['dur']
+
+    if rank == 0:
+        print('>> pipeline traces have a span per forward and backward pass '
+              'with {} stages, {} model chunks and {} microbatches'.format(
+                  pipeline_size, num_model_chunks, num_microbatches),
+              flush=True)
+
+
+def test_pipeline_trace(pipeline_size=4, num_model_chunks=2,
+                        num_microbatches=8, num_iterations=2):
+    trace_dir = tempfile.mkdtemp()
+    try:
+        spawn(_test_pipeline_trace, pipeline_size, pipeline_size,
+              num_model_chunks, num_microbatches, num_iterations, trace_dir)
+    finally:
+        shutil.rmtree(trace_dir)
+
+
+def _test_lossy_codecs(pipeline_size, num_model_chunks, num_microbatches,
+                       num_iterations):
+    results = []
+    for mode in ({},) + tuple(mode for mode, _ in LOSSY_CODECS):
+        set_global_variables(global_batch_size=num_microbatches * 2,
+                             micro_batch_size=2, **mode)
+        mpu.initialize_model_parallel(1, pipeline_size, num_model_chunks)
+        results.append(run_schedule(True, num_model_chunks, num_iterations))
+        mpu.destroy_model_parallel()
+
+    rank = torch.distributed.get_rank()
+    expected_grads, _ = results[0]
+    for (mode, tolerance), (grads, _) in zip(LOSSY_CODECS, results[1:]):
+        for iteration_grads, iteration_expected in zip(grads, expected_grads):
+            for grad, expected_grad in zip(iteration_grads,
+                                           iteration_expected):
+                error = (grad - expected_grad).norm() / expected_grad.norm()
+                assert error < tolerance, \
+                    'rank {}: relative gradient error {} with {}'.format(
+                        rank, error.item(), mode)
+    if rank == 0:
+        print('>> lossy pipeline codecs stay within their tolerances with {} '
+              'stages'.format(pipeline_size), flush=True)
+
+
+def test_lossy_codecs(pipeline_size=2, num_model_chunks=2,
+                      num_microbatches=4, num_iterations=3):
+    spawn(_test_lossy_codecs, pipeline_size, pipeline_size,
+          num_model_chunks, num_microbatches, num_iterations)
+
+
+# Stash options of PipeDream-2BW compared with an unbounded stash.
+STASH_MODES = (
+    {'pipeline_stash_limit': 1},
+    {'pipeline_stash_limit': 2},
+    {'offload_stashed_activations': True},
+    {'pipeline_stash_limit': 2, 'offload_stashed_activations': True,
+     'reuse_pipeline_receive_buffers': True,
+     'async_pipeline_communication': True},
+)
+
+
+def _test_stash_modes(pipeline_size, num_microbatches, num_iterations):
+    rank = torch.distributed.get_rank()
+    results = []
+    for mode in ({},) + STASH_MODES:
+        set_global_variables(global_batch_size=num_microbatches * 2,
+                             micro_batch_size=2, **mode)
+        mpu.initialize_model_parallel(1, pipeline_size)
+        get_stash_statistics()
+        results.append(run_schedule(True, 1, num_iterations))
+        depth, _, offloaded_bytes = get_stash_statistics()
+        expected_depth = min(pipeline_size - rank, num_microbatches + 1)
+        if mode.get('pipeline_stash_limit') is not None:
+            expected_depth = min(expected_depth, mode['pipeline_stash_limit'])
+        assert depth == expected_depth, \
+            'rank {}: stash depth {} with {}'.format(rank, depth, mode)
+        if mode.get('offload_stashed_activations') and rank > 0:
+            assert offloaded_bytes > 0
+        mpu.destroy_model_parallel()
+
+    expected_grads, expected_losses = results[0]
+    for mode, (grads, losses) in zip(STASH_MODES, results[1:]):
+        for iteration_grads, iteration_expected in zip(grads, expected_grads):
+            for grad, expected_grad in zip(iteration_grads,
+                                           iteration_expected):
+                assert torch.equal(grad, expected_grad), \
+                    'rank {}: gradients differ with {}'.format(rank, mode)
+        assert [loss.item() for loss in losses] == \
+            [loss.item() for loss in expected_losses], \
+            'rank {}: losses differ with {}'.format(rank, mode)
+    if rank == 0:
+        print('>> bounded and offloaded 2BW stashes match the unbounded one '
+              'with {} stages and {} microbatches'.format(
+                  pipeline_size, num_microbatches), flush=True)
+
+
+def test_stash_modes(pipeline_size=4, num_microbatches=8, num_iterations=3):
+    spawn(_test_stash_modes, pipeline_size, pipeline_size, num_microbatches,
+          num_iterations)
+
+
+def pipedream_reference(pipeline_size, num_microbatches, num_iterations, lr):
+    """Gradients of every stage and iteration of PipeDream weight stashing,
+    computed sequentially: microbatch m runs through stage s with the
+    weights of s after the optimizer steps that precede Forward(m) in the
+    program of s."""
+    args = get_args()
+    programs = build_training_instructions('pipedream', pipeline_size,
+                                           num_microbatches, num_iterations)
+    forward_versions = []
+    for program in programs:
+        num_steps, versions = 0, {}
+        for instruction in program:
+            if isinstance(instruction, OptimizerStep):
+                num_steps += 1
+            elif isinstance(instruction, Forward):
+                versions[instruction.microbatch] = num_steps
+        forward_versions.append(versions)
+
+    # Weights of every stage after every optimizer step.
+    history = []
+    for stage in range(pipeline_size):
+        chunk = Chunk(stage, args.hidden_size)
+        history.append([[param.detach().clone()
+                         for param in chunk.parameters()]])
+    data = microbatches()
+    grads = []
+    for iteration in range(num_iterations):
+        iteration_grads = [[torch.zeros_like(weights)
+                            for weights in history[stage][0]]
+                           for stage in range(pipeline_size)]
+        for microbatch in range(iteration * num_microbatches,
+                                (iteration + 1) * num_microbatches):
+            x, targets = next(data)
+            params = []
+            for stage in range(pipeline_size):
+                weight, bias = [
+                    weights.clone().requires_grad_() for weights in
+                    history[stage][forward_versions[stage][microbatch]]]
+                x = torch.tanh(torch.matmul(x, weight) + bias)
+                params.append((weight, bias))
+            loss = ((x - targets) ** 2).mean() / num_microbatches
+            loss.backward()
+            for stage in range(pipeline_size):
+                for grad, param in zip(iteration_grads[stage],
+                                       params[stage]):
+                    grad.add_(param.grad)
+        grads.append(iteration_grads)
+        for stage in range(pipeline_size):
+            history[stage].append(
+                [weights - lr * grad for weights, grad in
+                 zip(history[stage][-1], iteration_grads[stage])])
+    return grads
+
+
+def _test_weight_versions(pipeline_size, num_microbatches, num_iterations,
+                          num_versions):
+    set_global_variables(global_batch_size=num_microbatches * 2,
+                         micro_batch_size=2,
+                         pipeline_weight_versions=num_versions)
+    mpu.initialize_model_parallel(1, pipeline_size)
+    rank = mpu.get_pipeline_model_parallel_rank()
+    model = [Chunk(rank, get_args().hidden_size)]
+    optimizer = SGD(list(model[0].parameters()), lr=0.1)
+    data_iterator = microbatches()
+
+    grads = []
+    for iteration in range(num_iterations):
+        forward_backward_pipelining_no_flushes(
+            forward_step, data_iterator, model, optimizer, None,
+            first_iteration=(iteration == 0),
+            last_iteration=(iteration == num_iterations - 1),
+            num_iterations=num_iterations)
+        grads.append(optimizer.step())
+
+    expected = pipedream_reference(pipeline_size, num_microbatches,
+                                   num_iterations, 0.1)
+    for iteration in range(num_iterations):
+        for grad, expected_grad in zip(grads[iteration],
+                                       expected[iteration][rank]):
+            error = (grad - expected_grad).abs().max().item()
+            assert error < 1e-6, \
+                'rank {} iteration {}: max gradient error {}'.format(
+                    rank, iteration, error)
+
+    # Microbatches run up to ceil(warmup / num_microbatches) steps stale.
+    num_warmup = pipeline_size - rank - 1
+    staleness = -(-num_warmup // num_microbatches)
+    num_kept, num_bytes, max_staleness = get_weight_version_statistics()
+    assert max_staleness == staleness, \
+        'rank {}: staleness {}, expected {}'.format(rank, max_staleness,
+                                                    staleness)
+    assert 1 <= num_kept <= min(num_versions, staleness + 1)
+    assert num_bytes == num_kept * sum(
+        param.numel() * param.element_size()
+        for param in model[0].parameters())
+
+    mpu.destroy_model_parallel()
+    if rank == 0:
+        print('>> PipeDream weight stashing matches sequential training with '
+              '{} stages, {} microbatches and {} weight versions'.format(
+                  pipeline_size, num_microbatches, num_versions), flush=True)
+
+
+def test_weight_versions(pipeline_size=4, num_microbatches=2,
+                         num_iterations=5, num_versions=3):
+    spawn(_test_weight_versions, pipeline_size, pipeline_size,
+          num_microbatches, num_iterations, num_versions)
+
+
+def _test_forward_only_aliasing(pipeline_size, num_model_chunks,
+                                num_microbatches, async_communication):
+    rank = torch.distributed.get_rank()
+    set_global_variables(global_batch_size=num_microbatches * 2,
+                         micro_batch_size=2,
+                         reuse_pipeline_receive_buffers=True,
+                         async_pipeline_communication=async_communication)
+    mpu.initialize_model_parallel(1, pipeline_size, num_model_chunks)
+    send_and_recv = schedules.send_and_recv
+
+    def checked_send_and_recv(tensor_send_next, *args, **kwargs):
+        # The activation sent on is not in the pool of receive buffers.
+        for buffers in p2p_communication._RECEIVE_BUFFER_POOL.buffers.values():
+            for buffer in buffers:
+                assert not schedules._overlaps(tensor_send_next, buffer), \
+                    'rank {}: sending a recycled receive buffer'.format(rank)
+        return send_and_recv(tensor_send_next, *args, **kwargs)
+
+    # The output of every stage is its input, which the schedule may only
+    # recycle once it is sent.
+    model = [torch.nn.Identity() for _ in range(num_model_chunks)]
+    schedules.send_and_recv = checked_send_and_recv
+    try:
+        if num_model_chunks > 1:
+            losses = forward_backward_pipelining_with_interleaving(
+                forward_step, [microbatches() for _ in model], model, None,
+                None, forward_only=True)
+        else:
+            losses = schedules.forward_backward_pipelining(
+                forward_step, microbatches(), model, None, None,
+                forward_only=True)
+    finally:
+        schedules.send_and_recv = send_and_recv
+    if mpu.is_pipeline_last_stage(ignore_virtual=True):
+        expected = [((inputs - targets) ** 2).mean()
+                    for (inputs, targets), _ in zip(microbatches(), losses)]
+        assert [loss['loss'].item() for loss in losses] == \
+            [loss.item() for loss in expected], rank
+    mpu.destroy_model_parallel()
+    if rank == 0:
+        print('>> forward-only passes recycle receive buffers only once '
+              'they are sent on, with {} stages, {} model chunks and {} '
+              'communication'.format(
+                  pipeline_size, num_model_chunks,
+                  'non-blocking' if async_communication else 'blocking'),
+              flush=True)
+
+
+def test_forward_only_aliasing(pipeline_size=4, num_model_chunks=1,
+                               num_microbatches=8, async_communication=False):
+    spawn(_test_forward_only_aliasing, pipeline_size, pipeline_size,
+          num_model_chunks, num_microbatches, async_communication)
+
+
+def test_simulation_only_instructions():
+    for instruction in (AllReduceGrads(), OptimizerStep()):
+        try:
+            schedules.execute_instructions(
+                [Forward(0, 0), instruction], forward_step, [microbatches()],
+                [Chunk(0, 4)], SGD([], lr=0.1), None, forward_only=False)
+        except AssertionError as e:
+            assert 'only simulated' in str(e), e
+            continue
+        raise AssertionError('the executor ran {}'.format(instruction))
+    print('>> the executor rejects the simulation-only instructions',
+          flush=True)
+
+
+if __name__ == '__main__':
+    test_interleaved_no_flushes(2, 2, 4)
+    test_interleaved_no_flushes(4, 2, 8)
+    test_interleaved_no_flushes(2, 3, 4)
+    test_interleaved_no_flushes(4, 2, 8, variable_seq_lengths=True)
+    test_embedding_grad_sync(2, 2, 4)
+    test_embedding_grad_sync(4, 2, 8)
+    test_embedding_grad_sync(2, 2, 4, data_parallel_size=2)
+    test_communication_modes(2, 2, 4)
+    test_communication_modes(4, 2, 8)
+    test_communication_modes(2, 2, 4, tensor_model_parallel_size=2)
+    test_send_handles(4, 2, 8)
+    test_pipeline_trace(4, 2, 8)
+    test_lossy_codecs(4, 2, 8)
+    test_stash_modes(4, 8)
+    test_weight_versions(4, 2)
+    test_weight_versions(4, 1, num_versions=4)
+    test_weight_versions(4, 8, num_versions=2)
+    test_forward_only_aliasing(4, 1, 8)
+    test_forward_only_aliasing(4, 2, 8, async_communication=True)
+    test_simulation_only_instructions()
@@ -0,0 +1,151 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Check the schedule simulator against the known bubble fractions, weight
+versions, staleness and in-flight activations of the pipeline schedules, on
+the CPU:
+
+    python tests/test_schedule_simulator.py
+"""
+
+import commons  # Puts megatron on the path.
+
+from megatron.schedule_simulator import ring_allreduce_time
+from megatron.schedule_simulator import simulate_schedule
+
+
+def close(value, expected):
+    return abs(value - expected) < 1e-9
+
+
+def test_flush_bubbles(max_pipeline_size=4, max_microbatches=8,
+                       max_model_chunks=2):
+    """Without communication costs, the schedules with flushes idle for
+    p - 1 passes of the microbatches in each of m * v: a bubble fraction of
+    (p - 1) / (m * v + p - 1)."""
+    for p in range(1, max_pipeline_size + 1):
+        for m in range(1, max_microbatches + 1):
+            configurations = [('1f1b', 1), ('gpipe', 1)]
+            if p > 1 and m % p == 0:
+                configurations += [('interleaved', v)
+                                   for v in range(1, max_model_chunks + 1)]
+            for schedule, v in configurations:
+                result = simulate_schedule(schedule, p, m, 1.0, 2.0,
+                                           num_model_chunks=v)
+                expected = (p - 1) / (m * v + p - 1)
+                assert close(result.bubble_fraction, expected), \
+                    (schedule, p, m, v, result.bubble_fraction, expected)
+                assert close(result.iteration_time,
+                             3.0 * (m + (p - 1) / v)), (schedule, p, m, v)
+                assert result.peak_weight_versions == [1] * p
+                assert result.max_staleness == [0] * p
+                if schedule == '1f1b':
+                    assert result.peak_in_flight_activations == \
+                        [min(p - stage, m) for stage in range(p)]
+                elif schedule == 'gpipe':
+                    assert result.peak_in_flight_activations == [m] * p
+    print('>> bubble fractions of 1f1b, gpipe and interleaved are '
+          '(p - 1) / (m * v + p - 1)', flush=True)
+
+
+def test_no_flushes(max_pipeline_size=4, max_microbatches=8):
+    """2BW keeps two weight versions on every stage and runs backward
+    passes one step stale, PipeDream one version per optimizer step in
+    flight and a single one on the last stage; without flushes, neither
+    idles in the steady state."""
+    for p in range(1, max_pipeline_size + 1):
+        for m in range(1, max_microbatches + 1):
+            result = simulate_schedule('2bw', p, m, 1.0, 2.0)
+            assert result.peak_weight_versions == [2] * p, \
+                (p, m, result.peak_weight_versions)
+            assert result.max_staleness == [1] * p
+            if m >= p:
+                assert close(result.bubble_fraction, 0.0), (p, m)
+                assert close(result.iteration_time, 3.0 * m)
+
+            result = simulate_schedule('pipedream', p, m, 1.0, 2.0)
+            assert result.peak_weight_versions[-1] == 1
+            assert result.max_staleness[-1] == 0
+            if m >= p:
+                assert max(result.peak_weight_versions) == min(p, 2)
+                assert close(result.bubble_fraction, 0.0), (p, m)
+    print('>> 2bw keeps 2 weight versions with a staleness of 1 and no '
+          'bubble', flush=True)
+
+
+def test_costs(num_stages=4, num_microbatches=8):
+    """Per-stage costs: the slowest stage sets the 1F1B iteration time, and
+    the all-reduce and optimizer step of the last stage add to it."""
+    forward_times = [1.0, 1.0, 2.0, 1.0]
+    backward_times = [2.0, 2.0, 4.0, 2.0]
+    result = simulate_schedule('1f1b', num_stages, num_microbatches,
+                               forward_times, backward_times)
+    slowest = simulate_schedule('1f1b', num_stages, num_microbatches,
+                                2.0, 4.0)
+    assert result.iteration_time <= slowest.iteration_time
+    assert result.iteration_time >= 6.0 * num_microbatches
+    assert result.stage_busy_time == [num_microbatches * (f + b) for f, b
+                                      in zip(forward_times, backward_times)]
+
+    base = simulate_schedule('1f1b', num_stages, num_microbatches, 1.0, 2.0)
+    result = simulate_schedule('1f1b', num_stages, num_microbatches, 1.0,
+                               2.0, allreduce_times=0.5, optimizer_times=0.25)
+    assert close(result.iteration_time, base.iteration_time + 0.75)
+
+    # Communication latency lengthens the fill and drain of the pipeline.
+    result = simulate_schedule('1f1b', num_stages, num_microbatches, 1.0,
+                               2.0, p2p_times=0.1)
+    assert result.iteration_time > base.iteration_time
+    print('>> simulated iteration times follow the stage costs', flush=True)
+
+
+def test_data_parallel_allreduce(num_stages=4, num_microbatches=8):
+    """Without explicit all-reduce times, the ring all-reduce of each
+    stage's gradients costs 2 (dp - 1) / dp of their size over the
+    bandwidth, and nothing without data parallelism."""
+    base = simulate_schedule('1f1b', num_stages, num_microbatches, 1.0, 2.0)
+    result = simulate_schedule('1f1b', num_stages, num_microbatches, 1.0,
+                               2.0, data_parallel_size=1, grad_bytes=100.0,
+                               allreduce_bandwidth=50.0)
+    assert close(result.iteration_time, base.iteration_time)
+
+    assert close(ring_allreduce_time(4, 100.0, 50.0), 3.0)
+    result = simulate_schedule('1f1b', num_stages, num_microbatches, 1.0,
+                               2.0, data_parallel_size=4, grad_bytes=100.0,
+                               allreduce_bandwidth=50.0)
+    assert close(result.iteration_time, base.iteration_time + 3.0)
+    assert close(sum(result.stage_idle_time), sum(base.stage_idle_time))
+
+    # The first stage, the last to finish its backward passes, waits for
+    # its larger all-reduce; explicit all-reduce times take precedence.
+    result = simulate_schedule('1f1b', num_stages, num_microbatches, 1.0,
+                               2.0, data_parallel_size=2,
+                               grad_bytes=[100.0, 50.0, 50.0, 50.0],
+                               allreduce_bandwidth=50.0)
+    assert close(result.iteration_time, base.iteration_time + 2.0)
+    result = simulate_schedule('1f1b', num_stages, num_microbatches, 1.0,
+                               2.0, allreduce_times=0.5, data_parallel_size=2,
+                               grad_bytes=100.0, allreduce_bandwidth=50.0)
+    assert close(result.iteration_time, base.iteration_time + 0.5)
+    print('>> data-parallel all-reduce times follow the ring cost model',
+          flush=True)
+
+
+if __name__ == '__main__':
+    test_flush_bubbles()
+    test_no_flushes()
+    test_costs()
+    test_data_parallel_allreduce()
@@ -0,0 +1,174 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Check which timers synchronize at each timing level, the elapsed times
+of the host-clock timers and the folding of the CUDA events of the
+asynchronous ones, with a fake clock and fake events, on the CPU:
+
+    python tests/test_timers.py
+"""
+
+import time
+
+import commons  # Puts megatron on the path.
+import torch
+
+from megatron import global_vars
+from megatron.global_vars import Timers, _Timer
+
+
+class FakeClock:
+    """Host clock advanced by hand."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeEvent:
+    """CUDA event recorded at the time of the fake clock, complete once the
+    fake device has run up to that time."""
+
+    clock = None
+    device_time = 0.0
+
+    def __init__(self, enable_timing=False):
+        assert enable_timing
+        self.time = None
+
+    def record(self):
+        self.time = FakeEvent.clock.now
+
+    def query(self):
+        return self.time <= FakeEvent.device_time
+
+    def synchronize(self):
+        FakeEvent.device_time = max(FakeEvent.device_time, self.time)
+
+    def elapsed_time(self, end_event):
+        assert self.query() and end_event.query()
+        return (end_event.time - self.time) * 1000.0
+
+
+def run_with_fakes(func):
+    clock = FakeClock()
+    perf_counter, event = time.perf_counter, torch.cuda.Event
+    time.perf_counter = clock
+    FakeEvent.clock, FakeEvent.device_time = clock, 0.0
+    torch.cuda.Event = FakeEvent
+    try:
+        func(clock)
+    finally:
+        time.perf_counter, torch.cuda.Event = perf_counter, event
+
+
+def test_sync_levels():
+    for sync_level in (0, 1, 2):
+        timers = Timers(sync_level)
+        for log_level in (0, 1, 2):
+            timer = timers('level-{}'.format(log_level), log_level=log_level)
+            assert timer.synchronize == (log_level <= sync_level)
+            # Without a GPU, asynchronous timers use the host clock.
+            assert timer.use_events == \
+                (not timer.synchronize and torch.cuda.is_available())
+            # Later calls keep the level, and may not change it.
+            assert timers('level-{}'.format(log_level)) is timer
+            assert timers('level-{}'.format(log_level),
+                          log_level=log_level) is timer
+            try:
+                timers('level-{}'.format(log_level),
+                       log_level=(log_level + 1) % 3)
+            except AssertionError:
+                pass
+            else:
+                raise AssertionError('the level of a timer was changed')
+        assert timers('default').synchronize
+    print('>> timers of level at most the sync level synchronize',
+          flush=True)
+
+
+def test_host_clock():
+    def check(clock):
+        timer = _Timer('host', synchronize=False)
+        timer.use_events = False
+        for duration in (1.0, 2.0):
+            timer.start()
+            clock.now += duration
+            timer.stop()
+            clock.now += 10.0
+        assert timer.elapsed(reset=False) == 3.0
+        assert timer.elapsed(reset=False) == 3.0
+
+        # A running timer is stopped, read and restarted.
+        timer.start()
+        clock.now += 4.0
+        assert timer.elapsed() == 7.0
+        assert timer.started_
+        clock.now += 5.0
+        timer.stop()
+        assert timer.elapsed() == 5.0
+        assert timer.elapsed() == 0.0
+
+    run_with_fakes(check)
+    print('>> host-clock timers add up their intervals', flush=True)
+
+
+def test_events(num_completed=10):
+    def check(clock):
+        timer = _Timer('events', synchronize=False)
+        timer.use_events = True
+        stop_times = []
+        for _ in range(global_vars._MAX_PENDING_EVENTS - 1):
+            timer.start()
+            clock.now += 1.0
+            timer.stop()
+            stop_times.append(clock.now)
+            clock.now += 10.0
+        # The host ran ahead of the device: nothing is resolved yet.
+        assert len(timer.pending_events) == \
+            global_vars._MAX_PENDING_EVENTS - 1
+        assert timer.elapsed_ == 0.0
+
+        # The last pair that fits folds the completed events without
+        # waiting for the others.
+        FakeEvent.device_time = stop_times[num_completed - 1]
+        timer.start()
+        clock.now += 1.0
+        timer.stop()
+        assert timer.elapsed_ == float(num_completed)
+        assert len(timer.pending_events) == \
+            global_vars._MAX_PENDING_EVENTS - num_completed
+
+        # Reading the timer waits for the remaining events.
+        assert timer.elapsed(reset=False) == global_vars._MAX_PENDING_EVENTS
+        assert not timer.pending_events
+        timer.start()
+        clock.now += 2.0
+        assert timer.elapsed() == global_vars._MAX_PENDING_EVENTS + 2.0
+        timer.stop()
+        assert timer.elapsed() == 0.0
+
+    run_with_fakes(check)
+    print('>> asynchronous timers fold their completed events early and '
+          'wait for the others when read', flush=True)
+
+
+if __name__ == '__main__':
+    test_sync_levels()
+    test_host_clock()
+    test_events()
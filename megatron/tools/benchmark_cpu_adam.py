@@ -0,0 +1,134 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the CPU Adam of --offload-optimizer-state on the CPU.
+
+For flat params of every size, reports the step time and throughput of
+CPUAdam with fp32 grads, and with fp16 grads unscaled in the step and the
+updated params written to an fp16 buffer (as in the offloaded step), and
+of torch.optim.AdamW, with the largest difference of the params from the
+ones of torch.optim.AdamW. Only needs torch, not a GPU or apex. Example:
+
+    python tools/benchmark_cpu_adam.py --numels 1048576 16777216 \\
+        --threads 16
+"""
+
+import argparse
+import os
+import sys
+import time
+# megatron/optimizer/__init__.py imports apex, so the module is loaded on
+# its own.
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir, 'megatron',
+                                             'optimizer')))
+
+import torch
+
+from cpu_adam import CPUAdam
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='CPU Adam benchmark')
+    parser.add_argument('--numels', type=int, nargs='+',
+                        default=[2 ** 20, 2 ** 24],
+                        help='Numbers of elements of the param.')
+    parser.add_argument('--block-size', type=int, default=2 ** 20,
+                        help='Elements updated at a time by CPUAdam.')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Number of intra-op threads of torch.')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=1234)
+    return parser.parse_args()
+
+
+def make_param(numel, seed):
+    generator = torch.Generator().manual_seed(seed)
+    param = torch.nn.Parameter(torch.randn(numel, generator=generator))
+    grads = [torch.randn(numel, generator=generator) * 1e-3
+             for _ in range(2)]
+    return param, grads
+
+
+def time_steps(args, step):
+    for _ in range(args.warmup):
+        step()
+    start = time.time()
+    for _ in range(args.iterations):
+        step()
+    return (time.time() - start) / args.iterations
+
+
+def benchmark(args, numel):
+    kwargs = dict(lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.01)
+    param, grads = make_param(numel, args.seed)
+    reference, _ = make_param(numel, args.seed)
+    cpu_adam = CPUAdam([param], block_size=args.block_size, **kwargs)
+    adamw = torch.optim.AdamW([reference], **kwargs)
+    count = [0]
+
+    def cpu_adam_step():
+        param.grad = grads[count[0] % 2]
+        cpu_adam.step()
+        count[0] += 1
+
+    def adamw_step():
+        reference.grad = grads[count[0] % 2]
+        adamw.step()
+        count[0] += 1
+
+    cpu_adam_time = time_steps(args, cpu_adam_step)
+    count[0] = 0
+    adamw_time = time_steps(args, adamw_step)
+    max_error = (param - reference).abs().max().item()
+
+    # Offloaded step: loss-scaled fp16 grads in, fp16 params out.
+    scale = 1024.0
+    half_grads = [(grad * scale).half() for grad in grads]
+    transfer = torch.empty(numel, dtype=torch.half)
+    group = cpu_adam.param_groups[0]
+
+    def offload_step():
+        transfer.copy_(half_grads[count[0] % 2])
+        cpu_adam.update(param, transfer, group, grad_scale=1.0 / scale,
+                        out=transfer)
+        count[0] += 1
+
+    offload_time = time_steps(args, offload_step)
+    return cpu_adam_time, offload_time, adamw_time, max_error
+
+
+def main():
+    args = get_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    print('{} threads, block size {}'.format(torch.get_num_threads(),
+                                             args.block_size))
+    print('{:>10} | {:>14} | {:>16} | {:>14} | {:>8} | {:>12} | '
+          '{:>10}'.format('elements', 'cpu adam (ms)', 'fp16 offload (ms)',
+                          'adamw (ms)', 'speedup', 'Melem/s', 'max diff'))
+    for numel in args.numels:
+        cpu_adam_time, offload_time, adamw_time, max_error = benchmark(
+            args, numel)
+        print('{:>10d} | {:>14.2f} | {:>16.2f} | {:>14.2f} | {:>7.2f}x | '
+              '{:>12.1f} | {:>10.2e}'.format(
+                  numel, cpu_adam_time * 1000.0, offload_time * 1000.0,
+                  adamw_time * 1000.0, adamw_time / cpu_adam_time,
+                  numel / cpu_adam_time / 1e6, max_error))
+
+
+if __name__ == '__main__':
+    main()
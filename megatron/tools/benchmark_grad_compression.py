@@ -0,0 +1,182 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the convergence of a toy GPT-2 and the bytes that a rank sends
+per step with every grad compressor of the local DDP (--grad-compression),
+on the CPU with gloo.
+
+Spawns `--world-size` data-parallel processes, which train the same small
+causal transformer language model with tied embeddings from the same seed on
+their own samples of a fixed random Markov chain with momentum SGD, once
+per compressor. Example:
+
+    python tools/benchmark_grad_compression.py --world-size 4 --steps 300 \
+        --compressors none fp16 powersgd topk
+"""
+
+import argparse
+import os
+import socket
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+
+import torch
+
+from megatron import mpu
+from megatron.grad_compression import GRAD_COMPRESSORS
+from megatron.grad_compression import build_grad_compressor
+from megatron.model.distributed import DistributedDataParallel
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Grad compression benchmark')
+    parser.add_argument('--world-size', type=int, default=4)
+    parser.add_argument('--compressors', nargs='+',
+                        default=list(GRAD_COMPRESSORS),
+                        choices=GRAD_COMPRESSORS)
+    parser.add_argument('--powersgd-rank', type=int, default=4)
+    parser.add_argument('--grad-topk-ratio', type=float, default=0.01)
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--micro-batch-size', type=int, default=8)
+    parser.add_argument('--seq-length', type=int, default=32)
+    parser.add_argument('--vocab-size', type=int, default=64)
+    parser.add_argument('--hidden-size', type=int, default=64)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--num-attention-heads', type=int, default=4)
+    parser.add_argument('--lr', type=float, default=0.1)
+    parser.add_argument('--bucket-size', type=int, default=2 ** 16,
+                        help='Largest number of elements of a bucket of '
+                        'grads.')
+    return parser.parse_args()
+
+
+class ToyGPT2(torch.nn.Module):
+    """Pre-layernorm causal transformer language model whose output layer
+    is the transpose of the word embeddings."""
+
+    def __init__(self, args):
+        super(ToyGPT2, self).__init__()
+        self.word_embeddings = torch.nn.Embedding(args.vocab_size,
+                                                  args.hidden_size)
+        self.position_embeddings = torch.nn.Embedding(args.seq_length,
+                                                      args.hidden_size)
+        layer = torch.nn.TransformerEncoderLayer(
+            args.hidden_size, args.num_attention_heads,
+            dim_feedforward=4 * args.hidden_size, dropout=0.0,
+            activation='gelu', batch_first=True, norm_first=True)
+        self.transformer = torch.nn.TransformerEncoder(layer,
+                                                       args.num_layers)
+        self.final_layernorm = torch.nn.LayerNorm(args.hidden_size)
+        torch.nn.init.normal_(self.word_embeddings.weight, std=0.02)
+        torch.nn.init.normal_(self.position_embeddings.weight, std=0.02)
+        mask = torch.full((args.seq_length, args.seq_length), float('-inf'))
+        self.register_buffer('attention_mask', torch.triu(mask, diagonal=1))
+
+    def forward(self, tokens):
+        positions = torch.arange(tokens.size(1))
+        hidden = self.word_embeddings(tokens) + \
+            self.position_embeddings(positions)
+        hidden = self.transformer(hidden, mask=self.attention_mask)
+        return torch.matmul(self.final_layernorm(hidden),
+                            self.word_embeddings.weight.t())
+
+
+def batches(args, rank):
+    """Samples of a Markov chain whose transitions, the same on every rank,
+    each have a few likely next tokens."""
+    generator = torch.Generator().manual_seed(1234)
+    transitions = torch.softmax(
+        4.0 * torch.randn(args.vocab_size, args.vocab_size,
+                          generator=generator), dim=-1)
+    generator = torch.Generator().manual_seed(rank)
+    while True:
+        tokens = torch.randint(args.vocab_size, (args.micro_batch_size, 1),
+                               generator=generator)
+        for _ in range(args.seq_length):
+            tokens = torch.cat([tokens, torch.multinomial(
+                transitions[tokens[:, -1]], 1, generator=generator)], dim=1)
+        yield tokens[:, :-1], tokens[:, 1:]
+
+
+def train(args, name):
+    """Final loss, averaged over the last tenth of the steps and the ranks,
+    bytes that a rank sent per step and bytes of the fp32 grads."""
+    torch.manual_seed(1234)
+    compressor = build_grad_compressor(name, args.powersgd_rank,
+                                       args.grad_topk_ratio)
+    model = DistributedDataParallel(ToyGPT2(args),
+                                    bucket_size=args.bucket_size,
+                                    grad_compressor=compressor)
+    optimizer = torch.optim.SGD(model.parameters(), lr=args.lr,
+                                momentum=0.9)
+    data_iterator = batches(args, mpu.get_data_parallel_rank())
+
+    losses = []
+    for _ in range(args.steps):
+        tokens, labels = next(data_iterator)
+        logits = model(tokens)
+        loss = torch.nn.functional.cross_entropy(
+            logits.view(-1, args.vocab_size), labels.reshape(-1))
+        optimizer.zero_grad()
+        loss.backward()
+        model.allreduce_params(reduce_after=False)
+        optimizer.step()
+        losses.append(loss.item())
+
+    last = losses[-max(1, args.steps // 10):]
+    final_loss = torch.tensor(sum(last) / len(last))
+    torch.distributed.all_reduce(final_loss,
+                                 group=mpu.get_data_parallel_group())
+    final_loss /= torch.distributed.get_world_size()
+    grad_bytes = 4 * sum(param.numel() for param in model.parameters())
+    return final_loss.item(), compressor.bytes_sent / args.steps, grad_bytes
+
+
+def _worker(rank, args, port):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group(backend='gloo', rank=rank,
+                                         world_size=args.world_size)
+    mpu.initialize_model_parallel(1, 1)
+    torch.set_num_threads(1)
+
+    rows = [(name,) + train(args, name) for name in args.compressors]
+
+    if rank == 0:
+        print('{} data-parallel ranks, {} steps'.format(args.world_size,
+                                                        args.steps))
+        print('{:>10} | {:>10} | {:>14} | {:>11}'.format(
+            'compressor', 'final loss', 'KB sent / step', 'compression'))
+        for name, loss, bytes_per_step, grad_bytes in rows:
+            print('{:>10} | {:>10.4f} | {:>14.1f} | {:>10.1f}x'.format(
+                name, loss, bytes_per_step / 1024.0,
+                grad_bytes / bytes_per_step), flush=True)
+    mpu.destroy_model_parallel()
+    torch.distributed.destroy_process_group()
+
+
+def main():
+    args = get_args()
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        port = sock.getsockname()[1]
+    torch.multiprocessing.spawn(_worker, args=(args, port),
+                                nprocs=args.world_size, join=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the hierarchical data-parallel all-reduce against the flat one
+on a single CPU host, with gloo subgroups standing in for nodes.
+
+Spawns `--world-size` processes, of which every `--ranks-per-node`
+consecutive ones form a simulated node, and times mpu.hierarchical_all_reduce
+and one all-reduce over the data-parallel group for every size. Also reports
+the average bytes that a rank sends to other nodes with ring all-reduces,
+which the hierarchical all-reduce divides by the number of ranks per node.
+Example:
+
+    python tools/benchmark_hierarchical_allreduce.py --world-size 8 \
+        --ranks-per-node 4 --sizes 1048576 16777216
+"""
+
+import argparse
+import os
+import socket
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+
+import torch
+
+from megatron import mpu
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Hierarchical all-reduce benchmark')
+    parser.add_argument('--world-size', type=int, default=8)
+    parser.add_argument('--ranks-per-node', type=int, default=4)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[2 ** 16, 2 ** 20, 2 ** 24],
+                        help='Numbers of fp32 elements to all-reduce.')
+    parser.add_argument('--iterations', type=int, default=5,
+                        help='Timed all-reduces per size.')
+    return parser.parse_args()
+
+
+def inter_node_bytes(numel, world_size, ranks_per_node, hierarchical):
+    """Bytes that a rank sends to other nodes, on average, with ring
+    all-reduces of `numel` fp32 elements."""
+    num_bytes = 4.0 * numel
+    num_nodes = world_size // ranks_per_node
+    if hierarchical:
+        # Ring all-reduce of 1 / ranks_per_node of the data across nodes.
+        return 2.0 * (num_nodes - 1) / num_nodes * num_bytes / ranks_per_node
+    # A flat ring crosses nodes num_nodes times out of world_size steps.
+    return 2.0 * (world_size - 1) / world_size * num_bytes * \
+        num_nodes / world_size
+
+
+def timed(func, iterations):
+    func()
+    torch.distributed.barrier()
+    start = time.time()
+    for _ in range(iterations):
+        func()
+    torch.distributed.barrier()
+    return (time.time() - start) / iterations
+
+
+def _worker(rank, args, port):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group(backend='gloo', rank=rank,
+                                         world_size=args.world_size)
+    mpu.initialize_model_parallel(1, 1, ranks_per_node=args.ranks_per_node)
+    assert mpu.get_data_parallel_intra_node_group() is not None, \
+        'every simulated node needs at least two ranks, and there need to ' \
+        'be at least two nodes'
+
+    rows = []
+    for numel in args.sizes:
+        tensor = torch.randn(numel)
+        expected = tensor.clone()
+        torch.distributed.all_reduce(expected,
+                                     group=mpu.get_data_parallel_group())
+        result = tensor.clone()
+        mpu.hierarchical_all_reduce(result)
+        error = ((result - expected).abs().max() /
+                 expected.abs().max()).item()
+
+        flat_time = timed(lambda: torch.distributed.all_reduce(
+            tensor, group=mpu.get_data_parallel_group()), args.iterations)
+        hierarchical_time = timed(
+            lambda: mpu.hierarchical_all_reduce(tensor), args.iterations)
+        rows.append((numel, flat_time, hierarchical_time, error))
+
+    if rank == 0:
+        mega_bytes = 1024.0 * 1024.0
+        print('{} ranks, {} simulated nodes of {} ranks'.format(
+            args.world_size, args.world_size // args.ranks_per_node,
+            args.ranks_per_node))
+        print('{:>10} | {:>10} | {:>10} | {:>16} | {:>16} | {:>9}'.format(
+            'elements', 'flat (ms)', 'hier (ms)', 'flat inter (MB)',
+            'hier inter (MB)', 'rel error'))
+        for numel, flat_time, hierarchical_time, error in rows:
+            print('{:>10d} | {:>10.2f} | {:>10.2f} | {:>16.2f} | {:>16.2f} | '
+                  '{:>9.1e}'.format(
+                      numel, flat_time * 1000.0, hierarchical_time * 1000.0,
+                      inter_node_bytes(numel, args.world_size,
+                                       args.ranks_per_node, False) /
+                      mega_bytes,
+                      inter_node_bytes(numel, args.world_size,
+                                       args.ranks_per_node, True) /
+                      mega_bytes,
+                      error), flush=True)
+    mpu.destroy_model_parallel()
+    torch.distributed.destroy_process_group()
+
+
+def main():
+    args = get_args()
+    assert args.world_size % args.ranks_per_node == 0
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        port = sock.getsockname()[1]
+    torch.multiprocessing.spawn(_worker, args=(args, port),
+                                nprocs=args.world_size, join=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the pipeline codecs of megatron/p2p_compression.py on the CPU.
+
+For activation-like (normal) and gradient-like (heavy-tailed) tensors of
+shape (seq_length, micro_batch_size, hidden_size), reports the bytes sent
+by every codec, the reconstruction error and the encode + decode time. For
+gradients, also reports the error of the sum of `--steps` decoded
+gradients, which error feedback keeps small for the topk codec. Example:
+
+    python tools/benchmark_p2p_codecs.py --seq-length 1024 \
+        --micro-batch-size 4 --hidden-size 2048
+"""
+
+import argparse
+import os
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+
+import torch
+
+from megatron.p2p_compression import ACTIVATION_CODECS
+from megatron.p2p_compression import GRADIENT_CODECS
+from megatron.p2p_compression import build_codec
+from megatron.p2p_compression import wire_bytes
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Pipeline codec benchmark')
+    parser.add_argument('--seq-length', type=int, default=512)
+    parser.add_argument('--micro-batch-size', type=int, default=4)
+    parser.add_argument('--hidden-size', type=int, default=1024)
+    parser.add_argument('--fp32', action='store_true',
+                        help='Send fp32 tensors (--fp32-residual-connection) '
+                        'instead of fp16 ones.')
+    parser.add_argument('--block-size', type=int, default=64,
+                        help='Block size of the int8 codec.')
+    parser.add_argument('--topk-ratios', type=float, nargs='+',
+                        default=[0.01, 0.1])
+    parser.add_argument('--steps', type=int, default=8,
+                        help='Gradients accumulated to measure error '
+                        'feedback.')
+    parser.add_argument('--iterations', type=int, default=5,
+                        help='Timed encode + decode iterations.')
+    parser.add_argument('--seed', type=int, default=1234)
+    return parser.parse_args()
+
+
+def activations(shape, dtype):
+    return torch.randn(shape).to(dtype)
+
+
+def gradients(shape, dtype):
+    return (torch.randn(shape) * torch.exp(2 * torch.randn(shape)) *
+            1e-3).to(dtype)
+
+
+def relative_error(tensor, reference):
+    return ((tensor.float() - reference.float()).norm() /
+            reference.float().norm().clamp(min=1e-30)).item()
+
+
+def round_trip(codec, tensor, key=None):
+    wire = codec.encode(tensor, key=key)
+    return codec.decode(wire, torch.empty_like(tensor))
+
+
+def benchmark(args, name, codec, make_tensor, is_gradient):
+    shape = (args.seq_length, args.micro_batch_size, args.hidden_size)
+    dtype = torch.float if args.fp32 else torch.half
+    tensor = make_tensor(shape, dtype)
+
+    decoded = round_trip(codec, tensor)
+    error = relative_error(decoded, tensor)
+    max_error = (decoded.float() - tensor.float()).abs().max().item()
+
+    start = time.time()
+    for _ in range(args.iterations):
+        round_trip(codec, tensor)
+    elapsed = (time.time() - start) / args.iterations
+
+    raw_bytes = wire_bytes(build_codec('none'), shape, dtype)
+    sent_bytes = wire_bytes(codec, shape, dtype)
+    row = [name, 'gradients' if is_gradient else 'activations',
+           sent_bytes / 2.0 ** 20, 100.0 * (1.0 - sent_bytes / raw_bytes),
+           error, max_error, elapsed * 1000.0]
+
+    if is_gradient:
+        # Sum of `steps` decoded gradients compared with the sum of the
+        # gradients; the same key enables error feedback.
+        total = torch.zeros(shape)
+        decoded_total = torch.zeros(shape)
+        for _ in range(args.steps):
+            tensor = make_tensor(shape, dtype)
+            total += tensor.float()
+            decoded_total += round_trip(codec, tensor, key=0).float()
+        row.append(relative_error(decoded_total, total))
+    else:
+        row.append(None)
+    return row
+
+
+def main():
+    args = get_args()
+    torch.manual_seed(args.seed)
+
+    rows = []
+    for name in ACTIVATION_CODECS:
+        codec = build_codec(name, args.block_size)
+        rows.append(benchmark(args, name, codec, activations, False))
+    for name in GRADIENT_CODECS:
+        ratios = args.topk_ratios if name == 'topk' else [None]
+        for ratio in ratios:
+            if ratio is None:
+                codec = build_codec(name, args.block_size)
+                description = name
+            else:
+                codec = build_codec(name, args.block_size, ratio)
+                description = '{}-{:g}'.format(name, ratio)
+            rows.append(benchmark(args, description, codec, gradients, True))
+
+    print('{:>10} | {:>11} | {:>9} | {:>7} | {:>10} | {:>10} | {:>9} | '
+          '{:>10}'.format('codec', 'tensor', 'MiB sent', 'saved', 'rel error',
+                          'max error', 'time (ms)',
+                          'sum error'))
+    for name, kind, mib, saved, error, max_error, ms, sum_error in rows:
+        print('{:>10} | {:>11} | {:>9.2f} | {:>6.1f}% | {:>10.2e} | '
+              '{:>10.2e} | {:>9.2f} | {:>10}'.format(
+                  name, kind, mib, saved, error, max_error, ms,
+                  '-' if sum_error is None else '{:.2e}'.format(sum_error)))
+
+
+if __name__ == '__main__':
+    main()
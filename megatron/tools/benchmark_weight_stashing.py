@@ -0,0 +1,127 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the step of FP16OptimizerWithFP16Params with weight stashing
+(--pipeline-no-flushes) against the number of parameters, on one GPU.
+
+Compares the step, which stashes the older weight version with one
+multi-tensor copy, with the previous per-parameter clone-and-swap step, and
+reports the step time and the memory allocated during the step. Example:
+
+    python tools/benchmark_weight_stashing.py --num-params 100 1000 4000 \\
+        --param-numel 262144
+"""
+
+import argparse
+import os
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+
+import torch
+
+from megatron import global_vars
+from megatron.optimizer.grad_scaler import ConstantGradScaler
+from megatron.optimizer.optimizer import FP16OptimizerWithFP16Params
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Weight stashing benchmark')
+    parser.add_argument('--num-params', type=int, nargs='+',
+                        default=[100, 1000, 4000],
+                        help='Numbers of parameters to benchmark.')
+    parser.add_argument('--param-numel', type=int, default=65536,
+                        help='Number of elements of every parameter.')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    return parser.parse_args()
+
+
+class PerParameterSwapOptimizer(FP16OptimizerWithFP16Params):
+    """The previous weight stashing step: the newer version is copied into
+    the main params one parameter at a time before the optimizer step, and
+    the two versions are swapped through a clone of every parameter after
+    it."""
+
+    def _groups(self):
+        return [[self.fp32_from_fp16_groups, self.fp32_from_fp16_groups_copy],
+                [self.fp32_from_fp32_groups, self.fp32_from_fp32_groups_copy]]
+
+    @torch.no_grad()
+    def step(self):
+        self._copy_model_grads_to_main_grads()
+        for param_groups, param_groups_copy in self._groups():
+            for i, param_group in enumerate(param_groups):
+                for j, param in enumerate(param_group):
+                    param.data.copy_(param_groups_copy[i][j].data)
+        self.optimizer.step()
+        for param_groups, param_groups_copy in self._groups():
+            for i, param_group in enumerate(param_groups):
+                for j, param in enumerate(param_group):
+                    param_copy = param.detach().clone()
+                    param.data.copy_(param_groups_copy[i][j].data)
+                    param_groups_copy[i][j].data.copy_(param_copy.data)
+        self._copy_main_params_to_model_params()
+        return True
+
+
+def benchmark(args, optimizer_class, num_params):
+    params = [torch.nn.Parameter(torch.randn(args.param_numel,
+                                             device='cuda').half())
+              for _ in range(num_params)]
+    for param in params:
+        param.grad = torch.randn_like(param)
+    optimizer = optimizer_class(torch.optim.SGD(params, lr=1e-3),
+                                ConstantGradScaler(1.0), clip_grad=0.0,
+                                weight_stashing=True)
+
+    for _ in range(args.warmup):
+        optimizer.step()
+    torch.cuda.synchronize()
+    allocated = torch.cuda.memory_allocated()
+    torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(args.iterations):
+        optimizer.step()
+    torch.cuda.synchronize()
+    elapsed = (time.time() - start) / args.iterations
+    transient = torch.cuda.max_memory_allocated() - allocated
+    return elapsed, transient
+
+
+def main():
+    args = get_args()
+    global_vars._GLOBAL_TIMERS = global_vars.Timers()
+
+    print('{:>10} | {:>10} | {:>16} | {:>16} | {:>8} | {:>16} | {:>16}'.format(
+        'params', 'elements', 'swap step (ms)', 'stash step (ms)', 'speedup',
+        'swap alloc (MB)', 'stash alloc (MB)'))
+    for num_params in args.num_params:
+        swap_time, swap_memory = benchmark(args, PerParameterSwapOptimizer,
+                                           num_params)
+        stash_time, stash_memory = benchmark(
+            args, FP16OptimizerWithFP16Params, num_params)
+        print('{:>10d} | {:>10d} | {:>16.2f} | {:>16.2f} | {:>7.2f}x | '
+              '{:>16.1f} | {:>16.1f}'.format(
+                  num_params, num_params * args.param_numel,
+                  swap_time * 1000.0, stash_time * 1000.0,
+                  swap_time / stash_time, swap_memory / 2.0 ** 20,
+                  stash_memory / 2.0 ** 20))
+        torch.cuda.empty_cache()
+
+
+if __name__ == '__main__':
+    main()
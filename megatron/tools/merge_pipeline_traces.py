@@ -0,0 +1,57 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Merge the pipeline traces written by every rank with --pipeline-trace-dir
+into one Chrome trace, to open in chrome://tracing or ui.perfetto.dev:
+
+    python tools/merge_pipeline_traces.py <trace-dir> --output trace.json
+"""
+
+import argparse
+import glob
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+
+from megatron.pipeline_trace import merge_traces
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Pipeline trace merger')
+    parser.add_argument('trace_dir', type=str,
+                        help='Directory passed to --pipeline-trace-dir.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Merged trace (defaults to '
+                        '<trace-dir>/pipeline_trace.json).')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    paths = sorted(glob.glob(os.path.join(args.trace_dir,
+                                          'pipeline_trace_rank*.json')))
+    if not paths:
+        raise Exception('no pipeline traces in {}'.format(args.trace_dir))
+    output = args.output
+    if output is None:
+        output = os.path.join(args.trace_dir, 'pipeline_trace.json')
+    num_events = merge_traces(paths, output)
+    print('merged {} events of {} ranks into {}'.format(
+        num_events, len(paths), output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sweep (pipeline, data-parallel, micro-batch) configurations offline.
+
+Per-stage costs are derived from an analytical transformer cost model and
+fed to megatron.schedule_simulator. Example:
+
+    python tools/simulate_pipeline_schedules.py --num-gpus 64 \
+        --num-layers 32 --hidden-size 3072 --seq-length 512 \
+        --global-batch-size 256 --micro-batch-sizes 1 2 4 8 \
+        --checkpoint-activations
+"""
+
+import argparse
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+
+from megatron.schedule_simulator import simulate_schedule
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Pipeline schedule simulator')
+
+    group = parser.add_argument_group(title='model')
+    group.add_argument('--num-layers', type=int, required=True)
+    group.add_argument('--hidden-size', type=int, required=True)
+    group.add_argument('--seq-length', type=int, default=512)
+    group.add_argument('--vocab-size', type=int, default=30522)
+    group.add_argument('--checkpoint-activations', action='store_true',
+                       help='Backward pass recomputes the forward pass.')
+
+    group = parser.add_argument_group(title='configurations')
+    group.add_argument('--num-gpus', type=int, required=True)
+    group.add_argument('--global-batch-size', type=int, required=True)
+    group.add_argument('--micro-batch-sizes', type=int, nargs='+',
+                       default=[1, 2, 4, 8])
+    group.add_argument('--pipeline-sizes', type=int, nargs='+', default=None,
+                       help='Pipeline-parallel sizes to consider (defaults '
+                       'to all powers of two dividing the number of GPUs).')
+    group.add_argument('--schedules', type=str, nargs='+',
+                       default=['1f1b', 'gpipe', '2bw', 'pipedream',
+                                'interleaved', 'interleaved-2bw'])
+    group.add_argument('--virtual-pipeline-size', type=int, default=2,
+                       help='Model chunks per stage for the interleaved '
+                       'schedules.')
+    group.add_argument('--pipeline-stash-limit', type=int, default=None,
+                       help='Largest number of microbatches in flight per '
+                       'stage with the 2bw and pipedream schedules.')
+
+    group = parser.add_argument_group(title='hardware')
+    group.add_argument('--tflops', type=float, default=40.0,
+                       help='Achieved TFLOP/s per GPU.')
+    group.add_argument('--p2p-bandwidth', type=float, default=10.0,
+                       help='Inter-stage bandwidth in GB/s.')
+    group.add_argument('--allreduce-bandwidth', type=float, default=10.0,
+                       help='Data-parallel all-reduce bus bandwidth in GB/s.')
+    group.add_argument('--async-pipeline-communication', action='store_true',
+                       help='Simulate non-blocking communication between '
+                       'stages.')
+    group.add_argument('--top', type=int, default=10,
+                       help='Number of configurations to print.')
+    return parser.parse_args()
+
+
+def stage_costs(args, pipeline_size, micro_batch_size):
+    """Analytical per-stage forward, backward and p2p times and gradient
+    bytes."""
+    h, s, b = args.hidden_size, args.seq_length, micro_batch_size
+    layers_per_stage = args.num_layers / pipeline_size
+    # 24 b s h^2 (1 + s / 6h) flops per transformer layer forward pass.
+    layer_flops = 24.0 * b * s * h * h * (1.0 + s / (6.0 * h))
+    forward_time = layers_per_stage * layer_flops / (args.tflops * 1e12)
+    backward_time = 2.0 * forward_time
+    if args.checkpoint_activations:
+        backward_time += forward_time
+    # fp16 activations of shape (s, b, h).
+    p2p_time = 2.0 * s * b * h / (args.p2p_bandwidth * 1e9)
+    # fp16 gradients of 12 h^2 parameters per layer.
+    grad_bytes = 2.0 * 12.0 * h * h * layers_per_stage
+    return forward_time, backward_time, p2p_time, grad_bytes
+
+
+def main():
+    args = get_args()
+    pipeline_sizes = args.pipeline_sizes
+    if pipeline_sizes is None:
+        pipeline_sizes = [p for p in (2 ** i for i in range(16))
+                          if p <= args.num_gpus and args.num_gpus % p == 0]
+
+    results = []
+    for pipeline_size in pipeline_sizes:
+        if args.num_layers % pipeline_size != 0:
+            continue
+        data_parallel_size = args.num_gpus // pipeline_size
+        for micro_batch_size in args.micro_batch_sizes:
+            samples_per_step = micro_batch_size * data_parallel_size
+            if args.global_batch_size % samples_per_step != 0:
+                continue
+            num_microbatches = args.global_batch_size // samples_per_step
+            forward_time, backward_time, p2p_time, grad_bytes = \
+                stage_costs(args, pipeline_size, micro_batch_size)
+            for schedule in args.schedules:
+                num_model_chunks = 1
+                if schedule.startswith('interleaved'):
+                    num_model_chunks = args.virtual_pipeline_size
+                    if pipeline_size == 1 or \
+                            num_microbatches % pipeline_size != 0 or \
+                            args.num_layers % (pipeline_size *
+                                               num_model_chunks) != 0:
+                        continue
+                    # Two weight versions only cover one iteration of
+                    # warmup.
+                    if schedule == 'interleaved-2bw' and \
+                            2 * (pipeline_size - 1) + \
+                            (num_model_chunks - 1) * pipeline_size >= \
+                            num_microbatches * num_model_chunks:
+                        continue
+                result = simulate_schedule(
+                    schedule, pipeline_size, num_microbatches,
+                    forward_time, backward_time, p2p_time,
+                    data_parallel_size=data_parallel_size,
+                    grad_bytes=grad_bytes,
+                    allreduce_bandwidth=args.allreduce_bandwidth * 1e9,
+                    num_model_chunks=num_model_chunks,
+                    async_communication=args.async_pipeline_communication,
+                    max_in_flight=(args.pipeline_stash_limit
+                                   if schedule in ('2bw', 'pipedream')
+                                   else None))
+                throughput = args.global_batch_size / result.iteration_time
+                results.append((throughput, pipeline_size, data_parallel_size,
+                                micro_batch_size, result))
+
+    results.sort(key=lambda x: -x[0])
+    print('{:>12} | {:>4} | {:>4} | {:>4} | {:>15} | {:>8} | {:>10} | '
+          '{:>8} | {:>9}'.format(
+              'samples/s', 'pp', 'dp', 'mbs', 'schedule', 'bubble',
+              'peak stash', 'versions', 'staleness'))
+    for throughput, pipeline_size, data_parallel_size, micro_batch_size, \
+            result in results[:args.top]:
+        print('{:12.2f} | {:4d} | {:4d} | {:4d} | {:>15} | {:8.3f} | '
+              '{:10d} | {:8d} | {:9d}'.format(
+                  throughput, pipeline_size, data_parallel_size,
+                  micro_batch_size, result.schedule, result.bubble_fraction,
+                  max(result.peak_in_flight_activations),
+                  max(result.peak_weight_versions),
+                  max(result.max_staleness)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# coding=utf-8
+# Copyright (c) 2020, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Check the pipeline schedules for deadlocks and unmatched messages.
+
+Builds the instruction lists of every schedule for a range of pipeline sizes
+and numbers of microbatches and runs megatron.pipeline_instructions
+.verify_instructions on them, with blocking communication and with the
+non-blocking communication of --async-pipeline-communication. Runs on the
+CPU without torch. Example:
+
+    python tools/verify_pipeline_schedules.py --max-pipeline-size 8 \
+        --max-microbatches 16
+"""
+
+import argparse
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+
+from megatron.pipeline_instructions import build_training_instructions
+from megatron.pipeline_instructions import hoist_receives
+from megatron.pipeline_instructions import interleaved_instructions
+from megatron.pipeline_instructions import one_f_one_b_instructions
+from megatron.pipeline_instructions import verify_instructions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Pipeline schedule verifier')
+    parser.add_argument('--max-pipeline-size', type=int, default=8)
+    parser.add_argument('--max-microbatches', type=int, default=16)
+    parser.add_argument('--max-model-chunks', type=int, default=4,
+                        help='Largest number of model chunks per stage for '
+                        'the interleaved schedules.')
+    parser.add_argument('--num-iterations', type=int, default=3)
+    return parser.parse_args()
+
+
+def configurations(args):
+    """Yield (description, programs, num_model_chunks, forward_only)."""
+    for p in range(1, args.max_pipeline_size + 1):
+        for m in range(1, args.max_microbatches + 1):
+            for schedule in ('1f1b', 'gpipe', '2bw', 'pipedream'):
+                yield ('{} p={} m={}'.format(schedule, p, m),
+                       build_training_instructions(
+                           schedule, p, m, args.num_iterations), 1, False)
+            for limit in range(1, p):
+                for schedule in ('2bw', 'pipedream'):
+                    yield ('{} p={} m={} max-in-flight={}'.format(
+                               schedule, p, m, limit),
+                           build_training_instructions(
+                               schedule, p, m, args.num_iterations,
+                               max_in_flight=limit), 1, False)
+            yield ('1f1b forward-only p={} m={}'.format(p, m),
+                   [one_f_one_b_instructions(p, s, m, forward_only=True)
+                    for s in range(p)], 1, True)
+            if p == 1 or m % p != 0:
+                continue
+            for v in range(1, args.max_model_chunks + 1):
+                yield ('interleaved p={} m={} v={}'.format(p, m, v),
+                       build_training_instructions(
+                           'interleaved', p, m, args.num_iterations, v),
+                       v, False)
+                if 2 * (p - 1) + (v - 1) * p < m * v:
+                    yield ('interleaved-2bw p={} m={} v={}'.format(p, m, v),
+                           build_training_instructions(
+                               'interleaved-2bw', p, m, args.num_iterations,
+                               v),
+                           v, False)
+                yield ('interleaved forward-only p={} m={} v={}'.format(
+                           p, m, v),
+                       [interleaved_instructions(p, s, m, v,
+                                                 forward_only=True)
+                        for s in range(p)], v, True)
+
+
+def main():
+    args = get_args()
+    num_checked, failures = 0, []
+    for description, programs, num_model_chunks, forward_only in \
+            configurations(args):
+        for mode in ('blocking', 'async'):
+            num_checked += 1
+            try:
+                if mode == 'async':
+                    verify_instructions(
+                        [hoist_receives(program) for program in programs],
+                        num_model_chunks, forward_only, blocking=False)
+                else:
+                    verify_instructions(programs, num_model_chunks,
+                                        forward_only)
+            except (AssertionError, RuntimeError) as e:
+                failures.append((description, e))
+                print('FAILED {} ({}): {}'.format(description, mode, e))
+    print('checked {} configurations, {} failed'.format(num_checked,
+                                                       len(failures)))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
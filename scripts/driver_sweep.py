@@ -33,7 +33,7 @@ python -m torch.distributed.launch \
         --clip-grad 1.0 \
         --fp16 \
         --DDP-impl local \
-        --loss-scale 16384 \
+        --initial-loss-scale 16384 \
         --apply-query-key-layer-scaling \
         --bias-gelu-fusion \
         --bias-dropout-fusion \
@@ -70,7 +70,7 @@ python -m torch.distributed.launch \
         --clip-grad 1.0 \
         --fp16 \
         --DDP-impl local \
-        --loss-scale 16384 \
+        --initial-loss-scale 16384 \
         --apply-query-key-layer-scaling \
         --bias-gelu-fusion \
         --bias-dropout-fusion \